@@ -9,8 +9,12 @@ from pycryptopp.publickey import rsa
 
 import allmydata
 from allmydata.storage.server import StorageServer
+from allmydata.storage.packed import PACKED_MAX_SHARE_SIZE
+from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.scheduler import PRIORITIES
 from allmydata import storage_client
 from allmydata.immutable.upload import Uploader
+from allmydata.immutable.keycache import ConvergenceKeyCache
 from allmydata.immutable.offloaded import Helper
 from allmydata.control import ControlServer
 from allmydata.introducer.client import IntroducerClient
@@ -32,6 +36,16 @@ GiB=1024*MiB
 TiB=1024*GiB
 PiB=1024*TiB
 
+def parse_percentage(s):
+    """Parse a percentage like "5" (or "5%%" in tahoe.cfg, which becomes
+    "5%") into a fraction, or return None if s is None."""
+    if s is None:
+        return None
+    value = float(s.strip().rstrip("%")) / 100
+    if not 0 < value <= 1:
+        raise ValueError("percentage out of range: %s" % (s,))
+    return value
+
 def _make_secret():
     return base32.b2a(os.urandom(hashutil.CRYPTO_VAL_SIZE)) + "\n"
 
@@ -292,6 +306,120 @@ class Client(node.Node, pollmixin.PollMixin):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
 
+        leasedb_enabled = self.get_config("storage", "leasedb.enabled", False,
+                                          boolean=True)
+        inventory_enabled = self.get_config("storage", "inventory.enabled",
+                                            False, boolean=True)
+        share_counts_enabled = self.get_config("storage",
+                                               "share_counts.enabled", False,
+                                               boolean=True)
+        io_threads = int(self.get_config("storage", "io_threads", 0))
+        io_scheduler = self.get_config("storage", "io_scheduler", "fifo")
+        open_file_cache_size = int(self.get_config("storage",
+                                                   "open_file_cache", 0))
+        data = self.get_config("storage", "mmap_threshold", None)
+        try:
+            mmap_threshold = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[storage]mmap_threshold= contains unparseable value %s"
+                    % data)
+            raise
+        data = self.get_config("storage", "block_cache", None)
+        try:
+            block_cache_size = parse_abbreviated_size(data) or 0
+        except ValueError:
+            log.msg("[storage]block_cache= contains unparseable value %s"
+                    % data)
+            raise
+        data = self.get_config("storage", "write_buffer", None)
+        try:
+            write_buffer_size = parse_abbreviated_size(data) or 0
+        except ValueError:
+            log.msg("[storage]write_buffer= contains unparseable value %s"
+                    % data)
+            raise
+        data = self.get_config("storage", "write_buffer.flush_size", None)
+        try:
+            write_buffer_flush_size = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[storage]write_buffer.flush_size= contains unparseable "
+                    "value %s" % data)
+            raise
+        extra_share_dirs = [os.path.join(self.basedir,
+                                         os.path.expanduser(sharedir.strip()))
+                            for sharedir in self.get_config("storage",
+                                                            "extra_share_dirs",
+                                                            "").split(",")
+                            if sharedir.strip()]
+        share_dir_levels = int(self.get_config("storage", "share_dir_levels",
+                                               1))
+        packed_enabled = self.get_config("storage", "packed.enabled", False,
+                                         boolean=True)
+        data = self.get_config("storage", "packed.max_share_size", None)
+        try:
+            packed_max_share_size = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[storage]packed.max_share_size= contains unparseable"
+                    " value %s" % data)
+            raise
+        if packed_max_share_size is None:
+            packed_max_share_size = PACKED_MAX_SHARE_SIZE
+        crawler_listing_threads = int(self.get_config("storage",
+                                                      "crawler.listing_threads",
+                                                      0))
+        data = self.get_config("storage", "crawler.listings_per_second", None)
+        crawler_listings_per_second = None
+        if data is not None:
+            crawler_listings_per_second = float(data)
+        crawler_pacing = self.get_config("storage", "crawler.pacing", False,
+                                         boolean=True)
+        crawler_rates = {}
+        for name in ("bucket_counter", "lease_checker", "lease_migrator",
+                     "share_scrubber", "mutable_compactor",
+                     "share_dir_migrator"):
+            rates = []
+            for limit in ("min_rate", "max_rate"):
+                option = "crawler.%s.%s" % (name, limit)
+                data = self.get_config("storage", option, None)
+                try:
+                    rates.append(parse_percentage(data))
+                except ValueError:
+                    log.msg("[storage]%s= contains unparseable value %s"
+                            % (option, data))
+                    raise
+            # either one may be left at the crawler's default
+            (min_rate, max_rate) = rates
+            if min_rate is None:
+                min_rate = ShareCrawler.min_cpu_percentage
+            if max_rate is None:
+                max_rate = ShareCrawler.max_cpu_percentage
+            if min_rate > max_rate:
+                raise ValueError("[storage]crawler.%s.min_rate= (%g%%) must"
+                                 " not be more than crawler.%s.max_rate="
+                                 " (%g%%)" % (name, min_rate * 100,
+                                              name, max_rate * 100))
+            crawler_rates[name] = tuple(rates)
+        scrubber_enabled = self.get_config("storage", "scrubber.enabled", False,
+                                           boolean=True)
+        data = self.get_config("storage", "scrubber.bandwidth", None)
+        try:
+            scrubber_bytes_per_second = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[storage]scrubber.bandwidth= contains unparseable value %s"
+                    % data)
+            raise
+        if scrubber_bytes_per_second == 0:
+            raise ValueError("[storage]scrubber.bandwidth= must be more than"
+                             " zero, not %r" % (data,))
+        mutable_compaction_enabled = self.get_config("storage",
+                                                     "mutable_compaction.enabled",
+                                                     False, boolean=True)
+        durability = self.get_config("storage", "durability", "none")
+        data = self.get_config("storage", "group_commit.window", None)
+        group_commit_window = None
+        if data is not None:
+            group_commit_window = float(data)
+
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
                            discard_storage=discard,
@@ -301,7 +429,30 @@ class Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           leasedb_enabled=leasedb_enabled,
+                           inventory_enabled=inventory_enabled,
+                           io_threads=io_threads,
+                           io_scheduler=io_scheduler,
+                           open_file_cache_size=open_file_cache_size,
+                           mmap_threshold=mmap_threshold,
+                           block_cache_size=block_cache_size,
+                           write_buffer_size=write_buffer_size,
+                           write_buffer_flush_size=write_buffer_flush_size,
+                           extra_share_dirs=extra_share_dirs,
+                           share_dir_levels=share_dir_levels,
+                           packed_enabled=packed_enabled,
+                           packed_max_share_size=packed_max_share_size,
+                           crawler_listing_threads=crawler_listing_threads,
+                           crawler_listings_per_second=crawler_listings_per_second,
+                           crawler_pacing=crawler_pacing,
+                           crawler_rates=crawler_rates,
+                           share_counts_enabled=share_counts_enabled,
+                           scrubber_enabled=scrubber_enabled,
+                           scrubber_bytes_per_second=scrubber_bytes_per_second,
+                           mutable_compaction_enabled=mutable_compaction_enabled,
+                           durability=durability,
+                           group_commit_window=group_commit_window)
         self.add_service(ss)
 
         d = self.when_tub_ready()
@@ -327,19 +478,58 @@ class Client(node.Node, pollmixin.PollMixin):
         DEP["n"] = int(self.get_config("client", "shares.total", DEP["n"]))
         DEP["happy"] = int(self.get_config("client", "shares.happy", DEP["happy"]))
 
+        # uploads may read and encode segments while earlier ones are
+        # still being sent
+        pipeline_depth = int(self.get_config("client", "upload.pipeline_depth",
+                                             1))
+        data = self.get_config("client", "upload.pipeline_memory", None)
+        try:
+            pipeline_memory = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[client]upload.pipeline_memory= contains unparseable "
+                    "value %s" % data)
+            raise
+        # and may hash, encrypt and encode them in worker threads or processes
+        encoding_workers = int(self.get_config("client",
+                                               "upload.encoding_workers", 0))
+        encoding_worker_type = self.get_config("client",
+                                               "upload.encoding_worker_type",
+                                               "processes")
+        # and may skip hashing files that they have hashed before
+        key_cache = None
+        if self.get_config("client", "upload.convergence_key_cache", False,
+                           boolean=True):
+            max_entries = int(self.get_config(
+                "client", "upload.convergence_key_cache_size", 10000))
+            key_cache = ConvergenceKeyCache(
+                os.path.join(self.basedir, "private",
+                             "convergence-keys.sqlite"),
+                max_entries, self.stats_provider)
+
         self.init_client_storage_broker()
         self.history = History(self.stats_provider)
         self.terminator = Terminator()
         self.terminator.setServiceParent(self)
         self.add_service(Uploader(helper_furl, self.stats_provider,
-                                  self.history))
+                                  self.history, pipeline_depth,
+                                  pipeline_memory, encoding_workers,
+                                  encoding_worker_type, key_cache))
         self.init_blacklist()
         self.init_nodemaker()
 
     def init_client_storage_broker(self):
         # create a StorageFarmBroker object, for use by Uploader/Downloader
         # (and everybody else who wants to use storage servers)
-        sb = storage_client.StorageFarmBroker(self.tub, permute_peers=True)
+        # our requests are made through sessions on each server, so that it
+        # can share its disk fairly between clients. Each request is
+        # interactive or bulk, as whoever makes it says, but none is more
+        # urgent than storage_priority
+        priority = self.get_config("client", "storage_priority", "interactive")
+        if priority not in PRIORITIES:
+            raise ValueError("[client]storage_priority= must be one of %s,"
+                             " not %r" % (", ".join(PRIORITIES), priority))
+        sb = storage_client.StorageFarmBroker(self.tub, permute_peers=True,
+                                              storage_priority=priority)
         self.storage_broker = sb
 
         # load static server specifications from tahoe.cfg, if any.
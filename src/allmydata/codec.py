@@ -1,5 +1,7 @@
 # -*- test-case-name: allmydata.test.test_encode_share -*-
 
+import time
+
 from zope.interface import implements
 from twisted.internet import defer
 from allmydata.util import mathutil
@@ -7,10 +9,22 @@ from allmydata.util.assertutil import precondition
 from allmydata.interfaces import ICodecEncoder, ICodecDecoder
 import zfec
 
+def encode_blocks(required_shares, max_shares, inshares, share_ids):
+    # this may be run in a worker process: see CRSEncoder
+    encoder = zfec.Encoder(required_shares, max_shares)
+    return encoder.encode(inshares, share_ids)
+
 class CRSEncoder(object):
     implements(ICodecEncoder)
     ENCODER_TYPE = "crs"
 
+    def __init__(self, workers=None, times=None):
+        # if 'workers' (a WorkerPool) is given, encode() is done by one of
+        # them. If 'times' is given, the time spent encoding is added to
+        # times["cumulative_encoding_codec"].
+        self._workers = workers
+        self._times = times
+
     def set_params(self, data_size, required_shares, max_shares):
         assert required_shares <= max_shares
         self.data_size = data_size
@@ -41,7 +55,17 @@ class CRSEncoder(object):
 
         for inshare in inshares:
             assert len(inshare) == self.share_size, (len(inshare), self.share_size, self.data_size, self.required_shares)
+        if self._workers:
+            d = self._workers.run(encode_blocks,
+                                  (self.required_shares, self.max_shares,
+                                   inshares, desired_share_ids),
+                                  self._times, "cumulative_encoding_codec")
+            d.addCallback(lambda shares: (shares, desired_share_ids))
+            return d
+        start = time.time()
         shares = self.encoder.encode(inshares, desired_share_ids)
+        if self._times is not None:
+            self._times["cumulative_encoding_codec"] += time.time() - start
 
         return defer.succeed((shares, desired_share_ids))
 
@@ -15,6 +15,7 @@ from allmydata.interfaces import IFilesystemNode, IDirectoryNode, IFileNode, \
 from allmydata.check_results import DeepCheckResults, \
      DeepCheckAndRepairResults
 from allmydata.monitor import Monitor
+from allmydata.storage_client import prefetch_buckets, LeaseAdder
 from allmydata.util import hashutil, mathutil, base32, log
 from allmydata.util.encodingutil import quote_output
 from allmydata.util.assertutil import precondition
@@ -925,6 +926,62 @@ class ManifestWalker(DeepStats):
                 }
 
 
+def prefetch_check_queries(parent, children):
+    """Ask every connected server which shares it holds for all of the
+    immutable children of a directory, in one get_buckets_many() query per
+    server, so that the non-verifying checks which a deep-check is about to
+    perform on those children do not need a round trip each. Mutable
+    children are checked by mapupdate, which does not use get_buckets()."""
+    storage_indexes = []
+    for (child, metadata) in children.itervalues():
+        if isinstance(child, UnknownNode) or child.is_mutable():
+            continue
+        si = child.get_storage_index()
+        if si: # LIT files have no storage index
+            storage_indexes.append(si)
+    storage_broker = parent._nodemaker.storage_broker
+    if storage_indexes and storage_broker:
+        prefetch_buckets(storage_broker.get_connected_servers(),
+                         storage_indexes)
+
+
+class DeepLeaseAdder:
+    """I add leases to the nodes visited by a deep-check, on every connected
+    server, in batches of up to BATCH_SIZE storage indexes per call with at
+    most CONCURRENCY calls outstanding per server (see
+    storage_client.LeaseAdder). The checks themselves are then run with
+    add_lease=False, so they do not send one add_lease() call per node per
+    server."""
+    BATCH_SIZE = 100
+    CONCURRENCY = 2
+
+    def __init__(self, root):
+        self._storage_broker = root._nodemaker.storage_broker
+        self._secret_holder = root._nodemaker.secret_holder
+        self._lease_adder = LeaseAdder(self.BATCH_SIZE, self.CONCURRENCY)
+
+    def add_node(self, node):
+        si = node.get_storage_index()
+        if not si or not self._storage_broker:
+            return defer.succeed(None) # LIT files and unknown nodes
+        # these are the same lease secrets that the checkers would use
+        frs = hashutil.file_renewal_secret_hash(
+            self._secret_holder.get_renewal_secret(), si)
+        fcs = hashutil.file_cancel_secret_hash(
+            self._secret_holder.get_cancel_secret(), si)
+        ds = []
+        for server in self._storage_broker.get_connected_servers():
+            lease_seed = server.get_lease_seed()
+            renew_secret = hashutil.bucket_renewal_secret_hash(frs, lease_seed)
+            cancel_secret = hashutil.bucket_cancel_secret_hash(fcs, lease_seed)
+            ds.append(self._lease_adder.add_lease(server, si, renew_secret,
+                                                  cancel_secret))
+        return defer.gatherResults(ds)
+
+    def finish(self):
+        return self._lease_adder.flush()
+
+
 class DeepChecker:
     def __init__(self, root, verify, repair, add_lease):
         root_si = root.get_storage_index()
@@ -937,7 +994,9 @@ class DeepChecker:
                            si=root_si_base32, verify=verify, repair=repair)
         self._verify = verify
         self._repair = repair
-        self._add_lease = add_lease
+        self._lease_adder = None
+        if add_lease:
+            self._lease_adder = DeepLeaseAdder(root)
         if repair:
             self._results = DeepCheckAndRepairResults(root_si)
         else:
@@ -949,22 +1008,34 @@ class DeepChecker:
         monitor.set_status(self._results)
 
     def add_node(self, node, childpath):
+        # leases are added in batches by our DeepLeaseAdder, not by the
+        # individual checks
         if self._repair:
-            d = node.check_and_repair(self.monitor, self._verify, self._add_lease)
+            d = node.check_and_repair(self.monitor, self._verify, False)
             d.addCallback(self._results.add_check_and_repair, childpath)
         else:
-            d = node.check(self.monitor, self._verify, self._add_lease)
+            d = node.check(self.monitor, self._verify, False)
             d.addCallback(self._results.add_check, childpath)
+        if self._lease_adder:
+            d.addCallback(lambda ignored: self._lease_adder.add_node(node))
         d.addCallback(lambda ignored: self._stats.add_node(node, childpath))
         return d
 
     def enter_directory(self, parent, children):
+        if not self._verify:
+            prefetch_check_queries(parent, children)
         return self._stats.enter_directory(parent, children)
 
     def finish(self):
-        log.msg("deep-check done", parent=self._lp)
-        self._results.update_stats(self._stats.get_results())
-        return self._results
+        d = defer.succeed(None)
+        if self._lease_adder:
+            d.addCallback(lambda ignored: self._lease_adder.finish())
+        def _done(ignored):
+            log.msg("deep-check done", parent=self._lp)
+            self._results.update_stats(self._stats.get_results())
+            return self._results
+        d.addCallback(_done)
+        return d
 
 
 # use client.create_dirnode() to make one of these
@@ -5,6 +5,7 @@ from allmydata import hashtree, codec, uri
 from allmydata.interfaces import IValidatedThingProxy, IVerifierURI
 from allmydata.hashtree import IncompleteHashTree
 from allmydata.check_results import CheckResults
+from allmydata.storage_client import get_buckets
 from allmydata.uri import CHKFileVerifierURI
 from allmydata.util.assertutil import precondition
 from allmydata.util import base32, deferredutil, dictutil, log, mathutil
@@ -207,6 +208,24 @@ class ValidatedExtendedURIProxy:
         d.addCallback(self._parse_and_validate)
         return d
 
+class ServerVerifiedShare:
+    """I hold the summary of a share which a storage server has verified
+    for us (see RIStorageServer.verify_shares). I provide the UEB that it
+    sent back in the same way that a ReadBucketProxy would, so that a
+    ValidatedExtendedURIProxy can check it."""
+
+    def __init__(self, server, sharenum, summary):
+        self._server = server
+        self.sharenum = sharenum
+        self.summary = summary
+
+    def __repr__(self):
+        return "<ServerVerifiedShare %d on [%s]>" % (self.sharenum,
+                                                     self._server.get_name())
+
+    def get_uri_extension(self):
+        return defer.succeed(self.summary["uri-extension"])
+
 class ValidatedReadBucketProxy(log.PrefixingLogMixin):
     """I am a front-end for a remote storage bucket, responsible for
     retrieving and validating data from that bucket.
@@ -448,6 +467,13 @@ class Checker(log.PrefixingLogMixin):
     cryptographic integrity check on all of it. If not, I just ask each
     server 'Which shares do you have?' and believe its answer.
 
+    If verify_on_servers=True, then when verifying, a server which
+    advertises 'supports-verify-shares' is instead asked to read and check
+    the blocks of its shares itself, and to send back just the hashes and
+    the UEB, which I check against the verifycap. This trusts the server to
+    have hashed the blocks that it really holds, but saves transferring
+    every share over the network. It is off by default.
+
     In either case, I wait until I have gotten responses from all servers.
     This fact -- that I wait -- means that an ill-behaved server which fails
     to answer my questions will make me wait indefinitely. If it is
@@ -461,7 +487,7 @@ class Checker(log.PrefixingLogMixin):
     cancelled (by invoking its raise_if_cancelled() method).
     """
     def __init__(self, verifycap, servers, verify, add_lease, secret_holder,
-                 monitor):
+                 monitor, verify_on_servers=False):
         assert precondition(isinstance(verifycap, CHKFileVerifierURI), verifycap, type(verifycap))
 
         prefix = "%s" % base32.b2a_l(verifycap.get_storage_index()[:8], 60)
@@ -472,6 +498,7 @@ class Checker(log.PrefixingLogMixin):
         self._monitor = monitor
         self._servers = servers
         self._verify = verify # bool: verify what the servers claim, or not?
+        self._verify_on_servers = verify_on_servers
         self._add_lease = add_lease
 
         frs = file_renewal_secret_hash(secret_holder.get_renewal_secret(),
@@ -495,7 +522,8 @@ class Checker(log.PrefixingLogMixin):
         that we want to track and report whether or not each server
         responded.)"""
 
-        rref = s.get_rref()
+        # checking can wait for the users of this server
+        rref = s.get_rref("bulk")
         lease_seed = s.get_lease_seed()
         if self._add_lease:
             renew_secret = self._get_renewal_secret(lease_seed)
@@ -504,7 +532,9 @@ class Checker(log.PrefixingLogMixin):
                                  renew_secret, cancel_secret)
             d2.addErrback(self._add_lease_failed, s.get_name(), storageindex)
 
-        d = rref.callRemote("get_buckets", storageindex)
+        # only verification needs the bucket readers. Our query is batched
+        # with those of any other Checkers that are running at the same time.
+        d = get_buckets(s, storageindex, want_readers=self._verify)
         def _wrap_results(res):
             return (res, True)
 
@@ -662,6 +692,83 @@ class Checker(log.PrefixingLogMixin):
 
         return d
 
+    def _can_verify_on_server(self, server):
+        if not self._verify_on_servers:
+            return False
+        version = server.get_version() or {}
+        v1 = version.get("http://allmydata.org/tahoe/protocols/storage/v1",
+                         {})
+        return v1.get("supports-verify-shares", False)
+
+    def _verify_on_server(self, server, sharenums):
+        """Ask the server to verify these shares itself, and check the
+        summaries that it sends back. Return a deferred that fires with a
+        list of (success, sharenum, whynot) tuples, with the same meanings
+        as the results of _download_and_verify()."""
+        rref = server.get_rref("bulk")
+        d = rref.callRemote("verify_shares",
+                            self._verifycap.get_storage_index(),
+                            set(sharenums))
+        def _got_summaries(summaries):
+            ds = [self._check_summary(server, sharenum, summaries.get(sharenum))
+                  for sharenum in sharenums]
+            return deferredutil.gatherResults(ds)
+        def _err(f):
+            if f.check(DeadReferenceError):
+                whynot = 'disconnect'
+            elif f.check(RemoteException):
+                whynot = 'failure'
+            else:
+                return f
+            return [(False, sharenum, whynot) for sharenum in sharenums]
+        d.addCallbacks(_got_summaries, _err)
+        return d
+
+    def _check_summary(self, server, sharenum, summary):
+        if summary is None:
+            # the share went away before the server could verify it
+            return defer.succeed((False, sharenum, 'failure'))
+        if summary.get("status") != "ok":
+            self.log(format="server [%(name)s] found share %(sharenum)d to "
+                     "be %(status)s: %(reason)s",
+                     name=server.get_name(), sharenum=sharenum,
+                     status=summary.get("status"),
+                     reason=summary.get("reason"),
+                     level=log.UNUSUAL, umid="fVw4xQ")
+            if summary.get("status") == "incompatible":
+                return defer.succeed((False, sharenum, 'incompatible'))
+            return defer.succeed((False, sharenum, 'corrupt'))
+
+        vcap = self._verifycap
+        share = ServerVerifiedShare(server, sharenum, summary)
+        d = ValidatedExtendedURIProxy(share, vcap).start()
+        def _check_hashes(vup):
+            if summary["num-blocks"] != vup.num_segments:
+                raise BadOrMissingHash("share has %s blocks, not %d"
+                                       % (summary["num-blocks"],
+                                          vup.num_segments))
+            if summary["crypttext-hash-root"] != vup.crypttext_root_hash:
+                raise BadOrMissingHash("bad crypttext hash tree root")
+            share_hash_tree = IncompleteHashTree(vcap.total_shares)
+            share_hash_tree.set_hashes({0: vup.share_root_hash})
+            try:
+                share_hash_tree.set_hashes(dict(summary["share-hashes"]),
+                                           {sharenum:
+                                            summary["block-hash-root"]})
+            except IndexError, le:
+                raise BadOrMissingHash(le)
+            except (hashtree.BadHashError, hashtree.NotEnoughHashesError), le:
+                raise BadOrMissingHash(le)
+            return (True, sharenum, None)
+        d.addCallback(_check_hashes)
+        def _errb(f):
+            # a summary which is malformed, or does not match the verifycap,
+            # counts as a corrupt share
+            f.trap(IntegrityCheckReject, KeyError, TypeError, ValueError)
+            return (False, sharenum, 'corrupt')
+        d.addErrback(_errb)
+        return d
+
     def _verify_server_shares(self, s):
         """ Return a deferred which eventually fires with a tuple of
         (set(sharenum), server, set(corruptsharenum),
@@ -690,12 +797,15 @@ class Checker(log.PrefixingLogMixin):
         def _got_buckets(result):
             bucketdict, success = result
 
-            shareverds = []
-            for (sharenum, bucket) in bucketdict.items():
-                d = self._download_and_verify(s, sharenum, bucket)
-                shareverds.append(d)
+            if bucketdict and self._can_verify_on_server(s):
+                dl = self._verify_on_server(s, sorted(bucketdict))
+            else:
+                shareverds = []
+                for (sharenum, bucket) in bucketdict.items():
+                    d = self._download_and_verify(s, sharenum, bucket)
+                    shareverds.append(d)
 
-            dl = deferredutil.gatherResults(shareverds)
+                dl = deferredutil.gatherResults(shareverds)
 
             def collect(results):
                 verified = set()
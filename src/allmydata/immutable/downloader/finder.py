@@ -3,6 +3,7 @@ import time
 now = time.time
 from foolscap.api import eventually
 from allmydata.util import base32, log
+from allmydata.storage_client import get_buckets
 from twisted.internet import reactor
 
 from share import Share, CommonShare
@@ -139,7 +140,7 @@ class ShareFinder:
         # TODO: get the timer from a Server object, it knows best
         self.overdue_timers[req] = reactor.callLater(self.OVERDUE_TIMEOUT,
                                                      self.overdue, req)
-        d = server.get_rref().callRemote("get_buckets", self._storage_index)
+        d = get_buckets(server, self._storage_index)
         d.addBoth(incidentally, self._request_retired, req)
         d.addCallbacks(self._got_response, self._got_error,
                        callbackArgs=(server, req, d_ev, time_sent, lp),
@@ -9,6 +9,7 @@ from allmydata.storage.server import si_b2a
 from allmydata.hashtree import HashTree
 from allmydata.util import mathutil, hashutil, base32, log, happinessutil
 from allmydata.util.assertutil import _assert, precondition
+from allmydata.util.workerpool import in_thread
 from allmydata.codec import CRSEncoder
 from allmydata.interfaces import IEncoder, IStorageBucketWriter, \
      IEncryptedUploadable, IUploadStatus, UploadUnhappinessError
@@ -35,9 +36,13 @@ log(number of segments)).
 Each segment (A,B,C) is read into memory, encrypted, and encoded into
 blocks. The 'share' (say, share #1) that makes it out to a host is a
 collection of these blocks (block A1, B1, C1), plus some hash-tree
-information necessary to validate the data upon retrieval. Only one segment
-is handled at a time: all blocks for segment A are delivered before any
-work is begun on segment B.
+information necessary to validate the data upon retrieval. Segments are
+read and encoded one at a time, in order. By default all blocks for segment
+A are delivered before any work is begun on segment B, which means that a
+segment is sent at most once per round trip to the shareholders. With a
+pipeline depth of more than one, segment B is read and encoded (and its
+blocks sent) while those of segment A are still on their way, up to that
+many segments (and, if given, that many bytes of blocks) at a time.
 
 As blocks are created, we retain the hash of each one. The list of block hashes
 for a single share (say, hash(A1), hash(B1), hash(C1)) is used to form the base
@@ -65,6 +70,14 @@ hash tree is put into the URI.
 class UploadAborted(Exception):
     pass
 
+@in_thread
+def update_hashers(hashers, data):
+    for hasher in hashers:
+        hasher.update(data)
+
+def hash_blocks(blocks):
+    return [hashutil.block_hash(block) for block in blocks]
+
 KiB=1024
 MiB=1024*KiB
 GiB=1024*MiB
@@ -74,7 +87,8 @@ PiB=1024*TiB
 class Encoder(object):
     implements(IEncoder)
 
-    def __init__(self, log_parent=None, upload_status=None):
+    def __init__(self, log_parent=None, upload_status=None,
+                 pipeline_depth=1, pipeline_memory=None, workers=None):
         object.__init__(self)
         self.uri_extension_data = {}
         self._codec = None
@@ -86,6 +100,22 @@ class Encoder(object):
         self._log_number = log.msg("creating Encoder %s" % self,
                                    facility="tahoe.encoder", parent=log_parent)
         self._aborted = False
+        # up to 'pipeline_depth' segments may be in flight at once, as long
+        # as their blocks add up to no more than 'pipeline_memory' bytes
+        precondition(pipeline_depth >= 1, pipeline_depth)
+        self._pipeline_depth = pipeline_depth
+        self._pipeline_memory = pipeline_memory
+        # if 'workers' (a WorkerPool) is given, hashing and erasure coding
+        # are done by them, off the reactor thread
+        self._workers = workers
+        self._times = {
+            "cumulative_encoding": 0.0,
+            "cumulative_encoding_hash": 0.0,
+            "cumulative_encoding_codec": 0.0,
+            "cumulative_sending": 0.0,
+            "hashes_and_close": 0.0,
+            "total_encode_and_push": 0.0,
+            }
 
     def __repr__(self):
         if hasattr(self, "_storage_index"):
@@ -130,7 +160,7 @@ class Encoder(object):
         self.num_segments = mathutil.div_ceil(self.file_size,
                                               self.segment_size)
 
-        self._codec = CRSEncoder()
+        self._codec = CRSEncoder(self._workers, self._times)
         self._codec.set_params(self.segment_size,
                                self.required_shares, self.num_shares)
 
@@ -158,7 +188,7 @@ class Encoder(object):
         # the tail codec is responsible for encoding tail_size bytes
         padded_tail_size = mathutil.next_multiple(tail_size,
                                                   self.required_shares)
-        self._tail_codec = CRSEncoder()
+        self._tail_codec = CRSEncoder(self._workers, self._times)
         self._tail_codec.set_params(padded_tail_size,
                                     self.required_shares, self.num_shares)
         data['tail_codec_params'] = self._tail_codec.get_serialized_params()
@@ -216,30 +246,15 @@ class Encoder(object):
         # to landlord[i]. This list contains a hash of each segment_share
         # that we sent to that landlord.
         self.share_root_hashes = [None] * self.num_shares
+        # block hashes computed by workers, k: segnum, v: list of hashes
+        self._segment_block_hashes = {}
 
-        self._times = {
-            "cumulative_encoding": 0.0,
-            "cumulative_sending": 0.0,
-            "hashes_and_close": 0.0,
-            "total_encode_and_push": 0.0,
-            }
         self._start_total_timestamp = time.time()
 
         d = fireEventually()
 
         d.addCallback(lambda res: self.start_all_shareholders())
-
-        for i in range(self.num_segments-1):
-            # note to self: this form doesn't work, because lambda only
-            # captures the slot, not the value
-            #d.addCallback(lambda res: self.do_segment(i))
-            # use this form instead:
-            d.addCallback(lambda res, i=i: self._encode_segment(i))
-            d.addCallback(self._send_segment, i)
-            d.addCallback(self._turn_barrier)
-        last_segnum = self.num_segments - 1
-        d.addCallback(lambda res: self._encode_tail_segment(last_segnum))
-        d.addCallback(self._send_segment, last_segnum)
+        d.addCallback(lambda res: self._send_all_segments())
         d.addCallback(self._turn_barrier)
 
         d.addCallback(lambda res: self.finish_hashing())
@@ -286,6 +301,88 @@ class Encoder(object):
         return fireEventually(res)
 
 
+    def _send_all_segments(self):
+        """Read, encode and send every segment, keeping up to
+        self._pipeline_depth of them in flight. Segments are still read and
+        hashed one at a time and in order, and are sent in order, so the
+        crypttext and block hash trees come out just as they do when each
+        segment is delivered before the next is read. Returns a Deferred
+        that fires once every block has been acknowledged."""
+        self._in_flight = {} # k: segnum, v: bytes of blocks being sent
+        self._next_segnum = 0
+        self._reading = False
+        self._encoded = {} # k: segnum, v: (shares, shareids) waiting to go
+        self._next_to_send = 0
+        self._segments_done = defer.Deferred()
+        self._fill_pipeline()
+        return self._segments_done
+
+    def _pipeline_has_room(self):
+        if self._reading or self._next_segnum >= self.num_segments:
+            return False
+        if not self._in_flight:
+            return True
+        if len(self._in_flight) >= self._pipeline_depth:
+            return False
+        if self._pipeline_memory is None:
+            return True
+        return (sum(self._in_flight.values()) + self._segment_bytes()
+                <= self._pipeline_memory)
+
+    def _segment_bytes(self):
+        return self._codec.get_block_size() * self.num_shares
+
+    def _fill_pipeline(self, res=None):
+        if self._segments_done.called:
+            return # finished, or failed
+        if not self._pipeline_has_room():
+            if (not self._in_flight and not self._reading
+                and self._next_segnum >= self.num_segments):
+                self._segments_done.callback(None)
+            return
+        segnum = self._next_segnum
+        self._next_segnum += 1
+        self._reading = True
+        # a segment counts against the pipeline from when it is read: it
+        # may be encoded (by a worker) while the next one is read
+        self._in_flight[segnum] = self._segment_bytes()
+        if segnum == self.num_segments - 1:
+            d = defer.maybeDeferred(self._encode_tail_segment, segnum)
+        else:
+            d = defer.maybeDeferred(self._encode_segment, segnum)
+        d.addCallback(self._segment_encoded, segnum)
+        d.addErrback(self._pipeline_failure)
+
+    def _segment_gathered(self):
+        # called by _encode_segment once the segment has been read and
+        # hashed, before it is encoded. Give the reactor a turn (to send
+        # the blocks of earlier segments) before reading the next one.
+        self._reading = False
+        self._turn_barrier(None).addCallback(self._fill_pipeline)
+
+    def _segment_encoded(self, res, segnum):
+        # workers may finish encoding segments out of order, but they are
+        # sent in order
+        self._encoded[segnum] = res
+        while self._next_to_send in self._encoded:
+            segnum = self._next_to_send
+            self._next_to_send += 1
+            self._start_sending_segment(self._encoded.pop(segnum), segnum)
+
+    def _start_sending_segment(self, (shares, shareids), segnum):
+        self._in_flight[segnum] = sum([len(block) for block in shares])
+        d = self._send_segment((shares, shareids), segnum)
+        def _sent(res):
+            del self._in_flight[segnum]
+            self._turn_barrier(None).addCallback(self._fill_pipeline)
+        d.addCallbacks(_sent, self._pipeline_failure)
+
+    def _pipeline_failure(self, f):
+        # the first failure ends the upload: the sends of any other
+        # segments that were in flight are abandoned
+        if not self._segments_done.called:
+            self._segments_done.errback(f)
+
     def start_all_shareholders(self):
         self.log("starting shareholders", level=log.NOISY)
         self.set_status("Starting shareholders")
@@ -334,9 +431,11 @@ class Encoder(object):
             for c in chunks:
                 assert len(c) == input_piece_size
             self._crypttext_hashes.append(crypttext_segment_hasher.digest())
+            self._segment_gathered()
             # during this call, we hit 5*segsize memory
             return codec.encode(chunks)
         d.addCallback(_done_gathering)
+        d.addCallback(self._hash_blocks, segnum)
         def _done(res):
             elapsed = time.time() - start
             self._times["cumulative_encoding"] += elapsed
@@ -360,8 +459,10 @@ class Encoder(object):
                 # _gather_data
                 assert len(c) == input_piece_size
             self._crypttext_hashes.append(crypttext_segment_hasher.digest())
+            self._segment_gathered()
             return codec.encode(chunks)
         d.addCallback(_done_gathering)
+        d.addCallback(self._hash_blocks, segnum)
         def _done(res):
             elapsed = time.time() - start
             self._times["cumulative_encoding"] += elapsed
@@ -406,17 +507,43 @@ class Encoder(object):
             precondition(len(data) <= read_size, len(data), read_size)
             if not allow_short:
                 precondition(len(data) == read_size, len(data), read_size)
-            crypttext_segment_hasher.update(data)
-            self._crypttext_hasher.update(data)
-            if allow_short and len(data) < read_size:
-                # padding
-                data += "\x00" * (read_size - len(data))
-            encrypted_pieces = [data[i:i+input_chunk_size]
-                                for i in range(0, len(data), input_chunk_size)]
-            return encrypted_pieces
+            hashers = [crypttext_segment_hasher, self._crypttext_hasher]
+            if self._workers:
+                d2 = self._workers.run(update_hashers, (hashers, data),
+                                       self._times, "cumulative_encoding_hash")
+            else:
+                start = time.time()
+                update_hashers(hashers, data)
+                self._times["cumulative_encoding_hash"] += time.time() - start
+                d2 = defer.succeed(None)
+            d2.addCallback(lambda ign: self._split_data(data, read_size,
+                                                        input_chunk_size))
+            return d2
         d.addCallback(_got)
         return d
 
+    def _split_data(self, data, read_size, input_chunk_size):
+        if len(data) < read_size:
+            # padding
+            data += "\x00" * (read_size - len(data))
+        encrypted_pieces = [data[i:i+input_chunk_size]
+                            for i in range(0, len(data), input_chunk_size)]
+        return encrypted_pieces
+
+    def _hash_blocks(self, (shares, shareids), segnum):
+        # with workers, the block hashes are computed (in a worker process)
+        # as soon as the segment has been encoded, rather than when it is
+        # sent
+        if not self._workers:
+            return (shares, shareids)
+        d = self._workers.run(hash_blocks, (shares,),
+                              self._times, "cumulative_encoding_hash")
+        def _hashed(block_hashes):
+            self._segment_block_hashes[segnum] = block_hashes
+            return (shares, shareids)
+        d.addCallback(_hashed)
+        return d
+
     def _send_segment(self, (shares, shareids), segnum):
         # To generate the URI, we must generate the roothash, so we must
         # generate all shares, even if we aren't actually giving them to
@@ -431,12 +558,17 @@ class Encoder(object):
                                                       self.num_segments))
         self.set_encode_and_push_progress(segnum)
         lognum = self.log("send_segment(%d)" % segnum, level=log.NOISY)
+        block_hashes = self._segment_block_hashes.pop(segnum, None)
+        if block_hashes is None:
+            hash_start = time.time()
+            block_hashes = hash_blocks(shares)
+            self._times["cumulative_encoding_hash"] += time.time() - hash_start
         for i in range(len(shares)):
             block = shares[i]
             shareid = shareids[i]
             d = self.send_block(shareid, segnum, block, lognum)
             dl.append(d)
-            block_hash = hashutil.block_hash(block)
+            block_hash = block_hashes[i]
             #from allmydata.util import base32
             #log.msg("creating block (shareid=%d, blocknum=%d) "
             #        "len=%d %r .. %r: %s" %
@@ -92,9 +92,10 @@ class CiphertextFileNode:
     def check_and_repair(self, monitor, verify=False, add_lease=False):
         c = Checker(verifycap=self._verifycap,
                     servers=self._storage_broker.get_connected_servers(),
-                    verify=verify, add_lease=add_lease,
+                    verify=bool(verify), add_lease=add_lease,
                     secret_holder=self._secret_holder,
-                    monitor=monitor)
+                    monitor=monitor,
+                    verify_on_servers=(verify == "server"))
         d = c.start()
         d.addCallback(self._maybe_repair, monitor)
         return d
@@ -178,8 +179,9 @@ class CiphertextFileNode:
         sh = self._secret_holder
 
         v = Checker(verifycap=verifycap, servers=servers,
-                    verify=verify, add_lease=add_lease, secret_holder=sh,
-                    monitor=monitor)
+                    verify=bool(verify), add_lease=add_lease,
+                    secret_holder=sh, monitor=monitor,
+                    verify_on_servers=(verify == "server"))
         return v.start()
 
 class DecryptingConsumer:
@@ -0,0 +1,165 @@
+import os, time, sqlite3
+
+from allmydata.util import base32, log
+from allmydata.util.hashutil import tagged_hash, storage_index_hash
+
+# The convergence-key cache remembers the encryption key (and storage index)
+# that convergent encryption gave each local file that has been uploaded
+# with upload.FileName, so that uploading the same file again does not have
+# to read it all once just to hash it, before reading it again to encrypt
+# it. It is only a cache: it can be deleted at any time, and is recreated
+# if it cannot be used.
+#
+# An entry is only used if the file still has the same size, inode, device,
+# mtime and ctime as when it was hashed (ctime cannot be set back the way
+# mtime can), and the same convergence secret and encoding parameters are
+# in use. The convergence secret itself is not stored, only a hash of it.
+# The keys are secrets (each one lets its file be read), so the database
+# lives in BASEDIR/private/.
+
+KEYCACHE_SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE keys
+(
+ path          BLOB,         -- absolute, in the filesystem encoding
+ convergence   VARCHAR(52),  -- base32 hash of the convergence secret
+ k             INTEGER,
+ n             INTEGER,
+ segsize       INTEGER,
+ size          INTEGER,
+ mtime         NUMBER,
+ ctime         NUMBER,
+ inode         INTEGER,
+ device        INTEGER,
+ key           VARCHAR(26),  -- base32
+ storage_index VARCHAR(26),  -- base32
+ last_used     NUMBER,       -- seconds since epoch
+ PRIMARY KEY (path, convergence, k, n, segsize)
+);
+
+CREATE INDEX keys_by_last_used ON keys (last_used);
+"""
+
+CONVERGENCE_CACHE_TAG = "allmydata_convergence_key_cache_v1"
+
+
+class ConvergenceKeyCache:
+    """I hold the convergent encryption keys of local files, in an SQLite
+    database, see above. I keep up to 'max_entries' of them, forgetting the
+    least recently used ones first."""
+
+    # a file that was modified this soon before it was hashed might be
+    # modified again without its mtime changing
+    RACY_SECONDS = 2
+
+    def __init__(self, dbfile, max_entries=10000, stats_provider=None):
+        assert max_entries > 0, max_entries
+        self.dbfile = dbfile
+        self.max_entries = max_entries
+        self._stats_provider = stats_provider
+        self._db = None
+        try:
+            self._open()
+        except sqlite3.DatabaseError, e:
+            log.msg("convergence-key cache %s is unusable (%s), recreating it"
+                    % (dbfile, e), facility="tahoe.upload", level=log.UNUSUAL)
+            if self._db:
+                self._db.close()
+            os.unlink(dbfile)
+            self._open()
+
+    def _open(self):
+        must_create = not os.path.exists(self.dbfile)
+        self._db = sqlite3.connect(self.dbfile)
+        self._cursor = c = self._db.cursor()
+        if must_create:
+            c.executescript(KEYCACHE_SCHEMA_v1)
+            c.execute("INSERT INTO version (version) VALUES (1)")
+            self._db.commit()
+        c.execute("SELECT version FROM version")
+        version = c.fetchone()[0]
+        if version != 1:
+            raise sqlite3.DatabaseError("version %d, but we wanted 1"
+                                        % (version,))
+
+    def close(self):
+        self._db.close()
+
+    def _count(self, name):
+        if self._stats_provider:
+            self._stats_provider.count("uploader.convergence_key_cache."
+                                       + name, 1)
+
+    def _where(self, path, convergence, k, n, segsize):
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        return (buffer(os.path.abspath(path)),
+                base32.b2a(tagged_hash(CONVERGENCE_CACHE_TAG, convergence)),
+                k, n, segsize)
+
+    def get_key(self, path, st, convergence, k, n, segsize):
+        """Return the encryption key recorded for the file at 'path', if it
+        still has the os.stat() results 'st' that it had when the key was
+        recorded, or None. A stale entry is removed."""
+        where = self._where(path, convergence, k, n, segsize)
+        c = self._cursor
+        c.execute("SELECT size, mtime, ctime, inode, device, key,"
+                  " storage_index FROM keys"
+                  " WHERE path=? AND convergence=? AND k=? AND n=?"
+                  " AND segsize=?", where)
+        row = c.fetchone()
+        if not row:
+            self._count("misses")
+            return None
+        (size, mtime, ctime, inode, device, key_s, si_s) = row
+        key = base32.a2b(str(key_s))
+        if ((size, mtime, ctime, inode, device) !=
+            (st.st_size, st.st_mtime, st.st_ctime, st.st_ino, st.st_dev)
+            or base32.b2a(storage_index_hash(key)) != si_s):
+            # the file has changed (or the entry is bad)
+            c.execute("DELETE FROM keys"
+                      " WHERE path=? AND convergence=? AND k=? AND n=?"
+                      " AND segsize=?", where)
+            self._db.commit()
+            self._count("stale")
+            return None
+        c.execute("UPDATE keys SET last_used=?"
+                  " WHERE path=? AND convergence=? AND k=? AND n=?"
+                  " AND segsize=?", (time.time(),) + where)
+        self._db.commit()
+        self._count("hits")
+        return key
+
+    def add_key(self, path, before, after, hashed_at, convergence, k, n,
+                segsize, key):
+        """Record the encryption key of the file at 'path', which had the
+        os.stat() results 'before' when it started to be hashed (at time
+        'hashed_at'), and 'after' once it had been. Nothing is recorded if
+        the file might have been changed while it was hashed. Return True
+        if the key was recorded."""
+        identity = lambda st: (st.st_size, st.st_mtime, st.st_ctime,
+                               st.st_ino, st.st_dev)
+        if identity(before) != identity(after):
+            return False
+        if (max(before.st_mtime, before.st_ctime)
+            > hashed_at - self.RACY_SECONDS):
+            return False
+        where = self._where(path, convergence, k, n, segsize)
+        c = self._cursor
+        c.execute("INSERT OR REPLACE INTO keys"
+                  " VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                  where + identity(before) +
+                  (base32.b2a(key), base32.b2a(storage_index_hash(key)),
+                   time.time()))
+        c.execute("SELECT COUNT(*) FROM keys")
+        excess = c.fetchone()[0] - self.max_entries
+        if excess > 0:
+            c.execute("DELETE FROM keys WHERE rowid IN"
+                      " (SELECT rowid FROM keys ORDER BY last_used LIMIT ?)",
+                      (excess,))
+        self._db.commit()
+        return True
@@ -6,6 +6,7 @@ from foolscap.api import Referenceable, DeadReferenceError, eventually
 import allmydata # for __full_version__
 from allmydata import interfaces, uri
 from allmydata.storage.server import si_b2a
+from allmydata.storage_client import get_buckets
 from allmydata.immutable import upload
 from allmydata.immutable.layout import ReadBucketProxy
 from allmydata.util.assertutil import precondition
@@ -54,7 +55,7 @@ class CHKCheckerAndUEBFetcher:
     def _get_all_shareholders(self, storage_index):
         dl = []
         for s in self._peer_getter(storage_index):
-            d = s.get_rref().callRemote("get_buckets", storage_index)
+            d = get_buckets(s, storage_index)
             d.addCallbacks(self._got_response, self._got_error,
                            callbackArgs=(s,))
             dl.append(d)
@@ -61,7 +61,8 @@ class Repairer(log.PrefixingLogMixin):
             # (http://tahoe-lafs.org/trac/tahoe-lafs/ticket/1212)
             happy = 0
             self._encodingparams = (k, happy, N, segsize)
-            ul = upload.CHKUploader(self._storage_broker, self._secret_holder)
+            ul = upload.CHKUploader(self._storage_broker, self._secret_holder,
+                                    priority="bulk")
             return ul.start(self) # I am the IEncryptedUploadable
         d.addCallback(_got_segsize)
         return d
@@ -18,6 +18,7 @@ from allmydata.util.happinessutil import servers_of_happiness, \
                                          failure_message
 from allmydata.util.assertutil import precondition, _assert
 from allmydata.util.rrefutil import add_version_to_remote_reference
+from allmydata.util.workerpool import WorkerPool, in_thread
 from allmydata.interfaces import IUploadable, IUploader, IUploadResults, \
      IEncryptedUploadable, RIEncryptedUploadable, IUploadStatus, \
      NoServersError, InsufficientVersionError, UploadUnhappinessError, \
@@ -121,8 +122,11 @@ class ServerTracker:
     def __init__(self, server,
                  sharesize, blocksize, num_segments, num_share_hashes,
                  storage_index,
-                 bucket_renewal_secret, bucket_cancel_secret):
+                 bucket_renewal_secret, bucket_cancel_secret,
+                 priority="interactive"):
         self._server = server
+        # the priority of our requests, see IServer.get_rref()
+        self._priority = priority
         self.buckets = {} # k: shareid, v: IRemoteBucketWriter
         self.sharesize = sharesize
 
@@ -152,7 +156,7 @@ class ServerTracker:
         return self._server.get_name()
 
     def query(self, sharenums):
-        rref = self._server.get_rref()
+        rref = self._server.get_rref(self._priority)
         d = rref.callRemote("allocate_buckets",
                             self.storage_index,
                             self.renew_secret,
@@ -164,7 +168,7 @@ class ServerTracker:
         return d
 
     def ask_about_existing_shares(self):
-        rref = self._server.get_rref()
+        rref = self._server.get_rref(self._priority)
         return rref.callRemote("get_buckets", self.storage_index)
 
     def _got_reply(self, (alreadygot, buckets)):
@@ -203,8 +207,10 @@ def str_shareloc(shnum, bucketwriter):
 
 class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
-    def __init__(self, upload_id, logparent=None, upload_status=None):
+    def __init__(self, upload_id, logparent=None, upload_status=None,
+                 priority="interactive"):
         self.upload_id = upload_id
+        self._priority = priority
         self.query_count, self.good_query_count, self.bad_query_count = 0,0,0
         # Servers that are working normally, but full.
         self.full_count = 0
@@ -294,7 +300,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                                    share_size, block_size,
                                    num_segments, num_share_hashes,
                                    storage_index,
-                                   renew, cancel)
+                                   renew, cancel, self._priority)
                 trackers.append(st)
             return trackers
 
@@ -617,13 +623,31 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         raise UploadUnhappinessError(msg)
 
 
+def encrypt_chunk(key, offset, data):
+    """Return the AES-CTR encryption of 'data', which starts 'offset' bytes
+    into the ciphertext. This may be run in a worker process."""
+    (counter, skip) = divmod(offset, 16)
+    e = AES(key, iv=("%032x" % counter).decode("hex"))
+    return e.process("\x00" * skip + data)[skip:]
+
+@in_thread
+def hash_plaintext(updates):
+    """Feed each (hasher, data, closes) of 'updates' to its hasher, in order,
+    and return a list of the digests of those which are closed."""
+    digests = []
+    for (hasher, data, closes) in updates:
+        hasher.update(data)
+        if closes:
+            digests.append(hasher.digest())
+    return digests
+
 class EncryptAnUploadable:
     """This is a wrapper that takes an IUploadable and provides
     IEncryptedUploadable."""
     implements(IEncryptedUploadable)
     CHUNKSIZE = 50*1024
 
-    def __init__(self, original, log_parent=None):
+    def __init__(self, original, log_parent=None, workers=None):
         precondition(original.default_params_set,
                      "set_default_encoding_parameters not called on %r before wrapping with EncryptAnUploadable" % (original,))
         self.original = IUploadable(original)
@@ -636,6 +660,15 @@ class EncryptAnUploadable:
         self._file_size = None
         self._ciphertext_bytes_read = 0
         self._status = None
+        # if 'workers' (a WorkerPool) is given, the plaintext is hashed and
+        # encrypted by them, off the reactor thread. The chunks of each read
+        # are encrypted concurrently, and the next read is made once they
+        # have been hashed.
+        self._workers = workers
+        self._times = {
+            "cumulative_encoding_encrypt": 0.0,
+            "cumulative_encoding_hash": 0.0,
+            }
 
     def set_upload_status(self, upload_status):
         self._status = IUploadStatus(upload_status)
@@ -682,6 +715,7 @@ class EncryptAnUploadable:
         def _got(key):
             e = AES(key)
             self._encryptor = e
+            self._key = key
 
             storage_index = storage_index_hash(key)
             assert isinstance(storage_index, str)
@@ -711,28 +745,41 @@ class EncryptAnUploadable:
         return p, self._segment_size
 
     def _update_segment_hash(self, chunk):
+        for (p, piece, closes) in self._split_for_segment_hashers(chunk):
+            p.update(piece)
+            if closes:
+                self._closed_segment_hash(p.digest())
+
+    def _split_for_segment_hashers(self, chunk):
+        """Return a list of (hasher, piece, closes) tuples, one for each
+        plaintext segment hasher that a piece of 'chunk' should be fed to.
+        'closes' is True if that piece fills the segment, after which the
+        hasher's digest should be passed to _closed_segment_hash()."""
+        pieces = []
         offset = 0
         while offset < len(chunk):
             p, segment_left = self._get_segment_hasher()
             chunk_left = len(chunk) - offset
             this_segment = min(chunk_left, segment_left)
-            p.update(chunk[offset:offset+this_segment])
             self._plaintext_segment_hashed_bytes += this_segment
-
-            if self._plaintext_segment_hashed_bytes == self._segment_size:
+            closes = (self._plaintext_segment_hashed_bytes
+                      == self._segment_size)
+            if closes:
                 # we've filled this segment
-                self._plaintext_segment_hashes.append(p.digest())
                 self._plaintext_segment_hasher = None
-                self.log("closed hash [%d]: %dB" %
-                         (len(self._plaintext_segment_hashes)-1,
-                          self._plaintext_segment_hashed_bytes),
-                         level=log.NOISY)
-                self.log(format="plaintext leaf hash [%(segnum)d] is %(hash)s",
-                         segnum=len(self._plaintext_segment_hashes)-1,
-                         hash=base32.b2a(p.digest()),
-                         level=log.NOISY)
-
+            pieces.append((p, chunk[offset:offset+this_segment], closes))
             offset += this_segment
+        return pieces
+
+    def _closed_segment_hash(self, digest):
+        self._plaintext_segment_hashes.append(digest)
+        self.log("closed hash [%d]: %dB" %
+                 (len(self._plaintext_segment_hashes)-1, self._segment_size),
+                 level=log.NOISY)
+        self.log(format="plaintext leaf hash [%(segnum)d] is %(hash)s",
+                 segnum=len(self._plaintext_segment_hashes)-1,
+                 hash=base32.b2a(digest),
+                 level=log.NOISY)
 
 
     def read_encrypted(self, length, hash_only):
@@ -755,6 +802,15 @@ class EncryptAnUploadable:
 
     def _read_encrypted(self, remaining, ciphertext, hash_only, fire_when_done):
         if not remaining:
+            if self._workers:
+                # 'ciphertext' holds Deferreds for the chunks that are being
+                # encrypted
+                d = defer.gatherResults(ciphertext, consumeErrors=True)
+                def _failed(f):
+                    f.trap(defer.FirstError)
+                    fire_when_done.errback(f.value.subFailure)
+                d.addCallbacks(fire_when_done.callback, _failed)
+                return None
             fire_when_done.callback(ciphertext)
             return None
         # tolerate large length= values without consuming a lot of RAM by
@@ -773,11 +829,21 @@ class EncryptAnUploadable:
         def _good(plaintext):
             # and encrypt it..
             # o/' over the fields we go, hashing all the way, sHA! sHA! sHA! o/'
+            if self._workers:
+                d2 = self._hash_and_encrypt_in_workers(plaintext, hash_only,
+                                                       ciphertext)
+                d2.addCallback(lambda ign:
+                               self._read_encrypted(remaining, ciphertext,
+                                                    hash_only, fire_when_done))
+                return d2
             ct = self._hash_and_encrypt_plaintext(plaintext, hash_only)
             ciphertext.extend(ct)
             self._read_encrypted(remaining, ciphertext, hash_only,
                                  fire_when_done)
         def _err(why):
+            if self._workers:
+                # don't leave the failures of other chunks unhandled
+                defer.DeferredList(ciphertext, consumeErrors=True)
             fire_when_done.errback(why)
         d.addCallback(_good)
         d.addErrback(_err)
@@ -795,14 +861,18 @@ class EncryptAnUploadable:
             self.log(" read_encrypted handling %dB-sized chunk" % len(chunk),
                      level=log.NOISY)
             bytes_processed += len(chunk)
+            start = time.time()
             self._plaintext_hasher.update(chunk)
             self._update_segment_hash(chunk)
+            hashed = time.time()
             # TODO: we have to encrypt the data (even if hash_only==True)
             # because pycryptopp's AES-CTR implementation doesn't offer a
             # way to change the counter value. Once pycryptopp acquires
             # this ability, change this to simply update the counter
             # before each call to (hash_only==False) _encryptor.process()
             ciphertext = self._encryptor.process(chunk)
+            self._times["cumulative_encoding_hash"] += hashed - start
+            self._times["cumulative_encoding_encrypt"] += time.time() - hashed
             if hash_only:
                 self.log("  skipping encryption", level=log.NOISY)
             else:
@@ -815,6 +885,40 @@ class EncryptAnUploadable:
             self._status.set_progress(1, progress)
         return cryptdata
 
+    def _hash_and_encrypt_in_workers(self, data, hash_only, ciphertext):
+        """Like _hash_and_encrypt_plaintext(), but append a Deferred for the
+        encryption of each chunk of 'data' to 'ciphertext', and return a
+        Deferred that fires once 'data' has been hashed."""
+        assert isinstance(data, (tuple, list)), type(data)
+        updates = []
+        for chunk in data:
+            self.log(" read_encrypted handling %dB-sized chunk" % len(chunk),
+                     level=log.NOISY)
+            updates.append((self._plaintext_hasher, chunk, False))
+            updates.extend(self._split_for_segment_hashers(chunk))
+            # the counter can be set, so the chunks can be encrypted in
+            # any order, and need not be encrypted at all when hash_only
+            if not hash_only:
+                ciphertext.append(self._workers.run(
+                    encrypt_chunk,
+                    (self._key, self._ciphertext_bytes_read, chunk),
+                    self._times, "cumulative_encoding_encrypt"))
+            self._ciphertext_bytes_read += len(chunk)
+        del data
+        d = self._workers.run(hash_plaintext, (updates,),
+                              self._times, "cumulative_encoding_hash")
+        def _hashed(digests):
+            for digest in digests:
+                self._closed_segment_hash(digest)
+            if self._status:
+                progress = float(self._ciphertext_bytes_read) / self._file_size
+                self._status.set_progress(1, progress)
+        d.addCallback(_hashed)
+        return d
+
+    def get_times(self):
+        return self._times
+
 
     def get_plaintext_hashtree_leaves(self, first, last, num_segments):
         # this is currently unused, but will live again when we fix #453
@@ -893,11 +997,23 @@ class UploadStatus:
 
 class CHKUploader:
     server_selector_class = Tahoe2ServerSelector
-
-    def __init__(self, storage_broker, secret_holder):
+    # how many segments the Encoder may have in flight (see encode.py).
+    # CHKUploadHelper does not call our __init__, and uses these defaults
+    _pipeline_depth = 1
+    _pipeline_memory = None
+    _workers = None
+    # the priority of our storage requests, see IServer.get_rref()
+    _priority = "interactive"
+
+    def __init__(self, storage_broker, secret_holder, pipeline_depth=1,
+                 pipeline_memory=None, workers=None, priority="interactive"):
         # server_selector needs storage_broker and secret_holder
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
+        self._priority = priority
+        self._pipeline_depth = pipeline_depth
+        self._pipeline_memory = pipeline_memory
+        self._workers = workers
         self._log_number = self.log("CHKUploader starting", parent=None)
         self._encoder = None
         self._storage_index = None
@@ -945,10 +1061,14 @@ class CHKUploader:
     def start_encrypted(self, encrypted):
         """ Returns a Deferred that will fire with the UploadResults instance. """
         eu = IEncryptedUploadable(encrypted)
+        self._encrypted_uploadable = eu
 
         started = time.time()
         self._encoder = e = encode.Encoder(self._log_number,
-                                           self._upload_status)
+                                           self._upload_status,
+                                           self._pipeline_depth,
+                                           self._pipeline_memory,
+                                           self._workers)
         d = e.set_encrypted_uploadable(eu)
         d.addCallback(self.locate_all_shareholders, started)
         d.addCallback(self.set_shareholders, e)
@@ -967,7 +1087,8 @@ class CHKUploader:
         self.log("using storage index %s" % upload_id)
         server_selector = self.server_selector_class(upload_id,
                                                      self._log_number,
-                                                     self._upload_status)
+                                                     self._upload_status,
+                                                     self._priority)
 
         share_size = encoder.get_param("share_size")
         block_size = encoder.get_param("block_size")
@@ -1038,6 +1159,12 @@ class CHKUploader:
         timings["storage_index"] = self._storage_index_elapsed
         timings["peer_selection"] = self._server_selection_elapsed
         timings.update(e.get_times())
+        # an EncryptAnUploadable also reports how long it spent hashing and
+        # encrypting, which was part of the encoding time
+        get_times = getattr(self._encrypted_uploadable, "get_times", None)
+        if get_times:
+            for (key, val) in get_times().items():
+                timings[key] = timings.get(key, 0.0) + val
         ur = UploadResults(file_size=e.file_size,
                            ciphertext_fetched=0,
                            preexisting_shares=self._count_preexisting_shares,
@@ -1471,15 +1598,51 @@ class FileHandle(BaseUploadable):
         pass
 
 class FileName(FileHandle):
-    def __init__(self, filename, convergence):
+    def __init__(self, filename, convergence, key_cache=None):
         """
         Upload the data from the filename.  If convergence is None then a
         random encryption key will be used, else the plaintext will be hashed,
         then the hash will be hashed together with the string in the
-        "convergence" argument to form the encryption key.
+        "convergence" argument to form the encryption key. If a
+        ConvergenceKeyCache is given (see set_key_cache()), that hash is
+        skipped when the file has not changed since it was last made.
         """
         assert convergence is None or isinstance(convergence, str), (convergence, type(convergence))
         FileHandle.__init__(self, open(filename, "rb"), convergence=convergence)
+        self._filename = filename
+        self._key_cache = key_cache
+
+    def set_key_cache(self, key_cache):
+        self._key_cache = key_cache
+
+    def _get_encryption_key_convergent(self):
+        if self._key is not None or not self._key_cache:
+            return FileHandle._get_encryption_key_convergent(self)
+        d = self.get_size()
+        d.addCallback(lambda size: self.get_all_encoding_parameters())
+        def _got(params):
+            k, happy, n, segsize = params
+            key_cache = self._key_cache
+            hashed_at = time.time()
+            before = os.fstat(self._filehandle.fileno())
+            key = key_cache.get_key(self._filename, before, self.convergence,
+                                    k, n, segsize)
+            if key is not None:
+                self._key = key
+                if self._status:
+                    self._status.set_progress(0, 1.0)
+                return key
+            d2 = FileHandle._get_encryption_key_convergent(self)
+            def _hashed(key):
+                after = os.fstat(self._filehandle.fileno())
+                key_cache.add_key(self._filename, before, after, hashed_at,
+                                  self.convergence, k, n, segsize, key)
+                return key
+            d2.addCallback(_hashed)
+            return d2
+        d.addCallback(_got)
+        return d
+
     def close(self):
         FileHandle.close(self)
         self._filehandle.close()
@@ -1503,14 +1666,27 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
     name = "uploader"
     URI_LIT_SIZE_THRESHOLD = 55
 
-    def __init__(self, helper_furl=None, stats_provider=None, history=None):
+    def __init__(self, helper_furl=None, stats_provider=None, history=None,
+                 pipeline_depth=1, pipeline_memory=None,
+                 encoding_workers=0, encoding_worker_type="processes",
+                 key_cache=None):
         self._helper_furl = helper_furl
         self.stats_provider = stats_provider
         self._history = history
+        self._pipeline_depth = pipeline_depth
+        self._pipeline_memory = pipeline_memory
         self._helper = None
         self._all_uploads = weakref.WeakKeyDictionary() # for debugging
         log.PrefixingLogMixin.__init__(self, facility="tahoe.immutable.upload")
         service.MultiService.__init__(self)
+        # with encoding_workers, the hashing, encryption and erasure coding
+        # of uploads that we encode ourselves is done by a WorkerPool
+        self._workers = None
+        if encoding_workers:
+            self._workers = WorkerPool(encoding_workers, encoding_worker_type)
+            self._workers.setServiceParent(self)
+        # a ConvergenceKeyCache, used for FileName uploads
+        self._key_cache = key_cache
 
     def startService(self):
         service.MultiService.startService(self)
@@ -1556,6 +1732,8 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
             precondition(isinstance(default_params, dict), default_params)
             precondition("max_segment_size" in default_params, default_params)
             uploadable.set_default_encoding_parameters(default_params)
+            if self._key_cache and isinstance(uploadable, FileName):
+                uploadable.set_key_cache(self._key_cache)
 
             if self.stats_provider:
                 self.stats_provider.count('uploader.files_uploaded', 1)
@@ -1565,7 +1743,8 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 uploader = LiteralUploader()
                 return uploader.start(uploadable)
             else:
-                eu = EncryptAnUploadable(uploadable, self._parentmsgid)
+                eu = EncryptAnUploadable(uploadable, self._parentmsgid,
+                                         self._workers)
                 d2 = defer.succeed(None)
                 storage_broker = self.parent.get_storage_broker()
                 if self._helper:
@@ -1575,7 +1754,10 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 else:
                     storage_broker = self.parent.get_storage_broker()
                     secret_holder = self.parent._secret_holder
-                    uploader = CHKUploader(storage_broker, secret_holder)
+                    uploader = CHKUploader(storage_broker, secret_holder,
+                                           self._pipeline_depth,
+                                           self._pipeline_memory,
+                                           self._workers)
                     d2.addCallback(lambda x: uploader.start(eu))
 
                 self._all_uploads[uploader] = None
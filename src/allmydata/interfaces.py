@@ -18,6 +18,7 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_STORAGE_INDEXES = 1000 # per get_buckets_many() query
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -132,6 +133,25 @@ class RIStorageServer(RemoteInterface):
         """
         return Any() # returns None now, but future versions might change
 
+    def add_lease_many(leases=ListOf(TupleOf(StorageIndex,
+                                             LeaseRenewSecret,
+                                             LeaseCancelSecret),
+                                     maxLength=MAX_STORAGE_INDEXES)):
+        """
+        Add (or renew) a lease on each of several buckets, as if add_lease()
+        had been called once for each (storage_index, renew_secret,
+        cancel_secret) tuple. This saves a round trip per storage index when
+        adding leases to many files (e.g. during a deep-check).
+
+        I return a dictionary that maps each storage index to the number of
+        shares which received the lease. This is 0 for storage indexes for
+        which I hold no shares.
+
+        Servers which implement this method advertise it by setting
+        'supports-add-lease-many' in their version dictionary.
+        """
+        return DictOf(StorageIndex, int, maxKeys=MAX_STORAGE_INDEXES)
+
     def renew_lease(storage_index=StorageIndex, renew_secret=LeaseRenewSecret):
         """
         Renew the lease on a given bucket, resetting the timer to 31 days.
@@ -149,6 +169,52 @@ class RIStorageServer(RemoteInterface):
     def get_buckets(storage_index=StorageIndex):
         return DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS)
 
+    def get_buckets_many(storage_indexes=ListOf(StorageIndex,
+                                                maxLength=MAX_STORAGE_INDEXES),
+                         want_readers=bool):
+        """
+        Look up the shares held for several storage indexes at once. This
+        saves a round trip per storage index when checking or downloading
+        many files (e.g. during a deep-check).
+
+        I return a dictionary that maps storage index to a dictionary of
+        {sharenum: bucket}. Storage indexes for which I hold no shares are
+        omitted. If want_readers is True, each bucket is an RIBucketReader,
+        just as get_buckets() would return. If it is False, each bucket is
+        None: this is cheaper for callers that only want to know which
+        shares are present.
+
+        Servers which implement this method advertise it by setting
+        'supports-get-buckets-many' in their version dictionary.
+        """
+        return DictOf(StorageIndex,
+                      DictOf(int, ChoiceOf(RIBucketReader, None),
+                             maxKeys=MAX_BUCKETS),
+                      maxKeys=MAX_STORAGE_INDEXES)
+
+    def verify_shares(storage_index=StorageIndex,
+                      sharenums=SetOf(int, maxLength=MAX_BUCKETS)):
+        """
+        Read and verify the given immutable shares (or all of them, if
+        sharenums is empty) on the server's own disk, and return a compact
+        summary of each, so that a verifying client need not download every
+        block of every share. The server checks each block against the
+        share's block hash tree, and the hash trees and share hash chain
+        against each other and against the URI extension block.
+
+        I return a dictionary that maps share number to a dictionary with a
+        'status' of 'ok', 'corrupt' or 'incompatible'. A corrupt or
+        incompatible share also has a 'reason'. A good share also has the
+        'uri-extension' (the whole UEB), the 'share-hashes' chain (a list
+        of (hashnum, hash) tuples), the 'block-hash-root', the
+        'crypttext-hash-root' and the 'num-blocks'. The client must still
+        check these against the verify-cap: the server has only shown that
+        the share is consistent with its own UEB.
+
+        Servers which implement this method advertise it by setting
+        'supports-verify-shares' in their version dictionary.
+        """
+        return DictOf(int, DictOf(str, Any()), maxKeys=MAX_BUCKETS)
 
 
     def slot_readv(storage_index=StorageIndex,
@@ -290,6 +356,29 @@ class RIStorageServer(RemoteInterface):
         store that on disk.
         """
 
+    def open_session(canary=Referenceable, priority=str):
+        """
+        Return a reference to an object that provides this same
+        RIStorageServer interface, through which the caller can make their
+        requests. When the server has more disk I/O to do than it can start
+        at once, it can share the disk fairly between the clients that have
+        opened sessions, and the buckets returned through a session are
+        scheduled with it. A client is identified by the (authenticated)
+        connection that 'canary' was sent over, and the server forgets
+        about its sessions when that connection is lost.
+
+        'priority' is 'interactive' for requests that someone is waiting
+        for, or 'bulk' for those (such as checks and repairs) that can
+        wait; interactive requests get a larger share of the disk, up to a
+        limit, beyond which the server treats them as bulk requests. A
+        client may open a session for each priority, and make each request
+        through the one that suits it.
+
+        Servers which implement this method advertise it by setting
+        'supports-sessions' in their version dictionary.
+        """
+        return Any() # an RIStorageServer
+
 
 class IStorageBucketWriter(Interface):
     """
@@ -463,10 +552,15 @@ class IServer(IDisplayableServer):
     def start_connecting(tub, trigger_cb):
         pass
 
-    def get_rref():
+    def get_rref(priority="interactive"):
         """Once a server is connected, I return a RemoteReference.
         Before a server is connected for the first time, I return None.
 
+        'priority' says how urgent the requests that will be made through
+        the reference are: 'interactive' (for someone who is waiting), or
+        'bulk' (for checks, repairs, and other work that can wait). Servers
+        which support sessions schedule the two differently.
+
         Note that the rref I return will start producing DeadReferenceErrors
         once the connection is lost.
         """
@@ -1991,7 +2085,11 @@ class IUploadResults(Interface):
           helper_total : initial helper query to helper finished pushing
           cumulative_fetch : helper waiting for ciphertext requests
           total_fetch : helper start to last ciphertext response
-          cumulative_encoding : just time spent in zfec
+          cumulative_encoding : time spent reading, hashing, encrypting
+                                and erasure-coding segments
+          cumulative_encoding_encrypt : of which, time spent encrypting
+          cumulative_encoding_hash : of which, time spent hashing
+          cumulative_encoding_codec : of which, time spent in zfec
           cumulative_sending : just time spent waiting for storage servers
           hashes_and_close : last segment push to shareholder close
           total_encode_and_push : first encode to shareholder close
@@ -2071,6 +2169,14 @@ class ICheckable(Interface):
         failures during retrieval, or is malicious or buggy, then
         verification will detect the problem, but checking will not.
 
+        If verify='server', immutable files are verified as with
+        verify=True, except that storage servers which advertise
+        'supports-verify-shares' are asked to verify the blocks of their own
+        shares, and send back only the hashes, which are checked against the
+        verify-cap. This saves transferring every share, but trusts those
+        servers to have hashed the blocks that they really hold. Mutable
+        files are verified as with verify=True.
+
         If add_lease=True, I will ensure that an up-to-date lease is present
         on each share. The lease secrets will be derived from by node secret
         (in BASEDIR/private/secret), so either I will add a new lease to the
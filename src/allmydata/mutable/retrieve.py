@@ -292,7 +292,11 @@ class Retrieve:
             if key in self.servermap.proxies:
                 reader = self.servermap.proxies[key]
             else:
-                reader = MDMFSlotReadProxy(server.get_rref(),
+                # verifying can wait for the users of the server
+                priority = "interactive"
+                if self._verify:
+                    priority = "bulk"
+                reader = MDMFSlotReadProxy(server.get_rref(priority),
                                            self._storage_index, shnum, None)
             reader.server = server
             self.readers[shnum] = reader
@@ -393,6 +393,10 @@ class ServermapUpdater:
         self.mode = mode
         self._add_lease = add_lease
         self._running = True
+        # checks and repairs can wait for the users of the servers
+        self._priority = "interactive"
+        if mode in (MODE_CHECK, MODE_REPAIR):
+            self._priority = "bulk"
 
         self._storage_index = filenode.get_storage_index()
         self._last_failure = None
@@ -591,7 +595,7 @@ class ServermapUpdater:
         return d
 
     def _do_read(self, server, storage_index, shnums, readv):
-        ss = server.get_rref()
+        ss = server.get_rref(self._priority)
         if self._add_lease:
             # send an add-lease message in parallel. The results are handled
             # separately. This is sent before the slot_readv() so that we can
@@ -637,7 +641,7 @@ class ServermapUpdater:
         lp = self.log(format="got result from [%(name)s], %(numshares)d shares",
                       name=server.get_name(),
                       numshares=len(datavs))
-        ss = server.get_rref()
+        ss = server.get_rref(self._priority)
         now = time.time()
         elapsed = now - started
         def _done_processing(ignored=None):
@@ -645,15 +645,20 @@ def find_shares(options):
     /home/warner/testnet/node-2/storage/shares/44k/44kai1tui348689nrw8fjegc8c/2
     """
     from allmydata.storage.server import si_a2b, storage_index_to_dir
+    from allmydata.storage.common import SHARE_DIR_LEVELS
     from allmydata.util.encodingutil import listdir_unicode
 
     out = options.stdout
-    sharedir = storage_index_to_dir(si_a2b(options.si_s))
+    # the node may lay out its share directory with any number of levels
+    # of prefix directories, or be part-way from one layout to another
+    sharedirs = [storage_index_to_dir(si_a2b(options.si_s), levels)
+                 for levels in SHARE_DIR_LEVELS]
     for d in options.nodedirs:
-        d = os.path.join(d, "storage/shares", sharedir)
-        if os.path.exists(d):
-            for shnum in listdir_unicode(d):
-                print >>out, os.path.join(d, shnum)
+        for sharedir in sharedirs:
+            d2 = os.path.join(d, "storage/shares", sharedir)
+            if os.path.exists(d2):
+                for shnum in listdir_unicode(d2):
+                    print >>out, os.path.join(d2, shnum)
 
     return 0
 
@@ -827,6 +832,7 @@ def describe_share(abs_sharefile, si_s, shnum_s, now, out):
 
 def catalog_shares(options):
     from allmydata.util.encodingutil import listdir_unicode, quote_output
+    from allmydata.storage.common import list_buckets
 
     out = options.stdout
     err = options.stderr
@@ -847,9 +853,10 @@ def catalog_shares(options):
                 # that listdir_unicode will always succeed. Try to catalog as much
                 # as possible.
                 try:
-                    sharedirs = listdir_unicode(abbrevdir)
-                    for si_s in sorted(sharedirs):
-                        si_dir = os.path.join(abbrevdir, si_s)
+                    listdir_unicode(abbrevdir)
+                    # the buckets may be under more prefix directories
+                    for (si_s, parentdir) in sorted(list_buckets(abbrevdir)):
+                        si_dir = os.path.join(parentdir, si_s)
                         catalog_shares_one_abbrevdir(si_s, si_dir, now, out,err)
                 except:
                     print >>err, "Error processing %s" % quote_output(abbrevdir)
@@ -880,6 +887,77 @@ def catalog_shares_one_abbrevdir(si_s, si_dir, now, out, err):
         print >>err, "Error processing %s" % quote_output(si_dir)
         failure.Failure().printTraceback(err)
 
+class PackSharesOptions(BaseOptions):
+    def getSynopsis(self):
+        return "Usage: tahoe [global-opts] debug pack-shares NODEDIR"
+
+    optParameters = [
+        ["max-size", "m", None,
+         "Pack immutable shares of up to this size (default: the node's"
+         " [storage]packed.max_share_size, or 64KiB)."],
+        ]
+
+    def parseArgs(self, nodedir):
+        # kept as a bytestring, since the share directories are named in
+        # base32
+        self.nodedir = os.path.abspath(os.path.expanduser(nodedir))
+
+    def getUsage(self, width=None):
+        t = BaseOptions.getUsage(self, width)
+        t += """
+Move the small immutable share files of a storage server into its packed
+share store (storage/packed/), converting a node to the packed layout that
+[storage]packed.enabled=true uses for new shares. The share directories
+listed in [storage]extra_share_dirs are converted too. Each share file is
+deleted once it has been packed. The node must not be running.
+
+ tahoe debug pack-shares ~/.tahoe
+"""
+        return t
+
+def pack_shares(options):
+    from ConfigParser import SafeConfigParser
+    from allmydata.storage.packed import PackedShareStore, pack_share_dirs, \
+         PACKED_MAX_SHARE_SIZE
+    from allmydata.util.abbreviate import parse_abbreviated_size
+    from allmydata.util import fileutil
+    out = options.stdout
+    err = options.stderr
+
+    config = SafeConfigParser()
+    config.read(os.path.join(options.nodedir, "tahoe.cfg"))
+    def get_config(name, default):
+        if config.has_option("storage", name):
+            return config.get("storage", name)
+        return default
+    storedir = os.path.join(options.nodedir, "storage")
+    sharedirs = [os.path.join(storedir, "shares")]
+    for sharedir in get_config("extra_share_dirs", "").split(","):
+        if sharedir.strip():
+            sharedirs.append(os.path.join(options.nodedir,
+                                          os.path.expanduser(sharedir.strip())))
+    max_size = options["max-size"] or get_config("packed.max_share_size",
+                                                 None)
+    try:
+        max_size = parse_abbreviated_size(max_size)
+    except ValueError:
+        print >>err, "unparseable share size %s" % max_size
+        return 1
+    if max_size is None:
+        max_size = PACKED_MAX_SHARE_SIZE
+
+    store = PackedShareStore(os.path.join(storedir, "packed"))
+    (shares, packed_bytes) = pack_share_dirs(store, sharedirs, max_size, err)
+    store.close()
+    if shares:
+        # the share counts (if they are kept) measure packed shares
+        # differently, so make the node recount them
+        fileutil.remove_if_possible(os.path.join(storedir,
+                                                 "share_counts.state"))
+    print >>out, "packed %d shares (%d bytes)" % (shares, packed_bytes)
+    return 0
+
+
 class CorruptShareOptions(BaseOptions):
     def getSynopsis(self):
         return "Usage: tahoe [global-opts] debug corrupt-share SHARE_FILENAME"
@@ -1059,6 +1137,7 @@ class DebugCommand(BaseOptions):
         ["find-shares", None, FindSharesOptions, "Locate sharefiles in node dirs."],
         ["catalog-shares", None, CatalogSharesOptions, "Describe all shares in node dirs."],
         ["corrupt-share", None, CorruptShareOptions, "Corrupt a share by flipping a bit."],
+        ["pack-shares", None, PackSharesOptions, "Move small shares into the packed share store."],
         ["repl", None, ReplOptions, "Open a Python interpreter."],
         ["trial", None, TrialOptions, "Run tests using Twisted Trial with the right imports."],
         ["flogtool", None, FlogtoolOptions, "Utilities to access log files."],
@@ -1077,6 +1156,7 @@ Subcommands:
     tahoe debug find-shares     Locate sharefiles in node directories.
     tahoe debug catalog-shares  Describe all shares in node dirs.
     tahoe debug corrupt-share   Corrupt a share by flipping a bit.
+    tahoe debug pack-shares     Move small shares into the packed share store.
     tahoe debug repl            Open a Python interpreter.
     tahoe debug trial           Run tests using Twisted Trial with the right imports.
     tahoe debug flogtool        Utilities to access log files.
@@ -1118,6 +1198,7 @@ subDispatch = {
     "find-shares": find_shares,
     "catalog-shares": catalog_shares,
     "corrupt-share": corrupt_share,
+    "pack-shares": pack_shares,
     "repl": repl,
     "trial": trial,
     "flogtool": flogtool,
@@ -33,7 +33,9 @@ def check_location(options, where):
         url += "/" + escape_path(path)
     # todo: should it end with a slash?
     url += "?t=check&output=JSON"
-    if options["verify"]:
+    if options["verify-on-servers"]:
+        url += "&verify=server"
+    elif options["verify"]:
         url += "&verify=true"
     if options["repair"]:
         url += "&repair=true"
@@ -294,7 +296,9 @@ class DeepCheckStreamer(LineOnlyReceiver):
             url += "/" + escape_path(path)
         # todo: should it end with a slash?
         url += "?t=stream-deep-check"
-        if options["verify"]:
+        if options["verify-on-servers"]:
+            url += "&verify=server"
+        elif options["verify"]:
             url += "&verify=true"
         if options["repair"]:
             url += "&repair=true"
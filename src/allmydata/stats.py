@@ -60,6 +60,14 @@ class LoadMonitor(service.MultiService):
         self.last = now
         self.timer = reactor.callLater(self.loop_interval, self.loop)
 
+    def get_recent_delay(self, num_samples):
+        """Return the average reactor delay over the last 'num_samples'
+        loop intervals, or 0 if there are no samples yet."""
+        recent = list(self.stats)[-num_samples:]
+        if not recent:
+            return 0
+        return max(0, sum(recent) / len(recent))
+
     def get_stats(self):
         if self.stats:
             avg = sum(self.stats) / len(self.stats)
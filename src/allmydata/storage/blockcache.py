@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+
+
+class BlockCache:
+    """I keep the share data that was read most recently in memory, up to
+    'max_bytes' of it, so that a share which many clients download (a
+    popular file, or a directory near the top of everyone's tree) is read
+    from the disk once rather than once for each of them. Each read is
+    cached on its own, keyed by (storage index, shnum, offset): downloaders
+    of the same file ask for the same hash-tree regions and blocks, so the
+    same keys come round again. The least recently used reads are dropped
+    when I am full.
+
+    Anything which changes the data of a share (a mutable-share write) or
+    deletes one must call invalidate() for it. Reads which were in progress
+    at the time are not added to the cache when they finish, since they may
+    have read the old data. I may be used from several disk I/O threads at
+    once.
+    """
+
+    def __init__(self, max_bytes):
+        assert max_bytes > 0, max_bytes
+        self.max_bytes = max_bytes
+        # k: (storage_index, shnum, offset), v: (data, length asked for).
+        # 'data' is shorter than that length if it ran into the end of the
+        # share, and then answers any longer read at the same offset too.
+        self._entries = OrderedDict()
+        # k: (storage_index, shnum), v: set of offsets in _entries
+        self._offsets = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        # bumped by every invalidate(), like OpenFileCache._generation
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.evictions = 0
+
+    def read(self, storage_index, shnum, offset, length, reader):
+        """Return 'length' bytes of the share data of (storage_index,
+        shnum) from 'offset', calling reader(offset, length) to read them
+        if they are not cached."""
+        key = (storage_index, shnum, offset)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                (data, asked) = entry
+                self._entries[key] = entry # now the most recently used
+                if length <= asked or len(data) < asked:
+                    data = data[:length]
+                    self.hits += 1
+                    self.bytes_served += len(data)
+                    return data
+            self.misses += 1
+            generation = self._generation
+        data = reader(offset, length)
+        self._add(key, data, length, generation)
+        return data
+
+    def _add(self, key, data, length, generation):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+            self._entries[key] = (data, length)
+            self._offsets.setdefault(key[:2], set()).add(key[2])
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                (oldkey, (olddata, oldlength)) = self._entries.popitem(False)
+                self._forget(oldkey, olddata)
+                self.evictions += 1
+
+    def _forget(self, key, data):
+        self._size -= len(data)
+        offsets = self._offsets[key[:2]]
+        offsets.discard(key[2])
+        if not offsets:
+            del self._offsets[key[:2]]
+
+    def invalidate(self, storage_index, shnum):
+        """Forget everything that was read from (storage_index, shnum)."""
+        with self._lock:
+            self._generation += 1
+            for offset in self._offsets.pop((storage_index, shnum), ()):
+                (data, length) = self._entries.pop((storage_index, shnum,
+                                                    offset))
+                self._size -= len(data)
+
+    def get_size(self):
+        return self._size
+
+    def get_num_entries(self):
+        return len(self._entries)
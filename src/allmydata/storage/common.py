@@ -8,6 +8,10 @@ class UnknownMutableContainerVersionError(Exception):
     pass
 class UnknownImmutableContainerVersionError(Exception):
     pass
+class UnknownLeaseDBVersionError(Exception):
+    pass
+class UnknownPackedStoreVersionError(Exception):
+    pass
 
 
 def si_b2a(storageindex):
@@ -16,6 +20,37 @@ def si_b2a(storageindex):
 def si_a2b(ascii_storageindex):
     return base32.a2b(ascii_storageindex)
 
-def storage_index_to_dir(storageindex):
+# the number of levels of two-letter prefix directories that a share
+# directory may use. One level gives 1024 prefix directories, and each
+# level below that divides the buckets in them by another 1024.
+SHARE_DIR_LEVELS = (1, 2, 3)
+
+def storage_index_to_dir(storageindex, levels=1):
+    """Return the path of the bucket directory for this storage index,
+    relative to the share directory: 'levels' prefix directories named for
+    successive pairs of letters of the base32 storage index, then one named
+    for the whole of it. With one level (the original layout) this is like
+    'ab/abcde...'; with two, 'ab/cd/abcde...'."""
     sia = si_b2a(storageindex)
-    return os.path.join(sia[:2], sia)
+    prefixes = [sia[2*i:2*i+2] for i in range(levels)]
+    return os.path.join(*(prefixes + [sia]))
+
+def list_buckets(prefixdir):
+    """Return a list of (bucket name, parent directory) for every bucket
+    directory under the top-level prefix directory 'prefixdir', however
+    many levels of prefix directories lie between them. Prefix directories
+    have two-letter names, and bucket directories are named for a whole
+    storage index, so share directories that are part-way through changing
+    from one layout to another can be listed too. A missing or unreadable
+    directory holds no buckets."""
+    buckets = []
+    try:
+        names = os.listdir(prefixdir)
+    except EnvironmentError:
+        return buckets
+    for name in names:
+        if len(name) == 2:
+            buckets.extend(list_buckets(os.path.join(prefixdir, name)))
+        else:
+            buckets.append((name, prefixdir))
+    return buckets
@@ -0,0 +1,144 @@
+import os, time, errno
+
+from twisted.internet import defer
+
+from allmydata.storage.crawler import ShareCrawler, ListingPending
+from allmydata.storage.common import si_a2b, UnknownMutableContainerVersionError
+from allmydata.storage.inventory import get_share_type
+from allmydata.storage.mutable import MutableShareFile
+from allmydata.util import log
+
+
+class MutableShareCompactor(ShareCrawler):
+    """I look at every mutable share that a StorageServer holds, and compact
+    the ones whose container has become much larger than their data (see
+    MutableShareFile.compact()). A write that shrinks a share compacts it
+    at once, but a share whose container grew with slack and then stopped
+    being written keeps that slack until I come along.
+
+    Each bucket is compacted through the server's disk I/O engine, so with
+    I/O threads it is done in a worker thread, in order with any client
+    requests for the same bucket.
+
+    I add the following keys to my state:
+
+     cycle-to-date: (for the cycle in progress)
+      examined-buckets, examined-shares: what has been looked at
+      compacted-shares, compacted-bytes: what has been compacted, and the
+                                         number of bytes that freed
+     history: maps cyclenum to the cycle-to-date of that cycle, plus its
+              cycle-start-finish-times, for the last 10 cycles
+    """
+
+    slow_start = 15*60 # let the other crawlers go first
+    minimum_cycle_time = 24*60*60
+
+    def __init__(self, server, statefile):
+        self._compacted = {} # k: si_b32, v: results from a worker thread
+        ShareCrawler.__init__(self, server, statefile)
+
+    def add_initial_state(self):
+        so_far = self.create_empty_cycle_dict()
+        self.state.setdefault("cycle-to-date", so_far)
+        for k in so_far:
+            self.state["cycle-to-date"].setdefault(k, so_far[k])
+        self.state.setdefault("history", {})
+
+    def create_empty_cycle_dict(self):
+        return {"examined-buckets": 0,
+                "examined-shares": 0,
+                "compacted-shares": 0,
+                "compacted-bytes": 0,
+                }
+
+    def started_cycle(self, cycle):
+        self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        results = self._compacted.pop(storage_index_b32, None)
+        if results is None:
+            storage_index = si_a2b(storage_index_b32)
+            server = self.server
+            results = server.disk_io.run(
+                server._get_bucketdir(storage_index),
+                self.compact_bucket,
+                lambda: (storage_index,
+                         server._get_share_types(storage_index)))
+            if isinstance(results, defer.Deferred):
+                d = results
+                d.addCallbacks(self._compacted_bucket, self._compact_failed,
+                               callbackArgs=(storage_index_b32,),
+                               errbackArgs=(storage_index_b32,))
+                raise ListingPending(d)
+        self.record_results(storage_index_b32, results)
+
+    def _compacted_bucket(self, results, storage_index_b32):
+        self._compacted[storage_index_b32] = results
+
+    def _compact_failed(self, f, storage_index_b32):
+        log.err(f, "mutable share compactor could not compact bucket %s"
+                % (storage_index_b32,),
+                facility="tahoe.storage", level=log.UNUSUAL, umid="q7Lc3A")
+        self._compacted[storage_index_b32] = []
+
+    def compact_bucket(self, storage_index, sharetypes):
+        """Compact each of the mutable shares of 'storage_index' that needs
+        it, and return a list of (shnum, old_size, new_size, relocated_bytes)
+        tuples, one for each mutable share. This may be run in a disk I/O
+        thread."""
+        server = self.server
+        results = []
+        for shnum, filename, sharetype in server._find_shares(storage_index,
+                                                              sharetypes):
+            try:
+                if sharetype is None:
+                    sharetype = get_share_type(filename)
+                if sharetype != "mutable":
+                    continue
+                msf = MutableShareFile(filename, server,
+                                       file_cache=server.file_cache)
+                old_size = os.path.getsize(filename)
+                freed = msf.compact()
+            except EnvironmentError, e:
+                if e.errno == errno.ENOENT:
+                    continue # it was deleted since the bucket was listed
+                raise
+            except UnknownMutableContainerVersionError:
+                continue # the scrubber reports these
+            results.append((shnum, old_size, old_size - freed,
+                            msf.relocated_bytes))
+        return results
+
+    def record_results(self, storage_index_b32, results):
+        so_far = self.state["cycle-to-date"]
+        so_far["examined-buckets"] += 1
+        so_far["examined-shares"] += len(results)
+        compacted = [(shnum, old_size, new_size, relocated)
+                     for (shnum, old_size, new_size, relocated) in results
+                     if new_size != old_size]
+        if not compacted:
+            return
+        so_far["compacted-shares"] += len(compacted)
+        so_far["compacted-bytes"] += sum([old_size - new_size
+                                          for (shnum, old_size, new_size,
+                                               relocated) in compacted])
+        self.server._mutable_shares_compacted(si_a2b(storage_index_b32),
+                                              compacted)
+
+    def finished_cycle(self, cycle):
+        h = self.state["cycle-to-date"].copy()
+        h["cycle-start-finish-times"] = (self.state["current-cycle-start-time"],
+                                         time.time())
+        history = self.state["history"]
+        history[cycle] = h
+        while len(history) > 10:
+            del history[min(history.keys())]
+
+    def get_state(self):
+        """In addition to the crawler state described in
+        ShareCrawler.get_state(), I return 'cycle-to-date' (only while a
+        cycle is in progress) and 'history', as described above."""
+        state = ShareCrawler.get_state(self)
+        if self.state["current-cycle"] is None:
+            del state["cycle-to-date"]
+        return state
@@ -0,0 +1,213 @@
+import os
+import cPickle as pickle
+
+from twisted.application import service
+
+from allmydata.storage.common import si_a2b, si_b2a
+from allmydata.storage.crawler import BucketCountingCrawler
+from allmydata.storage.inventory import get_share_type
+from allmydata.util import fileutil, log
+
+SHARETYPES = ("immutable", "mutable")
+
+
+def empty_counts():
+    return dict([(sharetype, {"buckets": 0, "shares": 0, "bytes": 0})
+                 for sharetype in SHARETYPES])
+
+
+class ShareCounts(service.Service):
+    """I keep count of the buckets and shares that a StorageServer holds,
+    and of the total size of their share files, for each type of share.
+
+    The server tells me about every share that it adds or removes, so the
+    counts are always current, without walking the share directories. They
+    are saved to my statefile when the server is stopped. While the server
+    is running, the statefile is marked as not having been saved cleanly:
+    if the server is killed, the counts cannot be trusted the next time it
+    starts, and are reconciled with what is on disk by a full recount (see
+    ShareCountingCrawler). Until then, 'reconciled' is False.
+    """
+
+    def __init__(self, statefile):
+        self.statefile = statefile
+        self.counts = empty_counts()
+        self.reconciled = False
+        self.resumable = False # an unfinished recount may carry on
+        self.recount = None # the ShareCountingCrawler, while it recounts
+        try:
+            f = open(statefile, "rb")
+            state = pickle.load(f)
+            f.close()
+        except Exception:
+            state = None
+        if state and state["clean"]:
+            self.counts = state["counts"]
+            self.reconciled = state["reconciled"]
+            self.resumable = True
+        # if we are killed from here on, we cannot trust what we saved
+        self.save(clean=False)
+
+    def save(self, clean):
+        state = {"version": 1,
+                 "clean": clean,
+                 "reconciled": self.reconciled,
+                 "counts": self.counts,
+                 }
+        tmpfile = self.statefile + ".tmp"
+        f = open(tmpfile, "wb")
+        pickle.dump(state, f)
+        f.close()
+        fileutil.move_into_place(tmpfile, self.statefile)
+
+    def stopService(self):
+        self.save(clean=True)
+        return service.Service.stopService(self)
+
+    def update(self, storage_index, sharetype, buckets=0, shares=0, size=0):
+        """Add the given (possibly negative) numbers of buckets, shares and
+        bytes to the counts for 'sharetype'."""
+        if sharetype not in self.counts:
+            return
+        _add(self.counts[sharetype], buckets, shares, size)
+        if self.recount and self.recount.has_counted(storage_index):
+            # the recount has already been past this bucket, so it needs
+            # to hear about the change too
+            self.recount.update(sharetype, buckets, shares, size)
+
+    def reconcile(self, counts):
+        self.counts = counts
+        self.reconciled = True
+        self.recount = None
+        log.msg(format="share counts reconciled: %(counts)s",
+                counts=counts, facility="tahoe.storage")
+
+    def get_num_buckets(self):
+        return sum([c["buckets"] for c in self.counts.values()])
+
+    def get_stats(self):
+        stats = {}
+        for (sharetype, c) in self.counts.items():
+            for (name, value) in c.items():
+                stats["%s.%s" % (sharetype, name)] = value
+        return stats
+
+
+def _add(c, buckets, shares, size):
+    c["buckets"] += buckets
+    c["shares"] += shares
+    c["bytes"] += size
+
+
+class ShareCountingCrawler(BucketCountingCrawler):
+    """I am the bucket counter of a StorageServer that keeps ShareCounts.
+    The counts are maintained as shares come and go, so I only crawl when
+    they need to be reconciled with what is on disk (after an unclean
+    shutdown). I then count the shares, and their sizes, as well as the
+    buckets, and hand the totals to the ShareCounts at the end of the
+    cycle. Otherwise I report the live bucket count, and sleep.
+    """
+
+    def __init__(self, server, statefile, counts):
+        BucketCountingCrawler.__init__(self, server, statefile)
+        self.counts = counts
+        if counts.reconciled:
+            return
+        if not counts.resumable or self.state["share-tally"] is None:
+            # we cannot tell which changes an unfinished recount missed,
+            # so start it again from the beginning
+            self.state["current-cycle"] = None
+            self.state["last-complete-bucket"] = None
+            self.last_complete_prefix_index = -1
+        counts.recount = self
+
+    def add_initial_state(self):
+        BucketCountingCrawler.add_initial_state(self)
+        # ["share-tally"] = counts for the recount in progress, or None
+        self.state.setdefault("share-tally", None)
+
+    def startService(self):
+        if self.counts.reconciled:
+            # the counts are being kept for us
+            self.sleeping_between_cycles = True
+            return service.MultiService.startService(self)
+        return BucketCountingCrawler.startService(self)
+
+    def has_counted(self, storage_index):
+        """Have I already counted the bucket for this storage index, in the
+        recount that is in progress?"""
+        if self.state["current-cycle"] is None:
+            return False
+        prefix = si_b2a(storage_index)[:2]
+        return self.prefixes.index(prefix) <= self.last_complete_prefix_index
+
+    def update(self, sharetype, buckets, shares, size):
+        _add(self.state["share-tally"][sharetype], buckets, shares, size)
+
+    def started_cycle(self, cycle):
+        self.state["share-tally"] = empty_counts()
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets,
+                          start_slice):
+        BucketCountingCrawler.process_prefixdir(self, cycle, prefix,
+                                                prefixdir, buckets,
+                                                start_slice)
+        tally = self.state["share-tally"]
+        packed = self.server.packed
+        for bucket in buckets:
+            bucketdir = os.path.join(self.bucket_prefixdirs.get(bucket,
+                                                                prefixdir),
+                                     bucket)
+            sharetypes = set()
+            try:
+                filenames = os.listdir(bucketdir)
+            except EnvironmentError:
+                filenames = [] # all of its shares are packed
+            for fn in filenames:
+                if not fn.isdigit():
+                    continue
+                filename = os.path.join(bucketdir, fn)
+                try:
+                    sharetype = get_share_type(filename)
+                    size = os.path.getsize(filename)
+                except EnvironmentError:
+                    continue
+                if sharetype is None:
+                    continue
+                sharetypes.add(sharetype)
+                _add(tally[sharetype], 0, 1, size)
+            if packed:
+                storage_index = si_a2b(bucket)
+                for shnum in packed.get_shnums(storage_index):
+                    (segment, offset, length) = packed.get_location(
+                        storage_index, shnum)
+                    sharetypes.add("immutable")
+                    _add(tally["immutable"], 0, 1, length)
+            for sharetype in sharetypes:
+                _add(tally[sharetype], 1, 0, 0)
+
+    def finished_cycle(self, cycle):
+        BucketCountingCrawler.finished_cycle(self, cycle)
+        if self.counts.recount is self:
+            self.counts.reconcile(self.state["share-tally"])
+            self.state["share-tally"] = None
+
+    def start_slice(self):
+        BucketCountingCrawler.start_slice(self)
+        if self.counts.reconciled and self.timer:
+            # the recount is done, and there is no need for another
+            self.timer.cancel()
+            self.timer = None
+            self.next_wake_time = None
+
+    def get_state(self):
+        state = BucketCountingCrawler.get_state(self)
+        if self.counts.reconciled:
+            state["last-complete-bucket-count"] = \
+                self.counts.get_num_buckets()
+        return state
+
+    def get_progress(self):
+        p = BucketCountingCrawler.get_progress(self)
+        p["counted-live"] = self.counts.reconciled
+        return p
@@ -1,14 +1,23 @@
 
-import os, time, struct
+import os, time, struct, copy
 import cPickle as pickle
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, threads
 from twisted.application import service
+from twisted.python.threadpool import ThreadPool
 from allmydata.storage.common import si_b2a
-from allmydata.util import fileutil
+from allmydata.util import fileutil, log
 
 class TimeSliceExceeded(Exception):
     pass
 
+class ListingPending(Exception):
+    """The crawler has reached a prefixdir which a worker thread is still
+    listing (or a subclass is waiting for some other work on a bucket to be
+    done). The Deferred fires once it is done."""
+    def __init__(self, d):
+        Exception.__init__(self)
+        self.d = d
+
 class ShareCrawler(service.MultiService):
     """A ShareCrawler subclass is attached to a StorageServer, and
     periodically walks all of its shares, processing each one in some
@@ -25,6 +34,27 @@ class ShareCrawler(service.MultiService):
     long enough to ensure that 'minimum_cycle_time' elapses between the start
     of two consecutive cycles.
 
+    If the crawler is given a 'pacer' (a CrawlerPacer), the percentage is
+    instead chosen afresh for each slice, between min_cpu_percentage= (when
+    the server is busy with its clients) and max_cpu_percentage= (when it is
+    idle).
+
+    A server with more than one disk has a copy of each prefixdir on each of
+    them. The crawler lists all copies of a prefixdir at once (in parallel,
+    so the disks are read concurrently), and processes their buckets in a
+    single sorted sequence, so the crawl covers every disk at the same pace.
+
+    Buckets which are held in the server's packed share store (if it has
+    one) are included too, whether or not they also have a directory.
+
+    A share directory may have more than one level of prefix directories
+    (see storage_index_to_dir()). The crawl still goes through the 1024
+    top-level prefixdirs in order, and measures its progress by them:
+    listing one of them lists each of the smaller directories beneath it,
+    and each bucket is processed with whichever of them holds it as its
+    prefixdir. Buckets in the old and the new layout are both found while
+    the share directory is being migrated from one to the other.
+
     We assume that the normal upload/download/get_buckets traffic of a tahoe
     grid will cause the prefixdir contents to be mostly cached in the kernel,
     or that the number of buckets in each prefixdir will be small enough to
@@ -33,11 +63,22 @@ class ShareCrawler(service.MultiService):
     prefix. On this server, each prefixdir took 130ms-200ms to list the first
     time, and 17ms to list the second time.
 
+    When that is not good enough, set listing_threads= to have the next few
+    prefixdirs listed ahead of the crawl, in worker threads, while the
+    buckets of the current one are being processed. max_listings_per_second=
+    limits the I/O that those threads may do. A prefixdir is listed at most
+    'listing_threads' prefixdirs before it is reached, so a bucket added in
+    the meantime may be missed until the next cycle, as it could be when a
+    prefixdir takes more than one slice to process. The process_prefixdir(),
+    process_bucket() and finished_prefix() methods are still called on the
+    reactor thread, one prefixdir at a time and in order, so subclasses are
+    free to use the lease database and self.state from them.
+
     To use a crawler, create a subclass which implements the process_bucket()
-    method. It will be called with a prefixdir and a base32 storage index
-    string. process_bucket() must run synchronously. Any keys added to
-    self.state will be preserved. Override add_initial_state() to set up
-    initial state keys. Override finished_cycle() to perform additional
+    method. It will be called with a prefixdir (on whichever disk holds the
+    bucket) and a base32 storage index string. process_bucket() must run
+    synchronously. Any keys added to self.state will be preserved. Override
+    add_initial_state() to set up initial state keys. Override finished_cycle() to perform additional
     processing when the cycle is complete. Any status that the crawler
     produces should be put in the self.state dictionary. Status renderers
     (like a web page which describes the accomplishments of your crawler)
@@ -55,6 +96,14 @@ class ShareCrawler(service.MultiService):
     middle of a time slice will lose progress: the next time the node is
     started, the crawler will repeat some unknown amount of work.
 
+    Rather than rewriting the whole of self.state every time, the parts of
+    it which have changed since the last checkpoint are appended to a
+    journal (the statefile name plus ".journal"), and replayed on top of the
+    statefile when it is loaded. The statefile is rewritten, and the journal
+    emptied, at the end of each cycle, in stopService(), and whenever the
+    journal has grown larger than both the statefile and
+    'journal_compact_size'.
+
     The crawler instance must be started with startService() before it will
     do any work. To make it stop doing work, call stopService().
     """
@@ -64,6 +113,14 @@ class ShareCrawler(service.MultiService):
     allowed_cpu_percentage = .10 # use up to 10% of the CPU, on average
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
+    # used instead of allowed_cpu_percentage if we have a pacer
+    pacer = None
+    min_cpu_percentage = .01
+    max_cpu_percentage = .50
+    # set these two before the crawler is started
+    listing_threads = 0 # list this many prefixdirs ahead, in worker threads
+    max_listings_per_second = None # no limit
+    journal_compact_size = 64*1024
 
     def __init__(self, server, statefile, allowed_cpu_percentage=None):
         service.MultiService.__init__(self)
@@ -71,18 +128,26 @@ class ShareCrawler(service.MultiService):
             self.allowed_cpu_percentage = allowed_cpu_percentage
         self.server = server
         self.sharedir = server.sharedir
+        self.disks = server.disks
         self.statefile = statefile
+        self.journalfile = statefile + ".journal"
         self.prefixes = [si_b2a(struct.pack(">H", i << (16-10)))[:2]
                          for i in range(2**10)]
         self.prefixes.sort()
         self.timer = None
         self.bucket_cache = (None, [])
+        self.bucket_prefixdirs = {} # for the current prefix
         self.current_sleep_time = None
         self.next_wake_time = None
         self.last_prefix_finished_time = None
         self.last_prefix_elapsed_time = None
         self.last_cycle_started_time = None
         self.last_cycle_elapsed_time = None
+        self.current_cpu_percentage = self.allowed_cpu_percentage
+        self._listings = {} # k: prefix index, v: Deferred or listing
+        self._listing_pool = None # (ThreadPool, shutdown trigger)
+        self._next_listing_time = 0
+        self._waiting_for = None # a pending listing, while we wait for it
         self.load_state()
 
     def minus_or_none(self, a, b):
@@ -121,6 +186,9 @@ class ShareCrawler(service.MultiService):
          remaining-wait-time: float, seconds from now when next crawl starts
          estimated-time-per-cycle: float, seconds required to do a complete
                                    cycle
+
+        In either case, 'cpu-percentage' is the fraction of the time that
+        the crawler chose to work, after its last slice.
         """
 
         d = {}
@@ -153,6 +221,7 @@ class ShareCrawler(service.MultiService):
         elif self.last_prefix_elapsed_time is not None:
             per_cycle = len(self.prefixes) * self.last_prefix_elapsed_time
         d["estimated-time-per-cycle"] = per_cycle
+        d["cpu-percentage"] = self.current_cpu_percentage
         return d
 
     def get_state(self):
@@ -190,10 +259,14 @@ class ShareCrawler(service.MultiService):
         #  ["last-complete-bucket"]: str, base32 storage index bucket name
         #                            of the last bucket to be processed, or
         #                            None if we are sleeping between cycles
+        self._checkpointed = None # self.state as of the last checkpoint
+        self._journal_size = 0
+        self._snapshot_size = 0
         try:
             f = open(self.statefile, "rb")
-            state = pickle.load(f)
+            data = f.read()
             f.close()
+            state = pickle.loads(data)
         except Exception:
             state = {"version": 1,
                      "last-cycle-finished": None,
@@ -201,6 +274,10 @@ class ShareCrawler(service.MultiService):
                      "last-complete-prefix": None,
                      "last-complete-bucket": None,
                      }
+        else:
+            self._snapshot_size = len(data)
+            self._replay_journal(state)
+            self._checkpointed = copy.deepcopy(state)
         state.setdefault("current-cycle-start-time", time.time()) # approximate
         self.state = state
         lcp = state["last-complete-prefix"]
@@ -222,18 +299,73 @@ class ShareCrawler(service.MultiService):
         """
         pass
 
-    def save_state(self):
+    def save_state(self, compact=False):
+        """Checkpoint self.state, by appending whatever has changed since
+        the last checkpoint to the journal. If 'compact' is True, or the
+        journal has grown too large, rewrite the statefile instead."""
         lcpi = self.last_complete_prefix_index
         if lcpi == -1:
             last_complete_prefix = None
         else:
             last_complete_prefix = self.prefixes[lcpi]
         self.state["last-complete-prefix"] = last_complete_prefix
+        if (compact or self._checkpointed is None
+            or self._journal_size > max(self._snapshot_size,
+                                        self.journal_compact_size)):
+            self._write_snapshot()
+        else:
+            self._append_journal()
+
+    def _write_snapshot(self):
+        data = pickle.dumps(self.state)
         tmpfile = self.statefile + ".tmp"
         f = open(tmpfile, "wb")
-        pickle.dump(self.state, f)
+        f.write(data)
         f.close()
+        # if we are killed before the new statefile is in place, the old
+        # one is used without the journal: some work will be repeated, but
+        # the journal is never applied to a statefile it was not written
+        # for
+        fileutil.remove_if_possible(self.journalfile)
         fileutil.move_into_place(tmpfile, self.statefile)
+        self._checkpointed = copy.deepcopy(self.state)
+        self._snapshot_size = len(data)
+        self._journal_size = 0
+
+    def _append_journal(self):
+        ops = []
+        _diff_state(self._checkpointed, self.state, (), ops)
+        if not ops:
+            return
+        data = pickle.dumps(ops, 2)
+        f = open(self.journalfile, "ab")
+        f.write(struct.pack(">L", len(data)) + data)
+        f.close()
+        for op in ops:
+            _apply_op(self._checkpointed, op, copy.deepcopy)
+        self._journal_size += 4 + len(data)
+
+    def _replay_journal(self, state):
+        try:
+            f = open(self.journalfile, "rb")
+        except EnvironmentError:
+            return
+        data = f.read()
+        f.close()
+        offset = 0
+        while offset + 4 <= len(data):
+            (length,) = struct.unpack(">L", data[offset:offset+4])
+            record = data[offset+4:offset+4+length]
+            if len(record) < length:
+                break # we were killed while appending this one
+            try:
+                ops = pickle.loads(record)
+            except Exception:
+                break
+            for op in ops:
+                _apply_op(state, op)
+            offset += 4 + length
+        self._journal_size = offset
 
     def startService(self):
         # arrange things to look like we were just sleeping, so
@@ -248,7 +380,9 @@ class ShareCrawler(service.MultiService):
         if self.timer:
             self.timer.cancel()
             self.timer = None
-        self.save_state()
+        self._waiting_for = None
+        self._stop_listing()
+        self.save_state(compact=True)
         return service.MultiService.stopService(self)
 
     def start_slice(self):
@@ -257,27 +391,23 @@ class ShareCrawler(service.MultiService):
         self.sleeping_between_cycles = False
         self.current_sleep_time = None
         self.next_wake_time = None
+        pending = None
         try:
             self.start_current_prefix(start_slice)
             finished_cycle = True
         except TimeSliceExceeded:
             finished_cycle = False
+        except ListingPending, e:
+            # carry on once we have slept, and the listing has arrived
+            finished_cycle = False
+            pending = e.d
         self.save_state()
         if not self.running:
             # someone might have used stopService() to shut us down
             return
         # either we finished a whole cycle, or we ran out of time
         now = time.time()
-        this_slice = now - start_slice
-        # this_slice/(this_slice+sleep_time) = percentage
-        # this_slice/percentage = this_slice+sleep_time
-        # sleep_time = (this_slice/percentage) - this_slice
-        sleep_time = (this_slice / self.allowed_cpu_percentage) - this_slice
-        # if the math gets weird, or a timequake happens, don't sleep
-        # forever. Note that this means that, while a cycle is running, we
-        # will process at least one bucket every 5 minutes, no matter how
-        # long that bucket takes.
-        sleep_time = max(0.0, min(sleep_time, 299))
+        sleep_time = self.get_sleep_time(now - start_slice)
         if finished_cycle:
             # how long should we sleep between cycles? Don't run faster than
             # allowed_cpu_percentage says, but also run faster than
@@ -289,18 +419,59 @@ class ShareCrawler(service.MultiService):
         self.current_sleep_time = sleep_time # for status page
         self.next_wake_time = now + sleep_time
         self.yielding(sleep_time)
-        self.timer = reactor.callLater(sleep_time, self.start_slice)
+        if pending:
+            self.timer = reactor.callLater(sleep_time, self._wait_for_listing,
+                                           pending)
+        else:
+            self.timer = reactor.callLater(sleep_time, self.start_slice)
+
+    def get_sleep_time(self, this_slice):
+        """Return how long to sleep after a slice which took 'this_slice'
+        seconds. Subclasses which limit something other than the time they
+        spend may override this, but should start with the upcall."""
+        # this_slice/(this_slice+sleep_time) = percentage
+        # this_slice/percentage = this_slice+sleep_time
+        # sleep_time = (this_slice/percentage) - this_slice
+        percentage = self.get_cpu_percentage()
+        self.current_cpu_percentage = percentage # for status page
+        sleep_time = (this_slice / percentage) - this_slice
+        # if the math gets weird, or a timequake happens, don't sleep
+        # forever. Note that this means that, while a cycle is running, we
+        # will process at least one bucket every 5 minutes, no matter how
+        # long that bucket takes.
+        return max(0.0, min(sleep_time, 299))
+
+    def time_slice_exceeded(self, start_slice):
+        """Return True if the slice which started at 'start_slice' should
+        end now. Subclasses may override this to end it sooner."""
+        return time.time() >= start_slice + self.cpu_slice
+
+    def get_cpu_percentage(self):
+        """Return the fraction of the time that I may spend working, until
+        the end of the next slice."""
+        if self.pacer is None:
+            return self.allowed_cpu_percentage
+        return self.pacer.get_cpu_percentage(self.min_cpu_percentage,
+                                             self.max_cpu_percentage)
+
+    def _wait_for_listing(self, d):
+        self.timer = None
+        if d.called:
+            self.start_slice()
+            return
+        self._waiting_for = d
+        def _listed(res):
+            if self._waiting_for is d:
+                self._waiting_for = None
+                if self.running:
+                    self.start_slice()
+            return res
+        d.addBoth(_listed)
 
     def start_current_prefix(self, start_slice):
         state = self.state
         if state["current-cycle"] is None:
-            self.last_cycle_started_time = time.time()
-            state["current-cycle-start-time"] = self.last_cycle_started_time
-            if state["last-cycle-finished"] is None:
-                state["current-cycle"] = 0
-            else:
-                state["current-cycle"] = state["last-cycle-finished"] + 1
-            self.started_cycle(state["current-cycle"])
+            self.begin_cycle()
         cycle = state["current-cycle"]
 
         for i in range(self.last_complete_prefix_index+1, len(self.prefixes)):
@@ -310,12 +481,10 @@ class ShareCrawler(service.MultiService):
             if i == self.bucket_cache[0]:
                 buckets = self.bucket_cache[1]
             else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
+                self._prefetch(i)
+                (buckets, self.bucket_prefixdirs) = self._get_listing(i)
                 self.bucket_cache = (i, buckets)
+            self._prefetch(i+1)
             self.process_prefixdir(cycle, prefix, prefixdir,
                                    buckets, start_slice)
             self.last_complete_prefix_index = i
@@ -327,10 +496,111 @@ class ShareCrawler(service.MultiService):
             self.last_prefix_finished_time = now
 
             self.finished_prefix(cycle, prefix)
-            if time.time() >= start_slice + self.cpu_slice:
+            if self.time_slice_exceeded(start_slice):
                 raise TimeSliceExceeded()
 
         # yay! we finished the whole cycle
+        self.end_cycle(cycle)
+
+    def list_prefix(self, prefix):
+        """Return a sorted list of the buckets in the given prefix, on any
+        disk or in the packed share store, and a dict that maps each bucket
+        which has a directory to the prefix directory which holds it. This
+        may be called from a worker thread."""
+        # (bucket, disk, parentdir) for each bucket on any disk, in order.
+        # The prefix directory of a bucket is whichever directory holds it,
+        # which depends upon the layout of the share directory.
+        listing = self.disks.list_prefix(prefix)
+        prefixdirs = dict([(bucket, parentdir)
+                           for (bucket, disk, parentdir) in listing])
+        buckets = sorted(prefixdirs)
+        if self.server.packed:
+            # buckets whose shares are all packed have no directory
+            packed = self.server.packed.list_buckets(prefix)
+            buckets = sorted(set(buckets).union(packed))
+        return (buckets, prefixdirs)
+
+    def _get_listing(self, i):
+        listing = self._listings.get(i)
+        if isinstance(listing, defer.Deferred):
+            raise ListingPending(listing)
+        self._listings.pop(i, None)
+        if listing is None:
+            # it was not listed ahead of time
+            listing = self.list_prefix(self.prefixes[i])
+        return listing
+
+    def _prefetch(self, first):
+        # start listing the 'listing_threads' prefixes from 'first' onwards
+        # which are not already listed (or being listed), as far as the I/O
+        # budget allows
+        if not self.listing_threads:
+            return
+        last = min(first + self.listing_threads, len(self.prefixes))
+        for i in range(first, last):
+            if i in self._listings:
+                continue
+            if self.max_listings_per_second:
+                now = time.time()
+                if now < self._next_listing_time:
+                    return
+                self._next_listing_time = (max(now, self._next_listing_time)
+                                           + 1.0/self.max_listings_per_second)
+            d = threads.deferToThreadPool(reactor, self._get_listing_pool(),
+                                          self.list_prefix, self.prefixes[i])
+            self._listings[i] = d
+            d.addCallbacks(self._listed, self._listing_failed,
+                           callbackArgs=(i, d), errbackArgs=(i, d))
+
+    def _listed(self, listing, i, d):
+        if self._listings.get(i) is d:
+            self._listings[i] = listing
+
+    def _listing_failed(self, f, i, d):
+        log.err(f, "crawler could not list prefix %s" % (self.prefixes[i],),
+                facility="tahoe.storage", level=log.UNUSUAL)
+        # try again when the crawl reaches it
+        if self._listings.get(i) is d:
+            del self._listings[i]
+
+    def _get_listing_pool(self):
+        if self._listing_pool is None:
+            pool = ThreadPool(0, self.listing_threads,
+                              name="crawler %s" % (self.__class__.__name__,))
+            pool.start()
+            # don't let our threads keep the process alive after the reactor
+            # has stopped
+            trigger = reactor.addSystemEventTrigger("during", "shutdown",
+                                                    pool.stop)
+            self._listing_pool = (pool, trigger)
+        return self._listing_pool[0]
+
+    def _stop_listing(self):
+        self._listings.clear()
+        if self._listing_pool is not None:
+            (pool, trigger) = self._listing_pool
+            reactor.removeSystemEventTrigger(trigger)
+            pool.stop()
+            self._listing_pool = None
+
+    def begin_cycle(self):
+        """Start a new cycle: record its start time, assign it a cycle number,
+        and call started_cycle(). This is used by start_current_prefix(), and
+        by subclasses which override it to walk something other than the
+        prefix directories."""
+        state = self.state
+        self.last_cycle_started_time = time.time()
+        state["current-cycle-start-time"] = self.last_cycle_started_time
+        if state["last-cycle-finished"] is None:
+            state["current-cycle"] = 0
+        else:
+            state["current-cycle"] = state["last-cycle-finished"] + 1
+        self.started_cycle(state["current-cycle"])
+
+    def end_cycle(self, cycle):
+        """Record that 'cycle' is complete, call finished_cycle(), and save
+        our state."""
+        state = self.state
         self.last_complete_prefix_index = -1
         self.last_prefix_finished_time = None # don't include the sleep
         now = time.time()
@@ -339,12 +609,16 @@ class ShareCrawler(service.MultiService):
         state["last-complete-bucket"] = None
         state["last-cycle-finished"] = cycle
         state["current-cycle"] = None
+        self._listings.clear()
         self.finished_cycle(cycle)
-        self.save_state()
+        self.save_state(compact=True)
 
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         """This gets a list of bucket names (i.e. storage index strings,
-        base32-encoded) in sorted order.
+        base32-encoded) in sorted order. 'prefixdir' is the prefix directory
+        on the first disk: the buckets may be on any disk, or further down
+        the tree, and self.bucket_prefixdirs maps each of them to the
+        directory which holds it.
 
         You can override this if your crawler doesn't care about the actual
         shares, for example a crawler which merely keeps track of how many
@@ -357,9 +631,11 @@ class ShareCrawler(service.MultiService):
         for bucket in buckets:
             if bucket <= self.state["last-complete-bucket"]:
                 continue
-            self.process_bucket(cycle, prefix, prefixdir, bucket)
+            self.process_bucket(cycle, prefix,
+                                self.bucket_prefixdirs.get(bucket, prefixdir),
+                                bucket)
             self.state["last-complete-bucket"] = bucket
-            if time.time() >= start_slice + self.cpu_slice:
+            if self.time_slice_exceeded(start_slice):
                 raise TimeSliceExceeded()
 
     # the remaining methods are explictly for subclasses to implement.
@@ -486,3 +762,30 @@ class BucketCountingCrawler(ShareCrawler):
             if old_cycle != cycle:
                 del self.state["storage-index-samples"][prefix]
 
+
+def _diff_state(old, new, path, ops):
+    # append to 'ops' the changes that turn 'old' into 'new', going into
+    # dictionaries so that a small change to a large one stays small
+    for (key, value) in new.iteritems():
+        if key in old:
+            oldvalue = old[key]
+            if isinstance(value, dict) and isinstance(oldvalue, dict):
+                _diff_state(oldvalue, value, path + (key,), ops)
+                continue
+            if type(oldvalue) is type(value) and oldvalue == value:
+                continue
+        ops.append((path + (key,), value))
+    for key in old:
+        if key not in new:
+            ops.append((path + (key,),)) # i.e. delete it
+
+def _apply_op(state, op, copier=None):
+    path = op[0]
+    for key in path[:-1]:
+        state = state.setdefault(key, {})
+    if len(op) == 1:
+        state.pop(path[-1], None)
+    elif copier:
+        state[path[-1]] = copier(op[1])
+    else:
+        state[path[-1]] = op[1]
@@ -0,0 +1,266 @@
+import os, time
+from collections import deque
+
+from twisted.application import service
+from twisted.internet import defer, reactor, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from allmydata.storage.scheduler import FIFOScheduler, Request, \
+     RequesterStats, BACKGROUND
+
+
+def _identity(res):
+    return res
+
+
+class SynchronousDiskIO:
+    """I perform share-file I/O directly, on the reactor thread. This is the
+    default, and is what BucketWriters and BucketReaders that were not given
+    a disk-I/O engine will use."""
+
+    def run(self, bucketdir, f, args=(), then=_identity):
+        """Call f(*args), which is expected to block on disk I/O for the
+        bucket in 'bucketdir', then pass its result to then(). Return the
+        result of then(). 'args' may also be a function that returns the
+        argument tuple, see ThreadedDiskIO.run()."""
+        if callable(args):
+            args = args()
+        return then(f(*args))
+
+    def gather(self, results, then=_identity):
+        """Pass a list of the results of earlier run() calls to then(), and
+        return what it returns."""
+        return then(results)
+
+    def get_requester_stats(self):
+        # requests never wait, so there is nothing to report
+        return []
+
+    def forget_requester(self, requester):
+        pass
+
+    def get_queue_depth(self, disk_root=None):
+        return 0
+
+SYNCHRONOUS = SynchronousDiskIO()
+
+
+class ThreadedDiskIO(service.Service):
+    """I perform share-file I/O in worker threads, so that a slow disk does
+    not stall the reactor (and with it every other client of this server).
+
+    Each disk gets its own bounded pool of 'threads_per_disk' threads. A
+    disk is identified by one of the 'disk_roots' directories: an operation
+    is sent to the pool of the root that holds its bucket directory.
+    Operations on the same bucket are run one at a time, in the order they
+    were submitted, so the order of writes (and reads-after-writes) to any
+    given share is preserved. Operations on different buckets may run
+    concurrently.
+
+    f() runs in a worker thread and must not touch any state that is shared
+    with the reactor (the lease database, the share inventory, stats). The
+    then() callback runs on the reactor thread once f() has finished, and
+    before the next operation on the same bucket is started, and is where
+    that sort of bookkeeping belongs.
+
+    Two samples are added to the server's latencies for each operation:
+    'io-queue-depth' is the number of operations outstanding (queued or
+    running) when it was submitted, and 'io-wait' is the number of seconds
+    it waited before a worker started on it.
+
+    When all of a disk's threads are busy, the operations that are next in
+    line for their buckets wait in a scheduler (one per disk, made by
+    calling 'scheduler'), which decides which of them gets the next free
+    thread: see storage/scheduler.py. Each operation is made on behalf of
+    the Requester in the server's 'current_request' when it is submitted
+    (or, if there is none, one of the server's crawlers), and I keep
+    statistics for each of them until forget_requester() is called.
+    """
+
+    def __init__(self, server, disk_roots, threads_per_disk,
+                 scheduler=FIFOScheduler):
+        assert threads_per_disk > 0, threads_per_disk
+        self._server = server
+        self._disk_roots = sorted([os.path.join(os.path.abspath(root), "")
+                                   for root in disk_roots],
+                                  key=len, reverse=True)
+        self.threads_per_disk = threads_per_disk
+        self._pools = {} # k: disk root, v: (ThreadPool, shutdown trigger)
+        self._buckets = {} # k: bucketdir, v: deque of ops waiting their turn
+        self._outstanding = 0
+        self._outstanding_by_root = {} # k: disk root, v: count
+        self._make_scheduler = scheduler
+        self._schedulers = {} # k: disk root, v: scheduler
+        self._running_by_root = {} # k: disk root, v: count
+        self._requesters = {} # k: Requester, v: RequesterStats
+
+    def _get_root(self, path):
+        path = os.path.join(os.path.abspath(path), "")
+        for root in self._disk_roots:
+            if path.startswith(root):
+                return root
+        return ""
+
+    def _get_pool(self, bucketdir):
+        root = self._get_root(bucketdir)
+        if root not in self._pools:
+            pool = ThreadPool(0, self.threads_per_disk,
+                              name="storage-io %s" % (root,))
+            pool.start()
+            # like the reactor's own thread pool, make sure that our threads
+            # cannot keep the process alive once the reactor has stopped
+            trigger = reactor.addSystemEventTrigger("during", "shutdown",
+                                                    pool.stop)
+            self._pools[root] = (pool, trigger)
+        return self._pools[root][0]
+
+    def stopService(self):
+        for (pool, trigger) in self._pools.values():
+            reactor.removeSystemEventTrigger(trigger)
+            pool.stop()
+        self._pools.clear()
+        return service.Service.stopService(self)
+
+    def get_queue_depth(self, disk_root=None):
+        """Return the number of operations that are queued or running, on
+        all disks or just the one with the given root directory."""
+        if disk_root is None:
+            return self._outstanding
+        return self._outstanding_by_root.get(self._get_root(disk_root), 0)
+
+    def run(self, bucketdir, f, args=(), then=_identity):
+        """Arrange for f(*args) to be called in a worker thread, after any
+        operations on 'bucketdir' that were submitted earlier have finished,
+        then pass its result to then() on the reactor thread. Return a
+        Deferred that fires with the result of then().
+
+        If the arguments depend upon state that earlier operations on the
+        bucket will change (like the list of shares in the inventory),
+        'args' should instead be a function which returns the argument
+        tuple: it will be called on the reactor thread just before f() is
+        started."""
+        self._server.add_latency("io-queue-depth", self._outstanding)
+        self._outstanding += 1
+        root = self._get_root(bucketdir)
+        self._outstanding_by_root[root] = \
+            self._outstanding_by_root.get(root, 0) + 1
+        (requester, category) = (self._server.current_request
+                                 or (BACKGROUND, "other"))
+        stats = self._get_requester_stats(requester)
+        stats.requests[category] = stats.requests.get(category, 0) + 1
+        op = (f, args, Request(requester, category, time.time(), None))
+        d = defer.Deferred()
+        if bucketdir in self._buckets:
+            self._buckets[bucketdir].append((op, d))
+        else:
+            self._buckets[bucketdir] = deque()
+            self._start(bucketdir, op, d)
+        d.addCallback(then)
+        return d
+
+    def gather(self, results, then=_identity):
+        """Take a list of the Deferreds returned by earlier run() calls, and
+        return a Deferred that fires with the result of calling then() with
+        a list of their results, once they have all fired. If any of them
+        fails, the returned Deferred fails in the same way."""
+        d = defer.gatherResults(results, consumeErrors=True)
+        def _unwrap(f):
+            f.trap(defer.FirstError)
+            return f.value.subFailure
+        d.addCallbacks(then, _unwrap)
+        return d
+
+    def _get_requester_stats(self, requester):
+        stats = self._requesters.get(requester)
+        if stats is None:
+            stats = self._requesters[requester] = RequesterStats(requester)
+        return stats
+
+    def forget_requester(self, requester):
+        """Stop keeping statistics for 'requester', whose sessions have all
+        been closed, once nothing is queued or running on its behalf."""
+        stats = self._requesters.get(requester)
+        if stats is None:
+            return
+        stats.forgotten = True
+        self._maybe_forget(requester, stats)
+
+    def _maybe_forget(self, requester, stats):
+        if stats.forgotten and not (stats.queued or stats.running):
+            del self._requesters[requester]
+
+    def get_requester_stats(self):
+        """Return a list of dicts, one for each requester that has made a
+        request, with the number of its requests that are queued, running
+        and completed, their mean wait for a thread, and how many of each
+        category of request it has made."""
+        return [stats.get_stats() for stats in self._requesters.values()]
+
+    def _start(self, bucketdir, op, d):
+        # the operation is next in line for its bucket: it waits for a
+        # thread in the scheduler for its disk
+        (f, args, request) = op
+        request.op = (bucketdir, f, args, d)
+        root = self._get_root(bucketdir)
+        if root not in self._schedulers:
+            self._schedulers[root] = self._make_scheduler()
+        self._schedulers[root].add(request)
+        self._get_requester_stats(request.requester).queued += 1
+        self._dispatch(root)
+
+    def _dispatch(self, root):
+        scheduler = self._schedulers[root]
+        while self._running_by_root.get(root, 0) < self.threads_per_disk:
+            request = scheduler.pop()
+            if request is None:
+                return
+            (bucketdir, f, args, d) = request.op
+            stats = self._get_requester_stats(request.requester)
+            stats.queued -= 1
+            stats.running += 1
+            if request.demoted:
+                stats.demoted += 1
+            self._running_by_root[root] = \
+                self._running_by_root.get(root, 0) + 1
+            if callable(args):
+                try:
+                    args = args()
+                except:
+                    self._finished(Failure(), request)
+                    continue
+            d2 = threads.deferToThreadPool(reactor, self._get_pool(bucketdir),
+                                           self._call, f, args,
+                                           request.submitted)
+            d2.addBoth(self._finished, request)
+
+    def _call(self, f, args, submitted):
+        # this runs in a worker thread
+        wait = time.time() - submitted
+        return (wait, f(*args))
+
+    def _finished(self, res, request):
+        (bucketdir, f, args, d) = request.op
+        root = self._get_root(bucketdir)
+        self._outstanding -= 1
+        self._outstanding_by_root[root] -= 1
+        self._running_by_root[root] -= 1
+        stats = self._get_requester_stats(request.requester)
+        stats.running -= 1
+        stats.completed += 1
+        # let then() do its bookkeeping before anything else touches the
+        # bucket
+        if isinstance(res, Failure):
+            d.errback(res)
+        else:
+            (wait, result) = res
+            self._server.add_latency("io-wait", wait)
+            stats.total_wait += wait
+            d.callback(result)
+        self._maybe_forget(request.requester, stats)
+        waiting = self._buckets[bucketdir]
+        if waiting:
+            self._start(bucketdir, *waiting.popleft())
+        else:
+            del self._buckets[bucketdir]
+        self._dispatch(root)
@@ -0,0 +1,224 @@
+import os, threading
+
+from allmydata.storage.common import si_a2b, storage_index_to_dir, \
+     list_buckets, SHARE_DIR_LEVELS
+from allmydata.util import fileutil
+
+
+class ShareDisk:
+    """I am one of a storage server's share directories. Each is expected
+    to be on a filesystem (usually a disk) of its own, and keeps its own
+    'reserved_space' free. Shares are uploaded into my 'incomingdir', and
+    moved into my 'sharedir' once they are complete, so that both are on
+    the same filesystem."""
+
+    def __init__(self, number, sharedir, reserved_space):
+        self.number = number
+        self.sharedir = sharedir
+        self.incomingdir = os.path.join(sharedir, "incoming")
+        self.reserved_space = reserved_space
+        self.num_buckets = 0 # only counted when there is more than one disk
+        fileutil.make_dirs(sharedir)
+
+    def __repr__(self):
+        return "<ShareDisk %d %s>" % (self.number, self.sharedir)
+
+    def get_available_space(self):
+        return fileutil.get_available_space(self.sharedir,
+                                            self.reserved_space)
+
+    def get_disk_stats(self):
+        return fileutil.get_disk_stats(self.sharedir, self.reserved_space)
+
+    def list_prefix(self, prefix):
+        # returns a list of (bucket name, parent directory)
+        return list_buckets(os.path.join(self.sharedir, prefix))
+
+
+def _call_in_parallel(calls):
+    # run each of the functions in 'calls' in a thread of its own, and
+    # return their results. Disk-bound calls (like listing a directory) on
+    # different disks can then overlap.
+    results = [None] * len(calls)
+    def _run(i):
+        results[i] = calls[i]()
+    threads = [threading.Thread(target=_run, args=(i,))
+               for i in range(1, len(calls))]
+    for t in threads:
+        t.start()
+    if calls:
+        _run(0)
+    for t in threads:
+        t.join()
+    return results
+
+
+class DiskSet:
+    """I hold the share directories of a StorageServer, one per disk.
+
+    Each bucket (all of the shares of a storage index) lives on a single
+    disk. When there is more than one disk, I keep an index of which disk
+    holds each bucket, built by listing the prefix directories of every
+    disk at startup, so that finding a bucket never has to probe them all.
+    New buckets are placed on the disk with the best ratio of available
+    space to load (see choose_disk()). The index costs roughly 100 bytes
+    of memory per bucket.
+
+    Buckets placed in (or removed from) the share directories by other
+    processes while the server is running are not noticed until the next
+    restart, except that the first disk is assumed to hold any bucket that
+    is not in the index.
+
+    Every disk lays out its bucket directories under 'levels' levels of
+    prefix directories (see storage_index_to_dir()). While 'migrating' is
+    True, buckets may also be found in any of the other layouts, because
+    they have not been moved into this one yet.
+    """
+
+    def __init__(self, sharedirs, reserved_space=0, levels=1):
+        assert sharedirs
+        assert levels in SHARE_DIR_LEVELS, levels
+        self.levels = levels
+        self.migrating = False
+        self.disks = [ShareDisk(i, sharedir, reserved_space)
+                      for (i, sharedir) in enumerate(sharedirs)]
+        self._index = None # k: storage index, v: ShareDisk
+        if len(self.disks) > 1:
+            self._build_index()
+
+    def _build_index(self):
+        self._index = {}
+        prefixes = set()
+        for disk in self.disks:
+            prefixes.update([prefix for prefix in os.listdir(disk.sharedir)
+                             if prefix != "incoming"])
+        for prefix in sorted(prefixes):
+            for (bucket, disk, parentdir) in self.list_prefix(prefix):
+                try:
+                    storage_index = si_a2b(bucket)
+                except AssertionError:
+                    continue # not a bucket directory
+                self.add_bucket(storage_index, disk)
+
+    def __len__(self):
+        return len(self.disks)
+
+    def __iter__(self):
+        return iter(self.disks)
+
+    def __getitem__(self, i):
+        return self.disks[i]
+
+    def list_prefix(self, prefix):
+        """Return a sorted list of (bucket name, ShareDisk, parent directory)
+        for all of the buckets under the given top-level prefix directory,
+        on every disk. The disks are listed in parallel. While a migration
+        is in progress, a bucket may be listed twice, once in each layout."""
+        if len(self.disks) == 1:
+            disk = self.disks[0]
+            return sorted([(bucket, disk, parentdir)
+                           for (bucket, parentdir)
+                           in disk.list_prefix(prefix)])
+        listings = _call_in_parallel([lambda d=d: d.list_prefix(prefix)
+                                      for d in self.disks])
+        buckets = []
+        for (disk, listing) in zip(self.disks, listings):
+            buckets.extend([(bucket, disk, parentdir)
+                            for (bucket, parentdir) in listing])
+        buckets.sort()
+        return buckets
+
+    def find_disk(self, storage_index):
+        """Return the ShareDisk that holds (or should hold) the bucket for
+        this storage index, or None if it is not in the index. This may be
+        called from a disk I/O thread."""
+        if self._index is None:
+            return self.disks[0]
+        return self._index.get(storage_index)
+
+    def get_bucketdir(self, storage_index):
+        """Return the directory in which the bucket for this storage index
+        belongs, in the current layout. This is also the name under which
+        disk I/O for the bucket is ordered, wherever the bucket really is."""
+        disk = self.find_disk(storage_index) or self.disks[0]
+        return os.path.join(disk.sharedir,
+                            storage_index_to_dir(storage_index, self.levels))
+
+    def get_bucketdirs(self, storage_index):
+        """Return a list of the directories in which the bucket for this
+        storage index might be found, starting with get_bucketdir(). This
+        may be called from a disk I/O thread."""
+        bucketdir = self.get_bucketdir(storage_index)
+        if not self.migrating:
+            return [bucketdir]
+        disk = self.find_disk(storage_index) or self.disks[0]
+        return [bucketdir] + [os.path.join(disk.sharedir,
+                                           storage_index_to_dir(storage_index,
+                                                                levels))
+                              for levels in SHARE_DIR_LEVELS
+                              if levels != self.levels]
+
+    def add_bucket(self, storage_index, disk):
+        if self._index is None or storage_index in self._index:
+            return
+        self._index[storage_index] = disk
+        disk.num_buckets += 1
+
+    def remove_bucket(self, storage_index):
+        # called once the last share of a bucket has gone away
+        if self._index is None:
+            return
+        disk = self._index.pop(storage_index, None)
+        if disk:
+            disk.num_buckets -= 1
+
+    def choose_disk(self, storage_index, size, available, load):
+        """Return the disk on which a new share of 'size' bytes for this
+        storage index should be written, or None if there is no room for it.
+        A bucket that already exists keeps all of its shares on one disk.
+        Otherwise, of the disks with enough room, the one with the most
+        available space per unit of load is chosen. 'available(disk)' is
+        the space left on the disk once the uploads which are still in
+        progress are finished (or None if that cannot be told), and
+        'load(disk)' is a measure of how busy the disk is."""
+        disk = self.find_disk(storage_index)
+        if disk:
+            candidates = [disk]
+        else:
+            candidates = self.disks
+        best = None
+        for disk in candidates:
+            space = available(disk)
+            if space is None:
+                # no way to tell, so assume that there is plenty of room
+                score = 2**64
+            else:
+                if space < size:
+                    continue
+                score = space
+            score = float(score) / (1 + load(disk))
+            if best is None or score > best[0]:
+                best = (score, disk)
+        if best is None:
+            return None
+        return best[1]
+
+    def get_available_space(self):
+        """Return the total space available on all of my disks (each less
+        its reserved space), or None if that cannot be found out."""
+        total = 0
+        for disk in self.disks:
+            available = disk.get_available_space()
+            if available is None:
+                return None
+            total += available
+        return total
+
+    def get_disk_stats(self):
+        """Return the sum of fileutil.get_disk_stats() over all of my
+        disks."""
+        totals = {}
+        for disk in self.disks:
+            for (k, v) in disk.get_disk_stats().items():
+                totals[k] = totals.get(k, 0) + v
+        return totals
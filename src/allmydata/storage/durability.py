@@ -0,0 +1,205 @@
+import os, sys, time, errno
+
+from twisted.internet import defer, threads, reactor
+from twisted.application import service
+from twisted.python.threadpool import ThreadPool
+
+from allmydata.util import log
+
+DURABILITY_MODES = ("none", "fsync", "group")
+
+
+def dirs_to_sync(dirname):
+    """Return the directories that must be synced to make a new entry in
+    'dirname' durable: 'dirname' itself, and the parent of each directory
+    on the way to it that does not exist yet. Call this before making
+    'dirname'."""
+    dirs = [dirname]
+    while not os.path.isdir(dirname):
+        parent = os.path.dirname(dirname)
+        if parent == dirname:
+            break
+        dirname = parent
+        dirs.append(dirname)
+    return dirs
+
+def fsync_paths(files, dirs):
+    """fsync() each of 'files', then each of 'dirs' (so that the entries
+    for new, renamed or deleted files are written too). Anything that has
+    been deleted in the meantime has nothing left to write, and is
+    skipped."""
+    paths = [(f, os.O_RDONLY) for f in files]
+    if sys.platform != "win32":
+        # Windows cannot open a directory, and updates its entries as part
+        # of the file operations themselves
+        paths += [(d, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+                  for d in dirs]
+    for (path, flags) in paths:
+        try:
+            fd = os.open(path, flags)
+        except EnvironmentError, e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class NoDurability:
+    """Share writes are acknowledged as soon as they have been handed to the
+    operating system, which writes them to disk whenever it likes. This is
+    how the server has always behaved: a crash of the machine (rather than
+    of the server) can lose shares that clients were told were stored."""
+
+    mode = "none"
+
+    def sync(self, bucketdir, files, dirs):
+        """Make 'files' and the entries in 'dirs' durable, and return a
+        Deferred that fires when they are, or None if there is nothing to
+        wait for. 'bucketdir' is the bucket that they belong to."""
+        return None
+
+NO_DURABILITY = NoDurability()
+
+
+class FsyncDurability:
+    """Each closed share (and each mutable-share write) is synced to disk on
+    its own, through the server's disk I/O engine, before it is
+    acknowledged. The time this takes is added to the server's 'commit'
+    latencies."""
+
+    mode = "fsync"
+
+    def __init__(self, server):
+        self._server = server
+
+    def sync(self, bucketdir, files, dirs):
+        start = time.time()
+        def _synced(res):
+            self._server.add_latency("commit", time.time() - start)
+        return defer.maybeDeferred(self._server.disk_io.run, bucketdir,
+                                   fsync_paths, (files, dirs), _synced)
+
+
+class GroupCommitter(service.Service):
+    """I make share writes durable in batches. A sync() starts a batch that
+    collects every other sync() made in the next 'window' seconds (or until
+    it holds 'max_batch' of them), and then a worker thread syncs each of
+    their files and directories once, however many of them asked for it.
+    While one batch is being synced, the next one collects. This trades a
+    few milliseconds of latency on each acknowledgement for far fewer
+    fsync() calls when many shares are being written at once.
+
+    The time from each sync() to its batch being on disk is added to the
+    server's 'commit' latencies, and the number of syncs in each batch to
+    its 'commit-batch' samples."""
+
+    name = "group-committer"
+    mode = "group"
+    window = 0.005
+    max_batch = 1000
+
+    def __init__(self, server, window=None):
+        if window is not None:
+            self.window = window
+        self._server = server
+        self._pending = [] # (files, dirs, Deferred, start time)
+        self._timer = None
+        self._flushing = None # Deferred for the batch being synced
+        self._pool = ThreadPool(0, 1, name="group-commit")
+        self._trigger = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self._pool.start()
+        # like ThreadedDiskIO, don't let our thread keep the process alive
+        # once the reactor has stopped
+        self._trigger = reactor.addSystemEventTrigger("during", "shutdown",
+                                                      self._pool.stop)
+
+    def stopService(self):
+        # whatever is waiting is synced before we go, and from now on each
+        # sync() is made at once
+        service.Service.stopService(self)
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        d = defer.succeed(None)
+        if self._flushing:
+            d = self._when_flushed()
+        d.addCallback(lambda ign: self._pending and self._flush())
+        def _stop_pool(res):
+            reactor.removeSystemEventTrigger(self._trigger)
+            self._pool.stop()
+            return res
+        d.addBoth(_stop_pool)
+        return d
+
+    def _when_flushed(self):
+        d = defer.Deferred()
+        self._flushing.addBoth(lambda res: (d.callback(None), res)[1])
+        return d
+
+    def sync(self, bucketdir, files, dirs):
+        if not files and not dirs:
+            return None
+        if not self.running:
+            fsync_paths(files, dirs)
+            return None
+        d = defer.Deferred()
+        self._pending.append((files, dirs, d, time.time()))
+        if self._flushing:
+            pass # the next batch starts when this one is done
+        elif len(self._pending) >= self.max_batch:
+            self._flush()
+        elif not self._timer:
+            self._timer = reactor.callLater(self.window, self._flush)
+        return d
+
+    def _flush(self):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        batch = self._pending
+        self._pending = []
+        # each file and directory is synced once, in the order that they
+        # were asked for
+        files = []
+        dirs = []
+        seen = set()
+        for (these_files, these_dirs, d, start) in batch:
+            for (paths, path_list) in [(these_files, files),
+                                       (these_dirs, dirs)]:
+                for path in paths:
+                    if path not in seen:
+                        seen.add(path)
+                        path_list.append(path)
+        self._server.add_latency("commit-batch", len(batch))
+        self._flushing = threads.deferToThreadPool(reactor, self._pool,
+                                                   fsync_paths, files, dirs)
+        def _done(res):
+            self._flushing = None
+            now = time.time()
+            for (these_files, these_dirs, d, start) in batch:
+                self._server.add_latency("commit", now - start)
+                d.callback(None)
+            self._next_batch()
+        def _failed(f):
+            self._flushing = None
+            log.err(f, "group commit failed", facility="tahoe.storage",
+                    level=log.UNUSUAL, umid="Xs0L2g")
+            for (these_files, these_dirs, d, start) in batch:
+                d.errback(f)
+            self._next_batch()
+        self._flushing.addCallbacks(_done, _failed)
+        return self._flushing
+
+    def _next_batch(self):
+        if not self._pending or not self.running:
+            return # stopService() takes care of the rest
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif not self._timer:
+            self._timer = reactor.callLater(self.window, self._flush)
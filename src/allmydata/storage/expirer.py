@@ -1,8 +1,10 @@
 import time, os, pickle, struct
-from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
 from allmydata.storage.shares import get_share_file
+from allmydata.storage.packed import PackedShare
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     UnknownImmutableContainerVersionError
+     UnknownImmutableContainerVersionError, si_a2b
+from allmydata.util.hashutil import timing_safe_compare
 from twisted.python import log as twlog
 
 class LeaseCheckingCrawler(ShareCrawler):
@@ -114,11 +116,17 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
         bucketdir = os.path.join(prefixdir, storage_index_b32)
-        s = self.stat(bucketdir)
+        try:
+            s = self.stat(bucketdir)
+            filenames = os.listdir(bucketdir)
+        except OSError:
+            # all of the bucket's shares are packed
+            s = None
+            filenames = []
         would_keep_shares = []
         wks = None
 
-        for fn in os.listdir(bucketdir):
+        for fn in filenames:
             try:
                 shnum = int(fn)
             except ValueError:
@@ -133,9 +141,24 @@ class LeaseCheckingCrawler(ShareCrawler):
                 twlog.err()
                 which = (storage_index_b32, shnum)
                 self.state["cycle-to-date"]["corrupt-shares"].append(which)
-                wks = (1, 1, 1, "unknown")
+                wks = (1, 1, 1, "unknown", 0)
+            if not wks[2]:
+                # the last lease was cancelled, so the share was deleted
+                self.server.share_deleted(si_a2b(storage_index_b32), shnum,
+                                          wks[3], wks[4])
             would_keep_shares.append(wks)
 
+        packed = self.server.packed
+        if packed:
+            storage_index = si_a2b(storage_index_b32)
+            for shnum in packed.get_shnums(storage_index):
+                sf = PackedShare(packed, storage_index, shnum)
+                wks = self.process_share_leases(sf, sf.stat())
+                if not wks[2]:
+                    self.server.share_deleted(storage_index, shnum,
+                                              wks[3], wks[4])
+                would_keep_shares.append(wks)
+
         sharetype = None
         if wks:
             # use the last share's sharetype as the buckettype
@@ -148,7 +171,9 @@ class LeaseCheckingCrawler(ShareCrawler):
         try:
             bucket_diskbytes = s.st_blocks * 512
         except AttributeError:
-            bucket_diskbytes = 0 # no stat().st_blocks on windows
+            # no stat().st_blocks on windows, and no directory for a bucket
+            # of packed shares
+            bucket_diskbytes = 0
         if sum([wks[0] for wks in would_keep_shares]) == 0:
             self.increment_bucketspace("original", bucket_diskbytes, sharetype)
         if sum([wks[1] for wks in would_keep_shares]) == 0:
@@ -158,10 +183,14 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     def process_share(self, sharefilename):
         # first, find out what kind of a share it is
-        sf = get_share_file(sharefilename)
+        sf = get_share_file(sharefilename, self.server.file_cache)
+        return self.process_share_leases(sf, self.stat(sharefilename))
+
+    def process_share_leases(self, sf, s):
+        # 's' is the os.stat() of the share, taken before any of its leases
+        # are cancelled
         sharetype = sf.sharetype
         now = time.time()
-        s = self.stat(sharefilename)
 
         num_leases = 0
         num_valid_leases_original = 0
@@ -203,7 +232,8 @@ class LeaseCheckingCrawler(ShareCrawler):
         self.increment(so_far["leases-per-share-histogram"], num_leases, 1)
         self.increment_space("examined", s, sharetype)
 
-        would_keep_share = [1, 1, 1, sharetype]
+        # the last item is the size of the share, in case it is deleted
+        would_keep_share = [1, 1, 1, sharetype, s.st_size]
 
         if self.expiration_enabled:
             for li in expired_leases_configured:
@@ -422,3 +452,166 @@ class LeaseCheckingCrawler(ShareCrawler):
         state["estimated-remaining-cycle"] = remaining
         state["estimated-current-cycle"] = cycle
         return state
+
+
+class IndexedLeaseCheckingCrawler(LeaseCheckingCrawler):
+    """I am a LeaseCheckingCrawler for servers which keep a LeaseDB. Rather
+    than opening every share on disk, each cycle walks the database's
+    expiration-time index over just the leases which have expired under the
+    configured policy.
+
+    Before cancelling a lease, I re-read the share file's own lease records:
+    if the share holds a newer expiration time for that lease than the
+    database does (which can happen if the node was run without the leasedb
+    for a while), the database is corrected and the lease is kept.
+
+    Since unexpired leases are never looked at, the lease-age and
+    leases-per-share histograms are not collected, the 'original-' space
+    estimates are not computed, and the 'examined-' totals are taken from
+    the database rather than from the shares themselves.
+    """
+
+    minimum_cycle_time = 60*60 # index queries are cheap: once per hour
+    batch_size = 100 # leases fetched per query
+
+    def add_initial_state(self):
+        LeaseCheckingCrawler.add_initial_state(self)
+        # ["last-expired-lease"]: (expiration_time, rowid) of the last lease
+        #                         processed in this cycle, or None
+        self.state.setdefault("last-expired-lease", None)
+
+    def started_cycle(self, cycle):
+        LeaseCheckingCrawler.started_cycle(self, cycle)
+        self.state["last-expired-lease"] = None
+        rec = self.state["cycle-to-date"]["space-recovered"]
+        counts = self.server.leasedb.get_share_counts()
+        for sharetype, (buckets, shares) in counts.items():
+            self.increment(rec, "examined-buckets", buckets)
+            self.increment(rec, "examined-buckets-"+sharetype, buckets)
+            self.increment(rec, "examined-shares", shares)
+            self.increment(rec, "examined-shares-"+sharetype, shares)
+
+    def get_expiration_cutoff(self, now):
+        """Return the expiration time before which a lease is considered to
+        have expired, according to our configured policy."""
+        if self.mode == "age":
+            if self.override_lease_duration is None:
+                return now
+            # the grant/renew time of a lease is 31 days before its
+            # expiration time (see LeaseInfo.get_grant_renew_time_time)
+            return now - self.override_lease_duration + 31*24*60*60
+        assert self.mode == "cutoff-date"
+        return self.cutoff_date + 31*24*60*60
+
+    def start_current_prefix(self, start_slice):
+        if self.state["current-cycle"] is None:
+            self.begin_cycle()
+        cycle = self.state["current-cycle"]
+        leasedb = self.server.leasedb
+        cutoff = self.get_expiration_cutoff(time.time())
+
+        while True:
+            leases = leasedb.get_expired_leases(cutoff,
+                                                self.sharetypes_to_expire,
+                                                self.state["last-expired-lease"],
+                                                self.batch_size)
+            if not leases:
+                break
+            for lease in leases:
+                self.process_expired_lease(lease, cutoff)
+                self.state["last-expired-lease"] = lease[:2]
+            leasedb.commit()
+            if self.time_slice_exceeded(start_slice):
+                raise TimeSliceExceeded()
+
+        self.end_cycle(cycle)
+
+    def _get_sharefile_name(self, storage_index_b32, shnum):
+        # the share may not have been migrated into the current layout yet
+        storage_index = si_a2b(storage_index_b32)
+        sharefile = self.server._find_share_file(storage_index, shnum)
+        if sharefile is None:
+            bucketdir = self.disks.get_bucketdir(storage_index)
+            sharefile = os.path.join(bucketdir, "%d" % shnum)
+        return sharefile
+
+    def _get_packed_share(self, storage_index_b32, shnum):
+        # return the PackedShare for this share, if it is packed, else None
+        packed = self.server.packed
+        if not packed:
+            return None
+        storage_index = si_a2b(storage_index_b32)
+        if shnum not in packed.get_shnums(storage_index):
+            return None
+        return PackedShare(packed, storage_index, shnum)
+
+    def process_expired_lease(self, lease, cutoff):
+        (expiration_time, rowid, si_b32, shnum, sharetype,
+         renew_secret, unused_cancel_secret) = lease
+        leasedb = self.server.leasedb
+        sharefile = self._get_sharefile_name(si_b32, shnum)
+        packed_share = self._get_packed_share(si_b32, shnum)
+        if packed_share:
+            stat_share = packed_share.stat
+            share_exists = packed_share.exists
+        else:
+            stat_share = lambda: self.stat(sharefile)
+            share_exists = lambda: os.path.exists(sharefile)
+        if not share_exists():
+            # the share was deleted behind our back
+            self.server.share_deleted(si_a2b(si_b32), shnum, sharetype)
+            return
+
+        if not self.expiration_enabled:
+            # count the share as recoverable once we reach its last lease
+            if leasedb.is_last_lease(si_b32, shnum, expiration_time, rowid):
+                self.increment_space("configured", stat_share(), sharetype)
+            return
+
+        try:
+            sf = packed_share or get_share_file(sharefile,
+                                                self.server.file_cache)
+            for li in sf.get_leases():
+                if timing_safe_compare(li.renew_secret, renew_secret):
+                    break
+            else:
+                # the share no longer holds this lease
+                leasedb.remove_lease(si_b32, shnum, renew_secret)
+                return
+            if li.get_expiration_time() >= cutoff:
+                # the lease was renewed without the database hearing about it
+                leasedb.set_expiration_time(si_b32, shnum, renew_secret,
+                                            li.get_expiration_time())
+                return
+            s = stat_share()
+            sf.cancel_lease(li.cancel_secret)
+        except (UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError,
+                struct.error):
+            twlog.msg("lease-checker error processing %s" % sharefile)
+            twlog.err()
+            which = (si_b32, shnum)
+            self.state["cycle-to-date"]["corrupt-shares"].append(which)
+            leasedb.remove_share(si_b32, shnum)
+            return
+        leasedb.remove_lease(si_b32, shnum, renew_secret)
+
+        if not share_exists():
+            # that was the last lease, so the share has been deleted
+            self.server.share_deleted(si_a2b(si_b32), shnum, sharetype,
+                                      s.st_size)
+            self.increment_space("configured", s, sharetype)
+            self.increment_space("actual", s, sharetype)
+            if packed_share:
+                return
+            bucketdir = os.path.dirname(sharefile)
+            if not [fn for fn in os.listdir(bucketdir) if fn.isdigit()]:
+                bs = self.stat(bucketdir)
+                try:
+                    bucket_diskbytes = bs.st_blocks * 512
+                except AttributeError:
+                    bucket_diskbytes = 0 # no stat().st_blocks on windows
+                self.increment_bucketspace("configured", bucket_diskbytes,
+                                           sharetype)
+                self.increment_bucketspace("actual", bucket_diskbytes,
+                                           sharetype)
@@ -0,0 +1,146 @@
+import os, mmap, threading
+from collections import deque
+
+
+class _OpenFile:
+    # a share file that is open for reading, and perhaps mapped into memory
+
+    def __init__(self, filename, mmap_threshold):
+        self.f = open(filename, "rb", 0)
+        self.m = None
+        if mmap_threshold is not None:
+            size = os.fstat(self.f.fileno()).st_size
+            if size >= mmap_threshold:
+                try:
+                    self.m = mmap.mmap(self.f.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+                except (EnvironmentError, ValueError, OverflowError):
+                    pass # e.g. not enough address space: just read() it
+
+    def get_reader(self):
+        # both of these have seek() and read()
+        if self.m is not None:
+            return self.m
+        return self.f
+
+    def is_stale(self):
+        s = os.fstat(self.f.fileno())
+        if s.st_nlink == 0:
+            return True # deleted or replaced
+        if self.m is not None and s.st_size != len(self.m):
+            return True # the mapping no longer covers the whole file
+        return False
+
+    def close(self):
+        if self.m is not None:
+            self.m.close()
+        self.f.close()
+
+
+class OpenFileCache:
+    """I keep up to 'max_files' share files open for reading, so that the
+    many small reads that a download makes from each share (hashes, then
+    blocks) do not each have to open and close the file. The least recently
+    used file is closed when I am full.
+
+    If 'mmap_threshold' is not None, files of at least that many bytes are
+    also mapped into memory while they are open, and read from the mapping
+    instead: each read is then just a copy out of the page cache, without
+    any seek() or read() system calls.
+
+    Anything which modifies a share file other than by writing share data
+    into it (adding, renewing or cancelling a lease, or deleting it) must
+    call invalidate() first. Files are opened unbuffered, so that changes
+    made through other file objects are always seen, and a file which has
+    been deleted (or, if mapped, has changed size) behind my back is
+    noticed and reopened rather than read from. I may be used
+    from several disk I/O threads at once: a file which is in use by one
+    thread is not handed to another, which will open a file of its own
+    instead.
+    """
+
+    def __init__(self, max_files, mmap_threshold=None):
+        assert max_files > 0, max_files
+        assert mmap_threshold is None or mmap_threshold > 0, mmap_threshold
+        self.max_files = max_files
+        self.mmap_threshold = mmap_threshold
+        self._files = {} # k: filename, v: (tick, _OpenFile)
+        # (tick, filename) in order of use. Entries whose tick no longer
+        # matches the one in _files are stale, and are skipped.
+        self._order = deque()
+        self._tick = 0
+        self._lock = threading.Lock()
+        # bumped by every invalidate(), so that files which were in use at
+        # the time are closed rather than returned to the cache
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def use(self, filename, reader):
+        """Call reader() with an open file object (or a memory map, which
+        has the same seek() and read() methods) for 'filename', and return
+        its result. It must not be closed or written to."""
+        of, generation = self._checkout(filename)
+        try:
+            res = reader(of.get_reader())
+        except:
+            of.close()
+            raise
+        self._checkin(filename, of, generation)
+        return res
+
+    def read(self, filename, offset, length):
+        def _read(f):
+            f.seek(offset)
+            return f.read(length)
+        return self.use(filename, _read)
+
+    def invalidate(self, filename):
+        with self._lock:
+            self._generation += 1
+            (tick, of) = self._files.pop(filename, (None, None))
+        if of:
+            of.close()
+
+    def get_num_open(self):
+        return len(self._files)
+
+    def get_num_mapped(self):
+        with self._lock:
+            return len([of for (tick, of) in self._files.values()
+                        if of.m is not None])
+
+    def _checkout(self, filename):
+        with self._lock:
+            generation = self._generation
+            (tick, of) = self._files.pop(filename, (None, None))
+        if of and of.is_stale():
+            of.close()
+            of = None
+        with self._lock:
+            if of:
+                self.hits += 1
+                return of, generation
+            self.misses += 1
+        return _OpenFile(filename, self.mmap_threshold), generation
+
+    def _checkin(self, filename, of, generation):
+        evicted = []
+        with self._lock:
+            if generation != self._generation or filename in self._files:
+                evicted.append(of)
+            else:
+                self._tick += 1
+                self._files[filename] = (self._tick, of)
+                self._order.append((self._tick, filename))
+                while len(self._files) > self.max_files:
+                    (tick, oldest) = self._order.popleft()
+                    if self._files.get(oldest, (None,))[0] == tick:
+                        evicted.append(self._files.pop(oldest)[1])
+                        self.evictions += 1
+                if len(self._order) > 4 * self.max_files:
+                    self._order = deque(sorted([(t, fn) for (fn, (t, unused))
+                                                in self._files.items()]))
+        for old in evicted:
+            old.close()
@@ -1,5 +1,7 @@
-import os, stat, struct, time
+import os, stat, struct, time, errno
 
+from twisted.internet import defer
+from twisted.python.failure import Failure
 from foolscap.api import Referenceable
 
 from zope.interface import implements
@@ -10,6 +12,8 @@ from allmydata.util.hashutil import timing_safe_compare
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownImmutableContainerVersionError, \
      DataTooLargeError
+from allmydata.storage.diskio import SYNCHRONOUS
+from allmydata.storage.durability import NO_DURABILITY, dirs_to_sync
 
 # each share file (in storage/shares/$SI/$SHNUM) contains lease information
 # and share data. The share data is accessed by RIBucketWriter.write and
@@ -40,11 +44,12 @@ class ShareFile:
     LEASE_SIZE = struct.calcsize(">L32s32sL")
     sharetype = "immutable"
 
-    def __init__(self, filename, max_size=None, create=False):
-        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. """
+    def __init__(self, filename, max_size=None, create=False, file_cache=None):
+        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. If file_cache is provided, it is an OpenFileCache that I will read through. """
         precondition((max_size is not None) or (not create), max_size, create)
         self.home = filename
         self._max_size = max_size
+        self._file_cache = file_cache
         if create:
             # touch the file, so later callers will see that we're working on
             # it. Also construct the metadata.
@@ -65,10 +70,8 @@ class ShareFile:
             self._lease_offset = max_size + 0x0c
             self._num_leases = 0
         else:
-            f = open(self.home, 'rb')
-            filesize = os.path.getsize(self.home)
-            (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
-            f.close()
+            (header, filesize) = self._read_with(self._read_header)
+            (version, unused, num_leases) = struct.unpack(">LLL", header)
             if version != 1:
                 msg = "sharefile %s had version %d but we wanted 1" % \
                       (filename, version)
@@ -77,9 +80,36 @@ class ShareFile:
             self._lease_offset = filesize - (num_leases * self.LEASE_SIZE)
         self._data_offset = 0xc
 
+    def _read_with(self, reader):
+        # call reader() with a file opened for reading
+        if self._file_cache:
+            return self._file_cache.use(self.home, reader)
+        f = open(self.home, 'rb')
+        try:
+            return reader(f)
+        finally:
+            f.close()
+
+    def _read_header(self, f):
+        # 'f' may also be a memory map, which has no fileno()
+        f.seek(0)
+        header = f.read(0xc)
+        f.seek(0, os.SEEK_END)
+        return (header, f.tell())
+
+    def _invalidate(self):
+        # call this before modifying the file other than by writing share
+        # data into it
+        if self._file_cache:
+            self._file_cache.invalidate(self.home)
+
     def unlink(self):
+        self._invalidate()
         os.unlink(self.home)
 
+    def get_data_length(self):
+        return self._lease_offset - self._data_offset
+
     def read_share_data(self, offset, length):
         precondition(offset >= 0)
         # reads beyond the end of the data are truncated. Reads that start
@@ -88,6 +118,8 @@ class ShareFile:
         actuallength = max(0, min(length, self._lease_offset-seekpos))
         if actuallength == 0:
             return ""
+        if self._file_cache:
+            return self._file_cache.read(self.home, seekpos, actuallength)
         f = open(self.home, 'rb')
         f.seek(seekpos)
         return f.read(actuallength)
@@ -124,15 +156,22 @@ class ShareFile:
 
     def get_leases(self):
         """Yields a LeaseInfo instance for all leases."""
-        f = open(self.home, 'rb')
+        for data in self._read_with(self._read_lease_records):
+            yield LeaseInfo().from_immutable_data(data)
+
+    def _read_lease_records(self, f):
+        f.seek(0)
         (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
         f.seek(self._lease_offset)
+        records = []
         for i in range(num_leases):
             data = f.read(self.LEASE_SIZE)
             if data:
-                yield LeaseInfo().from_immutable_data(data)
+                records.append(data)
+        return records
 
     def add_lease(self, lease_info):
+        self._invalidate()
         f = open(self.home, 'rb+')
         num_leases = self._read_num_leases(f)
         self._write_lease_record(f, num_leases, lease_info)
@@ -146,6 +185,7 @@ class ShareFile:
                 if new_expire_time > lease.expiration_time:
                     # yes
                     lease.expiration_time = new_expire_time
+                    self._invalidate()
                     f = open(self.home, 'rb+')
                     self._write_lease_record(f, i, lease)
                     f.close()
@@ -181,6 +221,7 @@ class ShareFile:
             # the same order as they were added, so that if we crash while
             # doing this, we won't lose any non-cancelled leases.
             leases = [l for l in leases if l] # remove the cancelled leases
+            self._invalidate()
             f = open(self.home, 'rb+')
             for i,lease in enumerate(leases):
                 self._write_lease_record(f, i, lease)
@@ -197,20 +238,53 @@ class ShareFile:
 class BucketWriter(Referenceable):
     implements(RIBucketWriter)
 
-    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary):
+    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary,
+                 disk_io=SYNCHRONOUS, packer=None, requester=None,
+                 durability=NO_DURABILITY, write_budget=None):
         self.ss = ss
+        # if given, our remote calls are made on behalf of this Requester
+        self._requester = requester
         self.incominghome = incominghome
         self.finalhome = finalhome
+        # if given, packer(incominghome) copies the finished share into a
+        # PackedShareStore, and returns its size: it is not moved to
+        # finalhome at all
+        self._packer = packer
+        self.packed = packer is not None
+        self._disk_io = disk_io
+        # close() is not acknowledged until the share is as durable as this
+        # says it should be (see storage/durability.py)
+        self._durability = durability
+        # our disk I/O is ordered with that of other shares in the bucket
+        self._bucketdir = os.path.dirname(finalhome)
+        # the directories that get new entries (the server makes the bucket
+        # directory once we have been created), and so must be synced
+        self._synced_dirs = []
+        if durability.mode != "none" and not packer:
+            self._synced_dirs = dirs_to_sync(self._bucketdir)
         self._max_size = max_size # don't allow the client to write more than this
+        # if given, a WriteBufferBudget that lets us hold on to contiguous
+        # writes and make them in one go
+        self._write_budget = write_budget
+        self._buffer = [] # strings to be written from _buffer_offset on
+        self._buffer_offset = 0
+        self._buffered = 0
         self._canary = canary
         self._disconnect_marker = canary.notifyOnDisconnect(self._disconnected)
         self.closed = False
+        self._released = False # have we told the server that we are done?
         self.throw_out_all_data = False
         self._sharefile = ShareFile(incominghome, create=True, max_size=max_size)
         # also, add our lease to the file now, so that other ones can be
         # added by simultaneous uploaders
         self._sharefile.add_lease(lease_info)
 
+    def doRemoteCall(self, methodname, args, kwargs):
+        if self._requester is None:
+            return Referenceable.doRemoteCall(self, methodname, args, kwargs)
+        return self.ss.call_for(self._requester, self, methodname, args,
+                                kwargs)
+
     def allocated_size(self):
         return self._max_size
 
@@ -219,16 +293,152 @@ class BucketWriter(Referenceable):
         precondition(not self.closed)
         if self.throw_out_all_data:
             return
-        self._sharefile.write_share_data(offset, data)
-        self.ss.add_latency("write", time.time() - start)
-        self.ss.count("write")
+        def _written(res):
+            self.ss.bucket_writer_wrote(self, len(data))
+            self.ss.add_latency("write", time.time() - start)
+            self.ss.count("write")
+        if self._write_budget:
+            return self._buffer_write(offset, data, _written)
+        return self._disk_io.run(self._bucketdir,
+                                 self._sharefile.write_share_data,
+                                 (offset, data), _written)
+
+    def _buffer_write(self, offset, data, then):
+        if offset + len(data) > self._max_size:
+            # the ShareFile would refuse this when it was flushed
+            raise DataTooLargeError(self._max_size, offset, len(data))
+        results = []
+        if self._buffer and offset != self._buffer_offset + self._buffered:
+            # this does not follow on from what we hold
+            results.append(self._flush())
+        if self._write_budget.reserve(len(data)):
+            if not self._buffer:
+                self._buffer_offset = offset
+            self._buffer.append(data)
+            self._buffered += len(data)
+            then(None)
+            if self._buffered >= self._write_budget.flush_size:
+                results.append(self._flush())
+        else:
+            results.append(self._flush())
+            results.append(self._disk_io.run(self._bucketdir,
+                                             self._sharefile.write_share_data,
+                                             (offset, data), then))
+        # (with synchronous disk I/O, these are all None)
+        results = [r for r in results if r is not None]
+        if not results:
+            return None
+        # any error from writing out earlier data is reported here
+        return self._disk_io.gather(results, lambda ign: None)
+
+    def _flush(self):
+        # write out the data we hold, returning whatever disk_io.run() does
+        if not self._buffer:
+            return None
+        (offset, data) = (self._buffer_offset, "".join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+        budget = self._write_budget
+        def _flushed(res):
+            budget.release(len(data))
+            budget.flushed(len(data))
+        def _failed(f):
+            budget.release(len(data))
+            return f
+        try:
+            d = self._disk_io.run(self._bucketdir,
+                                  self._sharefile.write_share_data,
+                                  (offset, data), _flushed)
+        except:
+            budget.release(len(data))
+            raise
+        if isinstance(d, defer.Deferred):
+            d.addErrback(_failed)
+        return d
+
+    def _drop_buffer(self):
+        if self._buffered:
+            self._write_budget.release(self._buffered)
+        self._buffer = []
+        self._buffered = 0
 
     def remote_close(self):
         precondition(not self.closed)
         start = time.time()
-
-        fileutil.make_dirs(os.path.dirname(self.finalhome))
-        fileutil.rename(self.incominghome, self.finalhome)
+        # refuse any further writes, even while the rename is still queued
+        self.closed = True
+        self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
+        # whatever we hold must be written before the share is moved
+        try:
+            d = self._flush()
+        except:
+            self._close_failed()
+            raise
+        if isinstance(d, defer.Deferred):
+            d.addCallbacks(lambda ign: self._close(start), self._close_failed)
+            return d
+        return self._close(start)
+
+    def _close(self, start):
+        def _closed(filelen):
+            self._sharefile = None
+            self._release(filelen)
+            self.ss.add_latency("close", time.time() - start)
+            self.ss.count("close")
+        if self._durability.mode == "none" or self._packer:
+            # a packed share is synced by its PackedShareStore
+            try:
+                d = self._disk_io.run(self._bucketdir, self._move_into_place,
+                                      (), _closed)
+            except:
+                self._close_failed()
+                raise
+            if isinstance(d, defer.Deferred):
+                d.addErrback(self._close_failed)
+            return d
+        # the data must be on disk before the rename that makes the share
+        # visible, and the rename must be on disk before we say it is done
+        d = defer.maybeDeferred(self._durability.sync, self._bucketdir,
+                                [self.incominghome], [])
+        d.addCallback(lambda ign:
+                      self._disk_io.run(self._bucketdir,
+                                        self._move_into_place))
+        def _moved(filelen):
+            d2 = defer.maybeDeferred(self._durability.sync, self._bucketdir,
+                                     [], self._synced_dirs)
+            def _synced(res):
+                # the share is in place whether or not that worked, but the
+                # client is told if it may not survive a crash
+                _closed(filelen)
+                if isinstance(res, Failure):
+                    return res
+            d2.addBoth(_synced)
+            return d2
+        d.addCallbacks(_moved, self._close_failed)
+        return d
+
+    def _close_failed(self, f=None):
+        # the share could not be moved into place: give back its space, as
+        # an aborted upload would. Its incoming file is removed when the
+        # server is next started.
+        self._drop_buffer()
+        self._release(0)
+        return f
+
+    def _release(self, consumed_size):
+        if not self._released:
+            self._released = True
+            self.ss.bucket_writer_closed(self, consumed_size)
+
+    def _move_into_place(self):
+        # returns the size of the finished share
+        if self._packer:
+            size = self._packer(self.incominghome)
+            os.unlink(self.incominghome)
+        else:
+            fileutil.make_dirs(os.path.dirname(self.finalhome))
+            fileutil.rename(self.incominghome, self.finalhome)
+            size = os.stat(self.finalhome)[stat.ST_SIZE]
         try:
             # self.incominghome is like storage/shares/incoming/ab/abcde/4 .
             # We try to delete the parent (.../ab/abcde) to avoid leaving
@@ -253,14 +463,7 @@ class BucketWriter(Referenceable):
             # exceptions, those are normal consequences of the
             # above-mentioned conditions.
             pass
-        self._sharefile = None
-        self.closed = True
-        self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
-
-        filelen = os.stat(self.finalhome)[stat.ST_SIZE]
-        self.ss.bucket_writer_closed(self, filelen)
-        self.ss.add_latency("close", time.time() - start)
-        self.ss.count("close")
+        return size
 
     def _disconnected(self):
         if not self.closed:
@@ -271,36 +474,68 @@ class BucketWriter(Referenceable):
                 facility="tahoe.storage", level=log.UNUSUAL)
         if not self.closed:
             self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
-        self._abort()
+        d = self._abort()
         self.ss.count("abort")
+        return d
 
     def _abort(self):
         if self.closed:
             return
 
+        # We are now considered closed for further writing. We must tell
+        # the storage server about this so that it stops expecting us to
+        # use the space it allocated for us earlier.
+        self.closed = True
+        self._drop_buffer()
+        self._release(0)
+        def _removed(res):
+            self._sharefile = None
+        return self._disk_io.run(self._bucketdir, self._remove_incoming,
+                                 (), _removed)
+
+    def _remove_incoming(self):
         os.remove(self.incominghome)
         # if we were the last share to be moved, remove the incoming/
         # directory that was our parent
         parentdir = os.path.split(self.incominghome)[0]
         if not os.listdir(parentdir):
             os.rmdir(parentdir)
-        self._sharefile = None
-
-        # We are now considered closed for further writing. We must tell
-        # the storage server about this so that it stops expecting us to
-        # use the space it allocated for us earlier.
-        self.closed = True
-        self.ss.bucket_writer_closed(self, 0)
 
 
 class BucketReader(Referenceable):
     implements(RIBucketReader)
 
-    def __init__(self, ss, sharefname, storage_index=None, shnum=None):
+    def __init__(self, ss, sharefname, storage_index=None, shnum=None,
+                 disk_io=SYNCHRONOUS, file_cache=None, share_file=None,
+                 requester=None, block_cache=None):
+        # 'share_file' is used instead of opening 'sharefname', if it is
+        # given (a PackedShare, for example). Our remote calls are made on
+        # behalf of 'requester', if it is given, and our reads go through
+        # 'block_cache' (a BlockCache), if it is given
         self.ss = ss
-        self._share_file = ShareFile(sharefname)
+        self._requester = requester
+        self._share_file = share_file
+        if share_file is None:
+            self._share_file = ShareFile(sharefname, file_cache=file_cache)
         self.storage_index = storage_index
         self.shnum = shnum
+        self._disk_io = disk_io
+        self._bucketdir = os.path.dirname(sharefname)
+        if storage_index is not None:
+            # disk I/O for the bucket is ordered by the directory it belongs
+            # in, which is not where it is if it has yet to be migrated
+            self._bucketdir = ss._get_bucketdir(storage_index)
+        self._block_cache = block_cache
+        # a share file can be moved by ShareDirMigrator while we are using
+        # it, and then we look for it again
+        self._file_cache = file_cache
+        self._movable = (share_file is None and storage_index is not None)
+
+    def doRemoteCall(self, methodname, args, kwargs):
+        if self._requester is None:
+            return Referenceable.doRemoteCall(self, methodname, args, kwargs)
+        return self.ss.call_for(self._requester, self, methodname, args,
+                                kwargs)
 
     def __repr__(self):
         return "<%s %s %s>" % (self.__class__.__name__,
@@ -309,10 +544,34 @@ class BucketReader(Referenceable):
 
     def remote_read(self, offset, length):
         start = time.time()
-        data = self._share_file.read_share_data(offset, length)
-        self.ss.add_latency("read", time.time() - start)
-        self.ss.count("read")
-        return data
+        def _read(data):
+            self.ss.add_latency("read", time.time() - start)
+            self.ss.count("read")
+            return data
+        return self._disk_io.run(self._bucketdir, self._read_share_data,
+                                 (offset, length), _read)
+
+    def _read_share_data(self, offset, length):
+        # this may be run in a disk I/O thread
+        if self._block_cache:
+            return self._block_cache.read(self.storage_index, self.shnum,
+                                          offset, length,
+                                          self._read_share_file)
+        return self._read_share_file(offset, length)
+
+    def _read_share_file(self, offset, length):
+        try:
+            return self._share_file.read_share_data(offset, length)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT or not self._movable:
+                raise
+            sharefname = self.ss._find_share_file(self.storage_index,
+                                                  self.shnum)
+            if sharefname in (None, self._share_file.home):
+                raise
+            self._share_file = ShareFile(sharefname,
+                                         file_cache=self._file_cache)
+            return self._share_file.read_share_data(offset, length)
 
     def remote_advise_corrupt_share(self, reason):
         return self.ss.remote_advise_corrupt_share("immutable",
@@ -0,0 +1,111 @@
+import os, struct, sys, time
+
+from allmydata.storage.common import si_a2b, list_buckets
+from allmydata.storage.mutable import MutableShareFile
+
+IMMUTABLE_MAGIC = struct.pack(">L", 1)
+
+def get_share_type(filename):
+    """Return 'mutable' or 'immutable' according to the share file's header,
+    or None if the file does not look like a share."""
+    f = open(filename, 'rb')
+    header = f.read(32)
+    f.close()
+    if header == MutableShareFile.MAGIC:
+        return "mutable"
+    if header[:4] == IMMUTABLE_MAGIC:
+        return "immutable"
+    return None
+
+# rough per-entry costs, used to estimate our memory footprint without
+# walking every entry
+_BUCKET_OVERHEAD = (sys.getsizeof("\x00"*16) + sys.getsizeof({})
+                    + 2*struct.calcsize("P"))
+_SHARE_OVERHEAD = (sys.getsizeof(("immutable", 0)) + sys.getsizeof(0)
+                   + 3*struct.calcsize("P"))
+
+
+class ShareInventory:
+    """I remember which shares a StorageServer holds, so that share lookups
+    (especially for storage indexes that we do not hold at all) can be
+    answered without touching the disk.
+
+    I map storage index to a dict of {shnum: (sharetype, size)}, where
+    'size' is the size of the share file. I am populated by a scan of the
+    share directories at startup, and then kept up to date by the server as
+    shares are added and deleted. Shares placed in (or removed from) the
+    share directory by other processes while the server is running will not
+    be noticed until the next restart.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._num_shares = 0
+        self.build_time = None
+
+    def build(self, sharedirs):
+        start = time.time()
+        for sharedir in sharedirs:
+            for prefix in os.listdir(sharedir):
+                if prefix == "incoming":
+                    continue
+                # the buckets may be further down, in any layout
+                prefixdir = os.path.join(sharedir, prefix)
+                for (si_s, parentdir) in list_buckets(prefixdir):
+                    try:
+                        storage_index = si_a2b(si_s)
+                    except AssertionError:
+                        continue # not a bucket directory
+                    self.scan_bucket(storage_index,
+                                     os.path.join(parentdir, si_s))
+        self.build_time = time.time() - start
+
+    def scan_bucket(self, storage_index, bucketdir):
+        try:
+            filenames = os.listdir(bucketdir)
+        except EnvironmentError:
+            return
+        for fn in filenames:
+            if not fn.isdigit():
+                continue # non-numeric means not a sharefile
+            filename = os.path.join(bucketdir, fn)
+            try:
+                sharetype = get_share_type(filename)
+                size = os.path.getsize(filename)
+            except EnvironmentError:
+                continue
+            if sharetype is not None:
+                self.add_share(storage_index, int(fn), sharetype, size)
+
+    def get_shares(self, storage_index):
+        """Return a dict mapping shnum to (sharetype, size) for all the
+        shares we hold for this storage index. The dict is empty if we hold
+        none. Do not modify it."""
+        return self._buckets.get(storage_index, {})
+
+    def add_share(self, storage_index, shnum, sharetype, size):
+        shares = self._buckets.setdefault(storage_index, {})
+        if shnum not in shares:
+            self._num_shares += 1
+        shares[shnum] = (sharetype, size)
+
+    def remove_share(self, storage_index, shnum):
+        shares = self._buckets.get(storage_index)
+        if shares is None or shnum not in shares:
+            return
+        del shares[shnum]
+        self._num_shares -= 1
+        if not shares:
+            del self._buckets[storage_index]
+
+    def get_num_buckets(self):
+        return len(self._buckets)
+
+    def get_num_shares(self):
+        return self._num_shares
+
+    def get_memory_footprint(self):
+        """Return an estimate, in bytes, of the memory used by the index."""
+        return (sys.getsizeof(self._buckets)
+                + len(self._buckets) * _BUCKET_OVERHEAD
+                + self._num_shares * _SHARE_OVERHEAD)
@@ -0,0 +1,145 @@
+import math, time
+from array import array
+
+# Samples are counted in logarithmic buckets: each power of two from
+# 2**MIN_EXPONENT (about a microsecond) up to 2**(MIN_EXPONENT+OCTAVES)
+# (about twelve days) is split into SUB_BUCKETS equal parts, so a value is
+# reported to within about 1/(2*SUB_BUCKETS) (6%) of what was recorded.
+# Bucket 0 holds everything below the smallest octave (including zero),
+# and the last bucket also holds everything above the largest.
+MIN_EXPONENT = -20
+OCTAVES = 40
+SUB_BUCKETS = 8
+NUM_BUCKETS = 1 + OCTAVES * SUB_BUCKETS
+
+def _bucket_value(b):
+    # the value reported for samples that fell into bucket b: its midpoint
+    if b == 0:
+        return 0.0
+    octave, sub = divmod(b - 1, SUB_BUCKETS)
+    base = 2.0 ** (octave + MIN_EXPONENT)
+    return base * (1 + (sub + 0.5) / SUB_BUCKETS)
+BUCKET_VALUES = [_bucket_value(b) for b in range(NUM_BUCKETS)]
+
+def get_bucket(value):
+    if value <= 0:
+        return 0
+    (mantissa, exponent) = math.frexp(value) # value = mantissa * 2**exponent
+    octave = exponent - 1 - MIN_EXPONENT
+    if octave < 0:
+        return 0
+    if octave >= OCTAVES:
+        return NUM_BUCKETS - 1
+    return 1 + octave*SUB_BUCKETS + int((mantissa*2 - 1) * SUB_BUCKETS)
+
+# (name, seconds per slot, number of slots). A window holds the samples
+# from its last 'number of slots' slots, including the current one, so the
+# "1m" window covers between 50 and 60 seconds of traffic.
+WINDOWS = [("1m", 10, 6),
+           ("5m", 60, 5),
+           ("1h", 300, 12),
+           ]
+# the window that the storage_server.latencies.* stats describe
+STATS_WINDOW = "5m"
+
+# (percentile, name, minimum number of samples needed to report it)
+ORDER_STATISTICS = [(0.01, "01_0_percentile", 100),
+                    (0.1, "10_0_percentile", 10),
+                    (0.50, "50_0_percentile", 10),
+                    (0.90, "90_0_percentile", 10),
+                    (0.95, "95_0_percentile", 20),
+                    (0.99, "99_0_percentile", 100),
+                    (0.999, "99_9_percentile", 1000)]
+
+
+class _Window:
+    # a ring of per-slot histograms, stored end-to-end in one array
+
+    def __init__(self, slot_length, num_slots):
+        self.slot_length = slot_length
+        self.num_slots = num_slots
+        self.counts = array("I", [0] * (num_slots * NUM_BUCKETS))
+        self.sums = array("d", [0.0] * num_slots)
+        self.totals = array("I", [0] * num_slots)
+        # the absolute slot number (time // slot_length) that each position
+        # in the ring currently holds
+        self.slot_ids = array("l", [-1] * num_slots)
+        self._zeros = array("I", [0] * NUM_BUCKETS)
+
+    def add(self, now, bucket, value):
+        slot_id = int(now // self.slot_length)
+        i = slot_id % self.num_slots
+        if self.slot_ids[i] != slot_id:
+            # this position last held an older slot, which has now expired
+            self.counts[i*NUM_BUCKETS:(i+1)*NUM_BUCKETS] = self._zeros
+            self.sums[i] = 0.0
+            self.totals[i] = 0
+            self.slot_ids[i] = slot_id
+        self.counts[i*NUM_BUCKETS + bucket] += 1
+        self.sums[i] += value
+        self.totals[i] += 1
+
+    def get_current_slots(self, now):
+        oldest = int(now // self.slot_length) - self.num_slots
+        return [i for i in range(self.num_slots)
+                if self.slot_ids[i] > oldest and self.totals[i]]
+
+
+class LatencyHistogram:
+    """I record the latencies of one category of storage-server operation,
+    and report their distribution over each of the WINDOWS of recent time.
+
+    All of my storage is allocated up front: recording a sample just
+    increments a few counters, however many samples arrive. The price is
+    that the percentiles I report are the midpoints of the buckets that
+    they fell into, rather than exact samples.
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._windows = dict([(name, _Window(slot_length, num_slots))
+                              for (name, slot_length, num_slots) in WINDOWS])
+
+    def add(self, value):
+        now = self._clock()
+        bucket = get_bucket(value)
+        for w in self._windows.values():
+            w.add(now, bucket, value)
+
+    def get_stats(self, window):
+        """Return a dict with the number of samples recorded in the given
+        window ('samplesize'), their mean, and the ORDER_STATISTICS
+        percentiles. Values which need more samples than were recorded are
+        None. Return None if there were no samples at all."""
+        w = self._windows[window]
+        slots = w.get_current_slots(self._clock())
+        count = int(sum([w.totals[i] for i in slots]))
+        if not count:
+            return None
+        stats = {"samplesize": count}
+        if count > 1:
+            stats["mean"] = sum([w.sums[i] for i in slots]) / count
+        else:
+            stats["mean"] = None
+
+        merged = [0] * NUM_BUCKETS
+        for i in slots:
+            base = i * NUM_BUCKETS
+            for b in range(NUM_BUCKETS):
+                merged[b] += w.counts[base + b]
+        # walk up the buckets once, picking off each percentile (the value
+        # of the sample at index int(percentile*count), as if they had been
+        # sorted) as the running total passes it
+        wanted = sorted([(int(percentile*count), name)
+                         for (percentile, name, minimum) in ORDER_STATISTICS
+                         if count >= minimum])
+        for (percentile, name, minimum) in ORDER_STATISTICS:
+            stats[name] = None
+        seen = 0
+        for b in range(NUM_BUCKETS):
+            seen += merged[b]
+            while wanted and wanted[0][0] < seen:
+                stats[wanted.pop(0)[1]] = BUCKET_VALUES[b]
+            if not wanted:
+                break
+        return stats
@@ -0,0 +1,207 @@
+import os, time
+
+from twisted.internet import defer
+
+from allmydata.storage.crawler import ShareCrawler, ListingPending
+from allmydata.storage.common import si_a2b
+from allmydata.storage.durability import fsync_paths, dirs_to_sync
+from allmydata.util import fileutil, log
+
+
+def read_share_dir_levels(filename):
+    """Return the number of levels of prefix directories that the share
+    directories were last known to be laid out with, or None if that has
+    not been recorded in 'filename'."""
+    try:
+        return int(fileutil.read(filename).strip())
+    except EnvironmentError:
+        return None
+
+def write_share_dir_levels(filename, levels):
+    fileutil.write_atomically(filename, "%d\n" % levels, mode="")
+
+
+class ShareDirMigrator(ShareCrawler):
+    """I move every bucket directory that is not where the server's current
+    share-directory layout puts it (see storage_index_to_dir()) into that
+    place, while the server keeps running. Until I am done, lookups try
+    each of the layouts in turn (see DiskSet.get_bucketdirs()), so a bucket
+    can be found whether or not it has been moved yet.
+
+    Each bucket is moved through the server's disk I/O engine, in order with
+    any other disk I/O for it, by renaming its directory (or, if the bucket
+    already has a directory in the new layout, each of its share files).
+    Prefix directories that this leaves empty are removed. Once a cycle
+    finds nothing left to move, I record the new layout, so that lookups
+    stop trying the old ones, and remove myself from the service hierarchy.
+
+    I add the following keys to my state:
+
+     cycle-to-date: (for the cycle in progress)
+      examined-buckets: the buckets looked at
+      moved-buckets, moved-shares: what has been moved
+      remaining-buckets: buckets which could not be moved completely
+     cycle-levels: the number of levels of prefix directories that the
+                   cycle in progress (or the last one) moved buckets into
+     last-cycle: the cycle-to-date of the last complete cycle
+    """
+
+    slow_start = 60
+    minimum_cycle_time = 0 # keep going until we are done
+
+    def __init__(self, server, statefile):
+        self._moved = {} # k: si_b32, v: results from a worker thread
+        ShareCrawler.__init__(self, server, statefile)
+
+    def add_initial_state(self):
+        so_far = self.create_empty_cycle_dict()
+        self.state.setdefault("cycle-to-date", so_far)
+        for k in so_far:
+            self.state["cycle-to-date"].setdefault(k, so_far[k])
+        self.state.setdefault("last-cycle", None)
+
+    def create_empty_cycle_dict(self):
+        return {"examined-buckets": 0,
+                "moved-buckets": 0,
+                "moved-shares": 0,
+                "remaining-buckets": 0,
+                }
+
+    def started_cycle(self, cycle):
+        self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+        # the layout that this cycle moves buckets into
+        self.state["cycle-levels"] = self.disks.levels
+
+    def list_prefix(self, prefix):
+        # a bucket which has a directory in more than one layout is mapped
+        # to one which is not the one it belongs in, so that it gets moved
+        (buckets, prefixdirs) = ShareCrawler.list_prefix(self, prefix)
+        for (bucket, disk, parentdir) in self.disks.list_prefix(prefix):
+            if parentdir != self._get_parentdir(bucket):
+                prefixdirs[bucket] = parentdir
+        return (buckets, prefixdirs)
+
+    def _get_parentdir(self, storage_index_b32):
+        return os.path.dirname(self.server._get_bucketdir(
+            si_a2b(storage_index_b32)))
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        so_far = self.state["cycle-to-date"]
+        if prefixdir == self._get_parentdir(storage_index_b32):
+            # it is already where it belongs (or has only packed shares)
+            so_far["examined-buckets"] += 1
+            return
+        results = self._moved.pop(storage_index_b32, None)
+        if results is None:
+            storage_index = si_a2b(storage_index_b32)
+            results = self.server.disk_io.run(
+                self.server._get_bucketdir(storage_index),
+                self.move_bucket, (storage_index,))
+            if isinstance(results, defer.Deferred):
+                d = results
+                d.addCallbacks(self._moved_bucket, self._move_failed,
+                               callbackArgs=(storage_index_b32,),
+                               errbackArgs=(storage_index_b32,))
+                raise ListingPending(d)
+        self.record_results(storage_index_b32, results)
+
+    def _moved_bucket(self, results, storage_index_b32):
+        self._moved[storage_index_b32] = results
+
+    def _move_failed(self, f, storage_index_b32):
+        log.err(f, "share directory migration could not move bucket %s"
+                % (storage_index_b32,),
+                facility="tahoe.storage", level=log.UNUSUAL, umid="v3yDkA")
+        self._moved[storage_index_b32] = ([], True)
+
+    def move_bucket(self, storage_index):
+        """Move the bucket directory of 'storage_index' from wherever it is
+        into the current layout, and return a tuple of (the old names of
+        the share files that were moved, whether anything was left behind).
+        This may be run in a disk I/O thread."""
+        server = self.server
+        bucketdirs = server.disks.get_bucketdirs(storage_index)
+        newdir = bucketdirs[0]
+        disk = server.disks.find_disk(storage_index) or server.disks[0]
+        moved = []
+        synced_dirs = []
+        for olddir in bucketdirs[1:]:
+            if not os.path.isdir(olddir):
+                continue
+            if not os.path.exists(newdir):
+                synced_dirs.extend(dirs_to_sync(os.path.dirname(newdir)))
+                fileutil.make_dirs(os.path.dirname(newdir))
+                os.rename(olddir, newdir)
+                moved.extend([os.path.join(olddir, fn)
+                              for fn in os.listdir(newdir)])
+            else:
+                for fn in os.listdir(olddir):
+                    if os.path.exists(os.path.join(newdir, fn)):
+                        continue # leave it for someone to look at
+                    os.rename(os.path.join(olddir, fn),
+                              os.path.join(newdir, fn))
+                    moved.append(os.path.join(olddir, fn))
+                synced_dirs.append(newdir)
+                try:
+                    os.rmdir(olddir)
+                except EnvironmentError:
+                    pass
+            # remove the prefix directories that this emptied, but not the
+            # top-level one
+            parent = os.path.dirname(olddir)
+            synced_dirs.append(parent)
+            for i in range(os.path.relpath(olddir, disk.sharedir)
+                           .count(os.sep) - 1):
+                try:
+                    os.rmdir(parent)
+                except EnvironmentError:
+                    break
+                parent = os.path.dirname(parent)
+                synced_dirs.append(parent)
+        if server.durability.mode != "none":
+            # the moves must not be undone by a crash once they have been
+            # recorded as finished
+            fsync_paths([], synced_dirs)
+        left_behind = bool([d for d in bucketdirs[1:] if os.path.isdir(d)])
+        return (moved, left_behind)
+
+    def record_results(self, storage_index_b32, results):
+        (moved, left_behind) = results
+        so_far = self.state["cycle-to-date"]
+        so_far["examined-buckets"] += 1
+        if moved:
+            so_far["moved-buckets"] += 1
+            so_far["moved-shares"] += len(moved)
+        if left_behind:
+            so_far["remaining-buckets"] += 1
+        if self.server.file_cache:
+            for filename in moved:
+                self.server.file_cache.invalidate(filename)
+
+    def finished_cycle(self, cycle):
+        so_far = self.state["cycle-to-date"].copy()
+        so_far["cycle-start-finish-times"] = (
+            self.state["current-cycle-start-time"], time.time())
+        self.state["last-cycle"] = so_far
+        if self.state.get("cycle-levels") != self.disks.levels:
+            # the layout was changed part-way through the cycle, by a
+            # restart, so the buckets before that were moved elsewhere
+            return
+        if so_far["remaining-buckets"]:
+            log.msg("share directory migration left %d buckets behind, "
+                    "trying again" % so_far["remaining-buckets"],
+                    facility="tahoe.storage", level=log.UNUSUAL)
+            return
+        self.server.share_dirs_migrated()
+        log.msg("share directory migration finished",
+                facility="tahoe.storage")
+        self.disownServiceParent()
+
+    def get_state(self):
+        """In addition to the crawler state described in
+        ShareCrawler.get_state(), I return 'cycle-to-date' (only while a
+        cycle is in progress) and 'last-cycle', as described above."""
+        state = ShareCrawler.get_state(self)
+        if self.state["current-cycle"] is None:
+            del state["cycle-to-date"]
+        return state
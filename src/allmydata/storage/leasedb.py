@@ -0,0 +1,241 @@
+import os, struct, sqlite3
+
+from twisted.python import log as twlog
+from allmydata.util import base32, log
+from allmydata.storage.common import si_b2a, UnknownLeaseDBVersionError, \
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.shares import get_share_file
+
+# The lease database holds a copy of every lease that this storage server
+# has granted, keyed by (storage_index, shnum) and indexed by expiration
+# time. It lets the lease checker find expired leases with a range query,
+# instead of opening and parsing every share on disk once per cycle.
+#
+# The share files remain authoritative: every lease in the database is also
+# recorded in its share file, and the checker re-reads the share's own lease
+# records before cancelling anything. The database can therefore be deleted
+# at any time; it will be rebuilt from the share files by a
+# LeaseMigrationCrawler the next time the node is started.
+
+LEASEDB_SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE migration
+(
+ finished INTEGER -- contains one row: 1 once all in-share leases are imported
+);
+
+CREATE TABLE leases
+(
+ storage_index   VARCHAR(26), -- base32
+ shnum           INTEGER,
+ sharetype       VARCHAR(16), -- "immutable" or "mutable"
+ owner_num       INTEGER,
+ renew_secret    VARCHAR(52), -- base32
+ cancel_secret   VARCHAR(52), -- base32
+ expiration_time INTEGER,     -- seconds since epoch
+ PRIMARY KEY (storage_index, shnum, renew_secret)
+);
+
+CREATE INDEX leases_by_expiration ON leases (expiration_time);
+"""
+
+
+class LeaseDB:
+    """I hold an index of all leases held by a StorageServer, in an SQLite
+    database. None of my mutating methods commit: callers should call
+    commit() once they have finished handling a request."""
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        must_create = not os.path.exists(dbfile)
+        self._db = sqlite3.connect(dbfile)
+        self._cursor = self._db.cursor()
+        c = self._cursor
+        if must_create:
+            c.executescript(LEASEDB_SCHEMA_v1)
+            c.execute("INSERT INTO version (version) VALUES (1)")
+            c.execute("INSERT INTO migration (finished) VALUES (0)")
+            self._db.commit()
+        try:
+            c.execute("SELECT version FROM version")
+            version = c.fetchone()[0]
+        except sqlite3.DatabaseError, e:
+            raise UnknownLeaseDBVersionError("leasedb %s is unusable: %s"
+                                             % (dbfile, e))
+        if version != 1:
+            raise UnknownLeaseDBVersionError("leasedb %s had version %d but "
+                                             "we wanted 1" % (dbfile, version))
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def is_migrated(self):
+        self._cursor.execute("SELECT finished FROM migration")
+        return bool(self._cursor.fetchone()[0])
+
+    def set_migrated(self):
+        self._cursor.execute("UPDATE migration SET finished=1")
+
+    def add_or_renew_lease(self, storage_index, shnum, sharetype, lease_info):
+        """Record a lease. If a lease with the same renew secret is already
+        present on this share, its expiration time is extended (but never
+        shortened)."""
+        si_s = si_b2a(storage_index)
+        renew_s = base32.b2a(lease_info.renew_secret)
+        expiration_time = int(lease_info.expiration_time)
+        c = self._cursor
+        c.execute("UPDATE leases SET expiration_time=MAX(expiration_time, ?)"
+                  " WHERE storage_index=? AND shnum=? AND renew_secret=?",
+                  (expiration_time, si_s, shnum, renew_s))
+        if c.rowcount == 0:
+            c.execute("INSERT INTO leases VALUES (?,?,?,?,?,?,?)",
+                      (si_s, shnum, sharetype, lease_info.owner_num, renew_s,
+                       base32.b2a(lease_info.cancel_secret), expiration_time))
+
+    def renew_lease(self, storage_index, shnum, renew_secret, new_expire_time):
+        self._cursor.execute("UPDATE leases"
+                             " SET expiration_time=MAX(expiration_time, ?)"
+                             " WHERE storage_index=? AND shnum=?"
+                             " AND renew_secret=?",
+                             (int(new_expire_time), si_b2a(storage_index),
+                              shnum, base32.b2a(renew_secret)))
+
+    def set_expiration_time(self, storage_index_b32, shnum, renew_secret,
+                            expiration_time):
+        self._cursor.execute("UPDATE leases SET expiration_time=?"
+                             " WHERE storage_index=? AND shnum=?"
+                             " AND renew_secret=?",
+                             (int(expiration_time), storage_index_b32, shnum,
+                              base32.b2a(renew_secret)))
+
+    def get_leases(self, storage_index, shnum):
+        """Return a list of LeaseInfo instances for the given share."""
+        self._cursor.execute("SELECT owner_num, renew_secret, cancel_secret,"
+                             " expiration_time FROM leases"
+                             " WHERE storage_index=? AND shnum=?",
+                             (si_b2a(storage_index), shnum))
+        return [LeaseInfo(owner_num, base32.a2b(str(renew_s)),
+                          base32.a2b(str(cancel_s)), expiration_time)
+                for (owner_num, renew_s, cancel_s, expiration_time)
+                in self._cursor.fetchall()]
+
+    def remove_lease(self, storage_index_b32, shnum, renew_secret):
+        self._cursor.execute("DELETE FROM leases WHERE storage_index=?"
+                             " AND shnum=? AND renew_secret=?",
+                             (storage_index_b32, shnum,
+                              base32.b2a(renew_secret)))
+
+    def remove_share(self, storage_index_b32, shnum):
+        self._cursor.execute("DELETE FROM leases"
+                             " WHERE storage_index=? AND shnum=?",
+                             (storage_index_b32, shnum))
+
+    def get_expired_leases(self, cutoff, sharetypes, after=None, limit=100):
+        """Return up to 'limit' leases with an expiration time earlier than
+        'cutoff', on shares of the given types, in order of (expiration_time,
+        rowid). Each lease is returned as a tuple of (expiration_time, rowid,
+        storage_index_b32, shnum, sharetype, renew_secret, cancel_secret).
+        If 'after' is provided, it is the (expiration_time, rowid) pair of
+        the last lease returned by a previous call, and only leases which
+        sort after it are returned."""
+        if not sharetypes:
+            return []
+        if after is None:
+            after = (-1, -1)
+        (after_time, after_rowid) = after
+        qmarks = ",".join(["?"] * len(sharetypes))
+        self._cursor.execute("SELECT expiration_time, rowid, storage_index,"
+                             " shnum, sharetype, renew_secret, cancel_secret"
+                             " FROM leases"
+                             " WHERE expiration_time < ?"
+                             " AND (expiration_time > ?"
+                             "      OR (expiration_time = ? AND rowid > ?))"
+                             " AND sharetype IN (%s)"
+                             " ORDER BY expiration_time, rowid LIMIT ?"
+                             % qmarks,
+                             (cutoff, after_time, after_time, after_rowid)
+                             + tuple(sharetypes) + (limit,))
+        return [(expiration_time, rowid, str(si_s), shnum, str(sharetype),
+                 base32.a2b(str(renew_s)), base32.a2b(str(cancel_s)))
+                for (expiration_time, rowid, si_s, shnum, sharetype,
+                     renew_s, cancel_s)
+                in self._cursor.fetchall()]
+
+    def is_last_lease(self, storage_index_b32, shnum, expiration_time, rowid):
+        """Return True if no other lease on this share sorts after the given
+        (expiration_time, rowid) pair."""
+        self._cursor.execute("SELECT COUNT(*) FROM leases"
+                             " WHERE storage_index=? AND shnum=?"
+                             " AND (expiration_time > ?"
+                             "      OR (expiration_time = ? AND rowid > ?))",
+                             (storage_index_b32, shnum, expiration_time,
+                              expiration_time, rowid))
+        return self._cursor.fetchone()[0] == 0
+
+    def get_share_counts(self):
+        """Return a dict mapping sharetype to a (number of buckets, number of
+        shares) tuple, for all shares which hold at least one lease."""
+        self._cursor.execute("SELECT sharetype,"
+                             " COUNT(DISTINCT storage_index),"
+                             " COUNT(DISTINCT storage_index || '-' || shnum)"
+                             " FROM leases GROUP BY sharetype")
+        return dict([(str(sharetype), (buckets, shares))
+                     for (sharetype, buckets, shares)
+                     in self._cursor.fetchall()])
+
+
+class LeaseMigrationCrawler(ShareCrawler):
+    """I copy the leases recorded in every share file into the server's
+    LeaseDB. I run a single cycle, then mark the database as migrated and
+    remove myself from the service hierarchy."""
+
+    def __init__(self, server, statefile, leasedb):
+        self.leasedb = leasedb
+        ShareCrawler.__init__(self, server, statefile)
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        storage_index = base32.a2b(storage_index_b32)
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        if self.server.packed:
+            for shnum in self.server.packed.get_shnums(storage_index):
+                for li in self.server.packed.get_leases(storage_index, shnum):
+                    self.leasedb.add_or_renew_lease(storage_index, shnum,
+                                                    "immutable", li)
+        try:
+            filenames = os.listdir(bucketdir)
+        except OSError:
+            return # all of the bucket's shares are packed
+        for fn in filenames:
+            try:
+                shnum = int(fn)
+            except ValueError:
+                continue # non-numeric means not a sharefile
+            sharefile = os.path.join(bucketdir, fn)
+            try:
+                sf = get_share_file(sharefile)
+                for li in sf.get_leases():
+                    self.leasedb.add_or_renew_lease(storage_index, shnum,
+                                                    sf.sharetype, li)
+            except (UnknownMutableContainerVersionError,
+                    UnknownImmutableContainerVersionError,
+                    struct.error):
+                twlog.msg("leasedb-migration error processing %s" % sharefile)
+                twlog.err()
+
+    def finished_prefix(self, cycle, prefix):
+        self.leasedb.commit()
+
+    def finished_cycle(self, cycle):
+        self.leasedb.set_migrated()
+        self.leasedb.commit()
+        log.msg("leasedb migration finished", facility="tahoe.storage")
+        self.disownServiceParent()
@@ -53,8 +53,24 @@ class MutableShareFile:
     MAX_SIZE = MAX_MUTABLE_SHARE_SIZE
     # TODO: decide upon a policy for max share size
 
-    def __init__(self, filename, parent=None):
+    # when the data outgrows the container, the container grows to at least
+    # this many times its old size, so that a share which grows a little at
+    # a time (like a directory) moves its extra leases a logarithmic number
+    # of times rather than at every write
+    CONTAINER_GROWTH = 1.5
+    # a container at least this many times the size of its data (and with
+    # at least COMPACTION_MINIMUM bytes to gain) is worth compacting
+    COMPACTION_RATIO = 4
+    COMPACTION_MINIMUM = 64*1024
+
+    def __init__(self, filename, parent=None, file_cache=None):
         self.home = filename
+        # the number of bytes of leases that have been moved, to grow or
+        # compact the container, and the number freed by compaction
+        self.relocated_bytes = 0
+        self.compacted_bytes = 0
+        # if provided, this is an OpenFileCache that readv() will use
+        self._file_cache = file_cache
         if os.path.exists(self.home):
             # we don't cache anything, just check the magic
             f = open(self.home, 'rb')
@@ -92,7 +108,13 @@ class MutableShareFile:
         # extra leases go here, none at creation
         f.close()
 
+    def _invalidate(self):
+        # call this before modifying the file
+        if self._file_cache:
+            self._file_cache.invalidate(self.home)
+
     def unlink(self):
+        self._invalidate()
         os.unlink(self.home)
 
     def _read_data_length(self, f):
@@ -144,12 +166,19 @@ class MutableShareFile:
         old_extra_lease_offset = self._read_extra_lease_offset(f)
         new_extra_lease_offset = self.DATA_OFFSET + new_container_size
         if new_extra_lease_offset < old_extra_lease_offset:
-            # TODO: allow containers to shrink. For now they remain large.
+            # containers only shrink when they are compacted
             return
+        # leave some slack beyond what is needed right now
+        old_container_size = old_extra_lease_offset - self.DATA_OFFSET
+        new_extra_lease_offset = self.DATA_OFFSET + \
+            min(self.MAX_SIZE, max(new_container_size,
+                                   int(old_container_size
+                                       * self.CONTAINER_GROWTH)))
         num_extra_leases = self._read_num_extra_leases(f)
         f.seek(old_extra_lease_offset)
         leases_size = 4 + num_extra_leases * self.LEASE_SIZE
         extra_lease_data = f.read(leases_size)
+        self.relocated_bytes += leases_size
 
         # Zero out the old lease info (in order to minimize the chance that
         # it could accidentally be exposed to a reader later, re #1528).
@@ -173,9 +202,6 @@ class MutableShareFile:
             # They are expanding their data size.
 
             if self.DATA_OFFSET+offset+length > extra_lease_offset:
-                # TODO: allow containers to shrink. For now, they remain
-                # large.
-
                 # Their new data won't fit in the current container, so we
                 # have to move the leases. With luck, they're expanding it
                 # more than the size of the extra lease block, which will
@@ -277,6 +303,7 @@ class MutableShareFile:
 
     def add_lease(self, lease_info):
         precondition(lease_info.owner_num != 0) # 0 means "no lease here"
+        self._invalidate()
         f = open(self.home, 'rb+')
         num_lease_slots = self._get_num_lease_slots(f)
         empty_slot = self._get_first_empty_lease_slot(f)
@@ -288,6 +315,7 @@ class MutableShareFile:
 
     def renew_lease(self, renew_secret, new_expire_time):
         accepting_nodeids = set()
+        self._invalidate()
         f = open(self.home, 'rb+')
         for (leasenum,lease) in self._enumerate_leases(f):
             if timing_safe_compare(lease.renew_secret, renew_secret):
@@ -333,6 +361,7 @@ class MutableShareFile:
                                 cancel_secret="\x00"*32,
                                 expiration_time=0,
                                 nodeid="\x00"*20)
+        self._invalidate()
         f = open(self.home, 'rb+')
         for (leasenum,lease) in self._enumerate_leases(f):
             accepting_nodeids.add(lease.nodeid)
@@ -371,13 +400,18 @@ class MutableShareFile:
         return (write_enabler, write_enabler_nodeid)
 
     def readv(self, readv):
-        datav = []
+        if self._file_cache:
+            return self._file_cache.use(self.home,
+                                        lambda f: self._readv(f, readv))
         f = open(self.home, 'rb')
-        for (offset, length) in readv:
-            datav.append(self._read_share_data(f, offset, length))
+        datav = self._readv(f, readv)
         f.close()
         return datav
 
+    def _readv(self, f, readv):
+        return [self._read_share_data(f, offset, length)
+                for (offset, length) in readv]
+
 #    def remote_get_length(self):
 #        f = open(self.home, 'rb')
 #        data_length = self._read_data_length(f)
@@ -415,6 +449,7 @@ class MutableShareFile:
         return test_good
 
     def writev(self, datav, new_length):
+        self._invalidate()
         f = open(self.home, 'rb+')
         for (offset, data) in datav:
             self._write_share_data(f, offset, data)
@@ -422,11 +457,66 @@ class MutableShareFile:
             cur_length = self._read_data_length(f)
             if new_length < cur_length:
                 self._write_data_length(f, new_length)
-                # TODO: if we're going to shrink the share file when the
-                # share data has shrunk, then call
-                # self._change_container_size() here.
+                if self._is_bloated(f):
+                    self._compact(f)
         f.close()
 
+    def get_container_size(self):
+        """Return the number of bytes set aside for share data, of which
+        the data itself may use less."""
+        f = open(self.home, 'rb')
+        try:
+            return self._read_extra_lease_offset(f) - self.DATA_OFFSET
+        finally:
+            f.close()
+
+    def _is_bloated(self, f):
+        data_length = self._read_data_length(f)
+        container_size = self._read_extra_lease_offset(f) - self.DATA_OFFSET
+        return (container_size >= self.COMPACTION_RATIO * data_length
+                and container_size - data_length >= self.COMPACTION_MINIMUM)
+
+    def compact(self, force=False):
+        """If the container is much larger than the share data (or 'force'
+        is True), move the extra leases down to just after the data, and
+        truncate the file after them. Return the number of bytes by which
+        the file shrank."""
+        self._invalidate()
+        f = open(self.home, 'rb+')
+        try:
+            if not force and not self._is_bloated(f):
+                return 0
+            return self._compact(f)
+        finally:
+            f.close()
+
+    def _compact(self, f):
+        f.seek(0, os.SEEK_END)
+        old_size = f.tell()
+        old_extra_lease_offset = self._read_extra_lease_offset(f)
+        new_extra_lease_offset = self.DATA_OFFSET + self._read_data_length(f)
+        num_extra_leases = self._read_num_extra_leases(f)
+        leases_size = 4 + num_extra_leases * self.LEASE_SIZE
+        if new_extra_lease_offset + leases_size > old_extra_lease_offset:
+            # the leases would overwrite themselves, to save less space
+            # than they take up
+            return 0
+        f.seek(old_extra_lease_offset)
+        extra_lease_data = f.read(leases_size)
+        # The new place for the leases is beyond the end of the data, so
+        # nothing is lost if we are interrupted before the offset is
+        # updated, and the old leases are cut off by the truncation after.
+        f.seek(new_extra_lease_offset)
+        f.write(extra_lease_data)
+        f.flush()
+        self._write_extra_lease_offset(f, new_extra_lease_offset)
+        f.flush()
+        f.truncate(new_extra_lease_offset + leases_size)
+        self.relocated_bytes += leases_size
+        freed = old_size - (new_extra_lease_offset + leases_size)
+        self.compacted_bytes += freed
+        return freed
+
 def testv_compare(a, op, b):
     assert op in ("lt", "le", "eq", "ne", "ge", "gt")
     if op == "lt":
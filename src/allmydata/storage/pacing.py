@@ -0,0 +1,54 @@
+# the latency categories whose recent mean is taken as the disk latency
+DISK_CATEGORIES = ["read", "write", "readv", "writev", "io-wait"]
+
+
+class CrawlerPacer:
+    """I decide how hard the share crawlers may work, from how busy the
+    storage server is with its clients.
+
+    The load is measured three ways: the recent reactor delay (from a
+    stats.LoadMonitor), the number of disk operations queued for the I/O
+    threads, and the mean latency of the share reads and writes in the last
+    minute. Each is divided by the level at which the server is considered
+    fully busy, and the largest of these (up to 1.0) is the load. A crawler
+    with a pacer then works for a fraction of the time that falls from its
+    max_cpu_percentage, when the server is idle, to its min_cpu_percentage,
+    when it is fully busy.
+    """
+
+    busy_reactor_delay = 0.05 # seconds
+    busy_queue_depth = 8 # operations
+    busy_disk_latency = 0.05 # seconds
+    num_delay_samples = 10 # about ten seconds' worth
+
+    def __init__(self, server, load_monitor):
+        self.server = server
+        self.load_monitor = load_monitor
+
+    def get_load_components(self):
+        """Return a dict with the 'reactor-delay', 'queue-depth' and
+        'disk-latency' that the load is computed from."""
+        disk_latency = 0.0
+        for category in DISK_CATEGORIES:
+            stats = self.server.latencies[category].get_stats("1m")
+            if stats and stats["mean"] is not None:
+                disk_latency = max(disk_latency, stats["mean"])
+        return {"reactor-delay":
+                    self.load_monitor.get_recent_delay(self.num_delay_samples),
+                "queue-depth": self.server.disk_io.get_queue_depth(),
+                "disk-latency": disk_latency,
+                }
+
+    def get_load(self):
+        """Return how busy the server is, from 0.0 (idle) to 1.0."""
+        c = self.get_load_components()
+        load = max(c["reactor-delay"] / self.busy_reactor_delay,
+                   float(c["queue-depth"]) / self.busy_queue_depth,
+                   c["disk-latency"] / self.busy_disk_latency)
+        return max(0.0, min(load, 1.0))
+
+    def get_cpu_percentage(self, min_percentage, max_percentage):
+        """Return the fraction of the time that a crawler which may use
+        between 'min_percentage' and 'max_percentage' should use now."""
+        load = self.get_load()
+        return max_percentage - load * (max_percentage - min_percentage)
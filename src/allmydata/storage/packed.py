@@ -0,0 +1,618 @@
+import os, struct, time, sqlite3, threading
+
+from twisted.application import service
+from twisted.application.internet import TimerService
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from allmydata.util import base32, fileutil, log
+from allmydata.util.assertutil import precondition
+from allmydata.util.hashutil import timing_safe_compare
+from allmydata.storage.common import si_b2a, si_a2b, list_buckets, \
+     UnknownPackedStoreVersionError, UnknownImmutableContainerVersionError
+from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.immutable import ShareFile
+from allmydata.storage.inventory import get_share_type
+from allmydata.storage.durability import fsync_paths
+
+# A packed share store holds small immutable shares without giving each one
+# a file (and an inode, and a directory entry) of its own. The share data is
+# appended to large segment files, storage/packed/segment-$NUMBER, and an
+# SQLite index (storage/packed/index.sqlite) records where each share is,
+# along with its leases. Only the share data is kept in the segment: the
+# header and lease records of a share file are not.
+#
+# Packed shares are never modified once written. Deleting one only removes
+# it from the index, leaving a hole in its segment; compaction later copies
+# the live shares out of segments that are mostly holes, and removes them.
+
+# by default, immutable shares of up to this many bytes are packed
+PACKED_MAX_SHARE_SIZE = 64*1024
+
+PACKED_SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE segments
+(
+ segment INTEGER PRIMARY KEY, -- held in the file named segment-%08d
+ size    INTEGER, -- bytes appended to the segment so far
+ live    INTEGER, -- bytes of the segment that hold a share in the index
+ shares  INTEGER, -- number of shares in the segment
+ retired INTEGER  -- when compaction emptied the segment, or NULL
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26), -- base32
+ shnum         INTEGER,
+ segment       INTEGER,
+ offset        INTEGER,
+ length        INTEGER,
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE INDEX shares_by_segment ON shares (segment);
+
+CREATE TABLE leases
+(
+ storage_index   VARCHAR(26), -- base32
+ shnum           INTEGER,
+ owner_num       INTEGER,
+ renew_secret    VARCHAR(52), -- base32
+ cancel_secret   VARCHAR(52), -- base32
+ expiration_time INTEGER      -- seconds since epoch
+);
+
+CREATE INDEX leases_by_share ON leases (storage_index, shnum);
+"""
+
+
+class PackedShareStore:
+    """I hold small immutable shares in a few large segment files, indexed
+    by an SQLite database. New shares are appended to the current segment;
+    once that reaches 'segment_size' bytes, a new one is started.
+
+    I may be used from disk I/O threads as well as the reactor thread: every
+    method takes a lock around its use of the index. A share that is moved
+    by compact() stays readable at its old location until its old segment is
+    removed by remove_retired_segments(), so a reader which looked up the
+    location just before the move is not affected.
+
+    If 'fsync' is True, the data of each new share is synced to disk before
+    it is added to the index.
+    """
+
+    segment_size = 64*1024*1024
+    fsync = False
+
+    def __init__(self, packdir, file_cache=None):
+        self.packdir = packdir
+        self._file_cache = file_cache
+        fileutil.make_dirs(packdir)
+        dbfile = os.path.join(packdir, "index.sqlite")
+        must_create = not os.path.exists(dbfile)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(dbfile, check_same_thread=False)
+        if must_create:
+            self._db.executescript(PACKED_SCHEMA_v1)
+            self._db.execute("INSERT INTO version (version) VALUES (1)")
+            self._db.commit()
+        try:
+            version = self._db.execute("SELECT version FROM version"
+                                       ).fetchone()[0]
+        except sqlite3.DatabaseError, e:
+            raise UnknownPackedStoreVersionError("packed share index %s is"
+                                                 " unusable: %s" % (dbfile, e))
+        if version != 1:
+            raise UnknownPackedStoreVersionError("packed share index %s had"
+                                                 " version %d but we wanted 1"
+                                                 % (dbfile, version))
+        # the newest segment is the one that new shares are appended to. It
+        # is never retired by compaction.
+        current = self._db.execute("SELECT MAX(segment) FROM segments"
+                                   ).fetchone()[0]
+        if current is None:
+            self._start_segment(0)
+            self._db.commit()
+        else:
+            self._current = current
+        self.bytes_compacted = 0
+
+    def close(self):
+        self._db.close()
+
+    def get_segment_filename(self, segment):
+        return os.path.join(self.packdir, "segment-%08d" % segment)
+
+    def _start_segment(self, segment):
+        self._db.execute("INSERT INTO segments VALUES (?,0,0,0,NULL)",
+                         (segment,))
+        self._current = segment
+
+    def _append(self, data):
+        # append 'data' to the current segment, returning (segment, offset)
+        segment = self._current
+        filename = self.get_segment_filename(segment)
+        if not os.path.exists(filename):
+            open(filename, "wb").close()
+        f = open(filename, "r+b")
+        try:
+            # anything left beyond the recorded size by a crash is skipped
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+            if self.fsync:
+                # the share must be on disk before the index says it is
+                f.flush()
+                os.fsync(f.fileno())
+                if offset == 0:
+                    fsync_paths([], [self.packdir])
+        finally:
+            f.close()
+        size = offset + len(data)
+        self._db.execute("UPDATE segments SET size=? WHERE segment=?",
+                         (size, segment))
+        if size >= self.segment_size:
+            self._start_segment(segment + 1)
+        return (segment, offset)
+
+    def _insert_share(self, si_s, shnum, segment, offset, length):
+        self._db.execute("INSERT INTO shares VALUES (?,?,?,?,?)",
+                         (si_s, shnum, segment, offset, length))
+        self._db.execute("UPDATE segments SET live=live+?, shares=shares+1"
+                         " WHERE segment=?", (length, segment))
+
+    def _delete_share(self, si_s, shnum):
+        # returns the length of the share, or None if there was no such share
+        row = self._db.execute("SELECT segment, length FROM shares"
+                               " WHERE storage_index=? AND shnum=?",
+                               (si_s, shnum)).fetchone()
+        if row is None:
+            return None
+        (segment, length) = row
+        self._db.execute("DELETE FROM shares WHERE storage_index=?"
+                         " AND shnum=?", (si_s, shnum))
+        self._db.execute("UPDATE segments SET live=live-?, shares=shares-1"
+                         " WHERE segment=?", (length, segment))
+        return length
+
+    def _insert_lease(self, si_s, shnum, lease_info):
+        self._db.execute("INSERT INTO leases VALUES (?,?,?,?,?,?)",
+                         (si_s, shnum, lease_info.owner_num,
+                          base32.b2a(lease_info.renew_secret),
+                          base32.b2a(lease_info.cancel_secret),
+                          int(lease_info.expiration_time)))
+
+    def _get_lease_rows(self, si_s, shnum):
+        return self._db.execute("SELECT rowid, owner_num, renew_secret,"
+                                " cancel_secret, expiration_time FROM leases"
+                                " WHERE storage_index=? AND shnum=?"
+                                " ORDER BY rowid", (si_s, shnum)).fetchall()
+
+    def add_share(self, storage_index, shnum, data, leases):
+        """Append the data of an immutable share to the current segment, and
+        index it along with its leases (a list of LeaseInfo instances). A
+        packed share with the same number is replaced."""
+        si_s = si_b2a(storage_index)
+        with self._lock:
+            if self._delete_share(si_s, shnum) is not None:
+                self._db.execute("DELETE FROM leases WHERE storage_index=?"
+                                 " AND shnum=?", (si_s, shnum))
+            (segment, offset) = self._append(data)
+            self._insert_share(si_s, shnum, segment, offset, len(data))
+            for lease_info in leases:
+                self._insert_lease(si_s, shnum, lease_info)
+            self._db.commit()
+
+    def remove_share(self, storage_index, shnum):
+        """Delete a packed share, and its leases. Return the length of its
+        data, or None if there was no such share."""
+        si_s = si_b2a(storage_index)
+        with self._lock:
+            length = self._delete_share(si_s, shnum)
+            self._db.execute("DELETE FROM leases WHERE storage_index=?"
+                             " AND shnum=?", (si_s, shnum))
+            self._db.commit()
+        return length
+
+    def get_location(self, storage_index, shnum):
+        """Return (segment filename, offset, length) for a packed share, or
+        None if there is no such share."""
+        with self._lock:
+            row = self._db.execute("SELECT segment, offset, length"
+                                   " FROM shares"
+                                   " WHERE storage_index=? AND shnum=?",
+                                   (si_b2a(storage_index), shnum)).fetchone()
+        if row is None:
+            return None
+        (segment, offset, length) = row
+        return (self.get_segment_filename(segment), offset, length)
+
+    def read(self, filename, offset, length):
+        if self._file_cache:
+            return self._file_cache.read(filename, offset, length)
+        f = open(filename, "rb")
+        try:
+            f.seek(offset)
+            return f.read(length)
+        finally:
+            f.close()
+
+    def get_shnums(self, storage_index):
+        """Return a sorted list of the numbers of the packed shares of this
+        storage index."""
+        with self._lock:
+            rows = self._db.execute("SELECT shnum FROM shares"
+                                    " WHERE storage_index=? ORDER BY shnum",
+                                    (si_b2a(storage_index),)).fetchall()
+        return [shnum for (shnum,) in rows]
+
+    def list_buckets(self, prefix):
+        """Return a sorted list of the base32 storage indexes, starting with
+        'prefix', that have at least one packed share."""
+        # '~' sorts after every character of the base32 alphabet
+        with self._lock:
+            rows = self._db.execute("SELECT DISTINCT storage_index"
+                                    " FROM shares WHERE storage_index >= ?"
+                                    " AND storage_index < ?"
+                                    " ORDER BY storage_index",
+                                    (prefix, prefix + "~")).fetchall()
+        return [str(si_s) for (si_s,) in rows]
+
+    def has_shares(self):
+        with self._lock:
+            row = self._db.execute("SELECT SUM(shares) FROM segments"
+                                   ).fetchone()
+        return bool(row[0])
+
+    def get_leases(self, storage_index, shnum):
+        """Return a list of LeaseInfo instances for a packed share."""
+        with self._lock:
+            rows = self._get_lease_rows(si_b2a(storage_index), shnum)
+        return [LeaseInfo(owner_num, base32.a2b(str(renew_s)),
+                          base32.a2b(str(cancel_s)), expiration_time)
+                for (rowid, owner_num, renew_s, cancel_s, expiration_time)
+                in rows]
+
+    def add_lease(self, storage_index, shnum, lease_info):
+        with self._lock:
+            self._insert_lease(si_b2a(storage_index), shnum, lease_info)
+            self._db.commit()
+
+    def renew_lease(self, storage_index, shnum, renew_secret,
+                    new_expire_time, add_lease_info=None):
+        """Extend the lease with the given renew secret (but never shorten
+        it). If there is no such lease, add 'add_lease_info' if it was
+        provided, otherwise raise IndexError."""
+        si_s = si_b2a(storage_index)
+        with self._lock:
+            for (rowid, owner_num, renew_s, cancel_s, expiration_time) \
+                    in self._get_lease_rows(si_s, shnum):
+                if timing_safe_compare(base32.a2b(str(renew_s)),
+                                       renew_secret):
+                    if new_expire_time > expiration_time:
+                        self._db.execute("UPDATE leases SET expiration_time=?"
+                                         " WHERE rowid=?",
+                                         (int(new_expire_time), rowid))
+                        self._db.commit()
+                    return
+            if add_lease_info is None:
+                raise IndexError("unable to renew non-existent lease")
+            self._insert_lease(si_s, shnum, add_lease_info)
+            self._db.commit()
+
+    def cancel_lease(self, storage_index, shnum, cancel_secret):
+        """Remove the leases with the given cancel secret. If the last lease
+        is cancelled, the share is deleted. Return the length of the share
+        if it was deleted, else 0. Raise IndexError if there was no lease
+        with the given cancel secret."""
+        si_s = si_b2a(storage_index)
+        with self._lock:
+            rows = self._get_lease_rows(si_s, shnum)
+            cancelled = [rowid for (rowid, owner_num, renew_s, cancel_s,
+                                    expiration_time) in rows
+                         if timing_safe_compare(base32.a2b(str(cancel_s)),
+                                                cancel_secret)]
+            if not cancelled:
+                raise IndexError("unable to find matching lease to cancel")
+            for rowid in cancelled:
+                self._db.execute("DELETE FROM leases WHERE rowid=?", (rowid,))
+            space_freed = 0
+            if len(cancelled) == len(rows):
+                space_freed = self._delete_share(si_s, shnum) or 0
+            self._db.commit()
+        return space_freed
+
+    def compact(self, min_live_fraction, max_bytes):
+        """Copy the live shares out of the segments that have less than
+        'min_live_fraction' of their bytes still in use (emptiest first),
+        into the current segment, stopping once about 'max_bytes' have been
+        copied. A segment that is left with no shares is retired, to be
+        deleted by a later call to remove_retired_segments(). Return the
+        number of bytes copied."""
+        copied = 0
+        while copied < max_bytes:
+            with self._lock:
+                row = self._db.execute("SELECT segment FROM segments"
+                                       " WHERE retired IS NULL"
+                                       " AND segment != ? AND size > 0"
+                                       " AND live < size * ?"
+                                       " ORDER BY live * 1.0 / size LIMIT 1",
+                                       (self._current, min_live_fraction)
+                                       ).fetchone()
+            if row is None:
+                break
+            copied += self._compact_segment(row[0], max_bytes - copied)
+        self.bytes_compacted += copied
+        return copied
+
+    def _compact_segment(self, segment, max_bytes):
+        filename = self.get_segment_filename(segment)
+        copied = 0
+        while True:
+            # move one share at a time, so that readers and writers are only
+            # held up for one share's worth of copying
+            with self._lock:
+                row = self._db.execute("SELECT storage_index, shnum, offset,"
+                                       " length FROM shares WHERE segment=?"
+                                       " LIMIT 1", (segment,)).fetchone()
+                if row is None:
+                    self._db.execute("UPDATE segments SET retired=?"
+                                     " WHERE segment=?",
+                                     (int(time.time()), segment))
+                    self._db.commit()
+                    return copied
+                if copied >= max_bytes:
+                    return copied
+                (si_s, shnum, offset, length) = row
+                data = self.read(filename, offset, length)
+                self._delete_share(si_s, shnum)
+                (new_segment, new_offset) = self._append(data)
+                self._insert_share(si_s, shnum, new_segment, new_offset,
+                                   length)
+                self._db.commit()
+            copied += length
+
+    def remove_retired_segments(self, cutoff):
+        """Delete the segments that were retired before 'cutoff' (in
+        seconds since the epoch). Return the number deleted."""
+        with self._lock:
+            rows = self._db.execute("SELECT segment FROM segments"
+                                    " WHERE retired < ?", (cutoff,)
+                                    ).fetchall()
+        for (segment,) in rows:
+            filename = self.get_segment_filename(segment)
+            if self._file_cache:
+                self._file_cache.invalidate(filename)
+            try:
+                os.unlink(filename)
+            except EnvironmentError:
+                pass # never written to, or already gone
+            with self._lock:
+                self._db.execute("DELETE FROM segments WHERE segment=?",
+                                 (segment,))
+                self._db.commit()
+        return len(rows)
+
+    def get_stats(self):
+        """Return a dict with the number of shares held ('shares'), the
+        number of segments in use ('segments', including the current one)
+        and waiting to be deleted ('retired'), the bytes appended to the
+        segments in use ('size') and the part of those still holding shares
+        ('live')."""
+        with self._lock:
+            (segments, shares, size, live) = self._db.execute(
+                "SELECT COUNT(*), SUM(shares), SUM(size), SUM(live)"
+                " FROM segments WHERE retired IS NULL").fetchone()
+            (retired,) = self._db.execute("SELECT COUNT(*) FROM segments"
+                                          " WHERE retired IS NOT NULL"
+                                          ).fetchone()
+        return {"shares": shares or 0,
+                "segments": segments,
+                "retired": retired,
+                "size": size or 0,
+                "live": live or 0,
+                }
+
+
+class PackedShareStat:
+    # stands in for the os.stat() of a share file, for the lease checker's
+    # space accounting
+    def __init__(self, size):
+        self.st_size = size
+        self.st_blocks = (size + 511) // 512
+
+
+class PackedShare:
+    """I am an immutable share held in a PackedShareStore. I have the
+    methods of a ShareFile that are used for reading shares and managing
+    their leases."""
+
+    sharetype = "immutable"
+
+    def __init__(self, store, storage_index, shnum):
+        self.store = store
+        self.storage_index = storage_index
+        self.shnum = shnum
+
+    def __repr__(self):
+        return "<PackedShare %s %d>" % (si_b2a(self.storage_index),
+                                        self.shnum)
+
+    def get_data_length(self):
+        location = self.store.get_location(self.storage_index, self.shnum)
+        if location is None:
+            return 0
+        return location[2]
+
+    def stat(self):
+        return PackedShareStat(self.get_data_length())
+
+    def exists(self):
+        return self.store.get_location(self.storage_index,
+                                       self.shnum) is not None
+
+    def unlink(self):
+        self.store.remove_share(self.storage_index, self.shnum)
+
+    def read_share_data(self, offset, length):
+        precondition(offset >= 0)
+        # as with ShareFile, reads beyond the end of the data are truncated,
+        # and reads that start beyond the end of the data return an empty
+        # string. So does a read from a share that has been deleted.
+        location = self.store.get_location(self.storage_index, self.shnum)
+        if location is None:
+            return ""
+        (filename, share_offset, share_length) = location
+        actuallength = max(0, min(length, share_length - offset))
+        if actuallength == 0:
+            return ""
+        return self.store.read(filename, share_offset + offset, actuallength)
+
+    def get_leases(self):
+        """Yields a LeaseInfo instance for all leases."""
+        return iter(self.store.get_leases(self.storage_index, self.shnum))
+
+    def add_lease(self, lease_info):
+        self.store.add_lease(self.storage_index, self.shnum, lease_info)
+
+    def renew_lease(self, renew_secret, new_expire_time):
+        self.store.renew_lease(self.storage_index, self.shnum, renew_secret,
+                               new_expire_time)
+
+    def add_or_renew_lease(self, lease_info):
+        self.store.renew_lease(self.storage_index, self.shnum,
+                               lease_info.renew_secret,
+                               lease_info.expiration_time, lease_info)
+
+    def cancel_lease(self, cancel_secret):
+        return self.store.cancel_lease(self.storage_index, self.shnum,
+                                       cancel_secret)
+
+
+def pack_share_file(store, storage_index, shnum, filename):
+    """Copy the immutable share in 'filename' into 'store', with its leases.
+    The file is left in place. Return the length of the share data."""
+    sf = ShareFile(filename)
+    length = sf.get_data_length()
+    store.add_share(storage_index, shnum, sf.read_share_data(0, length),
+                    list(sf.get_leases()))
+    return length
+
+
+def pack_share_dirs(store, sharedirs, max_share_size, out=None):
+    """Move every immutable share with no more than 'max_share_size' bytes
+    of data from the share directories 'sharedirs' into 'store'. Each share
+    file is deleted once it has been packed, and so are its bucket and
+    prefix directories if they are left empty. This must not be run while
+    a storage server is using the share directories. Return a (number of
+    shares, bytes of share data) tuple."""
+    shares = 0
+    packed_bytes = 0
+    for sharedir in sharedirs:
+        for prefix in sorted(os.listdir(sharedir)):
+            prefixdir = os.path.join(sharedir, prefix)
+            if prefix == "incoming" or not os.path.isdir(prefixdir):
+                continue
+            parentdirs = set()
+            for (bucket, parentdir) in sorted(list_buckets(prefixdir)):
+                try:
+                    storage_index = si_a2b(bucket)
+                except AssertionError:
+                    continue # not a bucket directory
+                bucketdir = os.path.join(parentdir, bucket)
+                while parentdir != prefixdir:
+                    parentdirs.add(parentdir)
+                    parentdir = os.path.dirname(parentdir)
+                for fn in sorted(os.listdir(bucketdir)):
+                    if not fn.isdigit():
+                        continue
+                    filename = os.path.join(bucketdir, fn)
+                    try:
+                        if get_share_type(filename) != "immutable":
+                            continue
+                        if ShareFile(filename).get_data_length() > max_share_size:
+                            continue
+                        length = pack_share_file(store, storage_index,
+                                                 int(fn), filename)
+                    except (UnknownImmutableContainerVersionError,
+                            struct.error, EnvironmentError), e:
+                        if out:
+                            print >>out, "skipping %s: %s" % (filename, e)
+                        continue
+                    os.unlink(filename)
+                    shares += 1
+                    packed_bytes += length
+                try:
+                    os.rmdir(bucketdir)
+                except EnvironmentError:
+                    pass # still holds larger (or mutable) shares
+            # the deepest prefix directories first
+            for d in sorted(parentdirs, reverse=True) + [prefixdir]:
+                try:
+                    os.rmdir(d)
+                except EnvironmentError:
+                    pass # not empty
+    return (shares, packed_bytes)
+
+
+class PackedShareCompactor(service.MultiService):
+    """Every 'interval' seconds, I copy up to 'max_bytes' of live shares out
+    of the emptiest segments of a StorageServer's PackedShareStore (see
+    PackedShareStore.compact), and delete the segments that compaction
+    emptied more than 'grace_period' seconds ago. The grace period lets any
+    read that looked up a share's old location finish before it goes.
+
+    Each pass is run through the server's disk I/O engine, so with I/O
+    threads it is done in a worker thread. A tick that comes while the last
+    pass is still running is skipped."""
+
+    interval = 60
+    max_bytes = 16*1024*1024
+    min_live_fraction = 0.5
+    grace_period = 60*60
+
+    def __init__(self, server):
+        service.MultiService.__init__(self)
+        self.server = server
+        self.store = server.packed
+        self._compacting = False
+        TimerService(self.interval, self.compact).setServiceParent(self)
+
+    def compact(self):
+        if self._compacting:
+            return # the last pass has not finished yet
+        self._compacting = True
+        try:
+            d = self.server.disk_io.run(self.store.packdir, self.compact_store,
+                                        (time.time() - self.grace_period,),
+                                        self._compacted)
+        except Exception:
+            self._compact_failed(Failure())
+            return
+        if isinstance(d, defer.Deferred):
+            d.addErrback(self._compact_failed)
+        return d
+
+    def compact_store(self, cutoff):
+        """Do one pass, and return (copied_bytes, removed_segments). This may
+        be run in a disk I/O thread."""
+        copied = self.store.compact(self.min_live_fraction, self.max_bytes)
+        removed = self.store.remove_retired_segments(cutoff)
+        return (copied, removed)
+
+    def _compacted(self, (copied, removed)):
+        self._compacting = False
+        if copied or removed:
+            log.msg(format="packed share compaction copied %(copied)d bytes,"
+                    " removed %(removed)d segments",
+                    copied=copied, removed=removed,
+                    facility="tahoe.storage")
+
+    def _compact_failed(self, f):
+        self._compacting = False
+        log.err(f, "packed share compaction failed",
+                facility="tahoe.storage", level=log.UNUSUAL, umid="Rp4mVw")
@@ -0,0 +1,178 @@
+import heapq, itertools
+from collections import deque
+
+PRIORITIES = ("interactive", "bulk")
+
+# the category of storage request that each remote method makes
+REQUEST_CATEGORIES = {
+    "allocate_buckets": "allocate",
+    "write": "write",
+    "close": "write",
+    "abort": "write",
+    "get_buckets": "read",
+    "get_buckets_many": "read",
+    "read": "read",
+    "verify_shares": "read",
+    "slot_readv": "readv",
+    "slot_testv_and_readv_and_writev": "writev",
+    "add_lease": "lease",
+    "add_lease_many": "lease",
+    "renew_lease": "lease",
+    }
+
+
+class Requester:
+    """I identify whoever a storage request is being made for: a client,
+    which is named after the tub ID of the connection it opened a session
+    over, or one of the special requesters below. Requests with the same
+    'key' share a queue."""
+
+    def __init__(self, name, priority="interactive"):
+        assert priority in PRIORITIES, priority
+        self.name = name
+        self.priority = priority
+        self.key = (name, priority)
+
+    def __repr__(self):
+        return "<Requester %s (%s)>" % (self.name, self.priority)
+
+# clients that have not opened a session
+ANONYMOUS = Requester("(anonymous)", "interactive")
+# the server's own crawlers
+BACKGROUND = Requester("(background)", "bulk")
+
+
+class Request:
+    """A storage request that is waiting for a disk I/O thread. The
+    scheduler chooses the order in which they get one, and calls nothing:
+    the disk I/O engine starts whichever request pop() returns."""
+
+    def __init__(self, requester, category, submitted, op, cost=1):
+        self.requester = requester
+        self.category = category
+        self.submitted = submitted
+        self.op = op # opaque to the scheduler
+        self.cost = cost
+        # set if the scheduler gave it less than its requester's priority
+        self.demoted = False
+
+
+class FIFOScheduler:
+    """I start requests in the order that they were made, whoever made
+    them. This is how the server behaved before it had schedulers."""
+
+    def __init__(self):
+        self._queue = deque()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def add(self, request):
+        self._queue.append(request)
+
+    def pop(self):
+        """Return the next request to start, or None if there are none."""
+        if not self._queue:
+            return None
+        return self._queue.popleft()
+
+
+class FairQueueScheduler:
+    """I share the disk between requesters by weighted fair queueing: each
+    (client, priority) pair gets its own queue, and while several queues
+    have requests waiting, each of them gets a number of requests started
+    in proportion to the weight of its priority. A client that makes a
+    thousand requests at once then delays another client's single request
+    by about one request, rather than a thousand.
+
+    This is start-time fair queueing: each request is tagged with the
+    virtual time at which it may start, which is the later of the current
+    virtual time and the tag of the previous request from the same queue
+    plus that request's cost divided by its weight, and the request with the
+    earliest tag is started next.
+
+    Clients choose their own priority, so a client cannot be allowed to
+    claim the interactive weight for as much as it likes: once a queue
+    already holds 'interactive_backlog' requests, any more that are added
+    to it are weighted (and counted in Request.demoted) as bulk requests.
+    Someone who is waiting for a request is not usually waiting for many
+    of them at once."""
+
+    weights = {"interactive": 4, "bulk": 1}
+    interactive_backlog = 8
+
+    def __init__(self, weights=None):
+        if weights is not None:
+            self.weights = weights
+        self._queue = [] # heap of (start tag, seqnum, Request)
+        self._seqnum = itertools.count()
+        self._virtual_time = 0.0
+        self._finish = {} # k: Requester.key, v: finish tag of its last request
+        self._queued = {} # k: Requester.key, v: number of requests queued
+
+    def __len__(self):
+        return len(self._queue)
+
+    def add(self, request):
+        key = request.requester.key
+        priority = request.requester.priority
+        queued = self._queued.get(key, 0)
+        if priority != "bulk" and queued >= self.interactive_backlog:
+            priority = "bulk"
+            request.demoted = True
+        weight = self.weights.get(priority, 1)
+        start = max(self._virtual_time, self._finish.get(key, 0.0))
+        self._finish[key] = start + float(request.cost) / weight
+        self._queued[key] = queued + 1
+        heapq.heappush(self._queue, (start, self._seqnum.next(), request))
+
+    def pop(self):
+        """Return the next request to start, or None if there are none."""
+        if not self._queue:
+            return None
+        (start, seqnum, request) = heapq.heappop(self._queue)
+        self._virtual_time = start
+        key = request.requester.key
+        self._queued[key] -= 1
+        if not self._queued[key]:
+            del self._queued[key]
+        if not self._queue:
+            # every queue is empty, so none of them has any credit to keep
+            self._virtual_time = 0.0
+            self._finish.clear()
+        return request
+
+
+SCHEDULERS = {"fifo": FIFOScheduler,
+              "fair": FairQueueScheduler,
+              }
+
+
+class RequesterStats:
+    # what the disk I/O engine has done for one requester
+    def __init__(self, requester):
+        self.name = requester.name
+        self.priority = requester.priority
+        self.queued = 0 # waiting for a thread
+        self.running = 0
+        self.completed = 0
+        self.total_wait = 0.0 # seconds spent queued, by completed requests
+        self.requests = {} # k: category, v: number made
+        self.demoted = 0 # requests that were scheduled as bulk ones
+        # set once the requester's sessions have all been closed: the stats
+        # are dropped as soon as nothing is queued or running for them
+        self.forgotten = False
+
+    def get_stats(self):
+        mean_wait = None
+        if self.completed:
+            mean_wait = self.total_wait / self.completed
+        return {"name": self.name,
+                "priority": self.priority,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "mean_wait": mean_wait,
+                "requests": self.requests.copy(),
+                "demoted": self.demoted,
+                }
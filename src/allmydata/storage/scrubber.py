@@ -0,0 +1,220 @@
+import time, errno
+
+from twisted.internet import defer
+
+from allmydata.storage.crawler import ShareCrawler, ListingPending
+from allmydata.storage.common import si_a2b, \
+     UnknownImmutableContainerVersionError, UnknownMutableContainerVersionError
+from allmydata.storage.immutable import ShareFile
+from allmydata.storage.inventory import get_share_type
+from allmydata.storage.mutable import MutableShareFile
+from allmydata.storage.verify import verify_immutable_share, \
+     verify_mutable_share, CorruptShareError, IncompatibleShareError
+from allmydata.util import log
+
+
+class ShareScrubber(ShareCrawler):
+    """I read every share that a StorageServer holds, and check that it is
+    internally consistent (see verify_immutable_share() and
+    verify_mutable_share()), so that shares which have rotted on disk are
+    found before a client comes to need them. For each corrupt share that I
+    find, I write a corruption advisory, like the ones that clients send
+    with advise_corrupt_share(), unless I found it corrupt in the previous
+    cycle too.
+
+    Scrubbing is mostly reading, so as well as keeping to the CPU percentage
+    of an ordinary crawler, I keep to 'bytes_per_second' (unless it is
+    None): a slice ends once it has read that many bytes for each second of
+    'cpu_slice', and the sleep after it is long enough to bring the average
+    rate down to 'bytes_per_second'. The shares of a bucket are read through
+    the server's disk I/O engine, so with I/O threads they are read in a
+    worker thread, in order with any client requests for the same bucket.
+
+    I add the following keys to my state:
+
+     cycle-to-date: (for the cycle in progress)
+      examined-buckets, examined-shares, examined-bytes: what has been read
+      corrupt-shares: a list of (si_b32, shnum, sharetype, reason) tuples
+      incompatible-shares: the same, for shares of a version I cannot check
+     history: maps cyclenum to the cycle-to-date of that cycle, plus its
+              cycle-start-finish-times, for the last 10 cycles
+    """
+
+    slow_start = 15*60 # let the other crawlers go first
+    minimum_cycle_time = 7*24*60*60 # once a week is plenty
+    bytes_per_second = 1000*1000
+
+    def __init__(self, server, statefile, bytes_per_second=None):
+        if bytes_per_second is not None:
+            assert bytes_per_second > 0, bytes_per_second
+            self.bytes_per_second = bytes_per_second
+        self._slice_bytes = 0
+        self._scrubbed = {} # k: si_b32, v: results read in a worker thread
+        ShareCrawler.__init__(self, server, statefile)
+
+    def add_initial_state(self):
+        so_far = self.create_empty_cycle_dict()
+        self.state.setdefault("cycle-to-date", so_far)
+        for k in so_far:
+            self.state["cycle-to-date"].setdefault(k, so_far[k])
+        self.state.setdefault("history", {})
+
+    def create_empty_cycle_dict(self):
+        return {"examined-buckets": 0,
+                "examined-shares": 0,
+                "examined-bytes": 0,
+                "corrupt-shares": [],
+                "incompatible-shares": [],
+                }
+
+    def started_cycle(self, cycle):
+        self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        results = self._scrubbed.pop(storage_index_b32, None)
+        if results is None:
+            storage_index = si_a2b(storage_index_b32)
+            server = self.server
+            results = server.disk_io.run(
+                server._get_bucketdir(storage_index),
+                self.scrub_bucket,
+                lambda: (storage_index,
+                         server._get_share_types(storage_index)))
+            if isinstance(results, defer.Deferred):
+                # a worker thread is reading the shares: come back to this
+                # bucket when it is done
+                d = results
+                d.addCallbacks(self._scrubbed_bucket, self._scrub_failed,
+                               callbackArgs=(storage_index_b32,),
+                               errbackArgs=(storage_index_b32,))
+                raise ListingPending(d)
+        self.record_results(storage_index_b32, results)
+
+    def _scrubbed_bucket(self, results, storage_index_b32):
+        self._scrubbed[storage_index_b32] = results
+
+    def _scrub_failed(self, f, storage_index_b32):
+        log.err(f, "share scrubber could not read bucket %s"
+                % (storage_index_b32,),
+                facility="tahoe.storage", level=log.UNUSUAL, umid="eR2sVw")
+        self._scrubbed[storage_index_b32] = []
+
+    def scrub_bucket(self, storage_index, sharetypes):
+        """Check each of the shares of 'storage_index', and return a list of
+        (shnum, sharetype, status, reason, bytes_read) tuples, in which
+        'status' is 'ok', 'corrupt' or 'incompatible'. This may be run in a
+        disk I/O thread."""
+        server = self.server
+        results = []
+        for shnum, filename, sharetype in server._find_shares(storage_index,
+                                                              sharetypes):
+            def open_share(filename=filename):
+                if get_share_type(filename) == "mutable":
+                    msf = MutableShareFile(filename, server,
+                                           file_cache=server.file_cache)
+                    return ("mutable",
+                            lambda offset, length:
+                                msf.readv([(offset, length)])[0])
+                sf = ShareFile(filename, file_cache=server.file_cache)
+                return ("immutable", sf.read_share_data)
+            results.append(self.scrub_share(shnum, open_share))
+        for shnum, sf in server._get_packed_shares(storage_index):
+            results.append(self.scrub_share(shnum,
+                                            lambda sf=sf:
+                                                ("immutable",
+                                                 sf.read_share_data)))
+        return [r for r in results if r is not None]
+
+    def scrub_share(self, shnum, open_share):
+        bytes_read = [0]
+        sharetype = None
+        try:
+            (sharetype, read) = open_share()
+            def counting_read(offset, length):
+                data = read(offset, length)
+                bytes_read[0] += len(data)
+                return data
+            if sharetype == "mutable":
+                verify_mutable_share(shnum, counting_read)
+            else:
+                verify_immutable_share(shnum, counting_read)
+            (status, reason) = ("ok", None)
+        except IncompatibleShareError, e:
+            (status, reason) = ("incompatible", str(e))
+        except EnvironmentError, e:
+            if e.errno == errno.ENOENT:
+                return None # it was deleted since the bucket was listed
+            (status, reason) = ("corrupt", str(e))
+        except (CorruptShareError, UnknownImmutableContainerVersionError,
+                UnknownMutableContainerVersionError), e:
+            (status, reason) = ("corrupt", str(e))
+        return (shnum, sharetype, status, reason, bytes_read[0])
+
+    def record_results(self, storage_index_b32, results):
+        so_far = self.state["cycle-to-date"]
+        so_far["examined-buckets"] += 1
+        for (shnum, sharetype, status, reason, bytes_read) in results:
+            so_far["examined-shares"] += 1
+            so_far["examined-bytes"] += bytes_read
+            self._slice_bytes += bytes_read
+            if status == "ok":
+                continue
+            which = (storage_index_b32, shnum, sharetype, reason)
+            so_far[status + "-shares"].append(which)
+            if status == "corrupt" and not self._found_last_cycle(which):
+                self.report_corrupt_share(storage_index_b32, shnum,
+                                          sharetype, reason)
+
+    def _found_last_cycle(self, which):
+        history = self.state["history"]
+        last = history.get(self.state["last-cycle-finished"])
+        if not last:
+            return False
+        return which[:2] in [c[:2] for c in last["corrupt-shares"]]
+
+    def report_corrupt_share(self, storage_index_b32, shnum, sharetype,
+                             reason):
+        self.server.write_corruption_advisory(sharetype or "unknown",
+                                              si_a2b(storage_index_b32),
+                                              shnum,
+                                              "found by the share scrubber: "
+                                              + reason)
+        log.msg(format=("share scrubber found corruption in (%(share_type)s) "
+                        "%(si)s-%(shnum)d: %(reason)s"),
+                share_type=sharetype, si=storage_index_b32, shnum=shnum,
+                reason=reason, level=log.SCARY, umid="gP3tqQ")
+
+    def time_slice_exceeded(self, start_slice):
+        if (self.bytes_per_second is not None
+            and self._slice_bytes >= self.bytes_per_second * self.cpu_slice):
+            return True
+        return ShareCrawler.time_slice_exceeded(self, start_slice)
+
+    def get_sleep_time(self, this_slice):
+        sleep_time = ShareCrawler.get_sleep_time(self, this_slice)
+        if self.bytes_per_second is not None:
+            # this is not capped like the CPU-based sleep: a huge share is
+            # paid for with a long sleep
+            sleep_time = max(sleep_time,
+                             float(self._slice_bytes) / self.bytes_per_second
+                             - this_slice)
+        self._slice_bytes = 0
+        return sleep_time
+
+    def finished_cycle(self, cycle):
+        h = self.state["cycle-to-date"].copy()
+        h["cycle-start-finish-times"] = (self.state["current-cycle-start-time"],
+                                         time.time())
+        history = self.state["history"]
+        history[cycle] = h
+        while len(history) > 10:
+            del history[min(history.keys())]
+
+    def get_state(self):
+        """In addition to the crawler state described in
+        ShareCrawler.get_state(), I return 'cycle-to-date' (only while a
+        cycle is in progress) and 'history', as described above."""
+        state = ShareCrawler.get_state(self)
+        if self.state["current-cycle"] is None:
+            del state["cycle-to-date"]
+        return state
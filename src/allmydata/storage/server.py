@@ -1,22 +1,51 @@
-import os, re, weakref, struct, time
+import os, re, weakref, time
 
 from foolscap.api import Referenceable
+from twisted.internet import defer, reactor
 from twisted.application import service
+from twisted.python import threadable
 
 from zope.interface import implements
 from allmydata.interfaces import RIStorageServer, IStatsProducer
 from allmydata.util import fileutil, idlib, log, time_format
 import allmydata # for __full_version__
 
-from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir
+from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir, \
+     SHARE_DIR_LEVELS
 _pyflakes_hush = [si_b2a, si_a2b, storage_index_to_dir] # re-exported
+from allmydata.storage.common import UnknownImmutableContainerVersionError
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.mutable import MutableShareFile, EmptyShare, \
      create_mutable_sharefile
 from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
 from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
 from allmydata.storage.crawler import BucketCountingCrawler
-from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.expirer import LeaseCheckingCrawler, \
+     IndexedLeaseCheckingCrawler
+from allmydata.storage.leasedb import LeaseDB, LeaseMigrationCrawler
+from allmydata.storage.inventory import ShareInventory, get_share_type
+from allmydata.storage.diskio import SYNCHRONOUS, ThreadedDiskIO
+from allmydata.storage.durability import DURABILITY_MODES, NO_DURABILITY, \
+     FsyncDurability, GroupCommitter
+from allmydata.storage.filecache import OpenFileCache
+from allmydata.storage.blockcache import BlockCache
+from allmydata.storage.writebuffer import WriteBufferBudget
+from allmydata.storage.disks import DiskSet
+from allmydata.storage.packed import PackedShareStore, PackedShare, \
+     PackedShareCompactor, pack_share_file, PACKED_MAX_SHARE_SIZE
+from allmydata.storage.latency import LatencyHistogram, STATS_WINDOW
+from allmydata.storage.pacing import CrawlerPacer
+from allmydata.storage.counts import ShareCounts, ShareCountingCrawler
+from allmydata.storage.space import SpaceLedger
+from allmydata.storage.scrubber import ShareScrubber
+from allmydata.storage.compactor import MutableShareCompactor
+from allmydata.storage.layout import ShareDirMigrator, \
+     read_share_dir_levels, write_share_dir_levels
+from allmydata.storage.scheduler import REQUEST_CATEGORIES, SCHEDULERS, \
+     PRIORITIES, Requester, ANONYMOUS
+from allmydata.storage.verify import verify_immutable_share, \
+     CorruptShareError, IncompatibleShareError
+from allmydata.stats import LoadMonitor
 
 # storage/
 # storage/shares/incoming
@@ -28,6 +57,21 @@ from allmydata.storage.expirer import LeaseCheckingCrawler
 # Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
 # base-32 chars).
 
+# With share_dir_levels=2 (or 3), each $START directory holds another level
+# (or two) of prefix directories named for the next 2 base-32 chars, like
+# storage/shares/ab/cd/abcde.../$SHARENUM , so that no directory grows too
+# large. The number of levels that the buckets are laid out with is recorded
+# in storage/share_dir_levels : when it changes, a ShareDirMigrator moves the
+# buckets into the new layout while the server runs, and until it is done,
+# buckets are looked for in every layout.
+
+# storage/packed/ holds small immutable shares, if packed_enabled=True: see
+# allmydata.storage.packed . A bucket may then have no directory at all.
+
+# A server with more than one disk has a shares/ directory (with its own
+# incoming/) on each of them, laid out in the same way: every bucket is kept
+# on just one of them.
+
 # $SHARENUM matches this regex:
 NUM_RE=re.compile("^[0-9]+$")
 
@@ -37,6 +81,7 @@ class StorageServer(service.MultiService, Referenceable):
     implements(RIStorageServer, IStatsProducer)
     name = 'storage'
     LeaseCheckerClass = LeaseCheckingCrawler
+    IndexedLeaseCheckerClass = IndexedLeaseCheckingCrawler
 
     def __init__(self, storedir, nodeid, reserved_space=0,
                  discard_storage=False, readonly_storage=False,
@@ -45,7 +90,30 @@ class StorageServer(service.MultiService, Referenceable):
                  expiration_mode="age",
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
-                 expiration_sharetypes=("mutable", "immutable")):
+                 expiration_sharetypes=("mutable", "immutable"),
+                 leasedb_enabled=False,
+                 inventory_enabled=False,
+                 io_threads=0,
+                 io_scheduler="fifo",
+                 open_file_cache_size=0,
+                 mmap_threshold=None,
+                 block_cache_size=0,
+                 write_buffer_size=0,
+                 write_buffer_flush_size=None,
+                 extra_share_dirs=(),
+                 share_dir_levels=1,
+                 packed_enabled=False,
+                 packed_max_share_size=PACKED_MAX_SHARE_SIZE,
+                 crawler_listing_threads=0,
+                 crawler_listings_per_second=None,
+                 crawler_pacing=False,
+                 crawler_rates={},
+                 share_counts_enabled=False,
+                 scrubber_enabled=False,
+                 scrubber_bytes_per_second=None,
+                 mutable_compaction_enabled=False,
+                 durability="none",
+                 group_commit_window=None):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, str)
         assert len(nodeid) == 20
@@ -61,12 +129,40 @@ class StorageServer(service.MultiService, Referenceable):
         self.no_storage = discard_storage
         self.readonly_storage = readonly_storage
         self.stats_provider = stats_provider
+        self.crawler_listing_threads = crawler_listing_threads
+        self.crawler_listings_per_second = crawler_listings_per_second
+        self.crawler_rates = crawler_rates
         if self.stats_provider:
             self.stats_provider.register_producer(self)
+        # each disk has its own share directory and reserved_space, and
+        # lays out its buckets under 'share_dir_levels' levels of prefix
+        # directories
+        if share_dir_levels not in SHARE_DIR_LEVELS:
+            raise ValueError("share_dir_levels must be one of %s, not %r"
+                             % (", ".join(map(str, SHARE_DIR_LEVELS)),
+                                share_dir_levels))
+        self.disks = DiskSet([sharedir] + list(extra_share_dirs),
+                             self.reserved_space, share_dir_levels)
+        # the space used and promised on each of them
+        self.space = SpaceLedger(self.disks)
         self.incomingdir = os.path.join(sharedir, 'incoming')
         self._clean_incomplete()
-        fileutil.make_dirs(self.incomingdir)
-        self._active_writers = weakref.WeakKeyDictionary()
+        for disk in self.disks:
+            fileutil.make_dirs(disk.incomingdir)
+        # k: weakref to a BucketWriter, v: (storage index, shnum,
+        # LeaseInfo, ShareDisk)
+        self._active_writers = {}
+        # how many BucketWriters are writing into each bucket:
+        # k: storage index, v: count
+        self._bucket_writers = {}
+        # slots that are not in the DiskSet's index yet, but which are being
+        # written to: k: storage index, v: [ShareDisk, number of writes]
+        self._pending_slots = {}
+        # bytes of mutable-share leases moved to grow or compact their
+        # containers, and bytes freed by compaction
+        self.mutable_relocated_bytes = 0
+        self.mutable_compacted_bytes = 0
+        self.mutable_compactions = 0
         log.msg("StorageServer created", facility="tahoe.storage")
 
         if reserved_space:
@@ -74,55 +170,249 @@ class StorageServer(service.MultiService, Referenceable):
                 log.msg("warning: [storage]reserved_space= is set, but this platform does not support an API to get disk statistics (statvfs(2) or GetDiskFreeSpaceEx), so this reservation cannot be honored",
                         umin="0wZ27w", level=log.UNUSUAL)
 
-        self.latencies = {"allocate": [], # immutable
-                          "write": [],
-                          "close": [],
-                          "read": [],
-                          "get": [],
-                          "writev": [], # mutable
-                          "readv": [],
-                          "add-lease": [], # both
-                          "renew": [],
-                          "cancel": [],
-                          }
+        self.latencies = {}
+        for category in ["allocate", "write", "close", "read", # immutable
+                         "get", "get-many",
+                         "writev", "readv", # mutable
+                         "add-lease", "add-lease-many", "renew", "cancel", # both
+                         "verify",
+                         "io-wait", "io-queue-depth", # disk I/O thread pool
+                         "commit", "commit-batch", # syncing writes to disk
+                         ]:
+            self.latencies[category] = LatencyHistogram()
+        # the crawlers can be made to work harder when the server is idle,
+        # and less hard when it is busy
+        self.crawler_pacer = None
+        if crawler_pacing:
+            load_monitor = getattr(stats_provider, "load_monitor", None)
+            if load_monitor is None:
+                load_monitor = LoadMonitor(stats_provider)
+                load_monitor.setServiceParent(self)
+            self.crawler_pacer = CrawlerPacer(self, load_monitor)
+
+        # buckets, shares and bytes can be counted as shares are added and
+        # removed, rather than by crawling
+        self.share_counts = None
+        if share_counts_enabled:
+            self.share_counts = ShareCounts(os.path.join(storedir,
+                                                         "share_counts.state"))
+            self.share_counts.setServiceParent(self)
         self.add_bucket_counter()
 
+        # the (Requester, category) of the remote call being handled, if
+        # any, so that the disk I/O engine knows who its work is for
+        self.current_request = None
+        # the Requester for each (tub ID, priority) with open sessions, and
+        # how many of them there are: k: (tubid, priority),
+        # v: [Requester, count]
+        self._session_requesters = {}
+
+        # share-file reads and writes happen on the reactor thread unless
+        # we are given some I/O threads. 'io_scheduler' chooses the order in
+        # which waiting operations get a thread: it is a name from
+        # storage/scheduler.py, or something that makes a scheduler
+        self.disk_io = SYNCHRONOUS
+        if io_threads:
+            scheduler = io_scheduler
+            if isinstance(io_scheduler, str):
+                if io_scheduler not in SCHEDULERS:
+                    raise ValueError("unknown I/O scheduler %r (must be one"
+                                     " of %s)" % (io_scheduler,
+                                                  ", ".join(sorted(SCHEDULERS))))
+                scheduler = SCHEDULERS[io_scheduler]
+            self.disk_io = ThreadedDiskIO(self,
+                                          [disk.sharedir for disk in self.disks],
+                                          io_threads, scheduler)
+            self.disk_io.setServiceParent(self)
+
+        # share files that are being read from can be kept open, and the
+        # larger ones mapped into memory
+        self.file_cache = None
+        if open_file_cache_size:
+            self.file_cache = OpenFileCache(open_file_cache_size,
+                                            mmap_threshold or None)
+
+        # and the share data that was read most recently can be kept in
+        # memory, for the next client that asks for the same thing
+        self.block_cache = None
+        if block_cache_size:
+            self.block_cache = BlockCache(block_cache_size)
+
+        # the many small writes of an upload can be gathered up in memory,
+        # and made in a few large ones
+        self.write_budget = None
+        if write_buffer_size:
+            self.write_budget = WriteBufferBudget(write_buffer_size,
+                                                  write_buffer_flush_size)
+
+        # immutable shares of up to packed_max_share_size bytes can be kept
+        # in a few large segment files, rather than in a file each
+        self.packed = None
+        if packed_enabled:
+            self.packed = PackedShareStore(os.path.join(storedir, "packed"),
+                                           self.file_cache)
+            self.packed_max_share_size = packed_max_share_size
+            self.packed_compactor = PackedShareCompactor(self)
+            self.packed_compactor.setServiceParent(self)
+
+        # how sure we are that a share is on disk before we tell the client
+        # that it is stored
+        if durability not in DURABILITY_MODES:
+            raise ValueError("unknown durability mode %r (must be one of %s)"
+                             % (durability, ", ".join(DURABILITY_MODES)))
+        self.durability = NO_DURABILITY
+        if durability == "fsync":
+            self.durability = FsyncDurability(self)
+        elif durability == "group":
+            self.durability = GroupCommitter(self, group_commit_window)
+            self.durability.setServiceParent(self)
+        if self.packed:
+            self.packed.fsync = (durability != "none")
+
+        self.inventory = None
+        if inventory_enabled:
+            self.inventory = ShareInventory()
+            self.inventory.build([disk.sharedir for disk in self.disks])
+            log.msg(format="share inventory built in %(seconds).1fs:"
+                    " %(shares)d shares in %(buckets)d buckets",
+                    seconds=self.inventory.build_time,
+                    shares=self.inventory.get_num_shares(),
+                    buckets=self.inventory.get_num_buckets(),
+                    facility="tahoe.storage")
+
+        self.leasedb = None
+        self.lease_migrator = None
+        if leasedb_enabled:
+            self.init_leasedb()
+
         statefile = os.path.join(self.storedir, "lease_checker.state")
         historyfile = os.path.join(self.storedir, "lease_checker.history")
         klass = self.LeaseCheckerClass
+        if self.leasedb:
+            klass = self.IndexedLeaseCheckerClass
         self.lease_checker = klass(self, statefile, historyfile,
                                    expiration_enabled, expiration_mode,
                                    expiration_override_lease_duration,
                                    expiration_cutoff_date,
                                    expiration_sharetypes)
+        self.configure_crawler(self.lease_checker, "lease_checker")
         self.lease_checker.setServiceParent(self)
 
+        # shares can be re-read and checked in the background, to find the
+        # ones that have rotted before a client does
+        self.share_scrubber = None
+        if scrubber_enabled:
+            self.add_share_scrubber(scrubber_bytes_per_second)
+        # mutable shares that grew and then stopped being written can have
+        # their slack taken back in the background
+        self.mutable_compactor = None
+        if mutable_compaction_enabled:
+            self.add_mutable_compactor()
+
+        # buckets that were laid out with a different number of levels of
+        # prefix directories are moved into the new layout in the background
+        self.share_dir_migrator = None
+        self._share_dir_levels_file = os.path.join(storedir,
+                                                   "share_dir_levels")
+        old_levels = read_share_dir_levels(self._share_dir_levels_file)
+        if old_levels is None:
+            # servers from before there was a choice used one level
+            old_levels = 1
+            if not self.have_shares():
+                old_levels = share_dir_levels # nothing to move
+        if old_levels != share_dir_levels:
+            self.disks.migrating = True
+            self.add_share_dir_migrator()
+        else:
+            write_share_dir_levels(self._share_dir_levels_file,
+                                   share_dir_levels)
+
     def __repr__(self):
         return "<StorageServer %s>" % (idlib.shortnodeid_b2a(self.my_nodeid),)
 
     def have_shares(self):
         # quick test to decide if we need to commit to an implicit
         # permutation-seed or if we should use a new one
-        return bool(set(os.listdir(self.sharedir)) - set(["incoming"]))
+        for disk in self.disks:
+            if set(os.listdir(disk.sharedir)) - set(["incoming"]):
+                return True
+        if self.packed and self.packed.has_shares():
+            return True
+        return False
+
+    def init_leasedb(self):
+        self.leasedb = LeaseDB(os.path.join(self.storedir, "leasedb.sqlite"))
+        if self.leasedb.is_migrated():
+            return
+        if not self.have_shares():
+            # nothing to import
+            self.leasedb.set_migrated()
+            self.leasedb.commit()
+            return
+        statefile = os.path.join(self.storedir, "leasedb_migration.state")
+        self.lease_migrator = LeaseMigrationCrawler(self, statefile,
+                                                    self.leasedb)
+        self.configure_crawler(self.lease_migrator, "lease_migrator")
+        self.lease_migrator.setServiceParent(self)
 
     def add_bucket_counter(self):
         statefile = os.path.join(self.storedir, "bucket_counter.state")
-        self.bucket_counter = BucketCountingCrawler(self, statefile)
+        if self.share_counts:
+            self.bucket_counter = ShareCountingCrawler(self, statefile,
+                                                       self.share_counts)
+        else:
+            self.bucket_counter = BucketCountingCrawler(self, statefile)
+        self.configure_crawler(self.bucket_counter, "bucket_counter")
         self.bucket_counter.setServiceParent(self)
 
+    def add_share_scrubber(self, bytes_per_second=None):
+        statefile = os.path.join(self.storedir, "share_scrubber.state")
+        self.share_scrubber = ShareScrubber(self, statefile, bytes_per_second)
+        self.configure_crawler(self.share_scrubber, "share_scrubber")
+        self.share_scrubber.setServiceParent(self)
+
+    def add_mutable_compactor(self):
+        statefile = os.path.join(self.storedir, "mutable_compactor.state")
+        self.mutable_compactor = MutableShareCompactor(self, statefile)
+        self.configure_crawler(self.mutable_compactor, "mutable_compactor")
+        self.mutable_compactor.setServiceParent(self)
+
+    def add_share_dir_migrator(self):
+        statefile = os.path.join(self.storedir, "share_dir_migrator.state")
+        self.share_dir_migrator = ShareDirMigrator(self, statefile)
+        self.configure_crawler(self.share_dir_migrator, "share_dir_migrator")
+        self.share_dir_migrator.setServiceParent(self)
+
+    def share_dirs_migrated(self):
+        # called by the ShareDirMigrator when every bucket is where the
+        # current layout puts it
+        write_share_dir_levels(self._share_dir_levels_file, self.disks.levels)
+        self.disks.migrating = False
+
+    def configure_crawler(self, crawler, name):
+        # prefixdirs can be listed ahead of the crawl, in worker threads
+        crawler.listing_threads = self.crawler_listing_threads
+        crawler.max_listings_per_second = self.crawler_listings_per_second
+        if self.crawler_pacer:
+            crawler.pacer = self.crawler_pacer
+            (min_rate, max_rate) = self.crawler_rates.get(name, (None, None))
+            if min_rate is not None:
+                crawler.min_cpu_percentage = min_rate
+            if max_rate is not None:
+                crawler.max_cpu_percentage = max_rate
+
     def count(self, name, delta=1):
         if self.stats_provider:
             self.stats_provider.count("storage_server." + name, delta)
 
     def add_latency(self, category, latency):
-        a = self.latencies[category]
-        a.append(latency)
-        if len(a) > 1000:
-            self.latencies[category] = a[-1000:]
+        self.latencies[category].add(latency)
 
-    def get_latencies(self):
+    def get_latencies(self, window=STATS_WINDOW):
         """Return a dict, indexed by category, that contains a dict of
-        latency numbers for each category. If there are sufficient samples
+        latency numbers for each category, covering the operations of the
+        given window of recent time (one of the names in
+        allmydata.storage.latency.WINDOWS). If there are sufficient samples
         for unambiguous interpretation, each dict will contain the
         following keys: mean, 01_0_percentile, 10_0_percentile,
         50_0_percentile (median), 90_0_percentile, 95_0_percentile,
@@ -133,52 +423,39 @@ class StorageServer(service.MultiService, Referenceable):
         not be present in the return value. """
         # note that Amazon's Dynamo paper says they use 99.9% percentile.
         output = {}
-        for category in self.latencies:
-            if not self.latencies[category]:
-                continue
-            stats = {}
-            samples = self.latencies[category][:]
-            count = len(samples)
-            stats["samplesize"] = count
-            samples.sort()
-            if count > 1:
-                stats["mean"] = sum(samples) / count
-            else:
-                stats["mean"] = None
-
-            orderstatlist = [(0.01, "01_0_percentile", 100), (0.1, "10_0_percentile", 10),\
-                             (0.50, "50_0_percentile", 10), (0.90, "90_0_percentile", 10),\
-                             (0.95, "95_0_percentile", 20), (0.99, "99_0_percentile", 100),\
-                             (0.999, "99_9_percentile", 1000)]
-
-            for percentile, percentilestring, minnumtoobserve in orderstatlist:
-                if count >= minnumtoobserve:
-                    stats[percentilestring] = samples[int(percentile*count)]
-                else:
-                    stats[percentilestring] = None
-
-            output[category] = stats
+        for category, histogram in self.latencies.items():
+            stats = histogram.get_stats(window)
+            if stats is not None:
+                output[category] = stats
         return output
 
     def log(self, *args, **kwargs):
         if "facility" not in kwargs:
             kwargs["facility"] = "tahoe.storage"
+        if threadable.ioThread is not None and not threadable.isInIOThread():
+            # a MutableShareFile that is used in a disk I/O thread logs
+            # through us, and logging is only safe on the reactor thread
+            reactor.callFromThread(log.msg, *args, **kwargs)
+            return None
         return log.msg(*args, **kwargs)
 
     def _clean_incomplete(self):
-        fileutil.rm_dir(self.incomingdir)
+        for disk in self.disks:
+            fileutil.rm_dir(disk.incomingdir)
 
     def get_stats(self):
         # remember: RIStatsProvider requires that our return dict
         # contains numeric values.
         stats = { 'storage_server.allocated': self.allocated_size(), }
+        for (k, v) in self.space.get_stats().items():
+            stats['storage_server.space.' + k] = v
         stats['storage_server.reserved_space'] = self.reserved_space
         for category,ld in self.get_latencies().items():
             for name,v in ld.items():
                 stats['storage_server.latencies.%s.%s' % (category, name)] = v
 
         try:
-            disk = fileutil.get_disk_stats(self.sharedir, self.reserved_space)
+            disk = self.disks.get_disk_stats()
             writeable = disk['avail'] > 0
 
             # spacetime predictors should use disk_avail / (d(disk_used)/dt)
@@ -198,6 +475,60 @@ class StorageServer(service.MultiService, Referenceable):
             writeable = False
 
         stats['storage_server.accepting_immutable_shares'] = int(writeable)
+        if self.inventory:
+            inv = self.inventory
+            stats['storage_server.inventory.buckets'] = inv.get_num_buckets()
+            stats['storage_server.inventory.shares'] = inv.get_num_shares()
+            stats['storage_server.inventory.memory'] = inv.get_memory_footprint()
+            stats['storage_server.inventory.build_time'] = inv.build_time
+        if self.packed:
+            for (k, v) in self.packed.get_stats().items():
+                stats['storage_server.packed.' + k] = v
+            stats['storage_server.packed.compacted'] = \
+                self.packed.bytes_compacted
+        stats['storage_server.mutable.relocated'] = \
+            self.mutable_relocated_bytes
+        stats['storage_server.mutable.compacted'] = \
+            self.mutable_compacted_bytes
+        stats['storage_server.mutable.compactions'] = self.mutable_compactions
+        stats['storage_server.share_dir_levels'] = self.disks.levels
+        stats['storage_server.share_dir_migrating'] = int(self.disks.migrating)
+        if self.share_counts and self.share_counts.reconciled:
+            for (k, v) in self.share_counts.get_stats().items():
+                stats['storage_server.share_counts.' + k] = v
+        if self.file_cache:
+            fc = self.file_cache
+            stats['storage_server.open_file_cache.open'] = fc.get_num_open()
+            stats['storage_server.open_file_cache.mapped'] = \
+                fc.get_num_mapped()
+            stats['storage_server.open_file_cache.hits'] = fc.hits
+            stats['storage_server.open_file_cache.misses'] = fc.misses
+            stats['storage_server.open_file_cache.evictions'] = fc.evictions
+            lookups = fc.hits + fc.misses
+            if lookups:
+                stats['storage_server.open_file_cache.hit_rate'] = \
+                    float(fc.hits) / lookups
+        if self.block_cache:
+            bc = self.block_cache
+            stats['storage_server.block_cache.size'] = bc.get_size()
+            stats['storage_server.block_cache.entries'] = bc.get_num_entries()
+            stats['storage_server.block_cache.hits'] = bc.hits
+            stats['storage_server.block_cache.misses'] = bc.misses
+            stats['storage_server.block_cache.bytes_served'] = bc.bytes_served
+            stats['storage_server.block_cache.evictions'] = bc.evictions
+            lookups = bc.hits + bc.misses
+            if lookups:
+                stats['storage_server.block_cache.hit_rate'] = \
+                    float(bc.hits) / lookups
+        if self.write_budget:
+            for (k, v) in self.write_budget.get_stats().items():
+                stats['storage_server.write_buffer.' + k] = v
+        if len(self.disks) > 1:
+            for disk in self.disks:
+                prefix = 'storage_server.disks.%d.' % disk.number
+                stats[prefix + 'avail'] = self.space.get_free(disk)
+                stats[prefix + 'buckets'] = disk.num_buckets
+                stats[prefix + 'load'] = self.get_disk_load(disk)
         s = self.bucket_counter.get_state()
         bucket_count = s.get("last-complete-bucket-count")
         if bucket_count:
@@ -210,13 +541,19 @@ class StorageServer(service.MultiService, Referenceable):
 
         if self.readonly_storage:
             return 0
-        return fileutil.get_available_space(self.sharedir, self.reserved_space)
+        return self.space.get_free()
+
+    def allocated_size(self, disk=None):
+        """Return the space promised to uploads which are still in
+        progress, on all disks or just the given one."""
+        return self.space.get_reserved(disk)
 
-    def allocated_size(self):
-        space = 0
-        for bw in self._active_writers:
-            space += bw.allocated_size()
-        return space
+    def get_disk_load(self, disk):
+        """Return a measure of how busy a disk is: the number of uploads
+        in progress to it, plus the number of disk operations that are
+        waiting for (or running in) its I/O threads."""
+        return (self.space.get_uploads(disk)
+                + self.disk_io.get_queue_depth(disk.sharedir))
 
     def remote_get_version(self):
         remaining_space = self.get_available_space()
@@ -231,11 +568,68 @@ class StorageServer(service.MultiService, Referenceable):
                       "delete-mutable-shares-with-zero-length-writev": True,
                       "fills-holes-with-zero-bytes": True,
                       "prevents-read-past-end-of-share-data": True,
+                      "supports-get-buckets-many": True,
+                      "supports-add-lease-many": True,
+                      "supports-verify-shares": True,
+                      "supports-sessions": True,
                       },
                     "application-version": str(allmydata.__full_version__),
                     }
         return version
 
+    def doRemoteCall(self, methodname, args, kwargs):
+        # clients that have not opened a session are all the same to us
+        return self.call_for(ANONYMOUS, self, methodname, args, kwargs)
+
+    def call_for(self, requester, target, methodname, args, kwargs):
+        """Make a remote call to 'target' (me, or one of my buckets) on
+        behalf of 'requester', so that any disk I/O it starts is scheduled
+        and counted as theirs."""
+        category = REQUEST_CATEGORIES.get(methodname, "other")
+        previous = self.current_request
+        self.current_request = (requester, category)
+        try:
+            return Referenceable.doRemoteCall(target, methodname, args,
+                                              kwargs)
+        finally:
+            self.current_request = previous
+
+    def _get_requester(self):
+        # the buckets that a remote call creates make their own calls on
+        # behalf of the same requester
+        if self.current_request is None:
+            return None
+        return self.current_request[0]
+
+    def remote_open_session(self, canary, priority):
+        if priority not in PRIORITIES:
+            raise ValueError("unknown priority %r" % (priority,))
+        # the client is known by the tub ID of the connection that the
+        # canary came over, which foolscap has authenticated, rather than
+        # by anything it tells us. Its requester (and the disk I/O
+        # engine's statistics for it) last until its last session's
+        # connection is lost, so there is one for each connected client at
+        # most.
+        key = (canary.getRemoteTubID(), priority)
+        if key in self._session_requesters:
+            entry = self._session_requesters[key]
+            entry[1] += 1
+        else:
+            entry = [Requester(key[0], priority), 1]
+            self._session_requesters[key] = entry
+        canary.notifyOnDisconnect(self._session_closed, key)
+        return StorageSession(self, entry[0])
+
+    def _session_closed(self, key):
+        entry = self._session_requesters[key]
+        entry[1] -= 1
+        if not entry[1]:
+            del self._session_requesters[key]
+            self.disk_io.forget_requester(entry[0])
+
+    def get_requester_stats(self):
+        return self.disk_io.get_requester_stats()
+
     def remote_allocate_buckets(self, storage_index,
                                 renew_secret, cancel_secret,
                                 sharenums, allocated_size,
@@ -247,30 +641,39 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("allocate")
         alreadygot = set()
         bucketwriters = {} # k: shnum, v: BucketWriter
+        # incoming/ always has one level of prefix directories: a
+        # BucketWriter removes the two it made when it is closed
         si_dir = storage_index_to_dir(storage_index)
+        final_si_dir = storage_index_to_dir(storage_index, self.disks.levels)
         si_s = si_b2a(storage_index)
 
         log.msg("storage: allocate_buckets %s" % si_s)
 
         # in this implementation, the lease information (including secrets)
-        # goes into the share files themselves. It could also be put into a
-        # separate database. Note that the lease should not be added until
-        # the BucketWriter has been closed.
+        # goes into the share files themselves, and (if enabled) is copied
+        # into the lease database. Note that the lease should not be added to
+        # the database until the BucketWriter has been closed.
         expire_time = time.time() + 31*24*60*60
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
                                expire_time, self.my_nodeid)
 
         max_space_per_bucket = allocated_size
+        pack = (self.packed is not None
+                and max_space_per_bucket <= self.packed_max_share_size)
 
-        remaining_space = self.get_available_space()
-        limited = remaining_space is not None
-        if limited:
-            # this is a bit conservative, since some of this allocated_size()
-            # has already been written to disk, where it will show up in
-            # get_available_space.
-            remaining_space -= self.allocated_size()
-        # self.readonly_storage causes remaining_space <= 0
+        # all of a bucket's shares go onto the same disk. If no disk has
+        # room for even one of them (or we're read-only), we accept none.
+        disk = None
+        if not self.readonly_storage:
+            disk = self.disks.choose_disk(storage_index, max_space_per_bucket,
+                                          self.space.get_available,
+                                          self.get_disk_load)
+        if disk:
+            # this is a bit conservative, since some of the space promised
+            # to uploads in progress may already have been written to disk
+            remaining_space = self.space.get_available(disk)
+            limited = remaining_space is not None
 
         # fill alreadygot with all shares that we have, not just the ones
         # they asked about: this will save them a lot of work. Add or update
@@ -278,16 +681,29 @@ class StorageServer(service.MultiService, Referenceable):
         # file, they'll want us to hold leases for this file.
         for (shnum, fn) in self._get_bucket_shares(storage_index):
             alreadygot.add(shnum)
-            sf = ShareFile(fn)
+            sf = ShareFile(fn, file_cache=self.file_cache)
             sf.add_or_renew_lease(lease_info)
+            if self.leasedb:
+                self.leasedb.add_or_renew_lease(storage_index, shnum,
+                                                sf.sharetype, lease_info)
+        for (shnum, sf) in self._get_packed_shares(storage_index):
+            alreadygot.add(shnum)
+            sf.add_or_renew_lease(lease_info)
+            if self.leasedb:
+                self.leasedb.add_or_renew_lease(storage_index, shnum,
+                                                sf.sharetype, lease_info)
 
         for shnum in sharenums:
-            incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
-            finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
-            if os.path.exists(finalhome):
+            if shnum in alreadygot:
                 # great! we already have it. easy.
-                pass
-            elif os.path.exists(incominghome):
+                continue
+            if disk is None:
+                # bummer! not enough space to accept this bucket
+                continue
+            incominghome = os.path.join(disk.incomingdir, si_dir, "%d" % shnum)
+            finalhome = os.path.join(disk.sharedir, final_si_dir,
+                                     "%d" % shnum)
+            if os.path.exists(incominghome):
                 # Note that we don't create BucketWriters for shnums that
                 # have a partial share (in incoming/), so if a second upload
                 # occurs while the first is still in progress, the second
@@ -295,39 +711,113 @@ class StorageServer(service.MultiService, Referenceable):
                 pass
             elif (not limited) or (remaining_space >= max_space_per_bucket):
                 # ok! we need to create the new share file.
+                packer = None
+                if pack:
+                    packer = lambda filename, shnum=shnum: \
+                             pack_share_file(self.packed, storage_index,
+                                             shnum, filename)
                 bw = BucketWriter(self, incominghome, finalhome,
-                                  max_space_per_bucket, lease_info, canary)
+                                  max_space_per_bucket, lease_info, canary,
+                                  disk_io=self.disk_io, packer=packer,
+                                  requester=self._get_requester(),
+                                  durability=self.durability,
+                                  write_budget=self.write_budget)
                 if self.no_storage:
                     bw.throw_out_all_data = True
                 bucketwriters[shnum] = bw
-                self._active_writers[bw] = 1
+                ref = weakref.ref(bw, self._bucket_writer_collected)
+                self._active_writers[ref] = (storage_index, shnum, lease_info,
+                                             disk)
+                self._bucket_writers[storage_index] = \
+                    self._bucket_writers.get(storage_index, 0) + 1
+                self.space.reserve(bw, disk, max_space_per_bucket)
                 if limited:
                     remaining_space -= max_space_per_bucket
             else:
                 # bummer! not enough space to accept this bucket
                 pass
 
-        if bucketwriters:
-            fileutil.make_dirs(os.path.join(self.sharedir, si_dir))
+        if bucketwriters and not pack:
+            fileutil.make_dirs(os.path.join(disk.sharedir, final_si_dir))
+            self.disks.add_bucket(storage_index, disk)
+        if self.leasedb:
+            self.leasedb.commit()
 
         self.add_latency("allocate", time.time() - start)
         return alreadygot, bucketwriters
 
     def _iter_share_files(self, storage_index):
-        for shnum, filename in self._get_bucket_shares(storage_index):
-            f = open(filename, 'rb')
-            header = f.read(32)
-            f.close()
-            if header[:32] == MutableShareFile.MAGIC:
-                sf = MutableShareFile(filename, self)
+        for shnum, sf in self._iter_numbered_share_files(storage_index):
+            yield sf
+
+    def _iter_numbered_share_files(self, storage_index):
+        return self._open_share_files(storage_index,
+                                      self._get_share_types(storage_index))
+
+    def _get_share_types(self, storage_index):
+        """Return a list of (shnum, filename, sharetype) tuples for the shares
+        of this storage index, if they can be found without touching the
+        disk, else None. This must be called on the reactor thread, but its
+        result can be handed to _open_share_files() in a disk I/O thread."""
+        if not self.inventory:
+            return None
+        shares = self.inventory.get_shares(storage_index)
+        return [(shnum, filename, shares[shnum][0]) for (shnum, filename)
+                in self._get_bucket_shares(storage_index)]
+
+    def _find_shares(self, storage_index, sharetypes):
+        # this may be run in a disk I/O thread: 'sharetypes' is the result of
+        # an earlier _get_share_types() call, made on the reactor thread
+        if sharetypes is not None:
+            return sharetypes
+        return [(shnum, filename, None) for (shnum, filename)
+                in self._get_bucket_shares(storage_index)]
+
+    def _open_share_files(self, storage_index, sharetypes=None):
+        # this may be run in a disk I/O thread
+        for shnum, filename, sharetype in self._find_shares(storage_index,
+                                                            sharetypes):
+            if sharetype is None:
+                sharetype = get_share_type(filename)
+            if sharetype == "mutable":
+                sf = MutableShareFile(filename, self,
+                                      file_cache=self.file_cache)
                 # note: if the share has been migrated, the renew_lease()
                 # call will throw an exception, with information to help the
                 # client update the lease.
-            elif header[:4] == struct.pack(">L", 1):
-                sf = ShareFile(filename)
+            elif sharetype == "immutable":
+                sf = ShareFile(filename, file_cache=self.file_cache)
             else:
                 continue # non-sharefile
-            yield sf
+            yield shnum, sf
+        for shnum, sf in self._get_packed_shares(storage_index):
+            yield shnum, sf
+
+    def _get_packed_shares(self, storage_index):
+        """Return a list of (shnum, PackedShare) tuples for the shares of
+        this storage index that are held in the packed share store."""
+        if not self.packed:
+            return []
+        return [(shnum, PackedShare(self.packed, storage_index, shnum))
+                for shnum in self.packed.get_shnums(storage_index)]
+
+    def _get_bucketdir(self, storage_index):
+        if storage_index in self._pending_slots:
+            disk = self._pending_slots[storage_index][0]
+            return os.path.join(disk.sharedir,
+                                storage_index_to_dir(storage_index,
+                                                     self.disks.levels))
+        return self.disks.get_bucketdir(storage_index)
+
+    def _find_share_file(self, storage_index, shnum):
+        """Return the name of the file that holds this share, wherever it is
+        while the share directories are being migrated, or None if there is
+        no such file. This may be run in a disk I/O thread."""
+        for bucketdir in self.disks.get_bucketdirs(storage_index):
+            filename = os.path.join(bucketdir, "%d" % shnum)
+            if os.path.exists(filename):
+                return filename
+        return None
 
     def remote_add_lease(self, storage_index, renew_secret, cancel_secret,
                          owner_num=1):
@@ -337,41 +827,213 @@ class StorageServer(service.MultiService, Referenceable):
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
                                new_expire_time, self.my_nodeid)
-        for sf in self._iter_share_files(storage_index):
+        def _added(num_shares):
+            if self.leasedb:
+                self.leasedb.commit()
+            self.add_latency("add-lease", time.time() - start)
+            return None
+        return self._add_lease(storage_index, lease_info, _added)
+
+    def remote_add_lease_many(self, leases, owner_num=1):
+        start = time.time()
+        self.count("add-lease-many")
+        new_expire_time = time.time() + 31*24*60*60
+        added = []
+        for (storage_index, renew_secret, cancel_secret) in leases:
+            lease_info = LeaseInfo(owner_num,
+                                   renew_secret, cancel_secret,
+                                   new_expire_time, self.my_nodeid)
+            def _added(num_shares, storage_index=storage_index):
+                return (storage_index, num_shares)
+            added.append(self._add_lease(storage_index, lease_info, _added))
+        def _done(added):
+            if self.leasedb:
+                self.leasedb.commit()
+            self.add_latency("add-lease-many", time.time() - start)
+            # k: storage_index, v: number of shares leased
+            return dict(added)
+        return self.disk_io.gather(added, _done)
+
+    def _add_lease(self, storage_index, lease_info, then):
+        """Add (or renew) a lease on every share we hold for storage_index,
+        then call then() with the number of shares. The caller is
+        responsible for committing the leasedb."""
+        def _leased(leased):
+            if self.leasedb:
+                for shnum, sharetype in leased:
+                    self.leasedb.add_or_renew_lease(storage_index, shnum,
+                                                    sharetype, lease_info)
+            return then(len(leased))
+        return self.disk_io.run(self._get_bucketdir(storage_index),
+                                self._add_lease_to_share_files,
+                                lambda: (storage_index,
+                                         self._get_share_types(storage_index),
+                                 lease_info),
+                                _leased)
+
+    def _add_lease_to_share_files(self, storage_index, sharetypes,
+                                  lease_info):
+        # this may be run in a disk I/O thread
+        leased = [] # (shnum, sharetype)
+        for shnum, sf in self._open_share_files(storage_index, sharetypes):
             sf.add_or_renew_lease(lease_info)
-        self.add_latency("add-lease", time.time() - start)
-        return None
+            leased.append((shnum, sf.sharetype))
+        return leased
 
     def remote_renew_lease(self, storage_index, renew_secret):
         start = time.time()
         self.count("renew")
         new_expire_time = time.time() + 31*24*60*60
-        found_buckets = False
-        for sf in self._iter_share_files(storage_index):
-            found_buckets = True
+        def _renewed(renewed):
+            if self.leasedb:
+                for shnum in renewed:
+                    self.leasedb.renew_lease(storage_index, shnum,
+                                             renew_secret, new_expire_time)
+                self.leasedb.commit()
+            self.add_latency("renew", time.time() - start)
+            if not renewed:
+                raise IndexError("no such lease to renew")
+        return self.disk_io.run(self._get_bucketdir(storage_index),
+                                self._renew_lease_in_share_files,
+                                lambda: (storage_index,
+                                         self._get_share_types(storage_index),
+                                 renew_secret, new_expire_time),
+                                _renewed)
+
+    def _renew_lease_in_share_files(self, storage_index, sharetypes,
+                                    renew_secret, new_expire_time):
+        # this may be run in a disk I/O thread
+        renewed = [] # shnum
+        for shnum, sf in self._open_share_files(storage_index, sharetypes):
             sf.renew_lease(renew_secret, new_expire_time)
-        self.add_latency("renew", time.time() - start)
-        if not found_buckets:
-            raise IndexError("no such lease to renew")
+            renewed.append(shnum)
+        return renewed
 
     def bucket_writer_closed(self, bw, consumed_size):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
-        del self._active_writers[bw]
+        (storage_index, shnum, lease_info, disk) = \
+                        self._active_writers.pop(weakref.ref(bw))
+        self._bucket_writer_done(storage_index)
+        self.space.release(bw, consumed_size)
+        # an aborted BucketWriter reports that it consumed no space
+        if not consumed_size:
+            self._maybe_forget_bucket(storage_index)
+            return
+        if self.inventory and not bw.packed:
+            self.inventory.add_share(storage_index, shnum,
+                                     ShareFile.sharetype, consumed_size)
+        self._count_shares_changed(storage_index, ShareFile.sharetype,
+                                   [(None, consumed_size)])
+        if self.leasedb:
+            self.leasedb.add_or_renew_lease(storage_index, shnum,
+                                            ShareFile.sharetype, lease_info)
+            self.leasedb.commit()
+
+    def _bucket_writer_collected(self, ref):
+        # a BucketWriter that was neither closed nor aborted (the SpaceLedger
+        # gives back its reservation). This may happen in any thread, so the
+        # bucket is left in the DiskSet's index.
+        if ref not in self._active_writers:
+            return
+        (storage_index, shnum, lease_info, disk) = self._active_writers.pop(ref)
+        self._bucket_writer_done(storage_index)
+
+    def _bucket_writer_done(self, storage_index):
+        count = self._bucket_writers[storage_index] - 1
+        if count:
+            self._bucket_writers[storage_index] = count
+        else:
+            del self._bucket_writers[storage_index]
+
+    def bucket_writer_wrote(self, bw, length):
+        self.space.wrote(bw, length)
+
+    def share_deleted(self, storage_index, shnum, sharetype=None, size=None):
+        """Forget about a share which has just been deleted from disk. This
+        is called by the lease checker. The caller is responsible for
+        committing the leasedb. 'sharetype' and 'size' (of the share file)
+        are used to keep the share counts, if they are known."""
+        if self.inventory and sharetype is None:
+            (sharetype, size) = self.inventory.get_shares(
+                storage_index).get(shnum, (None, None))
+        disk = self.disks.find_disk(storage_index) or self.disks[0]
+        self._forget_share(storage_index, shnum)
+        self._count_shares_changed(storage_index, sharetype,
+                                   [(size or 0, None)])
+        if size:
+            self.space.commit(disk, -size)
+
+    def _forget_share(self, storage_index, shnum):
+        if self.block_cache:
+            self.block_cache.invalidate(storage_index, shnum)
+        if self.inventory:
+            self.inventory.remove_share(storage_index, shnum)
+        if self.leasedb:
+            self.leasedb.remove_share(si_b2a(storage_index), shnum)
+        self._maybe_forget_bucket(storage_index)
+
+    def _maybe_forget_bucket(self, storage_index):
+        # once a bucket has no shares left, and none are being written into
+        # it, the DiskSet no longer needs to know which disk it is on
+        if (len(self.disks) == 1 or storage_index in self._pending_slots
+            or storage_index in self._bucket_writers):
+            return
+        if not self._count_bucket_shares(storage_index):
+            self.disks.remove_bucket(storage_index)
+
+    def _count_bucket_shares(self, storage_index):
+        num_shares = len(list(self._get_bucket_shares(storage_index)))
+        if self.packed:
+            num_shares += len(self.packed.get_shnums(storage_index))
+        return num_shares
+
+    def _count_shares_changed(self, storage_index, sharetype, changes):
+        # 'changes' is a list of (old size, new size) for shares of this
+        # storage index that have just been written to disk, with None for
+        # the old size of a new share, and for the new size of a deleted
+        # one. This must be called before anything else can change the
+        # bucket, so that we can tell whether the bucket was (or now is)
+        # empty.
+        if not self.share_counts or sharetype is None:
+            return
+        added = len([1 for (old, new) in changes
+                     if old is None and new is not None])
+        removed = len([1 for (old, new) in changes
+                       if old is not None and new is None])
+        size = sum([(new or 0) - (old or 0) for (old, new) in changes])
+        num_shares = self._count_bucket_shares(storage_index)
+        had_shares = num_shares - added + removed
+        buckets = int(num_shares > 0) - int(had_shares > 0)
+        self.share_counts.update(storage_index, sharetype,
+                                 buckets, added - removed, size)
 
     def _get_bucket_shares(self, storage_index):
         """Return a list of (shnum, pathname) tuples for files that hold
         shares for this storage_index. In each tuple, 'shnum' will always be
-        the integer form of the last component of 'pathname'."""
-        storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
-        try:
-            for f in os.listdir(storagedir):
-                if NUM_RE.match(f):
-                    filename = os.path.join(storagedir, f)
-                    yield (int(f), filename)
-        except OSError:
-            # Commonly caused by there being no buckets at all.
-            pass
+        the integer form of the last component of 'pathname'. While the
+        share directories are being migrated, the shares of one bucket may
+        be in more than one layout."""
+        storagedirs = self.disks.get_bucketdirs(storage_index)
+        if self.inventory:
+            for shnum in self.inventory.get_shares(storage_index):
+                filename = os.path.join(storagedirs[0], "%d" % shnum)
+                if self.disks.migrating:
+                    filename = (self._find_share_file(storage_index, shnum)
+                                or filename)
+                yield (shnum, filename)
+            return
+        found = set()
+        for storagedir in storagedirs:
+            try:
+                for f in os.listdir(storagedir):
+                    if NUM_RE.match(f) and int(f) not in found:
+                        found.add(int(f))
+                        filename = os.path.join(storagedir, f)
+                        yield (int(f), filename)
+            except OSError:
+                # Commonly caused by there being no buckets at all.
+                pass
 
     def remote_get_buckets(self, storage_index):
         start = time.time()
@@ -381,10 +1043,98 @@ class StorageServer(service.MultiService, Referenceable):
         bucketreaders = {} # k: sharenum, v: BucketReader
         for shnum, filename in self._get_bucket_shares(storage_index):
             bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
+                                                storage_index, shnum,
+                                                disk_io=self.disk_io,
+                                                file_cache=self.file_cache,
+                                                requester=self._get_requester(),
+                                                block_cache=self.block_cache)
+        for shnum, sf in self._get_packed_shares(storage_index):
+            bucketreaders[shnum] = self._get_packed_reader(storage_index, sf)
         self.add_latency("get", time.time() - start)
         return bucketreaders
 
+    def remote_get_buckets_many(self, storage_indexes, want_readers=True):
+        start = time.time()
+        self.count("get-many")
+        log.msg("storage: get_buckets_many (%d storage indexes)"
+                % len(storage_indexes))
+        results = {} # k: storage_index, v: {sharenum: BucketReader or None}
+        for storage_index in storage_indexes:
+            buckets = {}
+            for shnum, filename in self._get_bucket_shares(storage_index):
+                if want_readers:
+                    buckets[shnum] = BucketReader(self, filename,
+                                                  storage_index, shnum,
+                                                  disk_io=self.disk_io,
+                                                  file_cache=self.file_cache,
+                                                  requester=self._get_requester(),
+                                                  block_cache=self.block_cache)
+                else:
+                    buckets[shnum] = None
+            for shnum, sf in self._get_packed_shares(storage_index):
+                if want_readers:
+                    buckets[shnum] = self._get_packed_reader(storage_index,
+                                                             sf)
+                else:
+                    buckets[shnum] = None
+            if buckets:
+                results[storage_index] = buckets
+        self.add_latency("get-many", time.time() - start)
+        return results
+
+    def remote_verify_shares(self, storage_index, sharenums):
+        start = time.time()
+        self.count("verify")
+        si_s = si_b2a(storage_index)
+        log.msg("storage: verify_shares %s %s" % (si_s, sorted(sharenums)))
+        def _verified(results):
+            self.add_latency("verify", time.time() - start)
+            return results
+        return self.disk_io.run(self._get_bucketdir(storage_index),
+                                self._verify_share_files,
+                                lambda: (storage_index,
+                                         self._get_share_types(storage_index),
+                                         sharenums),
+                                _verified)
+
+    def _verify_share_files(self, storage_index, sharetypes, sharenums):
+        # this may be run in a disk I/O thread
+        shares = [] # (shnum, function to open the share)
+        for shnum, filename, sharetype in self._find_shares(storage_index,
+                                                            sharetypes):
+            shares.append((shnum,
+                           lambda filename=filename:
+                               ShareFile(filename,
+                                         file_cache=self.file_cache)))
+        for shnum, sf in self._get_packed_shares(storage_index):
+            shares.append((shnum, lambda sf=sf: sf))
+        results = {}
+        for shnum, open_share in shares:
+            if sharenums and shnum not in sharenums:
+                continue
+            try:
+                sf = open_share()
+                summary = verify_immutable_share(shnum, sf.read_share_data)
+                summary["status"] = "ok"
+            except IncompatibleShareError, e:
+                summary = {"status": "incompatible", "reason": str(e)}
+            except (CorruptShareError, UnknownImmutableContainerVersionError,
+                    EnvironmentError), e:
+                # a mutable share has an unknown container version, too
+                summary = {"status": "corrupt", "reason": str(e)}
+            results[shnum] = summary
+        return results
+
+    def _get_packed_reader(self, storage_index, sf):
+        # the share's would-be filename keeps its reads in order with other
+        # disk I/O for the bucket
+        filename = os.path.join(self._get_bucketdir(storage_index),
+                                "%d" % sf.shnum)
+        return BucketReader(self, filename, storage_index, sf.shnum,
+                            disk_io=self.disk_io, share_file=sf,
+                            requester=self._get_requester(),
+                            block_cache=self.block_cache)
+
     def get_leases(self, storage_index):
         """Provide an iterator that yields all of the leases attached to this
         bucket. Each lease is returned as a LeaseInfo instance.
@@ -396,9 +1146,11 @@ class StorageServer(service.MultiService, Referenceable):
         # from the first share
         try:
             shnum, filename = self._get_bucket_shares(storage_index).next()
-            sf = ShareFile(filename)
+            sf = ShareFile(filename, file_cache=self.file_cache)
             return sf.get_leases()
         except StopIteration:
+            for shnum, sf in self._get_packed_shares(storage_index):
+                return sf.get_leases()
             return iter([])
 
     def remote_slot_testv_and_readv_and_writev(self, storage_index,
@@ -409,39 +1161,181 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("writev")
         si_s = si_b2a(storage_index)
         log.msg("storage: slot_writev %s" % si_s)
-        si_dir = storage_index_to_dir(storage_index)
+        (write_enabler, renew_secret, cancel_secret) = secrets
+
+        ownerid = 1 # TODO
+        expire_time = time.time() + 31*24*60*60   # one month
+        lease_info = LeaseInfo(ownerid,
+                               renew_secret, cancel_secret,
+                               expire_time, self.my_nodeid)
+
+        pending = None
+        if self.disks.find_disk(storage_index) is None:
+            # a slot we have never seen: choose the disk it would go on, but
+            # only add it to the DiskSet's index once a share is created
+            # there, since the test vector may fail, or this may only read
+            pending = self._pending_slots.get(storage_index)
+            if pending is None:
+                disk = self.disks.choose_disk(storage_index, 0,
+                                              self.space.get_available,
+                                              self.get_disk_load)
+                if disk:
+                    pending = self._pending_slots[storage_index] = [disk, 0]
+            if pending:
+                pending[1] += 1
+        released = []
+        def _release_pending():
+            if pending and not released:
+                released.append(True)
+                pending[1] -= 1
+                if not pending[1]:
+                    del self._pending_slots[storage_index]
+
+        def _written((testv_failure, read_data, changed, moved)):
+            # 'changed' maps sharenum to the (old, new) size of the share
+            # file, with None for a share that was created or deleted
+            _release_pending()
+            testv_is_good = testv_failure is None
+            if not testv_is_good:
+                self.log(testv_failure)
+            if pending and [1 for (old, new) in changed.values()
+                            if old is None and new is not None]:
+                self.disks.add_bucket(storage_index, pending[0])
+            # (before the bucket can be forgotten, if it is emptied)
+            disk = self.disks.find_disk(storage_index) or self.disks[0]
+            self._count_relocations(*moved)
+            for sharenum, (old_size, size) in changed.items():
+                if size is None:
+                    self._forget_share(storage_index, sharenum)
+                    continue
+                if self.leasedb:
+                    self.leasedb.add_or_renew_lease(storage_index, sharenum,
+                                                    MutableShareFile.sharetype,
+                                                    lease_info)
+                if self.inventory:
+                    self.inventory.add_share(storage_index, sharenum,
+                                             MutableShareFile.sharetype,
+                                             size)
+            self._count_shares_changed(storage_index,
+                                       MutableShareFile.sharetype,
+                                       changed.values())
+            growth = sum([(new or 0) - (old or 0)
+                          for (old, new) in changed.values()])
+            if growth:
+                self.space.commit(disk, growth)
+            if testv_is_good and self.leasedb:
+                self.leasedb.commit()
+
+            # all done, once the writes are as durable as they should be
+            result = (testv_is_good, read_data)
+            d = self._sync_mutable_writes(storage_index, changed)
+            if d is None:
+                self.add_latency("writev", time.time() - start)
+                return result
+            def _synced(ign):
+                self.add_latency("writev", time.time() - start)
+                return result
+            d.addCallback(_synced)
+            return d
+        def _failed(f):
+            _release_pending()
+            return f
+        try:
+            d = self.disk_io.run(self._get_bucketdir(storage_index),
+                                 self._testv_and_readv_and_writev,
+                                 lambda: (storage_index,
+                                          self._get_share_types(storage_index),
+                                          secrets, test_and_write_vectors,
+                                          read_vector,
+                                          lease_info),
+                                 _written)
+        except:
+            _release_pending()
+            raise
+        if isinstance(d, defer.Deferred):
+            d.addErrback(_failed)
+        return d
+
+    def _count_relocations(self, relocated_bytes, compacted_bytes,
+                           compactions):
+        self.mutable_relocated_bytes += relocated_bytes
+        self.mutable_compacted_bytes += compacted_bytes
+        self.mutable_compactions += compactions
+
+    def _mutable_shares_compacted(self, storage_index, compacted):
+        # called by the MutableShareCompactor, with a list of (shnum,
+        # old_size, new_size, relocated_bytes) for the shares of this
+        # storage index that it has just compacted
+        changes = [(old_size, new_size)
+                   for (shnum, old_size, new_size, relocated) in compacted]
+        self._count_shares_changed(storage_index, MutableShareFile.sharetype,
+                                   changes)
+        if self.inventory:
+            for (shnum, old_size, new_size, relocated) in compacted:
+                self.inventory.add_share(storage_index, shnum,
+                                         MutableShareFile.sharetype, new_size)
+        disk = self.disks.find_disk(storage_index) or self.disks[0]
+        self.space.commit(disk, sum([new - old for (old, new) in changes]))
+        self._count_relocations(sum([c[3] for c in compacted]),
+                                sum([old - new for (old, new) in changes]),
+                                len(compacted))
+
+    def _sync_mutable_writes(self, storage_index, changed):
+        # returns a Deferred that fires when the shares in 'changed' have
+        # been synced, or None if nothing needs to be waited for
+        if self.durability.mode == "none" or not changed:
+            return None
+        bucketdir = self._get_bucketdir(storage_index)
+        # a share that has yet to be migrated is somewhere else: files that
+        # do not exist are skipped
+        files = [os.path.join(d, "%d" % sharenum)
+                 for (sharenum, (old_size, size)) in changed.items()
+                 if size is not None
+                 for d in self.disks.get_bucketdirs(storage_index)]
+        dirs = []
+        if [sizes for sizes in changed.values() if None in sizes]:
+            # a share file was created or deleted, and with it perhaps the
+            # bucket and prefix directories
+            dirs = [bucketdir]
+            for i in range(self.disks.levels + 1):
+                dirs.append(os.path.dirname(dirs[-1]))
+        return defer.maybeDeferred(self.durability.sync, bucketdir,
+                                   files, dirs)
+
+    def _testv_and_readv_and_writev(self, storage_index, sharetypes, secrets,
+                                    test_and_write_vectors, read_vector,
+                                    lease_info):
+        # this may be run in a disk I/O thread, so it leaves the leasedb,
+        # the inventory and the log alone, and returns the sharenums it
+        # changed (and why the test vectors failed, if they did) instead
+        si_s = si_b2a(storage_index)
         (write_enabler, renew_secret, cancel_secret) = secrets
         # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
+        bucketdir = self._get_bucketdir(storage_index)
         shares = {}
-        if os.path.isdir(bucketdir):
-            for sharenum_s in os.listdir(bucketdir):
-                try:
-                    sharenum = int(sharenum_s)
-                except ValueError:
-                    continue
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                msf.check_write_enabler(write_enabler, si_s)
-                shares[sharenum] = msf
+        for sharenum, filename, sharetype in self._find_shares(storage_index,
+                                                               sharetypes):
+            msf = MutableShareFile(filename, self, file_cache=self.file_cache)
+            msf.check_write_enabler(write_enabler, si_s)
+            shares[sharenum] = msf
         # write_enabler is good for all existing shares.
 
-        # Now evaluate test vectors.
-        testv_is_good = True
+        # Now evaluate test vectors. A failure is described to the caller,
+        # which logs it on the reactor thread.
+        testv_failure = None
         for sharenum in test_and_write_vectors:
             (testv, datav, new_length) = test_and_write_vectors[sharenum]
             if sharenum in shares:
                 if not shares[sharenum].check_testv(testv):
-                    self.log("testv failed: [%d]: %r" % (sharenum, testv))
-                    testv_is_good = False
+                    testv_failure = "testv failed: [%d]: %r" % (sharenum,
+                                                               testv)
                     break
             else:
                 # compare the vectors against an empty share, in which all
                 # reads return empty strings.
                 if not EmptyShare().check_testv(testv):
-                    self.log("testv failed (empty): [%d] %r" % (sharenum,
-                                                                testv))
-                    testv_is_good = False
+                    testv_failure = "testv failed (empty): [%d] %r" % (sharenum,
+                                                                       testv)
                     break
 
         # now gather the read vectors, before we do any writes
@@ -449,19 +1343,18 @@ class StorageServer(service.MultiService, Referenceable):
         for sharenum, share in shares.items():
             read_data[sharenum] = share.readv(read_vector)
 
-        ownerid = 1 # TODO
-        expire_time = time.time() + 31*24*60*60   # one month
-        lease_info = LeaseInfo(ownerid,
-                               renew_secret, cancel_secret,
-                               expire_time, self.my_nodeid)
-
-        if testv_is_good:
+        changed = {} # k: sharenum, v: (old size, new size)
+        if testv_failure is None:
             # now apply the write vectors
             for sharenum in test_and_write_vectors:
                 (testv, datav, new_length) = test_and_write_vectors[sharenum]
+                old_size = None
+                if sharenum in shares:
+                    old_size = os.path.getsize(shares[sharenum].home)
                 if new_length == 0:
                     if sharenum in shares:
                         shares[sharenum].unlink()
+                        changed[sharenum] = (old_size, None)
                 else:
                     if sharenum not in shares:
                         # allocate a new share
@@ -474,16 +1367,24 @@ class StorageServer(service.MultiService, Referenceable):
                     shares[sharenum].writev(datav, new_length)
                     # and update the lease
                     shares[sharenum].add_or_renew_lease(lease_info)
+                    changed[sharenum] = (old_size,
+                                         os.path.getsize(shares[sharenum].home))
+                if self.block_cache:
+                    # whatever was read from this share before is now stale
+                    self.block_cache.invalidate(storage_index, sharenum)
 
-            if new_length == 0:
+            if [1 for (old, new) in changed.values() if new is None]:
                 # delete empty bucket directories
-                if not os.listdir(bucketdir):
-                    os.rmdir(bucketdir)
+                for d in self.disks.get_bucketdirs(storage_index):
+                    if os.path.isdir(d) and not os.listdir(d):
+                        os.rmdir(d)
 
-
-        # all done
-        self.add_latency("writev", time.time() - start)
-        return (testv_is_good, read_data)
+        # growing a container moves its extra leases, and so does shrinking
+        # it, if the data shrank enough
+        moved = (sum([s.relocated_bytes for s in shares.values()]),
+                 sum([s.compacted_bytes for s in shares.values()]),
+                 len([s for s in shares.values() if s.compacted_bytes]))
+        return (testv_failure, read_data, changed, moved)
 
     def _allocate_slot_share(self, bucketdir, secrets, sharenum,
                              allocated_size, owner_num=0):
@@ -501,29 +1402,53 @@ class StorageServer(service.MultiService, Referenceable):
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %s %s" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
-        # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
+        def _read(datavs):
+            log.msg("returning shares %s" % (datavs.keys(),),
+                    facility="tahoe.storage", level=log.NOISY, parent=lp)
             self.add_latency("readv", time.time() - start)
-            return {}
+            return datavs
+        return self.disk_io.run(self._get_bucketdir(storage_index),
+                                self._readv_share_files,
+                                lambda: (storage_index,
+                                         self._get_share_types(storage_index),
+                                 shares, readv),
+                                _read)
+
+    def _readv_share_files(self, storage_index, sharetypes, shares, readv):
+        # this may be run in a disk I/O thread
+        # shares exist if there is a file for them
         datavs = {}
-        for sharenum_s in os.listdir(bucketdir):
-            try:
-                sharenum = int(sharenum_s)
-            except ValueError:
-                continue
+        for sharenum, filename, sharetype in self._find_shares(storage_index,
+                                                               sharetypes):
             if sharenum in shares or not shares:
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                datavs[sharenum] = msf.readv(readv)
-        log.msg("returning shares %s" % (datavs.keys(),),
-                facility="tahoe.storage", level=log.NOISY, parent=lp)
-        self.add_latency("readv", time.time() - start)
+                msf = MutableShareFile(filename, self,
+                                       file_cache=self.file_cache)
+                if self.block_cache:
+                    def read(offset, length, msf=msf):
+                        return msf.readv([(offset, length)])[0]
+                    datavs[sharenum] = [self.block_cache.read(storage_index,
+                                                              sharenum,
+                                                              offset, length,
+                                                              read)
+                                        for (offset, length) in readv]
+                else:
+                    datavs[sharenum] = msf.readv(readv)
         return datavs
 
     def remote_advise_corrupt_share(self, share_type, storage_index, shnum,
                                     reason):
+        self.write_corruption_advisory(share_type, storage_index, shnum,
+                                       reason)
+        log.msg(format=("client claims corruption in (%(share_type)s) " +
+                        "%(si)s-%(shnum)d: %(reason)s"),
+                share_type=share_type, si=si_b2a(storage_index), shnum=shnum,
+                reason=reason, level=log.SCARY, umid="SGx2fA")
+        return None
+
+    def write_corruption_advisory(self, share_type, storage_index, shnum,
+                                  reason):
+        """Record a report of corruption in one of my shares, in the
+        corruption-advisories directory."""
         fileutil.make_dirs(self.corruption_advisory_dir)
         now = time_format.iso_utc(sep="T")
         si_s = si_b2a(storage_index)
@@ -539,8 +1464,20 @@ class StorageServer(service.MultiService, Referenceable):
         f.write(reason)
         f.write("\n")
         f.close()
-        log.msg(format=("client claims corruption in (%(share_type)s) " +
-                        "%(si)s-%(shnum)d: %(reason)s"),
-                share_type=share_type, si=si_s, shnum=shnum, reason=reason,
-                level=log.SCARY, umid="SGx2fA")
-        return None
+
+
+class StorageSession(Referenceable):
+    """I am a StorageServer as seen by one client, which has opened me (and
+    told the server how urgent the requests made through me are) with
+    open_session(). Calls made through me are made on the server's behalf
+    of that client, so the disk I/O engine can schedule and count them
+    separately from everyone else's."""
+    implements(RIStorageServer)
+
+    def __init__(self, server, requester):
+        self._server = server
+        self.requester = requester
+
+    def doRemoteCall(self, methodname, args, kwargs):
+        return self._server.call_for(self.requester, self._server,
+                                     methodname, args, kwargs)
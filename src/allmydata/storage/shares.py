@@ -3,12 +3,12 @@
 from allmydata.storage.mutable import MutableShareFile
 from allmydata.storage.immutable import ShareFile
 
-def get_share_file(filename):
+def get_share_file(filename, file_cache=None):
     f = open(filename, "rb")
     prefix = f.read(32)
     f.close()
     if prefix == MutableShareFile.MAGIC:
-        return MutableShareFile(filename)
+        return MutableShareFile(filename, file_cache=file_cache)
     # otherwise assume it's immutable
-    return ShareFile(filename)
+    return ShareFile(filename, file_cache=file_cache)
 
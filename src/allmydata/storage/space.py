@@ -0,0 +1,164 @@
+import time, weakref
+
+
+class _DiskSpace:
+    # what the ledger knows about one disk
+    def __init__(self):
+        self.available = None # as of the last refresh, or None if unknown
+        self.refreshed = None # when, or None if never
+        self.reserved = 0 # promised to uploads in progress
+        self.uploads = 0 # number of uploads in progress
+        self.in_flight = 0 # written so far by uploads in progress
+        self.seen = 0 # the part of in_flight written before the refresh
+        self.committed = 0 # added (or, if negative, freed) since refresh
+        self.written = 0 # bytes written since refresh
+
+
+class SpaceLedger:
+    """I keep track of the space on each of a StorageServer's disks, so
+    that deciding whether an upload will fit takes neither a statvfs(2)
+    call nor a walk over every upload that is in progress.
+
+    Each BucketWriter reserves its maximum size when it is created, and
+    gives the reservation back when it is closed or aborted (or is garbage
+    collected without either: I only hold weak references to them). The
+    size of a finished share, or the change in size of a mutable share, is
+    'committed'. The free space reported by the disk is remembered, and
+    only asked for again every 'refresh_interval' seconds, or once
+    'refresh_bytes' have been written to the disk: in between, the space
+    committed since then is subtracted from it instead. The space available
+    for new shares is what remains once the outstanding reservations are
+    subtracted too.
+
+    The disk's figure already leaves out whatever the uploads in progress
+    had written when it was asked for, so that much of their reservations
+    is not subtracted again, and only the rest of each finished share is
+    committed.
+    """
+
+    refresh_interval = 60 # seconds
+    refresh_bytes = 64*1024*1024
+
+    def __init__(self, disks):
+        self._disks = disks
+        self._space = dict([(disk, _DiskSpace()) for disk in disks])
+        # k: weakref to a BucketWriter, v: [disk, size, bytes written,
+        # bytes written before the disk was last refreshed]
+        self._writers = {}
+        self.committed_total = 0
+        self.refreshes = 0
+
+    def refresh(self, disk=None):
+        """Ask the disk (or every disk) how much space it has available."""
+        if disk is None:
+            for disk in self._disks:
+                self.refresh(disk)
+            return
+        s = self._space[disk]
+        s.available = disk.get_available_space()
+        s.refreshed = time.time()
+        s.committed = 0
+        s.written = 0
+        for w in self._writers.values():
+            if w[0] is disk:
+                w[3] = w[2]
+        s.seen = s.in_flight
+        self.refreshes += 1
+
+    def _get_space(self, disk):
+        s = self._space[disk]
+        if (s.refreshed is None
+            or s.written >= self.refresh_bytes
+            or time.time() - s.refreshed >= self.refresh_interval):
+            self.refresh(disk)
+        return s
+
+    def reserve(self, bw, disk, size):
+        """Set aside 'size' bytes on 'disk' for the upload that 'bw' (a
+        BucketWriter) is about to do."""
+        self._writers[weakref.ref(bw, self._collected)] = [disk, size, 0, 0]
+        s = self._space[disk]
+        s.reserved += size
+        s.uploads += 1
+
+    def wrote(self, bw, length):
+        """Note that 'bw' has written another 'length' bytes."""
+        w = self._writers.get(weakref.ref(bw))
+        if w is None:
+            return
+        w[2] += length
+        s = self._space[w[0]]
+        s.in_flight += length
+        s.written += length
+
+    def release(self, bw, committed_size):
+        """Give back the reservation of 'bw', which has finished (having
+        used 'committed_size' bytes) or been aborted (with a size of 0)."""
+        self._release(weakref.ref(bw), committed_size)
+
+    def _collected(self, ref):
+        self._release(ref, 0)
+
+    def _release(self, ref, committed_size):
+        if ref not in self._writers:
+            return
+        (disk, size, written, seen) = self._writers.pop(ref)
+        s = self._space[disk]
+        s.reserved -= size
+        s.uploads -= 1
+        s.in_flight -= written
+        s.seen -= seen
+        # the disk has already been asked about the first 'seen' bytes
+        s.committed += committed_size - seen
+        self.committed_total += committed_size
+
+    def commit(self, disk, size):
+        """Note that the shares on 'disk' have grown by 'size' bytes (or
+        shrunk, if it is negative)."""
+        s = self._space[disk]
+        s.committed += size
+        self.committed_total += size
+
+    def get_available(self, disk):
+        """Return the space on 'disk' that is available for new shares,
+        less what has been reserved for the uploads in progress, or None if
+        this platform cannot tell."""
+        s = self._get_space(disk)
+        if s.available is None:
+            return None
+        return s.available - s.committed - (s.reserved - s.seen)
+
+    def get_free(self, disk=None):
+        """Return the space available for shares on 'disk' (or all disks),
+        without regard to the uploads in progress, or None if this platform
+        cannot tell."""
+        if disk is None:
+            total = 0
+            for disk in self._disks:
+                free = self.get_free(disk)
+                if free is None:
+                    return None
+                total += free
+            return total
+        s = self._get_space(disk)
+        if s.available is None:
+            return None
+        return s.available - s.committed
+
+    def get_reserved(self, disk=None):
+        if disk is None:
+            return sum([s.reserved for s in self._space.values()])
+        return self._space[disk].reserved
+
+    def get_in_flight(self):
+        return sum([s.in_flight for s in self._space.values()])
+
+    def get_uploads(self, disk):
+        return self._space[disk].uploads
+
+    def get_stats(self):
+        return {"reserved": self.get_reserved(),
+                "in_flight": self.get_in_flight(),
+                "committed": self.committed_total,
+                "refreshes": self.refreshes,
+                }
@@ -0,0 +1,262 @@
+import struct
+
+from twisted.internet import defer
+from twisted.python import failure
+from pycryptopp.publickey import rsa
+
+from allmydata import hashtree
+from allmydata.interfaces import HASH_SIZE
+from allmydata.util import mathutil
+from allmydata.util.hashutil import block_hash
+
+# the fields of an immutable share's header (see immutable/layout.py), in
+# the order of their offsets
+OFFSET_FIELDS = ('data',
+                 'plaintext_hash_tree', # UNUSED
+                 'crypttext_hash_tree',
+                 'block_hashes',
+                 'share_hashes',
+                 'uri_extension',
+                 )
+
+# URI extension blocks are around 419 bytes long: one this large must be
+# corrupt, and is not worth sending back to the client
+MAX_UEB_SIZE = 64*1024
+
+
+class CorruptShareError(Exception):
+    """The share is not internally consistent."""
+
+class IncompatibleShareError(Exception):
+    """The share is of a version which I do not know how to verify."""
+
+
+def _read_exactly(read, offset, length, what):
+    if offset < 0 or length < 0:
+        raise CorruptShareError("%s has a negative offset or length" % what)
+    data = read(offset, length)
+    if len(data) != length:
+        raise CorruptShareError("%s is truncated: wanted %d bytes at %d, "
+                                "got %d" % (what, length, offset, len(data)))
+    return data
+
+def _split_hashes(data):
+    return [data[i:i+HASH_SIZE] for i in range(0, len(data), HASH_SIZE)]
+
+def _set_hashes(tree, hashes, leaves, what):
+    try:
+        tree.set_hashes(hashes, leaves)
+    except (IndexError, hashtree.BadHashError,
+            hashtree.NotEnoughHashesError), e:
+        raise CorruptShareError("bad %s: %s" % (what, e))
+
+def verify_immutable_share(shnum, read):
+    """Check that the immutable share numbered 'shnum' is internally
+    consistent. 'read(offset, length)' must return the share data (as
+    BucketReader.remote_read() would).
+
+    Every block is read and hashed, and the block hash tree that is built
+    from them must match the one stored in the share. The crypttext hash
+    tree must be consistent with its root, and the share hash chain must
+    lead from the root of the block hash tree to the share root hash in the
+    URI extension block (UEB).
+
+    None of this shows that the share belongs to any particular file: only
+    someone who holds the verify-cap can check the UEB. So I return a
+    summary from which they can do that without reading the blocks: a dict
+    with the 'uri-extension' (the UEB itself), the 'share-hashes' chain,
+    the 'block-hash-root', the 'crypttext-hash-root' and the 'num-blocks'.
+    I raise CorruptShareError or IncompatibleShareError if the share cannot
+    be verified."""
+    header = _read_exactly(read, 0, 4, "share header")
+    (version,) = struct.unpack(">L", header)
+    if version == 1:
+        (x, fieldsize, fieldstruct) = (0x0c, 4, ">L")
+    elif version == 2:
+        (x, fieldsize, fieldstruct) = (0x14, 8, ">Q")
+    else:
+        raise IncompatibleShareError("unknown share version %d" % version)
+    header = _read_exactly(read, x, fieldsize*len(OFFSET_FIELDS),
+                           "share header")
+    offsets = {}
+    for field in OFFSET_FIELDS:
+        (offsets[field],) = struct.unpack(fieldstruct, header[:fieldsize])
+        header = header[fieldsize:]
+
+    # the UEB tells us how the share is laid out
+    (ueb_length,) = struct.unpack(fieldstruct,
+                                  _read_exactly(read,
+                                                offsets['uri_extension'],
+                                                fieldsize,
+                                                "URI extension length"))
+    if ueb_length > MAX_UEB_SIZE:
+        raise CorruptShareError("URI extension is too large (%d bytes)"
+                                % ueb_length)
+    ueb = _read_exactly(read, offsets['uri_extension'] + fieldsize,
+                        ueb_length, "URI extension")
+    from allmydata.uri import unpack_extension
+    try:
+        d = unpack_extension(ueb)
+        size = d['size']
+        segment_size = d['segment_size']
+        needed_shares = d['needed_shares']
+        total_shares = d['total_shares']
+        share_root_hash = d['share_root_hash']
+    except (KeyError, ValueError, IndexError, AssertionError), e:
+        raise CorruptShareError("cannot parse URI extension: %r" % (e,))
+    if not (size > 0 and segment_size > 0
+            and 0 < needed_shares <= total_shares and shnum < total_shares):
+        raise CorruptShareError("impossible encoding parameters in URI "
+                                "extension")
+    block_size = mathutil.div_ceil(segment_size, needed_shares)
+    num_blocks = mathutil.div_ceil(size, segment_size)
+    share_size = mathutil.div_ceil(size, needed_shares)
+
+    # the block hash tree must be the one that the blocks build
+    empty_tree = hashtree.IncompleteHashTree(num_blocks)
+    stored = _split_hashes(_read_exactly(read, offsets['block_hashes'],
+                                         len(empty_tree)*HASH_SIZE,
+                                         "block hash tree"))
+    leaves = []
+    for blocknum in range(num_blocks):
+        if blocknum < num_blocks-1:
+            this_block_size = block_size
+        else:
+            this_block_size = share_size % block_size or block_size
+        data = _read_exactly(read, offsets['data'] + blocknum*block_size,
+                             this_block_size, "block %d" % blocknum)
+        leaves.append(block_hash(data))
+    computed = list(hashtree.HashTree(leaves))
+    if computed != stored:
+        for blocknum in range(num_blocks):
+            if computed[empty_tree.first_leaf_num + blocknum] != \
+                    stored[empty_tree.first_leaf_num + blocknum]:
+                raise CorruptShareError("block %d does not match its hash"
+                                        % blocknum)
+        raise CorruptShareError("bad block hash tree")
+    block_hash_root = computed[0]
+
+    crypttext_tree = hashtree.IncompleteHashTree(num_blocks)
+    hashes = _split_hashes(_read_exactly(read,
+                                         offsets['crypttext_hash_tree'],
+                                         len(crypttext_tree)*HASH_SIZE,
+                                         "crypttext hash tree"))
+    _set_hashes(crypttext_tree, dict(enumerate(hashes)), {},
+                "crypttext hash tree")
+
+    # the share hash chain must lead from this share to the root
+    length = offsets['uri_extension'] - offsets['share_hashes']
+    if length < 0 or length % (2+HASH_SIZE):
+        raise CorruptShareError("share hash chain should occupy a multiple "
+                                "of %d bytes, not %d" % (2+HASH_SIZE, length))
+    data = _read_exactly(read, offsets['share_hashes'], length,
+                         "share hash chain")
+    share_hashes = []
+    for i in range(0, length, 2+HASH_SIZE):
+        (hashnum,) = struct.unpack(">H", data[i:i+2])
+        share_hashes.append((hashnum, data[i+2:i+2+HASH_SIZE]))
+    share_tree = hashtree.IncompleteHashTree(total_shares)
+    _set_hashes(share_tree, {0: share_root_hash}, {}, "share root hash")
+    _set_hashes(share_tree, dict(share_hashes), {shnum: block_hash_root},
+                "share hash chain")
+
+    return {"uri-extension": ueb,
+            "share-hashes": share_hashes,
+            "block-hash-root": block_hash_root,
+            "crypttext-hash-root": hashes[0],
+            "num-blocks": num_blocks,
+            }
+
+
+class _LocalSlot:
+    # stands in for the RemoteReference of a storage server, so that an
+    # MDMFSlotReadProxy can read a mutable share through 'read'
+    def __init__(self, read):
+        self._read = read
+
+    def callRemote(self, methname, storage_index, shnums, readv):
+        assert methname == "slot_readv", methname
+        return defer.succeed(dict([(shnum, [self._read(offset, length)
+                                            for (offset, length) in readv])
+                                   for shnum in shnums]))
+
+def _result(d):
+    # the Deferreds of a proxy that reads from a _LocalSlot have already
+    # fired by the time they are returned
+    results = []
+    d.addBoth(results.append)
+    assert results, "read proxy did not fire synchronously"
+    if isinstance(results[0], failure.Failure):
+        results[0].raiseException()
+    return results[0]
+
+def verify_mutable_share(shnum, read):
+    """Check that the mutable (SDMF or MDMF) share numbered 'shnum' is
+    internally consistent. 'read(offset, length)' must return the share data
+    (as MutableShareFile.readv() would, for a single read vector).
+
+    The signature over the share's prefix must be made by the verification
+    key that the share carries. Every block is read and hashed, and must
+    match the block hash tree, and the share hash chain must lead from the
+    root of that tree to the (signed) root hash. Without the read-cap, this
+    does not show that the key is the right one for the storage index.
+
+    I return a dict with the 'seqnum', the 'root-hash' and the 'num-blocks'
+    of the share, or raise CorruptShareError or IncompatibleShareError."""
+    from allmydata.mutable.common import BadShareError, UnknownVersionError
+    from allmydata.mutable.layout import MDMFSlotReadProxy
+    reader = MDMFSlotReadProxy(_LocalSlot(read), None, shnum)
+    try:
+        return _verify_mutable_share(shnum, reader)
+    except UnknownVersionError, e:
+        raise IncompatibleShareError(str(e))
+    except (BadShareError, struct.error), e:
+        raise CorruptShareError(str(e))
+
+def _verify_mutable_share(shnum, reader):
+    (seqnum, root_hash, IV, segment_size, data_length, k, N, prefix,
+     offsets) = _result(reader.get_verinfo())
+    if not (0 < k <= N and shnum < N):
+        raise CorruptShareError("impossible encoding parameters in header")
+
+    verification_key = _result(reader.get_verification_key())
+    signature = _result(reader.get_signature())
+    try:
+        verifier = rsa.create_verifying_key_from_string(verification_key)
+        valid = verifier.verify(prefix, signature)
+    except rsa.Error, e:
+        raise CorruptShareError("bad verification key: %s" % (e,))
+    if not valid:
+        raise CorruptShareError("signature is invalid")
+
+    if data_length == 0:
+        num_blocks = 0
+    elif IV is not None:
+        num_blocks = 1 # SDMF files have a single segment
+    else:
+        if segment_size == 0:
+            raise CorruptShareError("impossible segment size in header")
+        num_blocks = mathutil.div_ceil(data_length, segment_size)
+    if num_blocks:
+        block_tree = hashtree.IncompleteHashTree(num_blocks)
+        hashes = _result(reader.get_blockhashes())
+        _set_hashes(block_tree, dict(enumerate(hashes)), {},
+                    "block hash tree")
+        for blocknum in range(num_blocks):
+            (block, salt) = _result(reader.get_block_and_salt(blocknum))
+            if IV is not None:
+                leaf = block_hash(block)
+            else:
+                leaf = block_hash(salt + block)
+            _set_hashes(block_tree, {}, {blocknum: leaf},
+                        "block %d" % blocknum)
+
+        share_tree = hashtree.IncompleteHashTree(N)
+        _set_hashes(share_tree, {0: root_hash}, {}, "root hash")
+        _set_hashes(share_tree, _result(reader.get_sharehashes()),
+                    {shnum: block_tree[0]}, "share hash chain")
+
+    return {"seqnum": seqnum,
+            "root-hash": root_hash,
+            "num-blocks": num_blocks,
+            }
@@ -0,0 +1,49 @@
+class WriteBufferBudget:
+    """I limit the memory that BucketWriters may use to buffer the data of
+    remote_write() calls. An upload writes each share as many small pieces
+    (a block at a time, then each hash tree), one after another: a writer
+    with a budget holds on to each run of contiguous pieces, and writes it
+    to the disk in one go once it reaches 'flush_size' bytes, or when the
+    share is closed. All writers together hold at most 'max_bytes'; a write
+    that would take them over that is written out at once, after whatever
+    its writer was holding.
+    """
+
+    flush_size = 256*1024
+
+    def __init__(self, max_bytes, flush_size=None):
+        assert max_bytes > 0, max_bytes
+        self.max_bytes = max_bytes
+        if flush_size is not None:
+            self.flush_size = flush_size
+        self.buffered = 0 # bytes held by writers, or being written out
+        self.writes_buffered = 0
+        self.writes_unbuffered = 0 # because the budget was used up
+        self.flushes = 0
+        self.bytes_flushed = 0
+
+    def reserve(self, size):
+        """Return True, and count 'size' bytes against the budget, if they
+        fit within it."""
+        if self.buffered + size > self.max_bytes:
+            self.writes_unbuffered += 1
+            return False
+        self.buffered += size
+        self.writes_buffered += 1
+        return True
+
+    def release(self, size):
+        self.buffered -= size
+        assert self.buffered >= 0, self.buffered
+
+    def flushed(self, size):
+        self.flushes += 1
+        self.bytes_flushed += size
+
+    def get_stats(self):
+        return {"buffered": self.buffered,
+                "writes_buffered": self.writes_buffered,
+                "writes_unbuffered": self.writes_unbuffered,
+                "flushes": self.flushes,
+                "bytes_flushed": self.bytes_flushed,
+                }
@@ -29,14 +29,20 @@ the foolscap-based server implemented in src/allmydata/storage/*.py .
 # 6: implement other sorts of IStorageClient classes: S3, etc
 
 
-import re, time
+import re, time, weakref
 from zope.interface import implements
-from foolscap.api import eventually
-from allmydata.interfaces import IStorageBroker, IDisplayableServer, IServer
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from foolscap.api import eventually, DeadReferenceError, RemoteException, \
+     Referenceable
+from allmydata.interfaces import IStorageBroker, IDisplayableServer, IServer, \
+     MAX_STORAGE_INDEXES
 from allmydata.util import log, base32
+from allmydata.util.observer import OneShotObserverList
 from allmydata.util.assertutil import precondition
 from allmydata.util.rrefutil import add_version_to_remote_reference
 from allmydata.util.hashutil import sha1
+from allmydata.storage.scheduler import PRIORITIES
 
 # who is responsible for de-duplication?
 #  both?
@@ -62,10 +68,13 @@ class StorageFarmBroker:
     I'm also responsible for subscribing to the IntroducerClient to find out
     about new servers as they are announced by the Introducer.
     """
-    def __init__(self, tub, permute_peers):
+    def __init__(self, tub, permute_peers, storage_priority=None):
         self.tub = tub
         assert permute_peers # False not implemented yet
         self.permute_peers = permute_peers
+        # if given, we open sessions on each server that supports them, and
+        # no request is made with a more urgent priority than this one
+        self.storage_priority = storage_priority
         # self.servers maps serverid -> IServer, and keeps track of all the
         # storage servers that we've heard about. Each descriptor manages its
         # own Reconnector, and will give us a RemoteReference when we ask
@@ -92,7 +101,8 @@ class StorageFarmBroker:
             precondition(isinstance(key_s, str), key_s)
             precondition(key_s.startswith("v0-"), key_s)
         assert ann["service-name"] == "storage"
-        s = NativeStorageServer(key_s, ann)
+        s = NativeStorageServer(key_s, ann,
+                                storage_priority=self.storage_priority)
         serverid = s.get_serverid()
         old = self.servers.get(serverid)
         if old:
@@ -182,14 +192,26 @@ class NativeStorageServer:
           "maximum-mutable-share-size": 2*1000*1000*1000, # maximum prior to v1.9.2
           "tolerates-immutable-read-overrun": False,
           "delete-mutable-shares-with-zero-length-writev": False,
+          "supports-get-buckets-many": False,
+          "supports-add-lease-many": False,
+          "supports-verify-shares": False,
+          "supports-sessions": False,
           },
         "application-version": "unknown: no get_version()",
         }
 
-    def __init__(self, key_s, ann, min_shares=1):
+    def __init__(self, key_s, ann, min_shares=1, storage_priority=None):
         self.key_s = key_s
         self.announcement = ann
         self.min_shares = min_shares
+        # if given, our requests are made through sessions, one for each
+        # priority no more urgent than this one, so that the server can
+        # tell them apart from other clients', and bulk ones from
+        # interactive ones. The server knows us by the connection that our
+        # canary is sent over
+        self.storage_priority = storage_priority
+        self._session_rrefs = {} # k: priority, v: RemoteReference
+        self._session_canary = Referenceable()
 
         assert "anonymous-storage-FURL" in ann, ann
         furl = str(ann["anonymous-storage-FURL"])
@@ -289,14 +311,46 @@ class NativeStorageServer:
                 facility="tahoe.storage_broker", umid="SWmJYg",
                 level=log.NOISY, parent=lp)
 
+        v1 = rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+        if self.storage_priority is None or not v1["supports-sessions"]:
+            self._connected({}, rref)
+            return
+        priorities = PRIORITIES[PRIORITIES.index(self.storage_priority):]
+        def _open(priority):
+            d = rref.callRemote("open_session", self._session_canary,
+                                priority)
+            def _opened(session_rref):
+                session_rref.version = rref.version
+                return (priority, session_rref)
+            def _failed(f):
+                log.msg(format="%(name)s would not open a %(priority)s session",
+                        name=self.get_name(), priority=priority, failure=f,
+                        facility="tahoe.storage_broker", umid="Jb6Fzw",
+                        level=log.UNUSUAL, parent=lp)
+                return None
+            d.addCallbacks(_opened, _failed)
+            return d
+        d = defer.gatherResults([_open(priority) for priority in priorities])
+        d.addCallback(lambda sessions: dict(filter(None, sessions)))
+        d.addCallback(self._connected, rref)
+        d.addErrback(log.err, format="storageclient._got_versioned_service",
+                     name=self.get_name(), umid="rY0u9Q")
+
+    def _connected(self, session_rrefs, rref):
+        # 'session_rrefs' holds the sessions (if any) that we opened with
+        # 'rref', by priority
         self.last_connect_time = time.time()
         self.remote_host = rref.getPeer()
         self.rref = rref
+        self._session_rrefs = session_rrefs
         self._is_connected = True
         rref.notifyOnDisconnect(self._lost)
 
-    def get_rref(self):
-        return self.rref
+    def get_rref(self, priority="interactive"):
+        if self.storage_priority is not None:
+            priority = PRIORITIES[max(PRIORITIES.index(priority),
+                                      PRIORITIES.index(self.storage_priority))]
+        return self._session_rrefs.get(priority, self.rref)
 
     def _lost(self):
         log.msg(format="lost connection to %(name)s", name=self.get_name(),
@@ -320,3 +374,279 @@ class NativeStorageServer:
 
 class UnknownServerTypeError(Exception):
     pass
+
+
+class BucketQueryBatcher:
+    """I coalesce the get_buckets() queries sent to a single storage server.
+
+    When no query is outstanding, a new query is sent right away, so an
+    idle client pays no extra latency. Otherwise, queries are held until
+    the end of the reactor turn in which they were made, and are then sent
+    together, in one get_buckets_many() call per MAX_STORAGE_INDEXES
+    storage indexes, if the server advertises support for it. At most
+    'max_in_flight' of those calls are outstanding at once: queries that
+    arrive while that many are in flight are held until one of them has
+    been answered, so the busier the client is, the larger the batches
+    become, but one slow call does not hold up all of the others. Servers
+    which do not support get_buckets_many() get one get_buckets() call per
+    storage index, sent right away, as before.
+
+    I can also prefetch the share numbers for a list of storage indexes
+    (e.g. all the files in a directory that is about to be deep-checked).
+    The next query for each of those storage indexes which does not need
+    bucket readers will be answered from the prefetched results. Each
+    prefetched answer is used only once, none are used once they are more
+    than PREFETCH_EXPIRY seconds old, and each prefetch() discards any
+    answers left over from the previous one.
+
+    I do not hold a reference to the server: it is passed in with each
+    query, and I fetch its current RemoteReference when the queries are
+    sent.
+    """
+
+    PREFETCH_EXPIRY = 60 # seconds
+
+    def __init__(self, max_in_flight=4):
+        assert max_in_flight > 0, max_in_flight
+        self.max_in_flight = max_in_flight
+        self._pending = {True: {}, False: {}} # want_readers -> {si: [d,..]}
+        self._in_flight = 0
+        self._flush_scheduled = False
+        self._prefetched = {} # storage_index -> OneShotObserverList
+        self._prefetched_at = None
+
+    def get_buckets(self, server, storage_index, want_readers=True):
+        if (self._prefetched and
+            time.time() - self._prefetched_at > self.PREFETCH_EXPIRY):
+            # the servers may have gained or lost shares since then
+            self._prefetched = {}
+        if not want_readers and storage_index in self._prefetched:
+            return self._prefetched.pop(storage_index).when_fired()
+        d = self._enqueue(storage_index, want_readers)
+        self._send_or_schedule(server)
+        return d
+
+    def prefetch(self, server, storage_indexes):
+        self._prefetched = prefetched = {}
+        self._prefetched_at = time.time()
+        for storage_index in storage_indexes:
+            if storage_index in prefetched:
+                continue
+            ol = OneShotObserverList()
+            prefetched[storage_index] = ol
+            d = self._enqueue(storage_index, False)
+            d.addBoth(ol.fire)
+        self._send_or_schedule(server)
+
+    def _enqueue(self, storage_index, want_readers):
+        d = defer.Deferred()
+        waiters = self._pending[want_readers].setdefault(storage_index, [])
+        waiters.append(d)
+        return d
+
+    def _send_or_schedule(self, server):
+        if self._in_flight or self._flush_scheduled:
+            self._schedule_flush(server)
+        else:
+            self._maybe_flush(server)
+
+    def _schedule_flush(self, server):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            eventually(self._flush, server)
+
+    def _flush(self, server):
+        self._flush_scheduled = False
+        self._maybe_flush(server)
+
+    def _maybe_flush(self, server):
+        rref = server.get_rref()
+        version = server.get_version() or {}
+        v1 = version.get("http://allmydata.org/tahoe/protocols/storage/v1",
+                         {})
+        batched = v1.get("supports-get-buckets-many", False)
+        for want_readers in (True, False):
+            pending = self._pending[want_readers]
+            if not pending:
+                continue
+            if not batched:
+                self._pending[want_readers] = {}
+                for storage_index in pending:
+                    d = rref.callRemote("get_buckets", storage_index)
+                    d.addBoth(self._distribute, [storage_index], pending)
+                continue
+            storage_indexes = sorted(pending)
+            while storage_indexes and self._in_flight < self.max_in_flight:
+                batch = storage_indexes[:MAX_STORAGE_INDEXES]
+                del storage_indexes[:MAX_STORAGE_INDEXES]
+                waiters = dict([(storage_index, pending.pop(storage_index))
+                                for storage_index in batch])
+                d = self._send(server, rref, "get_buckets_many",
+                               batch, want_readers)
+                d.addBoth(self._distribute_many, batch, waiters)
+            # anything left over is sent when a slot comes free
+
+    def _send(self, server, rref, methname, *args):
+        self._in_flight += 1
+        d = rref.callRemote(methname, *args)
+        def _retired(res):
+            self._in_flight -= 1
+            self._schedule_flush(server)
+            return res
+        d.addBoth(_retired)
+        return d
+
+    def _distribute(self, res, storage_indexes, pending):
+        for storage_index in storage_indexes:
+            for d in pending[storage_index]:
+                if isinstance(res, Failure):
+                    d.errback(res)
+                else:
+                    d.callback(dict(res))
+
+    def _distribute_many(self, res, storage_indexes, pending):
+        if isinstance(res, Failure):
+            return self._distribute(res, storage_indexes, pending)
+        for storage_index in storage_indexes:
+            self._distribute(res.get(storage_index, {}), [storage_index],
+                             pending)
+
+# server -> BucketQueryBatcher. The batchers are discarded along with the
+# IServer instances they belong to.
+_batchers = weakref.WeakKeyDictionary()
+
+def _get_batcher(server):
+    if server not in _batchers:
+        _batchers[server] = BucketQueryBatcher()
+    return _batchers[server]
+
+def get_buckets(server, storage_index, want_readers=True):
+    """Ask the given IServer which shares it holds for storage_index. I
+    return a Deferred that fires with a dict mapping sharenum to an
+    RIBucketReader, or errbacks if the query failed. If want_readers is
+    False, the caller only cares about the share numbers, and the values of
+    the dict should be ignored (they will usually be None).
+
+    Where the server supports it, the first query made while none are
+    outstanding is sent right away, and any others made in the same reactor
+    turn are batched into a single get_buckets_many() call at the end of
+    it (see BucketQueryBatcher). Callers that look up many storage indexes
+    should therefore issue their queries together rather than waiting for
+    each answer in turn."""
+    return _get_batcher(server).get_buckets(server, storage_index,
+                                            want_readers)
+
+def prefetch_buckets(servers, storage_indexes):
+    """Ask each of the given IServers which shares it holds for all of the
+    given storage indexes, in as few queries as possible. Subsequent
+    get_buckets(want_readers=False) calls for those storage indexes will
+    use the prefetched answers instead of sending a new query."""
+    for server in servers:
+        _get_batcher(server).prefetch(server, storage_indexes)
+
+
+class LeaseAdder:
+    """I add leases to many storage indexes on many servers, sending them in
+    batches of up to 'batch_size' storage indexes per add_lease_many() call,
+    with at most 'concurrency' calls outstanding to any one server. Servers
+    which do not support add_lease_many() are sent one add_lease() call per
+    storage index instead, and each batch of those counts as one call.
+
+    add_lease() returns a Deferred which fires when the caller may queue
+    more leases: it only waits when the server in question already has
+    'concurrency' batches in flight and a new full batch is ready. Call
+    flush() once all leases have been queued: it sends any partial batches
+    and returns a Deferred which fires when every call has been answered.
+
+    Failures are logged and otherwise ignored, like those of the individual
+    add_lease() calls sent by the checkers.
+    """
+
+    def __init__(self, batch_size=100, concurrency=2):
+        assert 0 < batch_size <= MAX_STORAGE_INDEXES, batch_size
+        assert concurrency > 0, concurrency
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self._pending = {} # server -> [(storage_index, renew, cancel),..]
+        self._in_flight = {} # server -> number of outstanding batches
+        self._slot_waiters = {} # server -> [Deferred,..]
+        self._calls = set() # Deferreds for the outstanding batches
+
+    def add_lease(self, server, storage_index, renew_secret, cancel_secret):
+        pending = self._pending.setdefault(server, [])
+        pending.append( (storage_index, renew_secret, cancel_secret) )
+        if len(pending) < self.batch_size:
+            return defer.succeed(None)
+        return self._send_when_possible(server)
+
+    def flush(self):
+        ds = []
+        for server, pending in self._pending.items():
+            num_batches = (len(pending) + self.batch_size - 1) // self.batch_size
+            for i in range(num_batches):
+                ds.append(self._send_when_possible(server))
+        d = defer.DeferredList(ds)
+        d.addCallback(lambda ign: defer.DeferredList(list(self._calls)))
+        d.addCallback(lambda ign: None)
+        return d
+
+    def _send_when_possible(self, server):
+        if self._in_flight.get(server, 0) < self.concurrency:
+            self._send_batch(server)
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._slot_waiters.setdefault(server, []).append(d)
+        d.addCallback(lambda ign: self._send_batch(server))
+        return d
+
+    def _send_batch(self, server):
+        pending = self._pending.get(server)
+        if not pending:
+            return # an earlier batch took everything
+        batch = pending[:self.batch_size]
+        del pending[:self.batch_size]
+        self._in_flight[server] = self._in_flight.get(server, 0) + 1
+        # the leases of a deep-check can wait for the users of this server
+        rref = server.get_rref("bulk")
+        version = server.get_version() or {}
+        v1 = version.get("http://allmydata.org/tahoe/protocols/storage/v1",
+                         {})
+        if v1.get("supports-add-lease-many", False):
+            d = rref.callRemote("add_lease_many", batch)
+            d.addErrback(self._add_lease_failed, server)
+        else:
+            ds = []
+            for (storage_index, renew_secret, cancel_secret) in batch:
+                d = rref.callRemote("add_lease", storage_index,
+                                    renew_secret, cancel_secret)
+                d.addErrback(self._add_lease_failed, server)
+                ds.append(d)
+            d = defer.DeferredList(ds)
+        self._calls.add(d)
+        def _retired(ign):
+            self._calls.discard(d)
+            self._in_flight[server] -= 1
+            # a waiter may find nothing left to send, in which case the slot
+            # passes on to the next one
+            waiters = self._slot_waiters.get(server, [])
+            while waiters and self._in_flight[server] < self.concurrency:
+                waiters.pop(0).callback(None)
+        d.addCallback(_retired)
+
+    def _add_lease_failed(self, f, server):
+        # servers older than tahoe-1.4.0 raise IndexError (or worse) from
+        # add_lease() on buckets they do not hold. See
+        # immutable.checker.Checker._add_lease_failed for the details.
+        if f.check(DeadReferenceError):
+            return
+        if f.check(RemoteException):
+            if f.value.failure.check(KeyError, IndexError, NameError):
+                return
+            log.msg(format="error in add_lease from [%(name)s]: %(f_value)s",
+                    name=server.get_name(), f_value=str(f.value),
+                    failure=f, level=log.WEIRD,
+                    facility="tahoe.storage_broker", umid="4mhdHQ")
+            return
+        log.err(f, format="local error in add_lease to [%(name)s]: %(f_value)s",
+                name=server.get_name(), f_value=str(f.value),
+                level=log.WEIRD, umid="Hn0UFQ")
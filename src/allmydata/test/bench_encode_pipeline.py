@@ -0,0 +1,89 @@
+"""
+Measure immutable upload throughput against the Encoder's pipeline depth,
+over simulated links to the shareholders. Each link has a round-trip time
+and a bandwidth: a block is acknowledged one round trip after the link has
+finished transmitting it, and a link transmits one block at a time. With a
+depth of one, an upload sends a segment per round trip; deeper pipelines
+should approach the bandwidth of the links. Usage:
+
+  python bench_encode_pipeline.py [FILE_SIZE_MB [RTT_MS [LINK_MBPS]]]
+"""
+
+import sys, time
+
+from zope.interface import implements
+from twisted.internet import defer, reactor
+
+from allmydata.immutable import encode, upload
+from allmydata.interfaces import IStorageBucketWriter
+
+DEPTHS = [1, 2, 4, 8, 16]
+
+class SimulatedLink:
+    implements(IStorageBucketWriter)
+
+    def __init__(self, peerid, rtt, bytes_per_second):
+        self.peerid = peerid
+        self.rtt = rtt
+        self.bytes_per_second = bytes_per_second
+        self.busy_until = 0
+
+    def get_peerid(self):
+        return self.peerid
+
+    def put_block(self, segmentnum, data):
+        now = time.time()
+        start = max(now, self.busy_until)
+        self.busy_until = start + len(data) / self.bytes_per_second
+        d = defer.Deferred()
+        reactor.callLater(self.busy_until + self.rtt - now, d.callback, None)
+        return d
+
+    def _call(self, *args):
+        d = defer.Deferred()
+        reactor.callLater(self.rtt, d.callback, None)
+        return d
+    put_header = put_crypttext_hashes = put_block_hashes = _call
+    put_share_hashes = put_uri_extension = close = _call
+
+    def abort(self):
+        return defer.succeed(None)
+
+def encode_file(data, depth, rtt, bytes_per_second):
+    e = encode.Encoder(pipeline_depth=depth)
+    u = upload.Data(data, convergence="")
+    u.set_default_encoding_parameters({'max_segment_size': 128*1024,
+                                       'k': 3, 'happy': 7, 'n': 10})
+    d = e.set_encrypted_uploadable(upload.EncryptAnUploadable(u))
+    def _ready(res):
+        shareholders = {}
+        servermap = {}
+        for shnum in range(10):
+            peerid = "peer%d" % shnum
+            shareholders[shnum] = SimulatedLink(peerid, rtt, bytes_per_second)
+            servermap[shnum] = set([peerid])
+        e.set_shareholders(shareholders, servermap)
+        return e.start()
+    d.addCallback(_ready)
+    return d
+
+@defer.inlineCallbacks
+def run_benchmarks(file_size, rtt, bytes_per_second):
+    data = "a" * file_size
+    print "%d byte file, 128KiB segments, 3-of-10, %dms RTT, %.1f MB/s links" % \
+          (file_size, rtt * 1000, bytes_per_second / 1e6)
+    try:
+        for depth in DEPTHS:
+            start = time.time()
+            yield encode_file(data, depth, rtt, bytes_per_second)
+            elapsed = time.time() - start
+            print "depth %2d %8.2f MB/s" % (depth, file_size / elapsed / 1e6)
+    finally:
+        reactor.stop()
+
+if __name__ == "__main__":
+    file_size = int(float((sys.argv[1:2] or ["8"])[0]) * 1024*1024)
+    rtt = float((sys.argv[2:3] or ["50"])[0]) / 1000
+    bytes_per_second = float((sys.argv[3:4] or ["10"])[0]) * 1e6
+    reactor.callWhenRunning(run_benchmarks, file_size, rtt, bytes_per_second)
+    reactor.run()
@@ -0,0 +1,87 @@
+"""
+Compare the storage server's ways of reading immutable share data: opening
+the share file for every read (the default), reading through an
+OpenFileCache of open files, and reading through an OpenFileCache which
+memory-maps the share.
+
+Each mode is run in a fresh child process, so that its resident set size
+can be measured on its own. Usage:
+
+  python bench_sharefile_read.py [SHARE_SIZE_MB [BLOCK_SIZE_KB]]
+"""
+
+import os, random, subprocess, sys, time
+
+from allmydata.storage.immutable import ShareFile
+from allmydata.storage.filecache import OpenFileCache
+
+MODES = ["open-per-read", "open-file-cache", "mmap"]
+PASSES = 3
+
+def get_rss():
+    # this is obviously linux-specific
+    try:
+        for line in open("/proc/self/status", "r").readlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    except EnvironmentError:
+        pass
+    return None
+
+def make_share(filename, share_size):
+    if os.path.exists(filename) and \
+       os.path.getsize(filename) >= share_size + 0x0c:
+        return
+    sf = ShareFile(filename, max_size=share_size, create=True)
+    chunk = os.urandom(1024*1024)
+    for offset in range(0, share_size, len(chunk)):
+        sf.write_share_data(offset, chunk[:share_size-offset])
+
+def run_mode(mode, filename, share_size, block_size):
+    file_cache = None
+    if mode == "open-file-cache":
+        file_cache = OpenFileCache(10)
+    elif mode == "mmap":
+        file_cache = OpenFileCache(10, mmap_threshold=1)
+    sf = ShareFile(filename, file_cache=file_cache)
+    offsets = range(0, share_size, block_size)
+    rss_before = get_rss()
+    start = time.time()
+    for i in range(PASSES):
+        # a download reads each block in order, along with some hashes from
+        # elsewhere in the share
+        for offset in offsets:
+            sf.read_share_data(offset, block_size)
+            sf.read_share_data(random.randrange(share_size), 32)
+    elapsed = time.time() - start
+    rss_after = get_rss()
+    reads = 2 * PASSES * len(offsets)
+    mbytes = PASSES * share_size / 1e6
+    print "%-16s %8.1f MB/s %8.0f reads/s" % (mode, mbytes / elapsed,
+                                              reads / elapsed),
+    if rss_before is not None:
+        print "  RSS %6.1f MB (+%.1f MB)" % (rss_after / 1e6,
+                                            (rss_after - rss_before) / 1e6),
+    print
+
+def run_benchmarks(share_size, block_size):
+    filename = os.path.abspath("bench_sharefile_read.share")
+    make_share(filename, share_size)
+    print "share size %d bytes, block size %d bytes, %d passes" % \
+          (share_size, block_size, PASSES)
+    try:
+        for mode in MODES:
+            subprocess.check_call([sys.executable, __file__, "--mode", mode,
+                                   filename, str(share_size),
+                                   str(block_size)])
+    finally:
+        os.unlink(filename)
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--mode"]:
+        (mode, filename, share_size, block_size) = sys.argv[2:6]
+        run_mode(mode, filename, int(share_size), int(block_size))
+    else:
+        share_size = int((sys.argv[1:2] or ["256"])[0]) * 1024*1024
+        block_size = int((sys.argv[2:3] or ["128"])[0]) * 1024
+        run_benchmarks(share_size, block_size)
@@ -105,6 +105,11 @@ class LocalWrapper:
             if methname == "get_buckets":
                 for shnum in res:
                     res[shnum] = LocalWrapper(res[shnum])
+            if methname == "get_buckets_many":
+                for buckets in res.values():
+                    for shnum in buckets:
+                        if buckets[shnum] is not None:
+                            buckets[shnum] = LocalWrapper(buckets[shnum])
             return res
         d.addCallback(_return_membrane)
         if self.post_call_notifier:
@@ -156,7 +161,7 @@ class NoNetworkServer:
         return idlib.nodeid_b2a(self.serverid)
     def get_nickname(self):
         return "nickname"
-    def get_rref(self):
+    def get_rref(self, priority="interactive"):
         return self.rref
     def get_version(self):
         return self.rref.version
@@ -3,11 +3,13 @@ import simplejson
 import os.path, shutil
 from twisted.trial import unittest
 from twisted.internet import defer
+from foolscap.api import flushEventualQueue
 from allmydata import check_results, uri
 from allmydata import uri as tahoe_uri
 from allmydata.util import base32
 from allmydata.web import check_results as web_check_results
-from allmydata.storage_client import StorageFarmBroker, NativeStorageServer
+from allmydata.storage_client import StorageFarmBroker, NativeStorageServer, \
+     LeaseAdder, BucketQueryBatcher
 from allmydata.storage.server import storage_index_to_dir
 from allmydata.monitor import Monitor
 from allmydata.test.no_network import GridTestMixin
@@ -467,6 +469,299 @@ class AddLease(GridTestMixin, unittest.TestCase):
         d.addCallback(lambda ign: self.failUnless(really_did_break))
         return d
 
+class BatchedQueries(GridTestMixin, unittest.TestCase):
+    # get_buckets() queries for many storage indexes should be batched into
+    # get_buckets_many() calls, when the servers support them
+
+    def _upload_files(self, count, num_clients=1):
+        self.set_up_grid(num_clients=num_clients, num_servers=4)
+        c0 = self.g.clients[0]
+        c0.DEFAULT_ENCODING_PARAMETERS['happy'] = 1
+        self.nodes = []
+        d = defer.succeed(None)
+        for i in range(count):
+            def _upload(ign, i=i):
+                return c0.upload(Data("data %d" % i * 100, convergence=""))
+            d.addCallback(_upload)
+            d.addCallback(lambda ur:
+                          self.nodes.append(c0.create_node_from_uri(ur.get_uri())))
+        d.addCallback(lambda ign: self._clear_counters())
+        return d
+
+    def _clear_counters(self):
+        for wrapper in self.g.wrappers_by_id.values():
+            wrapper._clear_counters()
+
+    def _count_calls(self, methname):
+        return [wrapper.counter_by_methname.get(methname, 0)
+                for wrapper in self.g.wrappers_by_id.values()]
+
+    def _check_all(self, ign):
+        ds = [n.check(Monitor()) for n in self.nodes]
+        d = defer.gatherResults(ds)
+        def _check(crs):
+            for cr in crs:
+                self.failUnless(cr.is_healthy(), cr)
+        d.addCallback(_check)
+        return d
+
+    def test_concurrent_checks(self):
+        self.basedir = "checker/BatchedQueries/concurrent_checks"
+        d = self._upload_files(5)
+        d.addCallback(self._check_all)
+        def _check_calls(ign):
+            # the first query to each server goes out on its own, and the
+            # other four are sent together at the end of the reactor turn
+            self.failUnlessEqual(self._count_calls("get_buckets_many"),
+                                 [2]*4)
+            self.failUnlessEqual(self._count_calls("get_buckets"), [0]*4)
+        d.addCallback(_check_calls)
+        return d
+
+    def test_old_servers(self):
+        self.basedir = "checker/BatchedQueries/old_servers"
+        d = self._upload_files(3)
+        def _downgrade(ign):
+            for wrapper in self.g.wrappers_by_id.values():
+                v1 = wrapper.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+                del v1["supports-get-buckets-many"]
+        d.addCallback(_downgrade)
+        d.addCallback(self._check_all)
+        def _check_calls(ign):
+            self.failUnlessEqual(self._count_calls("get_buckets_many"),
+                                 [0]*4)
+            self.failUnlessEqual(self._count_calls("get_buckets"), [3]*4)
+        d.addCallback(_check_calls)
+        return d
+
+    def test_deep_check(self):
+        self.basedir = "checker/BatchedQueries/deep_check"
+        d = self._upload_files(5)
+        d.addCallback(lambda ign: self.g.clients[0].create_dirnode())
+        def _add_children(dn):
+            self.root = dn
+            d2 = defer.succeed(None)
+            for i, n in enumerate(self.nodes):
+                d2.addCallback(lambda ign, i=i, n=n:
+                               dn.set_node(u"file%d" % i, n))
+            return d2
+        d.addCallback(_add_children)
+        d.addCallback(lambda ign: self._clear_counters())
+        d.addCallback(lambda ign: self.root.start_deep_check().when_done())
+        def _check_results(cr):
+            self.failUnlessEqual(cr.get_counters()["count-objects-checked"], 6)
+            self.failUnlessEqual(cr.get_counters()["count-objects-healthy"], 6)
+            # the children of the root directory are all looked up at once
+            self.failUnlessEqual(self._count_calls("get_buckets_many"),
+                                 [1]*4)
+            self.failUnlessEqual(self._count_calls("get_buckets"), [0]*4)
+        d.addCallback(_check_results)
+        return d
+
+    def test_deep_check_add_lease(self):
+        self.basedir = "checker/BatchedQueries/deep_check_add_lease"
+        d = self._upload_files(5, num_clients=2)
+        d.addCallback(lambda ign: self.g.clients[0].create_dirnode())
+        def _add_children(dn):
+            self.root = dn
+            d2 = defer.succeed(None)
+            for i, n in enumerate(self.nodes):
+                d2.addCallback(lambda ign, i=i, n=n:
+                               dn.set_node(u"file%d" % i, n))
+            return d2
+        d.addCallback(_add_children)
+        def _deep_check(ign):
+            # use the second client, so that it takes out new leases rather
+            # than renewing the ones which were added by the uploads
+            c1 = self.g.clients[1]
+            root = c1.create_node_from_uri(self.root.get_uri())
+            self._clear_counters()
+            return root.start_deep_check(add_lease=True).when_done()
+        d.addCallback(_deep_check)
+        def _check_results(cr):
+            self.failUnlessEqual(cr.get_counters()["count-objects-healthy"], 6)
+            # all six leases are sent to each server in a single call
+            self.failUnlessEqual(self._count_calls("add_lease_many"), [1]*4)
+            self.failUnlessEqual(self._count_calls("add_lease"), [0]*4)
+            # every share now has a second lease
+            for n in self.nodes:
+                si = n.get_storage_index()
+                num_leases = [len(list(ss.get_leases(si)))
+                              for ss in self.g.servers_by_number.values()]
+                self.failUnlessEqual(set(num_leases) - set([0]), set([2]))
+        d.addCallback(_check_results)
+        return d
+
+
+class FakeLeaseServer:
+    def __init__(self, name, batched=True):
+        self.name = name
+        v1 = {"supports-add-lease-many": batched,
+              "supports-get-buckets-many": batched}
+        self.version = {"http://allmydata.org/tahoe/protocols/storage/v1": v1}
+        self.calls = [] # (methname, args, Deferred)
+    def get_name(self):
+        return self.name
+    def get_version(self):
+        return self.version
+    def get_rref(self, priority="interactive"):
+        return self
+    def callRemote(self, methname, *args):
+        d = defer.Deferred()
+        self.calls.append( (methname, args, d) )
+        return d
+    def answer(self, i, result=None):
+        self.calls[i][2].callback(result)
+
+class LeaseBatching(unittest.TestCase):
+    def _add(self, adder, server, count):
+        return [adder.add_lease(server, "si%d" % i, "rs", "cs")
+                for i in range(count)]
+
+    def test_batches(self):
+        adder = LeaseAdder(batch_size=3, concurrency=1)
+        s = FakeLeaseServer("s")
+        ds = self._add(adder, s, 7)
+        # the first full batch goes out right away
+        self.failUnlessEqual(len(s.calls), 1)
+        self.failUnlessEqual(s.calls[0][0], "add_lease_many")
+        self.failUnlessEqual([l[0] for l in s.calls[0][1][0]],
+                             ["si0", "si1", "si2"])
+        # the second must wait for the first, and so must the caller
+        self.failUnless(ds[2].called)
+        self.failIf(ds[5].called)
+        flushed = []
+        adder.flush().addCallback(flushed.append)
+        s.answer(0, {})
+        self.failUnless(ds[5].called)
+        self.failUnlessEqual(len(s.calls), 2)
+        self.failUnlessEqual([l[0] for l in s.calls[1][1][0]],
+                             ["si3", "si4", "si5"])
+        s.answer(1, {})
+        self.failUnlessEqual(len(s.calls), 3)
+        self.failUnlessEqual([l[0] for l in s.calls[2][1][0]], ["si6"])
+        self.failIf(flushed)
+        s.answer(2, {})
+        self.failUnlessEqual(flushed, [None])
+
+    def test_concurrency(self):
+        adder = LeaseAdder(batch_size=2, concurrency=2)
+        s1 = FakeLeaseServer("s1")
+        s2 = FakeLeaseServer("s2")
+        ds = self._add(adder, s1, 6) + self._add(adder, s2, 1)
+        self.failUnlessEqual(len(s1.calls), 2)
+        self.failIf(ds[5].called)
+        self.failUnlessEqual(len(s2.calls), 0)
+        flushed = []
+        adder.flush().addCallback(flushed.append)
+        self.failUnlessEqual(len(s2.calls), 1)
+        s1.answer(1, {})
+        self.failUnless(ds[5].called)
+        self.failUnlessEqual(len(s1.calls), 3)
+        s1.answer(0, {})
+        s1.answer(2, {})
+        self.failIf(flushed)
+        s2.answer(0, {})
+        self.failUnlessEqual(flushed, [None])
+
+    def test_old_server(self):
+        adder = LeaseAdder(batch_size=2, concurrency=1)
+        s = FakeLeaseServer("s", batched=False)
+        self._add(adder, s, 3)
+        flushed = []
+        adder.flush().addCallback(flushed.append)
+        self.failUnlessEqual([(c[0], c[1][0]) for c in s.calls],
+                             [("add_lease", "si0"), ("add_lease", "si1")])
+        s.answer(0)
+        self.failUnlessEqual(len(s.calls), 2)
+        s.answer(1)
+        self.failUnlessEqual([(c[0], c[1][0]) for c in s.calls[2:]],
+                             [("add_lease", "si2")])
+        s.answer(2)
+        self.failUnlessEqual(flushed, [None])
+
+class QueryBatching(unittest.TestCase):
+    def _query(self, batcher, server, storage_indexes, want_readers=False):
+        results = {}
+        for si in storage_indexes:
+            d = batcher.get_buckets(server, si, want_readers)
+            d.addCallback(lambda res, si=si: results.__setitem__(si, res))
+        return results
+
+    def test_batches(self):
+        batcher = BucketQueryBatcher(max_in_flight=2)
+        s = FakeLeaseServer("s")
+        r2 = self._query(batcher, s, ["si3"], want_readers=True)
+        # the first query is sent right away, the others at the end of the
+        # reactor turn
+        self.failUnlessEqual(len(s.calls), 1)
+        r1 = self._query(batcher, s, ["si1", "si2"])
+        self.failUnlessEqual(len(s.calls), 1)
+        d = flushEventualQueue()
+        def _sent(ign):
+            self.failUnlessEqual([c[:2] for c in s.calls],
+                                 [("get_buckets_many", (["si3"], True)),
+                                  ("get_buckets_many", (["si1", "si2"],
+                                                        False))])
+            # with both slots in use, new queries must wait
+            self.r3 = self._query(batcher, s, ["si4", "si5"])
+            return flushEventualQueue()
+        d.addCallback(_sent)
+        def _held(ign):
+            self.failUnlessEqual(len(s.calls), 2)
+            # but not for the slowest query to be answered
+            s.answer(1, {"si1": {0: None}})
+            self.failUnlessEqual(r1, {"si1": {0: None}, "si2": {}})
+            self.failUnlessEqual(r2, {})
+            return flushEventualQueue()
+        d.addCallback(_held)
+        def _answered(ign):
+            self.failUnlessEqual(s.calls[2][:2],
+                                 ("get_buckets_many", (["si4", "si5"],
+                                                       False)))
+            s.answer(2, {})
+            s.answer(0, {"si3": {1: "reader"}})
+            self.failUnlessEqual(r2, {"si3": {1: "reader"}})
+            self.failUnlessEqual(self.r3, {"si4": {}, "si5": {}})
+        d.addCallback(_answered)
+        return d
+
+    def test_old_server(self):
+        batcher = BucketQueryBatcher(max_in_flight=1)
+        s = FakeLeaseServer("s", batched=False)
+        self._query(batcher, s, ["si1", "si2", "si3"])
+        d = flushEventualQueue()
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(sorted([c[:2] for c in s.calls]),
+                                           [("get_buckets", ("si1",)),
+                                            ("get_buckets", ("si2",)),
+                                            ("get_buckets", ("si3",))]))
+        return d
+
+    def test_prefetch(self):
+        batcher = BucketQueryBatcher()
+        s = FakeLeaseServer("s")
+        batcher.prefetch(s, ["si1", "si2"])
+        self.failUnlessEqual(len(s.calls), 1)
+        d = flushEventualQueue()
+        def _prefetched(ign):
+            s.answer(0, {"si1": {0: None}})
+            # a prefetched answer is used once
+            r = self._query(batcher, s, ["si1"])
+            self.failUnlessEqual(r, {"si1": {0: None}})
+            self._query(batcher, s, ["si1"])
+            # and not at all once it has expired
+            batcher._prefetched_at -= batcher.PREFETCH_EXPIRY + 1
+            self._query(batcher, s, ["si2"])
+            return flushEventualQueue()
+        d.addCallback(_prefetched)
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(s.calls[1][:2],
+                                           ("get_buckets_many",
+                                            (["si1", "si2"], False))))
+        return d
+
+
 class CounterHolder(object):
     def __init__(self):
         self._num_active_block_fetches = 0
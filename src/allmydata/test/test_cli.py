@@ -3033,6 +3033,11 @@ class Check(GridTestMixin, CLITestMixin, unittest.TestCase):
             self.failUnlessIn("list-corrupt-shares", data["results"])
         d.addCallback(_check3_raw)
 
+        d.addCallback(lambda ign:
+                      self.do_cli("check", "--verify-on-servers", "--raw",
+                                  self.uri))
+        d.addCallback(_check3_raw)
+
         d.addCallback(lambda ign:
                       self.do_cli("check", "--verify", "--repair", self.uri))
         def _check4((rc, out, err)):
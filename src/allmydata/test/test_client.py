@@ -1,11 +1,13 @@
 import os
 from twisted.trial import unittest
 from twisted.application import service
+from twisted.internet import defer
 
 import allmydata
 from allmydata.node import OldConfigError, OldConfigOptionError, MissingConfigEntry
 from allmydata import client
-from allmydata.storage_client import StorageFarmBroker
+from allmydata.storage_client import StorageFarmBroker, NativeStorageServer
+from allmydata.storage.scheduler import FairQueueScheduler
 from allmydata.util import base32, fileutil
 from allmydata.interfaces import IFilesystemNode, IFileNode, \
      IImmutableFileNode, IMutableFileNode, IDirectoryNode
@@ -150,6 +152,330 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
                            "reserved_space = bogus\n")
         self.failUnlessRaises(ValueError, client.Client, basedir)
 
+    def test_crawler_pacing(self):
+        basedir = "client.Basic.test_crawler_pacing"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "crawler.pacing = true\n" + \
+                           "crawler.lease_checker.min_rate = 2%%\n" + \
+                           "crawler.lease_checker.max_rate = 30\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnless(ss.crawler_pacer)
+        lc = ss.lease_checker
+        self.failUnlessIdentical(lc.pacer, ss.crawler_pacer)
+        self.failUnlessEqual((lc.min_cpu_percentage, lc.max_cpu_percentage),
+                             (0.02, 0.30))
+        self.failUnlessIdentical(ss.bucket_counter.pacer, ss.crawler_pacer)
+
+    def test_crawler_pacing_bad(self):
+        basedir = "client.Basic.test_crawler_pacing_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "crawler.pacing = true\n" + \
+                           "crawler.bucket_counter.max_rate = 150\n")
+        self.failUnlessRaises(ValueError, client.Client, basedir)
+
+    def test_crawler_pacing_inverted(self):
+        for (i, rates) in enumerate([("20", "10"), ("60", None),
+                                     (None, "0.5")]):
+            basedir = "client.Basic.test_crawler_pacing_inverted_%d" % i
+            os.mkdir(basedir)
+            config = (BASECONFIG +
+                      "[storage]\n" +
+                      "enabled = true\n" +
+                      "crawler.pacing = true\n")
+            for (limit, rate) in zip(("min_rate", "max_rate"), rates):
+                if rate is not None:
+                    config += ("crawler.lease_checker.%s = %s\n"
+                               % (limit, rate))
+            fileutil.write(os.path.join(basedir, "tahoe.cfg"), config)
+            e = self.failUnlessRaises(ValueError, client.Client, basedir)
+            self.failUnlessIn("crawler.lease_checker.min_rate", str(e))
+
+    def test_scrubber(self):
+        basedir = "client.Basic.test_scrubber"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n")
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.getServiceNamed("storage").share_scrubber, None)
+
+        basedir = "client.Basic.test_scrubber_enabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "scrubber.enabled = true\n" + \
+                           "scrubber.bandwidth = 500kB\n")
+        c = client.Client(basedir)
+        scrubber = c.getServiceNamed("storage").share_scrubber
+        self.failUnlessEqual(scrubber.bytes_per_second, 500*1000)
+
+    def test_scrubber_bad_bandwidth(self):
+        for (i, bandwidth) in enumerate(["0", "-5kB"]):
+            basedir = "client.Basic.test_scrubber_bad_bandwidth_%d" % i
+            os.mkdir(basedir)
+            fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                               BASECONFIG + \
+                               "[storage]\n" + \
+                               "enabled = true\n" + \
+                               "scrubber.enabled = true\n" + \
+                               "scrubber.bandwidth = %s\n" % bandwidth)
+            self.failUnlessRaises(ValueError, client.Client, basedir)
+
+    def test_block_cache(self):
+        basedir = "client.Basic.test_block_cache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n")
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.getServiceNamed("storage").block_cache, None)
+
+        basedir = "client.Basic.test_block_cache_enabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "block_cache = 64MB\n")
+        c = client.Client(basedir)
+        bc = c.getServiceNamed("storage").block_cache
+        self.failUnlessEqual(bc.max_bytes, 64*1000*1000)
+
+    def test_write_buffer(self):
+        basedir = "client.Basic.test_write_buffer"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n")
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.getServiceNamed("storage").write_budget, None)
+
+        basedir = "client.Basic.test_write_buffer_enabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "write_buffer = 16MB\n" + \
+                           "write_buffer.flush_size = 1MB\n")
+        c = client.Client(basedir)
+        budget = c.getServiceNamed("storage").write_budget
+        self.failUnlessEqual(budget.max_bytes, 16*1000*1000)
+        self.failUnlessEqual(budget.flush_size, 1000*1000)
+
+    def test_mutable_compaction(self):
+        basedir = "client.Basic.test_mutable_compaction"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.mutable_compactor, None)
+
+        basedir = "client.Basic.test_mutable_compaction_enabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "mutable_compaction.enabled = true\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnless(ss.mutable_compactor)
+
+    def test_share_dir_levels(self):
+        basedir = "client.Basic.test_share_dir_levels"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.disks.levels, 1)
+
+        basedir = "client.Basic.test_share_dir_levels_2"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "share_dir_levels = 2\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.disks.levels, 2)
+        self.failIf(ss.disks.migrating)
+
+    def test_io_scheduler(self):
+        basedir = "client.Basic.test_io_scheduler"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "io_threads = 2\n" + \
+                           "io_scheduler = fair\n")
+        c = client.Client(basedir)
+        disk_io = c.getServiceNamed("storage").disk_io
+        self.failUnlessEqual(disk_io._make_scheduler, FairQueueScheduler)
+
+        basedir = "client.Basic.test_io_scheduler_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "io_threads = 2\n" + \
+                           "io_scheduler = lifo\n")
+        self.failUnlessRaises(ValueError, client.Client, basedir)
+
+    def test_durability(self):
+        basedir = "client.Basic.test_durability"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n")
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.getServiceNamed("storage").durability.mode,
+                             "none")
+
+        basedir = "client.Basic.test_durability_group"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "durability = group\n" + \
+                           "group_commit.window = 0.02\n")
+        c = client.Client(basedir)
+        durability = c.getServiceNamed("storage").durability
+        self.failUnlessEqual(durability.mode, "group")
+        self.failUnlessEqual(durability.window, 0.02)
+
+        basedir = "client.Basic.test_durability_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "durability = sometimes\n")
+        self.failUnlessRaises(ValueError, client.Client, basedir)
+
+    def test_storage_priority(self):
+        basedir = "client.Basic.test_storage_priority"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.get_storage_broker().storage_priority,
+                             "interactive")
+
+        basedir = "client.Basic.test_storage_priority_bulk"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "storage_priority = bulk\n")
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.get_storage_broker().storage_priority, "bulk")
+
+        basedir = "client.Basic.test_storage_priority_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "storage_priority = urgent\n")
+        self.failUnlessRaises(ValueError, client.Client, basedir)
+
+    def test_upload_pipeline(self):
+        basedir = "client.Basic.test_upload_pipeline"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = client.Client(basedir)
+        uploader = c.getServiceNamed("uploader")
+        self.failUnlessEqual(uploader._pipeline_depth, 1)
+        self.failUnlessEqual(uploader._pipeline_memory, None)
+
+        basedir = "client.Basic.test_upload_pipeline_deep"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "upload.pipeline_depth = 8\n" + \
+                           "upload.pipeline_memory = 4MiB\n")
+        c = client.Client(basedir)
+        uploader = c.getServiceNamed("uploader")
+        self.failUnlessEqual(uploader._pipeline_depth, 8)
+        self.failUnlessEqual(uploader._pipeline_memory, 4*1024*1024)
+
+    def test_encoding_workers(self):
+        basedir = "client.Basic.test_encoding_workers"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.getServiceNamed("uploader")._workers, None)
+
+        basedir = "client.Basic.test_encoding_workers_processes"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "upload.encoding_workers = 2\n")
+        c = client.Client(basedir)
+        workers = c.getServiceNamed("uploader")._workers
+        self.failUnlessEqual(workers.num_workers, 2)
+        self.failUnlessEqual(workers.worker_type, "processes")
+
+        basedir = "client.Basic.test_encoding_workers_threads"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "upload.encoding_workers = 3\n" + \
+                           "upload.encoding_worker_type = threads\n")
+        c = client.Client(basedir)
+        workers = c.getServiceNamed("uploader")._workers
+        self.failUnlessEqual(workers.num_workers, 3)
+        self.failUnlessEqual(workers.worker_type, "threads")
+
+        basedir = "client.Basic.test_encoding_workers_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "upload.encoding_workers = 3\n" + \
+                           "upload.encoding_worker_type = fibers\n")
+        self.failUnlessRaises(ValueError, client.Client, basedir)
+
+    def test_convergence_key_cache(self):
+        basedir = "client.Basic.test_convergence_key_cache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.getServiceNamed("uploader")._key_cache, None)
+
+        basedir = "client.Basic.test_convergence_key_cache_enabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "upload.convergence_key_cache = true\n" + \
+                           "upload.convergence_key_cache_size = 50\n")
+        c = client.Client(basedir)
+        key_cache = c.getServiceNamed("uploader")._key_cache
+        self.failUnlessEqual(key_cache.max_entries, 50)
+        self.failUnless(os.path.exists(os.path.join(basedir, "private",
+                                                    "convergence-keys.sqlite")))
+
     def _permute(self, sb, key):
         return [ s.get_longname() for s in sb.get_servers_for_psi(key) ]
 
@@ -432,3 +758,72 @@ class NodeMaker(testutil.ReallyEqualMixin, unittest.TestCase):
         self.failUnlessReallyEqual(n.get_uri(), unknown_rw)
         self.failUnlessReallyEqual(n.get_write_uri(), unknown_rw)
         self.failUnlessReallyEqual(n.get_readonly_uri(), "ro." + unknown_ro)
+
+
+class FakeRemoteReference:
+    def __init__(self, version=None, sessions=None):
+        self.version = version
+        self._sessions = sessions
+        self.opened = []
+    def callRemote(self, methname, *args):
+        assert methname == "open_session", methname
+        (canary, priority) = args
+        self.opened.append(priority)
+        if self._sessions is None or priority not in self._sessions:
+            return defer.fail(IndexError("no such method"))
+        return defer.succeed(self._sessions[priority])
+    def getPeer(self):
+        return "peer"
+    def notifyOnDisconnect(self, cb):
+        pass
+
+class Sessions(unittest.TestCase):
+    def _connect(self, supports_sessions, sessions, storage_priority):
+        ann = {"anonymous-storage-FURL": "pb://abcde@nowhere/fake",
+               "permutation-seed-base32": base32.b2a("1")}
+        s = NativeStorageServer("v0-1", ann,
+                                storage_priority=storage_priority)
+        v1 = {"supports-sessions": supports_sessions}
+        version = {"http://allmydata.org/tahoe/protocols/storage/v1": v1}
+        rref = FakeRemoteReference(version, sessions)
+        s._got_versioned_service(rref, None)
+        return (s, rref)
+
+    def test_sessions(self):
+        sessions = {"interactive": FakeRemoteReference(),
+                    "bulk": FakeRemoteReference()}
+        (s, rref) = self._connect(True, sessions, "interactive")
+        self.failUnlessEqual(rref.opened, ["interactive", "bulk"])
+        self.failUnless(s.is_connected())
+        # requests are made through the session for their priority
+        self.failUnlessIdentical(s.get_rref(), sessions["interactive"])
+        self.failUnlessIdentical(s.get_rref("interactive"),
+                                 sessions["interactive"])
+        self.failUnlessIdentical(s.get_rref("bulk"), sessions["bulk"])
+        self.failUnlessIdentical(s.get_version(), rref.version)
+        self.failUnlessIdentical(s.get_rref("bulk").version, rref.version)
+
+    def test_bulk_only(self):
+        sessions = {"interactive": FakeRemoteReference(),
+                    "bulk": FakeRemoteReference()}
+        (s, rref) = self._connect(True, sessions, "bulk")
+        self.failUnlessEqual(rref.opened, ["bulk"])
+        self.failUnlessIdentical(s.get_rref(), sessions["bulk"])
+        self.failUnlessIdentical(s.get_rref("bulk"), sessions["bulk"])
+
+    def test_no_sessions(self):
+        (s, rref) = self._connect(False, {}, "interactive")
+        self.failUnlessEqual(rref.opened, [])
+        self.failUnlessIdentical(s.get_rref(), rref)
+        self.failUnlessIdentical(s.get_rref("bulk"), rref)
+        (s, rref) = self._connect(True, {}, None)
+        self.failUnlessEqual(rref.opened, [])
+        self.failUnlessIdentical(s.get_rref("bulk"), rref)
+
+    def test_session_refused(self):
+        sessions = {"interactive": FakeRemoteReference()}
+        (s, rref) = self._connect(True, sessions, "interactive")
+        self.failUnlessEqual(rref.opened, ["interactive", "bulk"])
+        self.failUnless(s.is_connected())
+        self.failUnlessIdentical(s.get_rref(), sessions["interactive"])
+        self.failUnlessIdentical(s.get_rref("bulk"), rref)
@@ -9,6 +9,8 @@ from foolscap.api import eventually, fireEventually
 from allmydata.util import fileutil, hashutil, pollmixin
 from allmydata.storage.server import StorageServer, si_b2a
 from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
+from allmydata.storage.pacing import CrawlerPacer
+from allmydata.stats import LoadMonitor
 
 from allmydata.test.test_storage import FakeCanary
 from allmydata.test.common_util import StallMixin
@@ -407,6 +409,156 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         return d
 
 
+    def test_listing_threads(self):
+        self.basedir = "crawler/Basic/listing_threads"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = []
+        for i in range(10):
+            for tail in range(3):
+                sis.append(self.write(i, ss, serverid, tail))
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        c.listing_threads = 4
+        c.max_listings_per_second = 2000
+        c.allowed_cpu_percentage = 1.0
+        listed = []
+        def list_prefix(prefix):
+            listed.append(prefix)
+            return ShareCrawler.list_prefix(c, prefix)
+        c.list_prefix = list_prefix
+        c.setServiceParent(self.s)
+
+        d = c.finished_d
+        def _check(ignored):
+            # the buckets are still processed in order, and each prefixdir
+            # is listed just once
+            self.failUnlessEqual(c.all_buckets, sorted(sis))
+            self.failUnlessEqual(sorted(listed), c.prefixes)
+            self.failUnless(c._listing_pool)
+            return c.disownServiceParent()
+        d.addCallback(_check)
+        d.addCallback(lambda ign: self.failIf(c._listing_pool))
+        return d
+
+    def test_journal(self):
+        self.basedir = "crawler/Basic/journal"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        statefile = os.path.join(self.basedir, "statefile")
+        journalfile = statefile + ".journal"
+
+        c = ShareCrawler(ss, statefile)
+        c.state["counts"] = {"a": 1, "b": 2}
+        c.state["samples"] = range(1000)
+        c.save_state() # no statefile yet, so a full one is written
+        self.failUnless(os.path.exists(statefile))
+        self.failIf(os.path.exists(journalfile))
+        statefile_size = os.stat(statefile).st_size
+
+        c.state["counts"]["c"] = 3
+        del c.state["counts"]["a"]
+        c.last_complete_prefix_index = 5
+        c.save_state()
+        # only the changes are written
+        journal_size = os.stat(journalfile).st_size
+        self.failUnless(0 < journal_size < statefile_size/4,
+                        (journal_size, statefile_size))
+        self.failUnlessEqual(os.stat(statefile).st_size, statefile_size)
+        c.save_state() # nothing has changed
+        self.failUnlessEqual(os.stat(journalfile).st_size, journal_size)
+
+        c2 = ShareCrawler(ss, statefile)
+        self.failUnlessEqual(c2.state, c.state)
+        self.failUnlessEqual(c2.state["counts"], {"b": 2, "c": 3})
+        self.failUnlessEqual(c2.last_complete_prefix_index, 5)
+
+        # a record that was only partly written is ignored
+        c.state["counts"]["d"] = 4
+        c.save_state()
+        f = open(journalfile, "rb+")
+        f.truncate(os.stat(journalfile).st_size - 1)
+        f.close()
+        c2 = ShareCrawler(ss, statefile)
+        self.failUnlessEqual(c2.state["counts"], {"b": 2, "c": 3})
+
+        # once the journal is large enough, it is folded into the statefile
+        c.journal_compact_size = 0
+        c.state["samples"] = range(5000)
+        c.save_state() # the journal is now larger than the statefile
+        c.state["samples"] = range(3000)
+        c.save_state()
+        self.failIf(os.path.exists(journalfile))
+        c2 = ShareCrawler(ss, statefile)
+        self.failUnlessEqual(c2.state["samples"], range(3000))
+        self.failUnlessEqual(c2.state["counts"], {"b": 2, "c": 3, "d": 4})
+
+    def test_pacer(self):
+        self.basedir = "crawler/Basic/pacer"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        lm = LoadMonitor(None)
+        pacer = CrawlerPacer(ss, lm)
+
+        # an idle server
+        self.failUnlessEqual(pacer.get_load(), 0.0)
+        self.failUnlessEqual(pacer.get_cpu_percentage(0.1, 0.5), 0.5)
+
+        # a slow reactor
+        lm.stats.extend([0.0] * 20 + [0.025] * 10)
+        self.failUnlessAlmostEqual(pacer.get_load(), 0.5)
+        self.failUnlessAlmostEqual(pacer.get_cpu_percentage(0.1, 0.5), 0.3)
+        lm.stats.extend([1.0] * 10)
+        self.failUnlessAlmostEqual(pacer.get_cpu_percentage(0.1, 0.5), 0.1)
+        lm.stats.clear()
+
+        # slow disks
+        for i in range(10):
+            ss.add_latency("read", 0.0125)
+        c = pacer.get_load_components()
+        self.failUnlessAlmostEqual(c["disk-latency"], 0.0125, places=3)
+        self.failUnlessEqual(c["queue-depth"], 0)
+        self.failUnlessAlmostEqual(pacer.get_load(), 0.25, places=1)
+
+        # a crawler uses the pacer, rather than allowed_cpu_percentage
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ShareCrawler(ss, statefile)
+        self.failUnlessEqual(c.get_cpu_percentage(), c.allowed_cpu_percentage)
+        c.pacer = pacer
+        c.min_cpu_percentage = 0.1
+        c.max_cpu_percentage = 0.5
+        lm.stats.extend([1.0] * 10)
+        self.failUnlessAlmostEqual(c.get_cpu_percentage(), 0.1)
+
+    def test_paced_slices(self):
+        self.basedir = "crawler/Basic/paced_slices"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+        for i in range(10):
+            self.write(i, ss, serverid)
+
+        class FakePacer:
+            def get_cpu_percentage(self, min_percentage, max_percentage):
+                return max_percentage
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        c.pacer = FakePacer()
+        c.max_cpu_percentage = 0.75
+        c.setServiceParent(self.s)
+        d = c.finished_d
+        def _check(ignored):
+            self.failUnlessEqual(c.get_progress()["cpu-percentage"], 0.75)
+        d.addCallback(_check)
+        return d
+
     def test_oneshot(self):
         self.basedir = "crawler/Basic/oneshot"
         fileutil.make_dirs(self.basedir)
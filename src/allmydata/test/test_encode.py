@@ -1,6 +1,6 @@
 from zope.interface import implements
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 from twisted.python.failure import Failure
 from foolscap.api import fireEventually
 from allmydata import uri
@@ -8,12 +8,17 @@ from allmydata.immutable import encode, upload, checker
 from allmydata.util import hashutil
 from allmydata.util.assertutil import _assert
 from allmydata.util.consumer import download_to_data
-from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader
+from allmydata.util.workerpool import WorkerPool
+from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader, \
+     IUploadStatus, UploadUnhappinessError
 from allmydata.test.no_network import GridTestMixin
 
 class LostPeerError(Exception):
     pass
 
+class Marker:
+    pass
+
 def flip_bit(good): # flips the last bit
     return good[:-1] + chr(ord(good[-1]) ^ 0x01)
 
@@ -350,6 +355,236 @@ class Encode(unittest.TestCase):
         return self.do_encode(25, 101, 100, 5, 15, 8)
 
 
+class SlowBucketProxy(FakeBucketReaderWriterProxy):
+    # acknowledges each block a little while after it is sent, like a
+    # shareholder at the far end of a long link, and records how many
+    # segments had blocks in flight at once
+    def __init__(self, tracker, mode="good", peerid="peer"):
+        FakeBucketReaderWriterProxy.__init__(self, mode, peerid)
+        self.tracker = tracker
+
+    def put_block(self, segmentnum, data):
+        tracker = self.tracker
+        tracker.in_flight[segmentnum] = tracker.in_flight.get(segmentnum, 0) + 1
+        tracker.max_in_flight = max(tracker.max_in_flight,
+                                    len(tracker.in_flight))
+        d = defer.Deferred()
+        reactor.callLater(0.01, d.callback, None)
+        d.addCallback(lambda ign:
+                      FakeBucketReaderWriterProxy.put_block(self, segmentnum,
+                                                            data))
+        def _acked(res):
+            tracker.in_flight[segmentnum] -= 1
+            if not tracker.in_flight[segmentnum]:
+                del tracker.in_flight[segmentnum]
+            return res
+        d.addBoth(_acked)
+        return d
+
+class FakeUploadStatus:
+    implements(IUploadStatus)
+    def __init__(self):
+        self.progress = []
+    def set_status(self, status):
+        pass
+    def set_progress(self, which, value):
+        if which == 2:
+            self.progress.append(value)
+
+class PipelineMixin:
+
+    def encode(self, pipeline_depth, pipeline_memory=None, modes={},
+               workers=None):
+        # 300 bytes in ten 30-byte segments, each encoded 3-of-10 into
+        # 10-byte blocks
+        self.tracker = tracker = Marker()
+        tracker.in_flight = {}
+        tracker.max_in_flight = 0
+        self.status = FakeUploadStatus()
+        e = encode.Encoder(upload_status=self.status,
+                           pipeline_depth=pipeline_depth,
+                           pipeline_memory=pipeline_memory,
+                           workers=workers)
+        u = upload.Data(make_data(300), convergence="some convergence string")
+        u.set_default_encoding_parameters({'max_segment_size': 30,
+                                           'k': 3, 'happy': 7, 'n': 10})
+        eu = self.eu = upload.EncryptAnUploadable(u, workers=workers)
+        d = e.set_encrypted_uploadable(eu)
+        self.shareholders = {}
+        def _ready(res):
+            self.failUnlessEqual(e.get_param("num_segments"), 10)
+            servermap = {}
+            for shnum in range(10):
+                peer = SlowBucketProxy(tracker, modes.get(shnum, "good"),
+                                       "peer%d" % shnum)
+                self.shareholders[shnum] = peer
+                servermap[shnum] = set([peer.get_peerid()])
+            e.set_shareholders(self.shareholders.copy(), servermap)
+            return e.start()
+        d.addCallback(_ready)
+        return d
+
+class Pipelining(PipelineMixin, unittest.TestCase):
+
+    def test_depth(self):
+        d = self.encode(1)
+        def _serial(verifycap):
+            self.serial_verifycap = verifycap
+            self.serial_block_hashes = [peer.block_hashes for peer
+                                        in self.shareholders.values()]
+            self.failUnlessEqual(self.tracker.max_in_flight, 1)
+        d.addCallback(_serial)
+        d.addCallback(lambda ign: self.encode(4))
+        def _pipelined(verifycap):
+            self.failUnlessEqual(self.tracker.max_in_flight, 4)
+            self.failUnlessEqual(self.tracker.in_flight, {})
+            for peer in self.shareholders.values():
+                self.failUnless(peer.closed)
+                self.failUnlessEqual(sorted(peer.blocks), range(10))
+            # the hash trees, and so the file's verify cap, are just the
+            # same as when the segments are sent one at a time
+            self.failUnlessEqual([peer.block_hashes for peer
+                                  in self.shareholders.values()],
+                                 self.serial_block_hashes)
+            self.failUnlessEqual(verifycap.to_string(),
+                                 self.serial_verifycap.to_string())
+            # progress is reported a segment at a time, and never goes back
+            progress = self.status.progress
+            self.failUnlessEqual(progress, sorted(progress))
+            self.failUnlessEqual(progress[:10],
+                                 [segnum / 11.0 for segnum in range(10)])
+            self.failUnlessEqual(progress[-1], 1.0)
+        d.addCallback(_pipelined)
+        return d
+
+    def test_memory(self):
+        # there is only room for the 100 bytes of blocks of two segments
+        d = self.encode(4, pipeline_memory=250)
+        def _check(verifycap):
+            self.failUnlessEqual(self.tracker.max_in_flight, 2)
+            for peer in self.shareholders.values():
+                self.failUnlessEqual(sorted(peer.blocks), range(10))
+        d.addCallback(_check)
+        # but a segment is always sent, even if it does not fit
+        d.addCallback(lambda ign: self.encode(4, pipeline_memory=10))
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(self.tracker.max_in_flight, 1))
+        return d
+
+    def test_lost_shareholder(self):
+        # a shareholder that goes away part-way through is dropped, and the
+        # other segments in flight carry on
+        d = self.encode(4, modes={0: "lost"})
+        def _check(verifycap):
+            lost = self.shareholders[0]
+            self.failIf(lost.closed)
+            self.failUnlessEqual(sorted(lost.blocks), [0])
+            for shnum in range(1, 10):
+                self.failUnless(self.shareholders[shnum].closed)
+        d.addCallback(_check)
+        return d
+
+    def test_unhappy(self):
+        # but losing too many of them fails the upload
+        d = self.encode(4, modes=dict([(shnum, "lost") for shnum in range(4)]))
+        def _check(res):
+            self.failUnless(isinstance(res, Failure))
+            self.failUnless(res.check(UploadUnhappinessError) or
+                            (res.check(defer.FirstError) and
+                             res.value.subFailure.check(UploadUnhappinessError)),
+                            res)
+        d.addBoth(_check)
+        # let the blocks that were still in flight be acknowledged
+        d.addCallback(lambda ign: task.deferLater(reactor, 0.1, lambda: None))
+        return d
+
+class Workers(PipelineMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.workers = None
+
+    def tearDown(self):
+        if self.workers:
+            return self.workers.stopService()
+
+    def _test_workers(self, worker_type):
+        self.workers = WorkerPool(2, worker_type)
+        self.workers.startService()
+        d = self.encode(1)
+        def _serial(verifycap):
+            self.serial_verifycap = verifycap
+            self.serial_blocks = [peer.blocks for peer
+                                  in self.shareholders.values()]
+            self.serial_block_hashes = [peer.block_hashes for peer
+                                        in self.shareholders.values()]
+        d.addCallback(_serial)
+        d.addCallback(lambda ign: self.encode(4, workers=self.workers))
+        def _check(verifycap):
+            # the workers produce exactly the same shares, in the same order
+            self.failUnlessEqual([peer.blocks for peer
+                                  in self.shareholders.values()],
+                                 self.serial_blocks)
+            self.failUnlessEqual([peer.block_hashes for peer
+                                  in self.shareholders.values()],
+                                 self.serial_block_hashes)
+            self.failUnlessEqual(verifycap.to_string(),
+                                 self.serial_verifycap.to_string())
+            for stage in ["encrypt", "hash"]:
+                key = "cumulative_encoding_" + stage
+                self.failUnless(self.eu.get_times()[key] > 0, stage)
+        d.addCallback(_check)
+        return d
+
+    def test_processes(self):
+        d = self._test_workers("processes")
+        def _check(ign):
+            # the hashers are updated in threads, the rest in processes
+            self.failUnless(self.workers.jobs["threads"] > 0)
+            self.failUnless(self.workers.jobs["processes"] > 0)
+        d.addCallback(_check)
+        return d
+
+    def test_threads(self):
+        d = self._test_workers("threads")
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(self.workers.jobs["processes"], 0))
+        return d
+
+    def test_encrypt(self):
+        # reads which do not start on an AES block boundary, and which are
+        # made of several chunks, come out just the same
+        self.workers = WorkerPool(2, "threads")
+        self.workers.startService()
+        self.patch(upload.EncryptAnUploadable, "CHUNKSIZE", 7)
+        def _encrypt(workers):
+            u = upload.Data(make_data(100), convergence="")
+            u.set_default_encoding_parameters({'max_segment_size': 30,
+                                               'k': 3, 'happy': 7, 'n': 10})
+            eu = upload.EncryptAnUploadable(u, workers=workers)
+            results = []
+            d = eu.read_encrypted(25, hash_only=False)
+            d.addCallback(results.append)
+            d.addCallback(lambda ign: eu.read_encrypted(20, hash_only=True))
+            d.addCallback(results.append)
+            d.addCallback(lambda ign: eu.read_encrypted(55, hash_only=False))
+            d.addCallback(results.append)
+            d.addCallback(lambda ign:
+                          eu.get_plaintext_hashtree_leaves(0, 4, 4))
+            d.addCallback(results.append)
+            d.addCallback(lambda ign: eu.get_plaintext_hash())
+            d.addCallback(results.append)
+            d.addCallback(lambda ign: ["".join(results[0]), results[1],
+                                       "".join(results[2])] + results[3:])
+            return d
+        d = _encrypt(None)
+        def _serial(expected):
+            self.failUnlessEqual(expected[1], [])
+            d2 = _encrypt(self.workers)
+            d2.addCallback(self.failUnlessEqual, expected)
+            return d2
+        d.addCallback(_serial)
+        return d
+
 class Roundtrip(GridTestMixin, unittest.TestCase):
 
     # a series of 3*3 tests to check out edge conditions. One axis is how the
@@ -386,6 +621,31 @@ class Roundtrip(GridTestMixin, unittest.TestCase):
     def test_125(self): return self.do_test_size(125)
     def test_101(self): return self.do_test_size(101)
 
+    def test_pipelined(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.c0.getServiceNamed("uploader")._pipeline_depth = 4
+        DATA = make_data(1000) # 40 segments
+        d = self.upload(DATA)
+        d.addCallback(lambda n: download_to_data(n))
+        d.addCallback(lambda newdata: self.failUnlessEqual(newdata, DATA))
+        return d
+
+    def test_workers(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        uploader = self.c0.getServiceNamed("uploader")
+        uploader._pipeline_depth = 4
+        uploader._workers = WorkerPool(2)
+        uploader._workers.setServiceParent(uploader)
+        DATA = make_data(1000) # 40 segments
+        d = self.upload(DATA)
+        d.addCallback(lambda n: download_to_data(n))
+        d.addCallback(lambda newdata: self.failUnlessEqual(newdata, DATA))
+        return d
+
     def upload(self, data):
         u = upload.Data(data, None)
         u.max_segment_size = 25
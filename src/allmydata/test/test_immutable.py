@@ -104,7 +104,7 @@ class TestShareFinder(unittest.TestCase):
                 self.rref = rref
             def get_serverid(self):
                 return self.serverid
-            def get_rref(self):
+            def get_rref(self, priority="interactive"):
                 return self.rref
             def get_name(self):
                 return "name-%s" % self.serverid
@@ -5,9 +5,15 @@ from allmydata import check_results
 from allmydata.interfaces import NotEnoughSharesError
 from allmydata.immutable import upload
 from allmydata.util.consumer import download_to_data
+from allmydata.interfaces import SDMF_VERSION, MDMF_VERSION
+from allmydata.mutable.publish import MutableData
+from allmydata.storage.diskio import ThreadedDiskIO
+from allmydata.storage.mutable import MutableShareFile
+from allmydata.storage.scrubber import ShareScrubber
+from allmydata.util import pollmixin
 from twisted.internet import defer
 from twisted.trial import unittest
-import random
+import os, random, struct, time
 from allmydata.test.no_network import GridTestMixin
 
 # We'll allow you to pass this test even if you trigger eighteen times as
@@ -69,6 +75,8 @@ class RepairTestMixin:
         return d
 
 class Verifier(GridTestMixin, unittest.TestCase, RepairTestMixin):
+    VERIFY = True
+
     def test_check_without_verify(self):
         """Check says the file is healthy when none of the shares have been
         touched. It says that the file is unhealthy when all of them have
@@ -109,7 +117,7 @@ class Verifier(GridTestMixin, unittest.TestCase, RepairTestMixin):
         d.addCallback(lambda ignored:
                       self.corrupt_shares_numbered(self.uri, [shnum],corruptor,debug=debug))
         d.addCallback(lambda ignored:
-                      self.c1_filenode.check(Monitor(), verify=True))
+                      self.c1_filenode.check(Monitor(), verify=self.VERIFY))
         def _check(vr):
             delta_reads, delta_allocates, delta_writes = self._get_delta_counts()
             self.failIfBigger(delta_reads, MAX_DELTA_READS)
@@ -340,7 +348,7 @@ class Verifier(GridTestMixin, unittest.TestCase, RepairTestMixin):
             for i in range(len(self.sh0_orig)):
                 d.addCallback(_corrupt, i)
                 d.addCallback(lambda ign:
-                              self.c1_filenode.check(Monitor(), verify=True))
+                              self.c1_filenode.check(Monitor(), verify=self.VERIFY))
                 d.addCallback(_did_check, i)
                 d.addCallback(_fix_sh0)
             return d
@@ -354,6 +362,233 @@ class Verifier(GridTestMixin, unittest.TestCase, RepairTestMixin):
         d.addCallback(_show_results)
         return d
 
+class ServerVerifyingVerifier(Verifier):
+    # the same tests, with verify="server", so that the servers verify the
+    # blocks of their own shares
+    VERIFY = "server"
+
+    def set_up_grid(self, *args, **kwargs):
+        self.basedir = self.basedir.replace("/Verifier/",
+                                            "/ServerVerifyingVerifier/")
+        GridTestMixin.set_up_grid(self, *args, **kwargs)
+
+class ServerVerifier(GridTestMixin, unittest.TestCase, RepairTestMixin):
+    def _count(self, name):
+        total = 0
+        for (i, ss, storedir) in self.iterate_servers():
+            counters = ss.stats_provider.get_stats()['counters']
+            total += counters.get('storage_server.' + name, 0)
+        return total
+
+    def test_no_block_reads(self):
+        # servers which verify their own shares send no blocks to the
+        # Verifier
+        self.basedir = "repairer/ServerVerifier/no_block_reads"
+        self.set_up_grid(num_clients=2)
+        d = self.upload_and_stash()
+        d.addCallback(lambda ignored: self._stash_counts())
+        d.addCallback(lambda ignored:
+                      self.c1_filenode.check(Monitor(), verify="server"))
+        def _check(vr):
+            self.failUnless(vr.is_healthy(), vr.as_dict())
+            delta_reads, delta_allocates, delta_writes = self._get_delta_counts()
+            self.failUnlessEqual(delta_reads, 0)
+            self.failUnlessEqual(self._count("verify"), 10)
+        d.addCallback(_check)
+        return d
+
+    def test_not_by_default(self):
+        # verify=True still downloads and checks every block itself
+        self.basedir = "repairer/ServerVerifier/not_by_default"
+        self.set_up_grid(num_clients=2)
+        d = self.upload_and_stash()
+        d.addCallback(lambda ignored: self._stash_counts())
+        d.addCallback(lambda ignored:
+                      self.c1_filenode.check(Monitor(), verify=True))
+        def _check(vr):
+            self.failUnless(vr.is_healthy(), vr.as_dict())
+            delta_reads, delta_allocates, delta_writes = self._get_delta_counts()
+            self.failUnless(delta_reads > 0, delta_reads)
+            self.failUnlessEqual(self._count("verify"), 0)
+        d.addCallback(_check)
+        return d
+
+    def test_lying_server(self):
+        # a server which claims that a share of some other file is good is
+        # caught out when the Verifier checks its summary against the
+        # verifycap
+        self.basedir = "repairer/ServerVerifier/lying_server"
+        self.set_up_grid(num_clients=2)
+        d = self.upload_and_stash()
+        def _lie(ign):
+            (i, ss, storedir) = list(self.iterate_servers())[0]
+            original = ss.remote_verify_shares
+            def _verify_shares(storage_index, sharenums):
+                d2 = defer.maybeDeferred(original, storage_index, sharenums)
+                def _tamper(results):
+                    for summary in results.values():
+                        summary["block-hash-root"] = "\x00" * 32
+                    return results
+                d2.addCallback(_tamper)
+                return d2
+            ss.remote_verify_shares = _verify_shares
+        d.addCallback(_lie)
+        d.addCallback(lambda ignored:
+                      self.c1_filenode.check(Monitor(), verify="server"))
+        def _check(vr):
+            self.failIf(vr.is_healthy())
+            self.failUnlessEqual(len(vr.get_corrupt_shares()), 1)
+        d.addCallback(_check)
+        return d
+
+class Scrubber(GridTestMixin, unittest.TestCase, RepairTestMixin,
+               pollmixin.PollMixin):
+    def _scrub(self, ss, bytes_per_second=None):
+        statefile = os.path.join(ss.storedir, "share_scrubber.state")
+        scrubber = ShareScrubber(ss, statefile, bytes_per_second)
+        scrubber.cpu_slice = 500
+        scrubber.start_current_prefix(time.time())
+        state = scrubber.get_state()
+        return state["history"][state["last-cycle-finished"]]
+
+    def _scrub_all(self):
+        # returns {serverid: history entry}
+        return dict([(ss.my_nodeid, self._scrub(ss))
+                     for (i, ss, storedir) in self.iterate_servers()])
+
+    def _get_server(self, serverid):
+        for (i, ss, storedir) in self.iterate_servers():
+            if ss.my_nodeid == serverid:
+                return ss
+
+    def _upload_to_one_server(self):
+        self.set_up_grid(num_clients=2, num_servers=1)
+        self.g.clients[0].DEFAULT_ENCODING_PARAMETERS['happy'] = 1
+        return self.upload_and_stash()
+
+    def _advisories(self, ss):
+        if not os.path.exists(ss.corruption_advisory_dir):
+            return []
+        return os.listdir(ss.corruption_advisory_dir)
+
+    def _check_one_corrupt(self, shares, bad):
+        # 'bad' is the (shnum, serverid, sharefile) of the only share
+        # which should be found to be corrupt
+        (bad_shnum, bad_serverid, bad_sharefile) = bad
+        results = self._scrub_all()
+        for (shnum, serverid, sharefile) in shares:
+            r = results[serverid]
+            self.failUnlessEqual(r["examined-shares"], 1)
+            self.failUnless(r["examined-bytes"] > 0)
+            self.failUnlessEqual(r["incompatible-shares"], [])
+            ss = self._get_server(serverid)
+            if serverid == bad_serverid:
+                corrupt = r["corrupt-shares"]
+                self.failUnlessEqual(len(corrupt), 1)
+                self.failUnlessEqual(corrupt[0][1], shnum)
+                self.failUnlessEqual(len(self._advisories(ss)), 1)
+            else:
+                self.failUnlessEqual(r["corrupt-shares"], [])
+                self.failUnlessEqual(self._advisories(ss), [])
+        return results
+
+    def test_immutable(self):
+        self.basedir = "repairer/Scrubber/immutable"
+        self.set_up_grid(num_clients=2)
+        d = self.upload_and_stash()
+        def _check(ign):
+            shares = self.find_uri_shares(self.uri)
+            self.failUnlessEqual(len(shares), 10)
+            for r in self._scrub_all().values():
+                self.failUnlessEqual(r["corrupt-shares"], [])
+            self.corrupt_share(shares[3], common._corrupt_share_data)
+            results = self._check_one_corrupt(shares, shares[3])
+            reason = results[shares[3][1]]["corrupt-shares"][0][3]
+            self.failUnlessIn("does not match its hash", reason)
+            # the next cycle finds it again, but does not report it again
+            self._check_one_corrupt(shares, shares[3])
+        d.addCallback(_check)
+        return d
+
+    def _test_mutable(self, version, corruptor):
+        self.set_up_grid(num_clients=1)
+        c0 = self.g.clients[0]
+        d = c0.create_mutable_file(MutableData("contents " * 10000),
+                                   version=version)
+        def _check(n):
+            shares = self.find_uri_shares(n.get_uri())
+            self.failUnlessEqual(len(shares), 10)
+            for r in self._scrub_all().values():
+                self.failUnlessEqual(r["corrupt-shares"], [])
+            self.corrupt_share(shares[3], corruptor)
+            self._check_one_corrupt(shares, shares[3])
+        d.addCallback(_check)
+        return d
+
+    def test_sdmf(self):
+        self.basedir = "repairer/Scrubber/sdmf"
+        return self._test_mutable(SDMF_VERSION,
+                                  common._corrupt_mutable_share_data)
+
+    def test_mdmf(self):
+        # the block hash tree is at the end of an MDMF share
+        def _corrupt_last_byte(data):
+            offset = MutableShareFile.DATA_LENGTH_OFFSET
+            (length,) = struct.unpack(">Q", data[offset:offset+8])
+            i = MutableShareFile.DATA_OFFSET + length - 1
+            return data[:i] + chr(ord(data[i]) ^ 0x01) + data[i+1:]
+        self.basedir = "repairer/Scrubber/mdmf"
+        return self._test_mutable(MDMF_VERSION, _corrupt_last_byte)
+
+    def test_bandwidth(self):
+        self.basedir = "repairer/Scrubber/bandwidth"
+        d = self._upload_to_one_server()
+        def _check(ign):
+            ss = self.g.servers_by_number[0]
+            statefile = os.path.join(ss.storedir, "share_scrubber.state")
+            scrubber = ShareScrubber(ss, statefile, bytes_per_second=100)
+            scrubber.cpu_slice = 500
+            # 100 bytes per second, for 500 seconds, is more than one share,
+            # so all 10 shares of the one bucket are read
+            scrubber.start_current_prefix(time.time())
+            state = scrubber.get_state()
+            size = state["history"][0]["examined-bytes"]
+            self.failUnlessEqual(state["history"][0]["examined-shares"], 10)
+            self.failUnless(scrubber.get_sleep_time(1.0) >= size/100.0 - 1.0)
+            # once the budget has been used, the slice ends
+            scrubber.record_results("a"*26, [(0, "immutable", "ok", None,
+                                              100*500)])
+            self.failUnless(scrubber.time_slice_exceeded(time.time()))
+            scrubber.get_sleep_time(1.0)
+            self.failIf(scrubber.time_slice_exceeded(time.time()))
+        d.addCallback(_check)
+        return d
+
+    def test_threaded(self):
+        # with I/O threads, the shares are read in a worker thread
+        self.basedir = "repairer/Scrubber/threaded"
+        d = self._upload_to_one_server()
+        def _start(ign):
+            ss = self.g.servers_by_number[0]
+            self.corrupt_shares_numbered(self.uri, [3],
+                                         common._corrupt_share_data)
+            ss.disk_io = ThreadedDiskIO(ss, [disk.sharedir
+                                             for disk in ss.disks], 2)
+            ss.disk_io.setServiceParent(ss)
+            statefile = os.path.join(ss.storedir, "share_scrubber.state")
+            self.scrubber = ShareScrubber(ss, statefile, None)
+            self.scrubber.slow_start = 0
+            self.scrubber.setServiceParent(ss)
+            return self.poll(lambda: self.scrubber.get_state()
+                                     ["last-cycle-finished"] is not None)
+        d.addCallback(_start)
+        def _check(ign):
+            r = self.scrubber.get_state()["history"][0]
+            self.failUnlessEqual(r["examined-shares"], 10)
+            self.failUnlessEqual([c[1] for c in r["corrupt-shares"]], [3])
+        d.addCallback(_check)
+        return d
+
 # We'll allow you to pass this test even if you trigger thirty-five times as
 # many block sends and disk writes as would be optimal.
 WRITE_LEEWAY = 35
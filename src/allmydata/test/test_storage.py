@@ -1,4 +1,4 @@
-import time, os.path, platform, stat, re, simplejson, struct, shutil
+import time, os.path, threading, platform, stat, re, simplejson, struct, shutil, copy
 
 import mock
 
@@ -9,15 +9,28 @@ from twisted.application import service
 from foolscap.api import fireEventually
 import itertools
 from allmydata import interfaces
-from allmydata.util import fileutil, hashutil, base32, pollmixin, time_format
+from allmydata.util import fileutil, hashutil, base32, pollmixin, time_format, \
+     log
 from allmydata.storage.server import StorageServer
 from allmydata.storage.mutable import MutableShareFile
-from allmydata.storage.immutable import BucketWriter, BucketReader
+from allmydata.storage.immutable import BucketWriter, BucketReader, ShareFile
 from allmydata.storage.common import DataTooLargeError, storage_index_to_dir, \
-     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError, \
+     si_b2a
 from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.diskio import ThreadedDiskIO
+from allmydata.storage import durability
+from allmydata.storage.durability import dirs_to_sync, GroupCommitter
+from allmydata.storage.scheduler import FIFOScheduler, FairQueueScheduler, \
+     Request, Requester, ANONYMOUS, BACKGROUND
+from allmydata.storage.filecache import OpenFileCache
+from allmydata.storage.blockcache import BlockCache
+from allmydata.storage.latency import LatencyHistogram
+from allmydata.storage.packed import PackedShareStore, PackedShare, \
+     pack_share_dirs
 from allmydata.storage.crawler import BucketCountingCrawler
-from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.expirer import LeaseCheckingCrawler, \
+     IndexedLeaseCheckingCrawler
 from allmydata.immutable.layout import WriteBucketProxy, WriteBucketProxy_v2, \
      ReadBucketProxy
 from allmydata.mutable.layout import MDMFSlotWriteProxy, MDMFSlotReadProxy, \
@@ -37,9 +50,12 @@ from allmydata.web.storage import StorageStatus, remove_prefix
 class Marker:
     pass
 class FakeCanary:
-    def __init__(self, ignore_disconnectors=False):
+    def __init__(self, ignore_disconnectors=False, tubid="fake"):
         self.ignore = ignore_disconnectors
         self.disconnectors = {}
+        self.tubid = tubid
+    def getRemoteTubID(self):
+        return self.tubid
     def notifyOnDisconnect(self, f, *args, **kwargs):
         if self.ignore:
             return
@@ -68,6 +84,8 @@ class Bucket(unittest.TestCase):
 
     def bucket_writer_closed(self, bw, consumed):
         pass
+    def bucket_writer_wrote(self, bw, length):
+        pass
     def add_latency(self, category, latency):
         pass
     def count(self, name, delta=1):
@@ -196,6 +214,8 @@ class BucketProxy(unittest.TestCase):
 
     def bucket_writer_closed(self, bw, consumed):
         pass
+    def bucket_writer_wrote(self, bw, length):
+        pass
     def add_latency(self, category, latency):
         pass
     def count(self, name, delta=1):
@@ -365,6 +385,65 @@ class Server(unittest.TestCase):
         reader = readers[shnum]
         self.failUnlessEqual(reader.remote_read(2**32, 2), "ab")
 
+    def test_get_buckets_many(self):
+        ss = self.create("test_get_buckets_many")
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get('supports-get-buckets-many'), sv1)
+
+        for (storage_index, sharenums) in [("si1", [0, 1]), ("si2", [3])]:
+            already, writers = self.allocate(ss, storage_index, sharenums, 10)
+            for i, wb in writers.items():
+                wb.remote_write(0, "%10d" % i)
+                wb.remote_close()
+        # an incomplete share should not be reported
+        already, writers = self.allocate(ss, "si3", [0], 10)
+
+        res = ss.remote_get_buckets_many(["si1", "si2", "si3", "si4"], True)
+        self.failUnlessEqual(sorted(res.keys()), ["si1", "si2"])
+        self.failUnlessEqual(sorted(res["si1"].keys()), [0, 1])
+        self.failUnlessEqual(res["si1"][1].remote_read(0, 10), "%10d" % 1)
+        self.failUnlessEqual(res["si2"].keys(), [3])
+        self.failUnlessEqual(res["si2"][3].remote_read(0, 10), "%10d" % 3)
+
+        res = ss.remote_get_buckets_many(["si1", "si2", "si3", "si4"], False)
+        self.failUnlessEqual(res, {"si1": {0: None, 1: None},
+                                   "si2": {3: None}})
+        self.failUnlessEqual(ss.remote_get_buckets_many([], False), {})
+
+    def test_add_lease_many(self):
+        ss = self.create("test_add_lease_many")
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get('supports-add-lease-many'), sv1)
+
+        for (storage_index, sharenums) in [("si1", [0, 1]), ("si2", [3])]:
+            already, writers = self.allocate(ss, storage_index, sharenums, 10)
+            for i, wb in writers.items():
+                wb.remote_write(0, "%10d" % i)
+                wb.remote_close()
+
+        def _secrets():
+            return (hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()),
+                    hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()))
+        rs1,cs1 = _secrets()
+        rs2,cs2 = _secrets()
+        res = ss.remote_add_lease_many([("si1", rs1, cs1),
+                                        ("si2", rs2, cs2),
+                                        ("si3", rs2, cs2)])
+        self.failUnlessEqual(res, {"si1": 2, "si2": 1, "si3": 0})
+        leases = list(ss.get_leases("si1"))
+        self.failUnlessEqual(len(leases), 2)
+        self.failUnlessIn(rs1, [l.renew_secret for l in leases])
+        leases = list(ss.get_leases("si2"))
+        self.failUnlessEqual(len(leases), 2)
+        self.failUnlessIn(rs2, [l.renew_secret for l in leases])
+
+        # adding the same leases again renews them
+        ss.remote_add_lease_many([("si1", rs1, cs1)])
+        self.failUnlessEqual(len(list(ss.get_leases("si1"))), 2)
+        self.failUnlessEqual(ss.remote_add_lease_many([]), {})
+
     def test_dont_overfill_dirs(self):
         """
         This test asserts that if you add a second share whose storage index
@@ -573,6 +652,93 @@ class Server(unittest.TestCase):
         ss.disownServiceParent()
         del ss
 
+    @mock.patch('allmydata.util.fileutil.get_disk_stats')
+    def test_space_ledger(self, mock_get_disk_stats):
+        mock_get_disk_stats.return_value = {
+            'free_for_nonroot': 20000,
+            'avail': 20000,
+            }
+        ss = self.create("test_space_ledger")
+        ss.space.refresh_bytes = 1000
+        ss.space.refresh()
+        calls = mock_get_disk_stats.call_count
+        disk = ss.disks.disks[0]
+
+        # allocating (and closing) shares does not look at the disk again
+        canary = FakeCanary(True)
+        already,writers = self.allocate(ss, "vid1", [0,1], 500, canary)
+        self.failUnlessEqual(mock_get_disk_stats.call_count, calls)
+        self.failUnlessEqual(ss.space.get_reserved(), 1000)
+        self.failUnlessEqual(ss.space.get_available(disk), 19000)
+        writers[0].remote_write(0, "a"*100)
+        stats = ss.space.get_stats()
+        self.failUnlessEqual(stats["reserved"], 1000)
+        self.failUnlessEqual(stats["in_flight"], 100)
+        self.failUnlessEqual(ss.get_disk_load(disk), 2)
+        writers[0].remote_close()
+        size = os.path.getsize(os.path.join(ss.sharedir,
+                                            storage_index_to_dir("vid1"), "0"))
+        self.failUnlessEqual(ss.space.get_reserved(), 500)
+        self.failUnlessEqual(ss.space.get_in_flight(), 0)
+        self.failUnlessEqual(ss.space.committed_total, size)
+        self.failUnlessEqual(ss.get_available_space(), 20000 - size)
+        self.failUnlessEqual(mock_get_disk_stats.call_count, calls)
+
+        # an abandoned writer gives back its reservation
+        del already
+        del writers
+        self.failUnlessEqual(ss.space.get_reserved(), 0)
+        self.failUnlessEqual(ss.get_disk_load(disk), 0)
+
+        # writing enough data makes the ledger ask the disk again
+        already,writers = self.allocate(ss, "vid2", [0], 2000)
+        writers[0].remote_write(0, "b"*1000)
+        mock_get_disk_stats.return_value = {
+            'free_for_nonroot': 15000,
+            'avail': 15000,
+            }
+        self.failUnlessEqual(ss.get_available_space(), 15000)
+        # the disk has already counted the 1000 bytes that were written, so
+        # only the rest of the reservation is subtracted
+        self.failUnlessEqual(ss.space.get_available(disk), 14000)
+        self.failUnlessEqual(mock_get_disk_stats.call_count, calls + 1)
+        writers[0].remote_abort()
+        # and aborting the upload frees them
+        self.failUnlessEqual(ss.space.get_available(disk), 16000)
+
+        # a share that was partly written before a refresh is only
+        # committed once
+        mock_get_disk_stats.return_value = {
+            'free_for_nonroot': 20000,
+            'avail': 20000,
+            }
+        ss.space.refresh()
+        already,writers = self.allocate(ss, "vid3", [0], 500, canary)
+        writers[0].remote_write(0, "c"*300)
+        mock_get_disk_stats.return_value = {
+            'free_for_nonroot': 19700,
+            'avail': 19700,
+            }
+        ss.space.refresh()
+        self.failUnlessEqual(ss.space.get_available(disk), 19500)
+        writers[0].remote_write(300, "c"*200)
+        writers[0].remote_close()
+        size = os.path.getsize(os.path.join(ss.sharedir,
+                                            storage_index_to_dir("vid3"), "0"))
+        self.failUnlessEqual(ss.get_available_space(), 20000 - size)
+        self.failUnlessEqual(ss.space.get_available(disk), 20000 - size)
+        del already
+        del writers
+
+        # mutable writes count as well
+        available = ss.space.get_available(disk)
+        secrets = ("we1", "rs1", "cs1")
+        ss.remote_slot_testv_and_readv_and_writev("si1", secrets,
+                                                  {0: ([], [(0, "c"*100)],
+                                                       None)},
+                                                  [])
+        self.failUnless(ss.space.get_available(disk) < available - 100)
+
     def test_seek(self):
         basedir = self.workdir("test_seek_behavior")
         fileutil.make_dirs(basedir)
@@ -687,6 +853,29 @@ class Server(unittest.TestCase):
         leases = list(ss.get_leases("si3"))
         self.failUnlessEqual(len(leases), 2)
 
+    def test_verify_shares(self):
+        ss = self.create("test_verify_shares")
+        already,writers = self.allocate(ss, "vid", [0,1,2], 100)
+        # a header for a share of an unknown version
+        writers[0].remote_write(0, struct.pack(">L", 7) + "\x00" * 60)
+        # a v1 header whose URI extension is past the end of the share
+        writers[1].remote_write(0, struct.pack(">LLLLLLLLL",
+                                               1, 10, 10, 0x24, 0x24, 0x24,
+                                               0x24, 0x24, 1000))
+        for wb in writers.values():
+            wb.remote_close()
+        results = ss.remote_verify_shares("vid", set([0, 1, 2]))
+        self.failUnlessEqual(results[0]["status"], "incompatible")
+        self.failUnlessEqual(results[1]["status"], "corrupt")
+        self.failUnlessIn("URI extension length is truncated",
+                          results[1]["reason"])
+        # an empty share looks like one of version 0
+        self.failUnlessEqual(results[2]["status"], "incompatible")
+        self.failUnlessEqual(sorted(ss.remote_verify_shares("vid", set([1]))),
+                             [1])
+        self.failUnlessEqual(ss.remote_verify_shares("other", set()), {})
+        self.failUnless(ss.remote_get_version()["http://allmydata.org/tahoe/protocols/storage/v1"]["supports-verify-shares"])
+
     def test_readonly(self):
         workdir = self.workdir("test_readonly")
         ss = StorageServer(workdir, "\x00" * 20, readonly_storage=True)
@@ -2778,6 +2967,2123 @@ class MDMFProxies(unittest.TestCase, ShouldFailMixin):
         return d
 
 
+class Inventory(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name, start=True, **kwargs):
+        basedir = os.path.join("storage", "Inventory", name)
+        ss = StorageServer(basedir, "\x00" * 20, **kwargs)
+        if start:
+            ss.setServiceParent(self.sparent)
+        return ss
+
+    def write_immutable(self, ss, si, sharenums):
+        a,w = ss.remote_allocate_buckets(si, "r"*32, "c"*32, sharenums, 100,
+                                         FakeCanary())
+        for bw in w.values():
+            bw.remote_write(0, "a"*100)
+            bw.remote_close()
+
+    def writev(self, ss, si, sharenum, new_length):
+        secrets = ("we"*16, "r"*32, "c"*32)
+        return ss.remote_slot_testv_and_readv_and_writev(
+            si, secrets, {sharenum: ([], [(0, "m"*50)], new_length)}, [])
+
+    def test_build(self):
+        ss = self.create("test_build", start=False)
+        self.write_immutable(ss, "\x01"*16, [0, 1])
+        self.writev(ss, "\x02"*16, 3, None)
+        # a numeric file which is not a share is ignored
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("\x03"*16), "7")
+        fileutil.make_dirs(os.path.dirname(fn))
+        fileutil.write(fn, "not a share")
+        self.failUnlessEqual(ss.inventory, None)
+
+        ss2 = self.create("test_build", inventory_enabled=True)
+        inv = ss2.inventory
+        self.failIfEqual(inv.build_time, None)
+        self.failUnlessEqual(inv.get_num_buckets(), 2)
+        self.failUnlessEqual(inv.get_num_shares(), 3)
+        self.failUnlessEqual(sorted(inv.get_shares("\x01"*16).keys()), [0, 1])
+        self.failUnlessEqual(inv.get_shares("\x01"*16)[0],
+                             ("immutable", 0x0c + 100 + ShareFile.LEASE_SIZE))
+        self.failUnlessEqual(inv.get_shares("\x02"*16)[3][0], "mutable")
+        self.failUnlessEqual(inv.get_shares("\x03"*16), {})
+        self.failUnless(inv.get_memory_footprint() > 0)
+
+        stats = ss2.get_stats()
+        self.failUnlessEqual(stats["storage_server.inventory.shares"], 3)
+        self.failUnlessEqual(stats["storage_server.inventory.buckets"], 2)
+        html = StorageStatus(ss2).renderSynchronously()
+        self.failUnlessIn("Share inventory: 3 shares in 2 buckets", html)
+
+    def test_updates(self):
+        ss = self.create("test_updates", inventory_enabled=True)
+        inv = ss.inventory
+        self.write_immutable(ss, "\x01"*16, [0, 1])
+        self.failUnlessEqual(sorted(inv.get_shares("\x01"*16)), [0, 1])
+        self.failUnlessEqual(sorted(ss.remote_get_buckets("\x01"*16)), [0, 1])
+
+        # aborted uploads are not recorded
+        a,w = ss.remote_allocate_buckets("\x04"*16, "r"*32, "c"*32, [0], 100,
+                                         FakeCanary())
+        w[0].remote_abort()
+        self.failUnlessEqual(inv.get_shares("\x04"*16), {})
+
+        self.writev(ss, "\x02"*16, 3, None)
+        (sharetype, size) = inv.get_shares("\x02"*16)[3]
+        self.failUnlessEqual(sharetype, "mutable")
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("\x02"*16), "3")
+        self.failUnlessEqual(size, os.path.getsize(fn))
+        self.failUnlessEqual(ss.remote_slot_readv("\x02"*16, [], [(0, 5)]),
+                             {3: ["mmmmm"]})
+
+        self.writev(ss, "\x02"*16, 3, 0)
+        self.failUnlessEqual(inv.get_shares("\x02"*16), {})
+        self.failUnlessEqual(inv.get_num_shares(), 2)
+
+    def test_absent_lookups_avoid_disk(self):
+        ss = self.create("test_absent_lookups_avoid_disk",
+                         inventory_enabled=True)
+        absent = "\x05"*16
+        def _no_disk(*args):
+            raise AssertionError("touched the disk: %r" % (args,))
+        with mock.patch("os.listdir", side_effect=_no_disk), \
+             mock.patch("os.path.isdir", side_effect=_no_disk), \
+             mock.patch("os.path.exists", side_effect=_no_disk):
+            self.failUnlessEqual(ss.remote_get_buckets(absent), {})
+            self.failUnlessEqual(ss.remote_slot_readv(absent, [], [(0, 10)]),
+                                 {})
+
+class FakeIOServer:
+    current_request = None
+    def __init__(self):
+        self.latencies = {}
+    def add_latency(self, category, latency):
+        self.latencies.setdefault(category, []).append(latency)
+
+class ThreadedIO(unittest.TestCase, ShouldFailMixin):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name, **kwargs):
+        basedir = os.path.join("storage", "ThreadedIO", name)
+        ss = StorageServer(basedir, "\x00" * 20, io_threads=2, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def test_ordering(self):
+        server = FakeIOServer()
+        dio = ThreadedDiskIO(server, ["a"], 3)
+        dio.setServiceParent(self.sparent)
+        done = []
+        def _op(bucket, i):
+            # the earlier operations on each bucket take longer, so any
+            # reordering would show up
+            time.sleep(0.01 * (5-i))
+            done.append((bucket, i))
+            return i
+        ds = []
+        for i in range(5):
+            for bucket in ["a/1", "a/2", "b/1"]:
+                ds.append(dio.run(bucket, _op, (bucket, i),
+                                  lambda res: res*10))
+        self.failUnlessEqual(dio.get_queue_depth(), 15)
+        d = dio.gather(ds)
+        def _check(res):
+            self.failUnlessEqual(res, [i*10 for i in range(5) for b in "abc"])
+            for bucket in ["a/1", "a/2", "b/1"]:
+                self.failUnlessEqual([i for (b,i) in done if b == bucket],
+                                     range(5))
+            self.failUnlessEqual(server.latencies["io-queue-depth"],
+                                 range(15))
+            self.failUnlessEqual(len(server.latencies["io-wait"]), 15)
+            self.failUnlessEqual(dio.get_queue_depth(), 0)
+        d.addCallback(_check)
+        def _fail():
+            raise ValueError("oops")
+        d.addCallback(lambda ign:
+                      self.shouldFail(ValueError, "gather", "oops",
+                                      dio.gather,
+                                      [dio.run("a/1", _fail),
+                                       dio.run("a/2", lambda: 1)]))
+        return d
+
+    def _run_load(self, scheduler):
+        # one thread, which is kept busy while a big client queues ten
+        # reads and then a small client queues two
+        server = FakeIOServer()
+        dio = ThreadedDiskIO(server, ["a"], 1, scheduler)
+        dio.setServiceParent(self.sparent)
+        big = Requester("big")
+        small = Requester("small")
+        go = threading.Event()
+        done = []
+        def _op(who, i):
+            go.wait(10)
+            done.append((who, i))
+        ds = []
+        for (who, count) in [(big, 10), (small, 2)]:
+            server.current_request = (who, "read")
+            for i in range(count):
+                ds.append(dio.run("a/%s%d" % (who.name, i), _op,
+                                  (who.name, i)))
+        server.current_request = None
+        go.set()
+        d = dio.gather(ds)
+        d.addCallback(lambda ign: (done, dio))
+        return d
+
+    def test_fifo_scheduling(self):
+        d = self._run_load(FIFOScheduler)
+        def _check((done, dio)):
+            self.failUnlessEqual(done[-2:], [("small", 0), ("small", 1)])
+        d.addCallback(_check)
+        return d
+
+    def test_fair_scheduling(self):
+        d = self._run_load(FairQueueScheduler)
+        def _check((done, dio)):
+            # the small client waits for a request or so of the big one's,
+            # not for all of them
+            self.failUnlessEqual(done[:5], [("big", 0), ("big", 1),
+                                            ("small", 0), ("big", 2),
+                                            ("small", 1)])
+            stats = dict([(r["name"], r) for r in dio.get_requester_stats()])
+            self.failUnlessEqual(sorted(stats.keys()), ["big", "small"])
+            small = stats["small"]
+            self.failUnlessEqual(small["priority"], "interactive")
+            self.failUnlessEqual((small["queued"], small["running"],
+                                  small["completed"]), (0, 0, 2))
+            self.failUnlessEqual(small["requests"], {"read": 2})
+            self.failUnless(small["mean_wait"] >= 0, small)
+            self.failUnlessEqual(stats["big"]["completed"], 10)
+        d.addCallback(_check)
+        return d
+
+    def test_sessions(self):
+        ss = self.create("test_sessions", io_scheduler="fair")
+        v1 = ss.remote_get_version()["http://allmydata.org/tahoe/protocols/storage/v1"]
+        self.failUnless(v1["supports-sessions"])
+        self.failUnlessRaises(ValueError, ss.remote_open_session,
+                              FakeCanary(tubid="alice"), "urgent")
+        # the client is known by its tub ID, not by anything it says
+        canary = FakeCanary(tubid="alice")
+        session = ss.remote_open_session(canary, "bulk")
+        si = "\x01"*16
+        a,w = session.doRemoteCall("allocate_buckets",
+                                   (si, "r"*32, "c"*32, [0], 100,
+                                    FakeCanary()), {})
+        self.failUnlessEqual(ss.current_request, None)
+        bw = w[0]
+        d = bw.doRemoteCall("write", (0, "a"*100), {})
+        d.addCallback(lambda ign: bw.doRemoteCall("close", (), {}))
+        def _read(ign):
+            # a reader that was fetched through the session reads for alice,
+            # one fetched without a session reads for nobody in particular
+            b = session.doRemoteCall("get_buckets", (si,), {})
+            d1 = b[0].doRemoteCall("read", (0, 10), {})
+            b = ss.doRemoteCall("get_buckets", (si,), {})
+            d2 = b[0].doRemoteCall("read", (0, 10), {})
+            return defer.gatherResults([d1, d2])
+        d.addCallback(_read)
+        def _check(res):
+            self.failUnlessEqual(res, ["a"*10, "a"*10])
+            stats = dict([(r["name"], r) for r in ss.get_requester_stats()])
+            alice = stats["alice"]
+            self.failUnlessEqual(alice["priority"], "bulk")
+            self.failUnlessEqual(alice["requests"], {"write": 2, "read": 1})
+            self.failUnlessEqual(alice["completed"], 3)
+            self.failUnlessEqual(stats["(anonymous)"]["requests"],
+                                 {"read": 1})
+            # once the client's connection is lost, the server forgets it
+            for (f, args, kwargs) in canary.disconnectors.values():
+                f(*args, **kwargs)
+            stats = dict([(r["name"], r) for r in ss.get_requester_stats()])
+            self.failUnlessEqual(stats.keys(), ["(anonymous)"])
+            self.failUnlessEqual(ss._session_requesters, {})
+        d.addCallback(_check)
+        return d
+
+    def test_session_requesters(self):
+        ss = self.create("test_session_requesters", io_scheduler="fair")
+        alice1 = FakeCanary(tubid="alice")
+        alice2 = FakeCanary(tubid="alice")
+        s1 = ss.remote_open_session(alice1, "interactive")
+        s2 = ss.remote_open_session(alice2, "interactive")
+        s3 = ss.remote_open_session(alice2, "bulk")
+        s4 = ss.remote_open_session(FakeCanary(tubid="bob"), "interactive")
+        # sessions opened over the same connection (or another connection
+        # from the same tub) share a requester
+        self.failUnlessIdentical(s1.requester, s2.requester)
+        self.failIfIdentical(s1.requester, s3.requester)
+        self.failIfIdentical(s1.requester, s4.requester)
+        self.failUnlessEqual(len(ss._session_requesters), 3)
+
+        # stats for a requester whose sessions have all gone are dropped
+        # once nothing is queued or running for it
+        go = threading.Event()
+        ss.current_request = (s1.requester, "read")
+        d = ss.disk_io.run("a", go.wait, (10,))
+        ss.current_request = None
+        for (f, args, kwargs) in alice1.disconnectors.values():
+            f(*args, **kwargs)
+        self.failUnless(("alice", "interactive") in ss._session_requesters)
+        for (f, args, kwargs) in alice2.disconnectors.values():
+            f(*args, **kwargs)
+        self.failIf(("alice", "interactive") in ss._session_requesters)
+        names = [(r["name"], r["priority"])
+                 for r in ss.get_requester_stats()]
+        self.failUnlessEqual(names, [("alice", "interactive")])
+        go.set()
+        d.addCallback(fireEventually)
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(ss.get_requester_stats(), []))
+        return d
+
+    def test_bad_scheduler(self):
+        self.failUnlessRaises(ValueError, self.create, "test_bad_scheduler",
+                              io_scheduler="lifo")
+
+    def test_immutable(self):
+        ss = self.create("test_immutable", leasedb_enabled=True,
+                         inventory_enabled=True)
+        si = "\x01"*16
+        a,w = ss.remote_allocate_buckets(si, "r"*32, "c"*32, [0, 1], 100,
+                                         FakeCanary())
+        ds = []
+        for shnum, bw in w.items():
+            # don't wait for each write: they are queued in order
+            for i in range(10):
+                ds.append(bw.remote_write(10*i, "%10d" % (shnum*100+i)))
+            ds.append(bw.remote_close())
+            self.failUnless(bw.closed)
+        d = defer.gatherResults(ds)
+        def _written(ign):
+            self.failUnlessEqual(ss.allocated_size(), 0)
+            self.failUnlessEqual(sorted(ss.inventory.get_shares(si)), [0, 1])
+            self.failUnlessEqual(len(ss.leasedb.get_leases(si, 1)), 1)
+            b = ss.remote_get_buckets(si)
+            return b[1].remote_read(10, 20)
+        d.addCallback(_written)
+        d.addCallback(lambda data:
+                      self.failUnlessEqual(data, "%10d%10d" % (101, 102)))
+        d.addCallback(lambda ign:
+                      ss.remote_add_lease(si, "R"*32, "C"*32))
+        d.addCallback(lambda ign:
+                      ss.remote_add_lease_many([(si, "S"*32, "D"*32),
+                                                ("\x02"*16, "S"*32, "D"*32)]))
+        d.addCallback(lambda res:
+                      self.failUnlessEqual(res, {si: 2, "\x02"*16: 0}))
+        d.addCallback(lambda ign:
+                      ss.remote_renew_lease(si, "R"*32))
+        def _leased(ign):
+            leases = ss.leasedb.get_leases(si, 0)
+            self.failUnlessEqual(sorted([l.renew_secret for l in leases]),
+                                 ["R"*32, "S"*32, "r"*32])
+            self.failUnlessEqual(len(list(ss.get_leases(si))), 3)
+        d.addCallback(_leased)
+        d.addCallback(lambda ign:
+                      self.shouldFail(IndexError, "renew", None,
+                                      ss.remote_renew_lease,
+                                      "\x02"*16, "R"*32))
+        def _check_stats(ign):
+            latencies = ss.get_latencies()
+            self.failUnlessIn("io-wait", latencies)
+            self.failUnlessIn("io-queue-depth", latencies)
+            self.failUnless(latencies["io-queue-depth"]["90_0_percentile"]
+                            >= 10, latencies)
+        d.addCallback(_check_stats)
+        return d
+
+    def test_abort(self):
+        ss = self.create("test_abort")
+        a,w = ss.remote_allocate_buckets("\x01"*16, "r"*32, "c"*32, [0], 100,
+                                         FakeCanary())
+        bw = w[0]
+        bw.remote_write(0, "a"*50)
+        d = bw.remote_abort()
+        self.failUnless(bw.closed)
+        def _aborted(ign):
+            self.failIf(os.path.exists(bw.incominghome))
+            self.failUnlessEqual(ss.allocated_size(), 0)
+            self.failUnlessEqual(ss.remote_get_buckets("\x01"*16), {})
+        d.addCallback(_aborted)
+        return d
+
+    def test_mutable(self):
+        ss = self.create("test_mutable", leasedb_enabled=True,
+                         inventory_enabled=True)
+        si = "\x02"*16
+        secrets = ("we"*16, "r"*32, "c"*32)
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        # nothing is logged from the I/O threads
+        logged = []
+        real_msg = log.msg
+        def _msg(*args, **kwargs):
+            logged.append((threading.current_thread(), args, kwargs))
+            return real_msg(*args, **kwargs)
+        self.patch(log, "msg", _msg)
+        d1 = writev(si, secrets, {3: ([], [(0, "m"*50)], None)}, [])
+        # a read submitted before the write has finished sees its results
+        d2 = ss.remote_slot_readv(si, [], [(0, 5)])
+        d = defer.gatherResults([d1, d2])
+        def _written((wres, rres)):
+            self.failUnlessEqual(wres, (True, {}))
+            self.failUnlessEqual(rres, {3: ["mmmmm"]})
+            (sharetype, size) = ss.inventory.get_shares(si)[3]
+            self.failUnlessEqual(sharetype, "mutable")
+            self.failUnlessEqual(len(ss.leasedb.get_leases(si, 3)), 1)
+        d.addCallback(_written)
+        d.addCallback(lambda ign:
+                      self.shouldFail(BadWriteEnablerError, "bad we", None,
+                                      writev, si, ("XX"*16, "r"*32, "c"*32),
+                                      {3: ([], [(0, "x")], None)}, []))
+        d.addCallback(lambda ign:
+                      writev(si, secrets, {3: ([(0, 5, "eq", "xxxxx")],
+                                               [(0, "y"*5)], None)},
+                             [(0, 2)]))
+        d.addCallback(lambda res:
+                      self.failUnlessEqual(res, (False, {3: ["mm"]})))
+        d.addCallback(lambda ign:
+                      writev(si, secrets, {3: ([], [], 0)}, []))
+        def _deleted(res):
+            self.failUnlessEqual(res, (True, {3: []}))
+            self.failUnlessEqual(ss.inventory.get_shares(si), {})
+            self.failUnlessEqual(ss.leasedb.get_leases(si, 3), [])
+            self.failIf(os.path.exists(ss._get_bucketdir(si)))
+            self.failUnless([1 for (t, args, kwargs) in logged
+                             if args and args[0].startswith("testv failed")])
+            self.failUnless([1 for (t, args, kwargs) in logged
+                             if kwargs.get("umid") == "cE1eBQ"])
+            main = threading.current_thread()
+            self.failUnlessEqual([t for (t, args, kwargs) in logged
+                                  if t is not main], [])
+        d.addCallback(_deleted)
+        return d
+
+class Schedulers(unittest.TestCase):
+
+    def _drain(self, scheduler):
+        order = []
+        while True:
+            request = scheduler.pop()
+            if request is None:
+                return order
+            order.append(request.op)
+
+    def test_fifo(self):
+        s = FIFOScheduler()
+        self.failUnlessEqual(s.pop(), None)
+        for i in range(3):
+            s.add(Request(BACKGROUND, "other", 0, i))
+        s.add(Request(ANONYMOUS, "read", 0, 3))
+        self.failUnlessEqual(len(s), 4)
+        self.failUnlessEqual(self._drain(s), [0, 1, 2, 3])
+
+    def test_fair(self):
+        s = FairQueueScheduler()
+        self.failUnlessEqual(s.pop(), None)
+        a = Requester("a")
+        b = Requester("b")
+        for i in range(3):
+            s.add(Request(a, "read", 0, ("a", i)))
+        for i in range(3):
+            s.add(Request(b, "read", 0, ("b", i)))
+        self.failUnlessEqual(len(s), 6)
+        # equal weights take turns
+        self.failUnlessEqual(self._drain(s), [("a", 0), ("b", 0),
+                                              ("a", 1), ("b", 1),
+                                              ("a", 2), ("b", 2)])
+        self.failUnlessEqual(len(s), 0)
+
+    def test_weights(self):
+        s = FairQueueScheduler()
+        bulk = Requester("a", "bulk")
+        interactive = Requester("a", "interactive")
+        for i in range(10):
+            s.add(Request(bulk, "read", 0, "bulk"))
+            s.add(Request(interactive, "read", 0, "interactive"))
+        order = self._drain(s)
+        # while both have requests queued, interactive ones get 4 turns for
+        # every bulk one
+        self.failUnlessEqual(order[:10].count("bulk"), 2)
+        self.failUnlessEqual(sorted(order), ["bulk"]*10 + ["interactive"]*10)
+
+        s = FairQueueScheduler({"interactive": 1, "bulk": 1})
+        for i in range(10):
+            s.add(Request(bulk, "read", 0, "bulk"))
+            s.add(Request(interactive, "read", 0, "interactive"))
+        self.failUnlessEqual(self._drain(s)[:10].count("bulk"), 5)
+
+    def test_demotion(self):
+        # a client cannot claim the interactive weight for everything it
+        # queues
+        s = FairQueueScheduler()
+        greedy = Requester("greedy", "interactive")
+        other = Requester("other", "bulk")
+        requests = [Request(greedy, "read", 0, "greedy") for i in range(40)]
+        for request in requests:
+            s.add(request)
+        for i in range(40):
+            s.add(Request(other, "read", 0, "other"))
+        self.failUnlessEqual([r.demoted for r in requests],
+                             [False]*8 + [True]*32)
+        order = self._drain(s)
+        # the first 8 go four times as fast, and then they take turns
+        self.failUnlessEqual(order[:10].count("other"), 2)
+        self.failUnless(order[:40].count("other") >= 15,
+                        order[:40].count("other"))
+        # nothing is held against a queue once it has emptied
+        self.failUnlessEqual(s._queued, {})
+        request = Request(greedy, "read", 0, "greedy")
+        s.add(request)
+        self.failIf(request.demoted)
+
+    def test_simulated_load(self):
+        # a greedy client queues a hundred bulk writes, then other clients
+        # queue a read every other tick, while one request is started per
+        # tick. With fair queueing none of the reads waits for long, but in
+        # FIFO order they all wait behind the writes
+        def _simulate(s):
+            greedy = Requester("greedy", "bulk")
+            for i in range(100):
+                s.add(Request(greedy, "write", 0, ("greedy", i)))
+            waits = []
+            for tick in range(150):
+                if tick % 2 == 0:
+                    s.add(Request(Requester("client%d" % tick), "read", tick,
+                                  ("client", tick)))
+                request = s.pop()
+                if request.op[0] == "client":
+                    waits.append(tick - request.submitted)
+            return (waits, len(s))
+        (waits, left) = _simulate(FairQueueScheduler())
+        self.failUnlessEqual(len(waits), 75)
+        self.failUnless(max(waits) <= 1, max(waits))
+        self.failUnlessEqual(left, 25) # the greedy client is still waiting
+        (waits, left) = _simulate(FIFOScheduler())
+        self.failUnlessEqual(len(waits), 50)
+        self.failUnless(min(waits) >= 50, min(waits))
+
+class Durability(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+        # watch what gets synced
+        self.synced = []
+        real_fsync_paths = durability.fsync_paths
+        def _fsync_paths(files, dirs):
+            self.synced.append((list(files), list(dirs)))
+            return real_fsync_paths(files, dirs)
+        patcher = mock.patch("allmydata.storage.durability.fsync_paths",
+                             _fsync_paths)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name, **kwargs):
+        basedir = os.path.join("storage", "Durability", name)
+        ss = StorageServer(basedir, "\x00" * 20, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def write(self, ss, si, sharenums):
+        a,w = ss.remote_allocate_buckets(si, "r"*32, "c"*32, sharenums, 100,
+                                         FakeCanary())
+        ds = []
+        for shnum, bw in sorted(w.items()):
+            bw.remote_write(0, "%d" % shnum * 100)
+            ds.append(bw.remote_close())
+        return (w, ds)
+
+    def test_dirs_to_sync(self):
+        basedir = os.path.join("storage", "Durability", "dirs_to_sync")
+        fileutil.make_dirs(basedir)
+        self.failUnlessEqual(dirs_to_sync(basedir), [basedir])
+        bucketdir = os.path.join(basedir, "ab", "abcde")
+        self.failUnlessEqual(dirs_to_sync(bucketdir),
+                             [bucketdir, os.path.join(basedir, "ab"), basedir])
+
+    def test_fsync_paths(self):
+        basedir = os.path.join("storage", "Durability", "fsync_paths")
+        fileutil.make_dirs(basedir)
+        fn = os.path.join(basedir, "file")
+        fileutil.write(fn, "data")
+        # deleted files are skipped
+        durability.fsync_paths([fn, fn + "-gone"],
+                               [basedir, basedir + "-gone"])
+
+    def test_none(self):
+        ss = self.create("none")
+        (w, ds) = self.write(ss, "\x01"*16, [0])
+        self.failUnlessEqual(ds, [None])
+        self.failUnlessEqual(self.synced, [])
+
+    def test_fsync(self):
+        ss = self.create("fsync", durability="fsync")
+        si = "\x01"*16
+        (w, ds) = self.write(ss, si, [0])
+        d = defer.gatherResults(ds)
+        def _closed(ign):
+            bucketdir = ss._get_bucketdir(si)
+            prefixdir = os.path.dirname(bucketdir)
+            # the data was synced before the rename, and the new bucket and
+            # prefix directories after it
+            self.failUnlessEqual(self.synced,
+                                 [([w[0].incominghome], []),
+                                  ([], [bucketdir, prefixdir,
+                                        os.path.dirname(prefixdir)])])
+            self.failUnless(os.path.exists(w[0].finalhome))
+            self.failUnlessEqual(
+                ss.get_latencies()["commit"]["samplesize"], 2)
+            del self.synced[:]
+            # a second share in the same bucket only needs the bucket
+            return defer.gatherResults(self.write(ss, si, [1])[1])
+        d.addCallback(_closed)
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(self.synced[1],
+                                           ([], [ss._get_bucketdir(si)])))
+        return d
+
+    def test_sync_failure(self):
+        ss = self.create("sync_failure", durability="fsync")
+        failing = ["dirs"]
+        def _fail(files, dirs):
+            if (failing[0] == "dirs" and dirs) or (failing[0] == "files"
+                                                   and files):
+                raise OSError("the disk went away")
+        patcher = mock.patch("allmydata.storage.durability.fsync_paths",
+                             _fail)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        (w, ds) = self.write(ss, "\x01"*16, [0])
+        d = self.assertFailure(ds[0], OSError)
+        def _failed(ign):
+            # the share was moved into place, and the server is not left
+            # waiting for it to finish
+            self.failUnless(os.path.exists(w[0].finalhome))
+            self.failUnlessEqual(len(ss._active_writers), 0)
+            self.failUnlessEqual(ss.space.get_reserved(), 0)
+            self.failUnlessEqual(ss.space.get_in_flight(), 0)
+            # if the data cannot be synced, the share is not moved, but its
+            # space is given back all the same
+            failing[0] = "files"
+            (w2, ds2) = self.write(ss, "\x02"*16, [0])
+            d2 = self.assertFailure(ds2[0], OSError)
+            def _failed2(ign):
+                self.failIf(os.path.exists(w2[0].finalhome))
+                self.failUnlessEqual(len(ss._active_writers), 0)
+                self.failUnlessEqual(ss.space.get_reserved(), 0)
+            d2.addCallback(_failed2)
+            return d2
+        d.addCallback(_failed)
+        return d
+
+    def test_group(self):
+        ss = self.create("group", durability="group", group_commit_window=0.1)
+        self.failUnless(isinstance(ss.durability, GroupCommitter))
+        (w, ds) = self.write(ss, "\x01"*16, range(5))
+        fired = []
+        for d in ds:
+            d.addCallback(fired.append)
+        # nothing is acknowledged until its batch has been synced
+        self.failUnlessEqual(fired, [])
+        d = defer.gatherResults(ds)
+        def _closed(ign):
+            self.failUnlessEqual(len(fired), 5)
+            # one batch for the data, one for the directories
+            self.failUnlessEqual(len(self.synced), 2)
+            (files, dirs) = self.synced[0]
+            self.failUnlessEqual(sorted(files),
+                                 sorted([bw.incominghome
+                                         for bw in w.values()]))
+            (files, dirs) = self.synced[1]
+            self.failUnlessEqual(dirs[0], ss._get_bucketdir("\x01"*16))
+            self.failUnlessEqual(len(dirs), 3)
+            for bw in w.values():
+                self.failUnless(os.path.exists(bw.finalhome))
+            latencies = ss.get_latencies()
+            self.failUnlessEqual(latencies["commit-batch"]["samplesize"], 2)
+            self.failUnlessEqual(latencies["commit-batch"]["mean"], 5)
+            self.failUnlessEqual(latencies["commit"]["samplesize"], 10)
+        d.addCallback(_closed)
+        return d
+
+    def test_group_threaded(self):
+        ss = self.create("group_threaded", durability="group", io_threads=2)
+        si = "\x01"*16
+        (w, ds) = self.write(ss, si, range(3))
+        d = defer.gatherResults(ds)
+        def _closed(ign):
+            for bw in w.values():
+                self.failUnless(os.path.exists(bw.finalhome))
+            synced = set()
+            for (files, dirs) in self.synced:
+                synced.update(files + dirs)
+            self.failUnless(set([bw.incominghome for bw in w.values()])
+                            <= synced)
+            self.failUnlessIn(ss._get_bucketdir(si), synced)
+            return ss.remote_get_buckets(si)[2].remote_read(0, 3)
+        d.addCallback(_closed)
+        d.addCallback(lambda data: self.failUnlessEqual(data, "222"))
+        return d
+
+    def test_group_mutable(self):
+        ss = self.create("group_mutable", durability="group")
+        si = "\x02"*16
+        secrets = ("we"*16, "r"*32, "c"*32)
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        d = writev(si, secrets, {3: ([], [(0, "m"*50)], None)}, [])
+        def _written(res):
+            self.failUnlessEqual(res, (True, {}))
+            bucketdir = ss._get_bucketdir(si)
+            self.failUnlessEqual(self.synced[0][0],
+                                 [os.path.join(bucketdir, "3")])
+            self.failUnlessIn(bucketdir, self.synced[0][1])
+            del self.synced[:]
+            return writev(si, secrets, {3: ([], [(0, "n"*50)], None)}, [])
+        d.addCallback(_written)
+        def _rewritten(res):
+            # an existing share does not change its directory
+            self.failUnlessEqual(self.synced[0][1], [])
+            # a failed test vector writes nothing, so syncs nothing
+            del self.synced[:]
+            return writev(si, secrets, {3: ([(0, 1, "eq", "x")], [], None)},
+                          [])
+        d.addCallback(_rewritten)
+        def _failed(res):
+            self.failUnlessEqual(res, (False, {3: []}))
+            self.failUnlessEqual(self.synced, [])
+        d.addCallback(_failed)
+        return d
+
+    def test_group_stop(self):
+        ss = self.create("group_stop", durability="group",
+                         group_commit_window=60)
+        (w, ds) = self.write(ss, "\x01"*16, [0])
+        # stopping the server syncs whatever is waiting, rather than waiting
+        # out the window, and anything after that is synced at once
+        d = ss.disownServiceParent()
+        d.addCallback(lambda ign: defer.gatherResults(ds))
+        def _stopped(ign):
+            self.failUnlessEqual(self.synced[0], ([w[0].incominghome], []))
+            self.failUnlessEqual(len(self.synced), 2)
+            self.failUnless(os.path.exists(w[0].finalhome))
+        d.addCallback(_stopped)
+        return d
+
+    def test_packed(self):
+        ss = self.create("packed", durability="fsync", packed_enabled=True,
+                         packed_max_share_size=1000)
+        self.failUnless(ss.packed.fsync)
+        si = "\x01"*16
+        (w, ds) = self.write(ss, si, [0])
+        self.failUnlessEqual(ds, [None])
+        readers = ss.remote_get_buckets(si)
+        self.failUnlessEqual(readers[0].remote_read(0, 5), "00000")
+
+    def test_bad_mode(self):
+        self.failUnlessRaises(ValueError, self.create, "bad_mode",
+                              durability="sometimes")
+
+class OpenFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def make_files(self, name, count):
+        basedir = os.path.join("storage", "OpenFiles", name)
+        fileutil.make_dirs(basedir)
+        filenames = []
+        for i in range(count):
+            fn = os.path.join(basedir, "%d" % i)
+            fileutil.write(fn, "%d" % i * 10)
+            filenames.append(fn)
+        return filenames
+
+    def test_lru(self):
+        (a, b, c) = self.make_files("test_lru", 3)
+        fc = OpenFileCache(2)
+        self.failUnlessEqual(fc.read(a, 0, 2), "00")
+        self.failUnlessEqual(fc.read(b, 2, 3), "111")
+        self.failUnlessEqual(fc.read(a, 8, 5), "00")
+        self.failUnlessEqual((fc.hits, fc.misses, fc.evictions), (1, 2, 0))
+        # b is now the least recently used
+        self.failUnlessEqual(fc.read(c, 0, 1), "2")
+        self.failUnlessEqual((fc.hits, fc.misses, fc.evictions), (1, 3, 1))
+        self.failUnlessEqual(fc.get_num_open(), 2)
+        fc.read(a, 0, 1)
+        fc.read(c, 0, 1)
+        self.failUnlessEqual(fc.hits, 3)
+        fc.read(b, 0, 1)
+        self.failUnlessEqual((fc.hits, fc.misses, fc.evictions), (3, 4, 2))
+        # lots of hits do not let the use-order records grow without bound
+        for i in range(100):
+            fc.read([b, c][i%2], 0, 1)
+        self.failUnless(len(fc._order) <= 4*2, len(fc._order))
+        self.failUnlessEqual(fc.get_num_open(), 2)
+
+    def test_invalidate(self):
+        (a, b) = self.make_files("test_invalidate", 2)
+        fc = OpenFileCache(5)
+        fc.read(a, 0, 1)
+        fc.invalidate(a)
+        self.failUnlessEqual(fc.get_num_open(), 0)
+        self.failUnlessEqual(fc.read(a, 0, 3), "000")
+        self.failUnlessEqual((fc.hits, fc.misses), (0, 2))
+
+        # changes made through other file objects are seen
+        f = open(a, "rb+")
+        f.write("x")
+        f.close()
+        self.failUnlessEqual(fc.read(a, 0, 3), "x00")
+        # and a file which was replaced is reopened
+        os.unlink(a)
+        fileutil.write(a, "new")
+        self.failUnlessEqual(fc.read(a, 0, 3), "new")
+        self.failUnlessEqual((fc.hits, fc.misses), (1, 3))
+
+        # a file that is in use while it is invalidated is not kept
+        def _reader(f):
+            fc.invalidate(b)
+            return f.read(1)
+        self.failUnlessEqual(fc.use(b, _reader), "1")
+        self.failUnlessEqual(fc.get_num_open(), 1)
+        self.failUnlessEqual(fc.read(b, 0, 1), "1")
+        self.failUnlessEqual((fc.hits, fc.misses), (1, 5))
+
+    def test_mmap(self):
+        (small, large) = self.make_files("test_mmap", 2)
+        fileutil.write(large, "".join(["%10d" % i for i in range(100)]))
+        fc = OpenFileCache(5, mmap_threshold=100)
+        self.failUnlessEqual(fc.read(small, 0, 3), "000")
+        self.failUnlessEqual(fc.read(large, 20, 20), "%10d%10d" % (2, 3))
+        self.failUnlessEqual(fc.read(large, 995, 10), "   99")
+        self.failUnlessEqual(fc.get_num_open(), 2)
+        self.failUnlessEqual(fc.get_num_mapped(), 1)
+        self.failUnlessEqual(fc.hits, 1)
+
+        # a mapped file that changes size is mapped afresh
+        f = open(large, "ab")
+        f.write("extra")
+        f.close()
+        self.failUnlessEqual(fc.read(large, 995, 10), "   99extra")
+        self.failUnlessEqual(fc.get_num_mapped(), 1)
+        self.failUnlessEqual((fc.hits, fc.misses), (1, 3))
+        fc.invalidate(large)
+        self.failUnlessEqual(fc.get_num_mapped(), 0)
+
+    def test_server_mmap(self):
+        basedir = os.path.join("storage", "OpenFiles", "test_server_mmap")
+        ss = StorageServer(basedir, "\x00" * 20, open_file_cache_size=10,
+                           mmap_threshold=1)
+        ss.setServiceParent(self.sparent)
+        fc = ss.file_cache
+        a,w = ss.remote_allocate_buckets("\x01"*16, "r"*32, "c"*32, [0], 100,
+                                         FakeCanary())
+        w[0].remote_write(0, "".join(["%10d" % i for i in range(10)]))
+        w[0].remote_close()
+        b = ss.remote_get_buckets("\x01"*16)
+        self.failUnlessEqual(b[0].remote_read(90, 20), "%10d" % 9)
+        self.failUnlessEqual(fc.get_num_mapped(), 1)
+
+        si = "\x02"*16
+        secrets = ("we"*16, "r"*32, "c"*32)
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        writev(si, secrets, {0: ([], [(0, "a"*50)], None)}, [])
+        self.failUnlessEqual(ss.remote_slot_readv(si, [], [(45, 10)]),
+                             {0: ["a"*5]})
+        self.failUnlessEqual(fc.get_num_mapped(), 2)
+        # writing to the share drops its mapping, so the new data is seen
+        writev(si, secrets, {0: ([], [(40, "b"*20)], None)}, [])
+        self.failUnlessEqual(ss.remote_slot_readv(si, [], [(45, 20)]),
+                             {0: ["b"*15]})
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.open_file_cache.mapped"], 2)
+
+    def test_server(self):
+        basedir = os.path.join("storage", "OpenFiles", "test_server")
+        ss = StorageServer(basedir, "\x00" * 20, open_file_cache_size=10)
+        ss.setServiceParent(self.sparent)
+        fc = ss.file_cache
+        si = "\x01"*16
+        a,w = ss.remote_allocate_buckets(si, "r"*32, "c"*32, [0, 1], 100,
+                                         FakeCanary())
+        for shnum, bw in w.items():
+            bw.remote_write(0, "%d" % shnum * 100)
+            bw.remote_close()
+        b = ss.remote_get_buckets(si)
+        for i in range(10):
+            self.failUnlessEqual(b[0].remote_read(i*10, 10), "0"*10)
+        self.failUnlessEqual(fc.get_num_open(), 2)
+        self.failUnless(fc.hits >= 9, fc.hits)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.open_file_cache.open"], 2)
+        self.failUnless(stats["storage_server.open_file_cache.hit_rate"] > 0.5)
+        self.failUnlessIn("storage_server.open_file_cache.evictions", stats)
+
+        # rewriting the leases closes the files
+        ss.remote_add_lease(si, "R"*32, "C"*32)
+        self.failUnlessEqual(fc.get_num_open(), 0)
+        self.failUnlessEqual(len(list(ss.get_leases(si))), 2)
+        self.failUnlessEqual(b[1].remote_read(0, 5), "11111")
+
+        # and so does deleting the share
+        sf = list(ss._iter_share_files(si))[1]
+        self.failUnlessEqual(fc.get_num_open(), 2)
+        sf.cancel_lease("c"*32)
+        sf.cancel_lease("C"*32)
+        self.failIf(os.path.exists(sf.home))
+        self.failUnlessEqual(fc.get_num_open(), 1)
+
+class BlockCaching(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def reader(self, data):
+        reads = []
+        def read(offset, length):
+            reads.append((offset, length))
+            return data[offset:offset+length]
+        return (read, reads)
+
+    def test_lru(self):
+        (read, reads) = self.reader("".join(["%10d" % i for i in range(10)]))
+        bc = BlockCache(30)
+        self.failUnlessEqual(bc.read("si", 0, 0, 10, read), "%10d" % 0)
+        self.failUnlessEqual(bc.read("si", 0, 10, 10, read), "%10d" % 1)
+        self.failUnlessEqual(bc.read("si", 0, 0, 10, read), "%10d" % 0)
+        # a shorter read at the same offset is answered from the cache too
+        self.failUnlessEqual(bc.read("si", 0, 0, 5, read), " "*5)
+        self.failUnlessEqual(reads, [(0, 10), (10, 10)])
+        self.failUnlessEqual((bc.hits, bc.misses, bc.bytes_served),
+                             (2, 2, 15))
+        # but a longer one is not
+        self.failUnlessEqual(bc.read("si", 0, 10, 20, read),
+                             "%10d%10d" % (1, 2))
+        self.failUnlessEqual(reads[-1], (10, 20))
+        self.failUnlessEqual(bc.get_size(), 30)
+        # offset 10 is now the most recently used, so 0 makes way for 20
+        bc.read("si", 0, 20, 10, read)
+        self.failUnlessEqual((bc.get_num_entries(), bc.evictions), (2, 1))
+        self.failUnlessEqual(bc.get_size(), 30)
+        bc.read("si", 0, 10, 20, read)
+        bc.read("si", 0, 0, 10, read)
+        self.failUnlessEqual(reads[-1], (0, 10))
+        self.failUnlessEqual((bc.hits, bc.misses), (3, 5))
+
+        # a read that ran into the end of the share answers longer ones
+        self.failUnlessEqual(bc.read("si", 0, 95, 10, read), "    9")
+        self.failUnlessEqual(bc.read("si", 0, 95, 1000, read), "    9")
+        self.failUnlessEqual(reads[-1], (95, 10))
+        # and one too large for the cache is not kept
+        self.failUnlessEqual(len(bc.read("si", 1, 0, 100, read)), 100)
+        self.failUnlessEqual(len(bc.read("si", 1, 0, 100, read)), 100)
+        self.failUnlessEqual(reads[-2:], [(0, 100), (0, 100)])
+
+    def test_invalidate(self):
+        (read, reads) = self.reader("0123456789")
+        bc = BlockCache(100)
+        bc.read("si", 0, 0, 5, read)
+        bc.read("si", 0, 5, 5, read)
+        bc.read("si", 1, 0, 5, read)
+        bc.invalidate("si", 0)
+        self.failUnlessEqual((bc.get_num_entries(), bc.get_size()), (1, 5))
+        bc.read("si", 0, 0, 5, read)
+        bc.read("si", 1, 0, 5, read)
+        self.failUnlessEqual((bc.hits, bc.misses), (1, 4))
+
+        # a read that was in progress when its share was invalidated may
+        # have read the old data, so it is not kept
+        def _invalidating_read(offset, length):
+            bc.invalidate("si", 2)
+            return "old"
+        bc.read("si", 2, 0, 3, _invalidating_read)
+        self.failUnlessEqual(bc.read("si", 2, 0, 3, read), "012")
+
+    def test_server_immutable(self):
+        basedir = os.path.join("storage", "BlockCaching",
+                               "test_server_immutable")
+        ss = StorageServer(basedir, "\x00" * 20, block_cache_size=1000)
+        ss.setServiceParent(self.sparent)
+        bc = ss.block_cache
+        si = "\x01"*16
+        a,w = ss.remote_allocate_buckets(si, "r"*32, "c"*32, [0, 1], 100,
+                                         FakeCanary())
+        for shnum, bw in w.items():
+            bw.remote_write(0, "%d" % shnum * 100)
+            bw.remote_close()
+        for i in range(3):
+            b = ss.remote_get_buckets(si)
+            self.failUnlessEqual(b[0].remote_read(0, 10), "0"*10)
+            self.failUnlessEqual(b[1].remote_read(50, 10), "1"*10)
+        self.failUnlessEqual((bc.hits, bc.misses), (4, 2))
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.block_cache.size"], 20)
+        self.failUnlessEqual(stats["storage_server.block_cache.bytes_served"],
+                             40)
+        self.failUnlessApproximates(
+            stats["storage_server.block_cache.hit_rate"], 4.0/6, 0.01)
+
+        # deleting a share forgets what was read from it
+        sf = list(ss._iter_share_files(si))[1]
+        sf.cancel_lease("c"*32)
+        ss.share_deleted(si, 1)
+        self.failUnlessEqual(bc.get_size(), 10)
+        self.failUnlessEqual(ss.remote_get_buckets(si).keys(), [0])
+
+    def test_server_mutable(self):
+        basedir = os.path.join("storage", "BlockCaching",
+                               "test_server_mutable")
+        ss = StorageServer(basedir, "\x00" * 20, block_cache_size=1000)
+        ss.setServiceParent(self.sparent)
+        bc = ss.block_cache
+        si = "\x02"*16
+        secrets = ("we"*16, "r"*32, "c"*32)
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        writev(si, secrets, {0: ([], [(0, "a"*50)], None),
+                             1: ([], [(0, "b"*50)], None)}, [])
+        for i in range(2):
+            self.failUnlessEqual(ss.remote_slot_readv(si, [],
+                                                      [(0, 5), (45, 10)]),
+                                 {0: ["a"*5, "a"*5], 1: ["b"*5, "b"*5]})
+        self.failUnlessEqual((bc.hits, bc.misses), (4, 4))
+
+        # writing to a share forgets what was read from it
+        writev(si, secrets, {0: ([], [(40, "c"*20)], None)}, [])
+        self.failUnlessEqual(ss.remote_slot_readv(si, [0], [(45, 20)]),
+                             {0: ["c"*15]})
+        self.failUnlessEqual(ss.remote_slot_readv(si, [1], [(45, 10)]),
+                             {1: ["b"*5]})
+        self.failUnlessEqual((bc.hits, bc.misses), (5, 5))
+        # and so does deleting it
+        writev(si, secrets, {1: ([], [], 0)}, [])
+        self.failUnlessEqual(ss.remote_slot_readv(si, [], [(45, 10)]),
+                             {0: ["c"*10]})
+        self.failUnlessEqual(bc.get_num_entries(), 1)
+        self.failUnlessEqual((bc.hits, bc.misses), (6, 5))
+
+class WriteBuffering(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name, **kwargs):
+        basedir = os.path.join("storage", "WriteBuffering", name)
+        ss = StorageServer(basedir, "\x00" * 20, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def allocate(self, ss, storage_index, sharenums, size):
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, hashutil.tagged_hash("renew", storage_index),
+            hashutil.tagged_hash("cancel", storage_index), sharenums, size,
+            FakeCanary())
+        # record the writes that reach each share file
+        for bw in writers.values():
+            bw.disk_writes = []
+            def write_share_data(offset, data, bw=bw,
+                                 write=bw._sharefile.write_share_data):
+                bw.disk_writes.append((offset, len(data)))
+                return write(offset, data)
+            bw._sharefile.write_share_data = write_share_data
+        return writers
+
+    def read(self, ss, storage_index, shnum, size):
+        return ss.remote_get_buckets(storage_index)[shnum].remote_read(0, size)
+
+    def test_coalesce(self):
+        ss = self.create("test_coalesce", write_buffer_size=1000,
+                         write_buffer_flush_size=100)
+        budget = ss.write_budget
+        bw = self.allocate(ss, "si1", [0], 500)[0]
+        data = "".join(["%10d" % i for i in range(50)])
+        for i in range(0, 250, 10):
+            self.failUnlessEqual(bw.remote_write(i, data[i:i+10]), None)
+        # two flushes of 100 bytes, and 50 bytes held
+        self.failUnlessEqual(bw.disk_writes, [(0, 100), (100, 100)])
+        self.failUnlessEqual(budget.buffered, 50)
+        # a write that does not follow on writes out what is held first
+        bw.remote_write(300, data[300:])
+        self.failUnlessEqual(bw.disk_writes[2:], [(200, 50), (300, 200)])
+        self.failUnlessEqual(budget.buffered, 0)
+        bw.remote_write(250, data[250:300])
+        self.failUnlessEqual(len(bw.disk_writes), 4)
+        # and closing writes out the rest
+        bw.remote_close()
+        self.failUnlessEqual(bw.disk_writes[4:], [(250, 50)])
+        self.failUnlessEqual(budget.buffered, 0)
+        self.failUnlessEqual(self.read(ss, "si1", 0, 500), data)
+
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.write_buffer.buffered"], 0)
+        self.failUnlessEqual(
+            stats["storage_server.write_buffer.writes_buffered"], 27)
+        self.failUnlessEqual(stats["storage_server.write_buffer.flushes"], 5)
+        self.failUnlessEqual(
+            stats["storage_server.write_buffer.bytes_flushed"], 500)
+        # the space ledger saw each write as it was accepted
+        self.failUnlessEqual(ss.space.committed_total,
+                             os.path.getsize(bw.finalhome))
+
+    def test_budget(self):
+        ss = self.create("test_budget", write_buffer_size=150,
+                         write_buffer_flush_size=100)
+        budget = ss.write_budget
+        writers = self.allocate(ss, "si1", [0, 1], 200)
+        for i in range(0, 90, 10):
+            writers[0].remote_write(i, "a"*10)
+            writers[1].remote_write(i, "b"*10)
+        # the budget ran out at the 16th write, so share 1 wrote out what it
+        # held, and then that write, straight to disk
+        self.failUnlessEqual(writers[0].disk_writes, [])
+        self.failUnlessEqual(writers[1].disk_writes, [(0, 70), (70, 10)])
+        self.failUnlessEqual(budget.buffered, 100)
+        self.failUnlessEqual(budget.writes_unbuffered, 1)
+        writers[0].remote_write(90, "a"*10)
+        self.failUnlessEqual(writers[0].disk_writes, [(0, 100)])
+        # aborting gives back what was held
+        writers[1].remote_write(90, "b"*10)
+        self.failUnlessEqual(budget.buffered, 20)
+        writers[1].remote_abort()
+        self.failUnlessEqual(budget.buffered, 0)
+        writers[0].remote_close()
+        self.failUnlessEqual(self.read(ss, "si1", 0, 100), "a"*100)
+        self.failUnlessEqual(ss.remote_get_buckets("si1").keys(), [0])
+
+    def test_too_large(self):
+        ss = self.create("test_too_large", write_buffer_size=1000)
+        bw = self.allocate(ss, "si1", [0], 100)[0]
+        bw.remote_write(0, "a"*90)
+        self.failUnlessRaises(DataTooLargeError, bw.remote_write, 90, "a"*20)
+        bw.remote_write(90, "a"*10)
+        bw.remote_close()
+        self.failUnlessEqual(self.read(ss, "si1", 0, 200), "a"*100)
+
+    def test_threaded(self):
+        ss = self.create("test_threaded", io_threads=2,
+                         write_buffer_size=1000, write_buffer_flush_size=100)
+        budget = ss.write_budget
+        writers = self.allocate(ss, "si1", [0, 1], 500)
+        ds = []
+        for i in range(0, 500, 25):
+            for shnum, bw in writers.items():
+                d = bw.remote_write(i, chr(ord("a")+shnum) * 25)
+                if d is not None:
+                    ds.append(d)
+        # one in four writes reaches the flush size
+        self.failUnlessEqual(len(ds), 10)
+        d = defer.gatherResults(ds)
+        d.addCallback(lambda ign:
+                      defer.gatherResults([bw.remote_close()
+                                           for bw in writers.values()]))
+        def _closed(ign):
+            self.failUnlessEqual(budget.buffered, 0)
+            for shnum, bw in writers.items():
+                self.failUnlessEqual(bw.disk_writes,
+                                     [(i, 100) for i in range(0, 500, 100)])
+            return self.read(ss, "si1", 1, 500)
+        d.addCallback(_closed)
+        d.addCallback(lambda data: self.failUnlessEqual(data, "b"*500))
+        return d
+
+class MultiDisk(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+        self._lease_secret = itertools.count()
+        # k: basename of a share directory, v: bytes available for shares
+        self.avail = {"shares": 0, "disk1": 0, "disk2": 0}
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def get_disk_stats(self, whichdir, reserved_space=0):
+        avail = self.avail[os.path.basename(whichdir)]
+        return {'total': 10**9, 'used': 10**9 - avail - reserved_space,
+                'free_for_root': avail + reserved_space,
+                'free_for_nonroot': avail + reserved_space, 'avail': avail}
+
+    def create(self, name, **kwargs):
+        basedir = os.path.join("storage", "MultiDisk", name)
+        extra_share_dirs = [os.path.join(basedir, "disk1"),
+                            os.path.join(basedir, "disk2")]
+        ss = StorageServer(basedir, "\x00" * 20,
+                           extra_share_dirs=extra_share_dirs, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def allocate(self, ss, storage_index, sharenums, size):
+        renew_secret = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+        cancel_secret = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+        return ss.remote_allocate_buckets(storage_index,
+                                          renew_secret, cancel_secret,
+                                          sharenums, size, FakeCanary())
+
+    def write(self, ss, storage_index, sharenums, size=100):
+        already, writers = self.allocate(ss, storage_index, sharenums, size)
+        for shnum, bw in writers.items():
+            bw.remote_write(0, "%d" % shnum * 10)
+            bw.remote_close()
+        return already, writers
+
+    def get_disk(self, ss, storage_index):
+        return os.path.basename(ss.disks.find_disk(storage_index).sharedir)
+
+    def test_placement(self):
+        self.avail = {"shares": 1000, "disk1": 50000, "disk2": 20000}
+        patcher = mock.patch('allmydata.util.fileutil.get_disk_stats',
+                             self.get_disk_stats)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        ss = self.create("test_placement")
+        self.failUnlessEqual(ss.get_available_space(), 71000)
+
+        # a new bucket goes to the disk with the most room
+        already, writers = self.write(ss, "si1", [0, 1], 500)
+        self.failUnlessEqual(sorted(writers), [0, 1])
+        self.failUnlessEqual(self.get_disk(ss, "si1"), "disk1")
+        disk1 = ss.disks.find_disk("si1")
+        self.failUnless(os.path.exists(os.path.join(disk1.sharedir,
+                                                    storage_index_to_dir("si1"),
+                                                    "1")))
+        self.failIf(os.path.exists(os.path.join(ss.sharedir,
+                                                storage_index_to_dir("si1"))))
+
+        # but more shares for it go to the same disk, even if another disk
+        # now has more room
+        self.avail["disk2"] = 90000
+        ss.space.refresh()
+        already, writers = self.write(ss, "si1", [2], 500)
+        self.failUnlessEqual((sorted(already), sorted(writers)), ([0, 1], [2]))
+        self.failUnlessEqual(self.get_disk(ss, "si1"), "disk1")
+        bucketdir = os.path.join(disk1.sharedir, storage_index_to_dir("si1"))
+        self.failUnlessEqual(sorted(os.listdir(bucketdir)), ["0", "1", "2"])
+        self.write(ss, "si2", [0], 500)
+        self.failUnlessEqual(self.get_disk(ss, "si2"), "disk2")
+
+        # shares that fit on no disk are refused, even though the total
+        # space available would hold them
+        already, writers = self.allocate(ss, "si3", [0], 100000)
+        self.failUnlessEqual(writers, {})
+        self.failUnlessEqual(ss.disks.find_disk("si3"), None)
+        # a disk which is nearly full is not used
+        already, writers = self.allocate(ss, "si1", [3], 60000)
+        self.failUnlessEqual(writers, {})
+
+        b = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(sorted(b), [0, 1, 2])
+        self.failUnlessEqual(b[2].remote_read(0, 10), "2" * 10)
+        ss.space.refresh()
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.disks.1.buckets"], 1)
+        self.failUnlessEqual(stats["storage_server.disks.2.avail"], 90000)
+        self.failUnlessEqual(stats["storage_server.disk_avail"], 141000)
+        self.failUnlessIn("Share directories:",
+                          StorageStatus(ss).renderSynchronously())
+
+        # a restarted server finds the buckets again
+        ss.disownServiceParent()
+        ss = self.create("test_placement", inventory_enabled=True)
+        self.failUnlessEqual(self.get_disk(ss, "si1"), "disk1")
+        self.failUnlessEqual(self.get_disk(ss, "si2"), "disk2")
+        self.failUnlessEqual(ss.disks.find_disk("si3"), None)
+        self.failUnlessEqual(sorted(ss.remote_get_buckets("si1")), [0, 1, 2])
+        self.failUnlessEqual(ss.inventory.get_num_shares(), 4)
+        self.failUnlessEqual(ss.remote_get_buckets("si3"), {})
+
+    def test_load(self):
+        self.avail = {"shares": 10000, "disk1": 10000, "disk2": 10000}
+        patcher = mock.patch('allmydata.util.fileutil.get_disk_stats',
+                             self.get_disk_stats)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        ss = self.create("test_load")
+        # with no uploads in progress, the disks are equally good
+        already, w1 = self.allocate(ss, "si1", [0], 100)
+        self.failUnlessEqual(self.get_disk(ss, "si1"), "shares")
+        # but a disk that is being written to is busier than the others
+        already, w2 = self.allocate(ss, "si2", [0], 100)
+        self.failUnlessEqual(self.get_disk(ss, "si2"), "disk1")
+        already, w3 = self.allocate(ss, "si3", [0], 100)
+        self.failUnlessEqual(self.get_disk(ss, "si3"), "disk2")
+        for w in (w1, w2, w3):
+            w[0].remote_close()
+        # the "shares" disk has less room now that si1 has been written to it
+        self.avail["shares"] -= 200
+        ss.space.refresh()
+        self.allocate(ss, "si4", [0], 100)
+        self.failUnlessEqual(self.get_disk(ss, "si4"), "disk1")
+
+    def test_mutable_and_crawlers(self):
+        self.avail = {"shares": 10000, "disk1": 30000, "disk2": 20000}
+        patcher = mock.patch('allmydata.util.fileutil.get_disk_stats',
+                             self.get_disk_stats)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        ss = self.create("test_mutable_and_crawlers")
+        self.write(ss, "si1", [0])
+        self.avail["disk2"] = 40000
+        ss.space.refresh()
+        self.write(ss, "si2", [0])
+        self.avail["shares"] = 50000
+        ss.space.refresh()
+        self.write(ss, "si3", [0])
+
+        secrets = ("we1", "rs1", "cs1")
+        data = "".join([ ("%d" % i) * 10 for i in range(10) ])
+        write = ss.remote_slot_testv_and_readv_and_writev
+        self.failUnlessEqual(write("si4", secrets, {0: ([], [(0,data)], None)},
+                                   []),
+                             (True, {}))
+        self.failUnlessEqual(self.get_disk(ss, "si4"), "shares")
+        self.avail["shares"] = 0
+        ss.space.refresh()
+        self.failUnlessEqual(write("si5", secrets, {0: ([], [(0,data)], None)},
+                                   []),
+                             (True, {}))
+        self.failUnlessEqual(self.get_disk(ss, "si5"), "disk2")
+        self.failUnlessEqual(ss.remote_slot_readv("si5", [0], [(0, 10)]),
+                             {0: ["0" * 10]})
+        self.failUnlessEqual([self.get_disk(ss, si)
+                              for si in ("si1", "si2", "si3")],
+                             ["disk1", "disk2", "shares"])
+
+        # the crawlers see the buckets on every disk
+        bc = ss.bucket_counter
+        bc.cpu_slice = 500
+        bc.start_current_prefix(time.time())
+        self.failUnlessEqual(bc.get_state()["last-complete-bucket-count"], 5)
+        lc = ss.lease_checker
+        lc.cpu_slice = 500
+        lc.start_current_prefix(time.time())
+        rec = lc.get_state()["history"][0]["space-recovered"]
+        self.failUnlessEqual(rec["examined-buckets"], 5)
+        self.failUnlessEqual(rec["examined-shares"], 5)
+
+    def test_bucket_index(self):
+        self.avail = {"shares": 10000, "disk1": 30000, "disk2": 20000}
+        patcher = mock.patch('allmydata.util.fileutil.get_disk_stats',
+                             self.get_disk_stats)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        ss = self.create("test_bucket_index")
+        def num_buckets():
+            return sum([disk.num_buckets for disk in ss.disks])
+
+        # reads, and writes whose test vectors fail, create no buckets
+        secrets = tuple([hashutil.tagged_hash("blah", x)
+                         for x in ("we1", "rs1", "cs1")])
+        write = ss.remote_slot_testv_and_readv_and_writev
+        self.failUnlessEqual(write("si1", secrets, {}, [(0, 10)]),
+                             (True, {}))
+        self.failUnlessEqual(write("si2", secrets,
+                                   {0: ([(0, 1, "eq", "x")], [(0, "data")],
+                                        None)}, []),
+                             (False, {}))
+        self.failUnlessEqual(ss.disks.find_disk("si1"), None)
+        self.failUnlessEqual(ss.disks.find_disk("si2"), None)
+        self.failUnlessEqual(num_buckets(), 0)
+        self.failUnlessEqual(ss._pending_slots, {})
+
+        # a slot is forgotten once its last share is deleted
+        self.failUnlessEqual(write("si3", secrets,
+                                   {0: ([], [(0, "data")], None),
+                                    1: ([], [(0, "data")], None)}, []),
+                             (True, {}))
+        self.failUnlessEqual(self.get_disk(ss, "si3"), "disk1")
+        self.failUnlessEqual(num_buckets(), 1)
+        self.failUnlessEqual(write("si3", secrets, {0: ([], [], 0)}, []),
+                             (True, {0: [], 1: []}))
+        self.failUnlessEqual(self.get_disk(ss, "si3"), "disk1")
+        self.failUnlessEqual(write("si3", secrets, {1: ([], [], 0)}, []),
+                             (True, {1: []}))
+        self.failUnlessEqual(ss.disks.find_disk("si3"), None)
+        self.failUnlessEqual(num_buckets(), 0)
+
+        # and so is an immutable bucket whose upload is aborted, once the
+        # last of its writers is gone
+        already, writers = self.allocate(ss, "si4", [0, 1], 100)
+        self.failUnlessEqual(self.get_disk(ss, "si4"), "disk1")
+        self.failUnlessEqual(ss._bucket_writers, {"si4": 2})
+        writers[0].remote_abort()
+        self.failUnlessEqual(self.get_disk(ss, "si4"), "disk1")
+        self.failUnlessEqual(ss._bucket_writers, {"si4": 1})
+        writers[1].remote_abort()
+        self.failUnlessEqual(ss.disks.find_disk("si4"), None)
+        self.failUnlessEqual(num_buckets(), 0)
+        self.failUnlessEqual(ss._bucket_writers, {})
+
+        # writers that are abandoned are no longer counted
+        already, writers = ss.remote_allocate_buckets(
+            "si5", hashutil.tagged_hash("blah", "rs5"),
+            hashutil.tagged_hash("blah", "cs5"), [0, 1], 100, FakeCanary(True))
+        self.failUnlessEqual(ss._bucket_writers, {"si5": 2})
+        del writers
+        self.failUnlessEqual(ss._bucket_writers, {})
+        self.failUnlessEqual(ss._active_writers, {})
+
+class Packed(unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def make_lease(self, tag, expiration_time=None):
+        if expiration_time is None:
+            expiration_time = time.time() + 5000
+        return LeaseInfo(0, hashutil.tagged_hash("renew", tag),
+                         hashutil.tagged_hash("cancel", tag),
+                         expiration_time, "\x00" * 20)
+
+    def test_store(self):
+        basedir = "storage/Packed/store"
+        store = PackedShareStore(basedir)
+        store.segment_size = 1000
+        self.failIf(store.has_shares())
+        for i in range(10):
+            store.add_share("si%d" % i + "\x00" * 13, 0, chr(65+i) * 300,
+                            [self.make_lease("%d" % i)])
+        self.failUnless(store.has_shares())
+        # four shares fill a segment, so there are three segments
+        self.failUnlessEqual(len([fn for fn in os.listdir(basedir)
+                                  if fn.startswith("segment-")]), 3)
+        stats = store.get_stats()
+        self.failUnlessEqual((stats["shares"], stats["segments"],
+                              stats["live"], stats["size"]),
+                             (10, 3, 3000, 3000))
+
+        si3 = "si3" + "\x00" * 13
+        self.failUnlessEqual(store.get_shnums(si3), [0])
+        self.failUnlessEqual(store.get_shnums("si9" + "\x00" * 14), [])
+        self.failUnlessEqual(store.list_buckets(si_b2a(si3)[:2]),
+                             sorted([si_b2a("si%d" % i + "\x00" * 13)
+                                     for i in range(10)]))
+        self.failUnlessEqual(store.list_buckets("aa"), [])
+        sf = PackedShare(store, si3, 0)
+        self.failUnlessEqual(sf.read_share_data(0, 5), "DDDDD")
+        self.failUnlessEqual(sf.read_share_data(298, 10), "DD")
+        self.failUnlessEqual(sf.read_share_data(300, 10), "")
+        self.failUnlessEqual(sf.stat().st_size, 300)
+
+        # leases work as they do in a share file
+        [li] = list(sf.get_leases())
+        self.failUnlessEqual(li.renew_secret, hashutil.tagged_hash("renew", "3"))
+        sf.add_or_renew_lease(self.make_lease("3", time.time() + 9000))
+        [li] = list(sf.get_leases())
+        self.failUnless(li.expiration_time > time.time() + 8000)
+        sf.add_or_renew_lease(self.make_lease("x"))
+        self.failUnlessEqual(len(list(sf.get_leases())), 2)
+        self.failUnlessRaises(IndexError, sf.renew_lease, "nope" * 8, 0)
+        self.failUnlessRaises(IndexError, sf.cancel_lease, "nope" * 8)
+        self.failUnlessEqual(sf.cancel_lease(hashutil.tagged_hash("cancel",
+                                                                  "x")), 0)
+        self.failUnless(sf.exists())
+        # cancelling the last lease deletes the share
+        self.failUnlessEqual(sf.cancel_lease(hashutil.tagged_hash("cancel",
+                                                                  "3")), 300)
+        self.failIf(sf.exists())
+        self.failUnlessEqual(sf.read_share_data(0, 5), "")
+        self.failUnlessEqual(store.get_shnums(si3), [])
+        self.failUnlessEqual(store.get_stats()["live"], 2700)
+
+        # the index survives a restart
+        store.close()
+        store = PackedShareStore(basedir)
+        sf = PackedShare(store, "si4" + "\x00" * 13, 0)
+        self.failUnlessEqual(sf.read_share_data(0, 5), "EEEEE")
+        self.failUnlessEqual(store.get_stats()["shares"], 9)
+
+    def test_compaction(self):
+        basedir = "storage/Packed/compaction"
+        fc = OpenFileCache(10, 1)
+        store = PackedShareStore(basedir, fc)
+        store.segment_size = 1000
+        sis = ["si%d" % i + "\x00" * 13 for i in range(12)]
+        for i, si in enumerate(sis):
+            store.add_share(si, 0, chr(65+i) * 250, [self.make_lease("%d" % i)])
+        # segments 0, 1 and 2 are full, and 3 is current
+        for si in sis[:3] + sis[4:7]:
+            store.remove_share(si, 0)
+        self.failUnlessEqual(store.get_stats()["live"], 1500)
+        # keep a reader open on a share that is about to move
+        old_location = store.get_location(sis[3], 0)
+        self.failUnlessEqual(fc.read(old_location[0], old_location[1], 3),
+                             "DDD")
+
+        # segment 0 (1/4 live) goes first, then segment 1 (2/4 live)
+        copied = store.compact(0.6, 300)
+        self.failUnlessEqual(copied, 500)
+        self.failUnlessEqual(store.bytes_compacted, 500)
+        stats = store.get_stats()
+        self.failUnlessEqual((stats["segments"], stats["retired"],
+                              stats["live"]), (2, 2, 1500))
+        new_location = store.get_location(sis[3], 0)
+        self.failIfEqual(new_location[0], old_location[0])
+        for i, si in enumerate(sis):
+            data = PackedShare(store, si, 0).read_share_data(0, 300)
+            if si in sis[:3] + sis[4:7]:
+                self.failUnlessEqual(data, "")
+            else:
+                self.failUnlessEqual(data, chr(65+i) * 250)
+            if i == 7:
+                self.failUnlessEqual(len(list(PackedShare(store, si, 0)
+                                              .get_leases())), 1)
+        # a read of the old location still works until the segment goes
+        self.failUnlessEqual(store.read(old_location[0], old_location[1], 3),
+                             "DDD")
+        self.failUnlessEqual(store.remove_retired_segments(time.time() - 60),
+                             0)
+        self.failUnlessEqual(store.remove_retired_segments(time.time() + 1),
+                             2)
+        self.failIf(os.path.exists(old_location[0]))
+        self.failIf(old_location[0] in fc._files)
+        self.failUnlessEqual(store.get_stats()["retired"], 0)
+        # nothing else is worth compacting
+        self.failUnlessEqual(store.compact(0.6, 10000), 0)
+
+    def write(self, ss, storage_index, sharenums, size, lease_tag="lease"):
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, hashutil.tagged_hash("renew", lease_tag),
+            hashutil.tagged_hash("cancel", lease_tag), sharenums, size,
+            FakeCanary())
+        for shnum, bw in writers.items():
+            bw.remote_write(0, chr(48+shnum) * size)
+            bw.remote_close()
+        return already, writers
+
+    def test_server(self):
+        basedir = "storage/Packed/server"
+        ss = StorageServer(basedir, "\x00" * 20, packed_enabled=True,
+                           packed_max_share_size=1000, inventory_enabled=True,
+                           stats_provider=FakeStatsProvider())
+        ss.setServiceParent(self.s)
+        self.failIf(ss.have_shares())
+        si = "a" * 16
+        already, writers = self.write(ss, si, [0, 1, 2], 1000)
+        self.failUnlessEqual(set(writers), set([0, 1, 2]))
+        # the small shares were packed: there is no bucket directory
+        self.failIf(os.path.exists(os.path.join(basedir, "shares",
+                                                storage_index_to_dir(si))))
+        self.failUnlessEqual(os.listdir(os.path.join(basedir, "shares")),
+                             ["incoming"])
+        self.failUnless(ss.have_shares())
+        self.failUnlessEqual(ss.inventory.get_num_shares(), 0)
+        # a larger share is stored in a file as usual
+        self.write(ss, "b" * 16, [0], 2000)
+        self.failUnless(os.path.exists(os.path.join(basedir, "shares",
+                                                    storage_index_to_dir("b" * 16),
+                                                    "0")))
+        self.failUnlessEqual(ss.inventory.get_num_shares(), 1)
+
+        readers = ss.remote_get_buckets(si)
+        self.failUnlessEqual(set(readers), set([0, 1, 2]))
+        self.failUnlessEqual(readers[1].remote_read(0, 5), "11111")
+        self.failUnlessEqual(readers[2].remote_read(995, 10), "22222")
+        many = ss.remote_get_buckets_many([si, "b" * 16, "c" * 16], False)
+        self.failUnlessEqual(many, {si: {0: None, 1: None, 2: None},
+                                    "b" * 16: {0: None}})
+
+        # uploading again finds the packed shares, and adds the new lease
+        already, writers = self.write(ss, si, [0, 3], 1000, "lease2")
+        self.failUnlessEqual(already, set([0, 1, 2]))
+        self.failUnlessEqual(set(writers), set([3]))
+        self.failUnlessEqual(len(list(ss.get_leases(si))), 2)
+        ss.remote_add_lease(si, hashutil.tagged_hash("renew", "lease3"),
+                            hashutil.tagged_hash("cancel", "lease3"))
+        ss.remote_renew_lease(si, hashutil.tagged_hash("renew", "lease3"))
+        for shnum in [0, 1, 2]:
+            self.failUnlessEqual(len(ss.packed.get_leases(si, shnum)), 3)
+        self.failUnlessEqual(len(ss.packed.get_leases(si, 3)), 2)
+
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.packed.shares"], 4)
+        self.failUnlessEqual(stats["storage_server.packed.live"], 4000)
+        self.failUnlessEqual(stats["storage_server.packed.compacted"], 0)
+
+    def test_compactor(self):
+        basedir = "storage/Packed/compactor"
+        ss = StorageServer(basedir, "\x00" * 20, packed_enabled=True,
+                           packed_max_share_size=1000, io_threads=2)
+        ss.setServiceParent(self.s)
+        store = ss.packed
+        store.segment_size = 1000
+        for i in range(8):
+            store.add_share("si%d" % i + "\x00" * 13, 0, chr(65+i) * 250,
+                            [self.make_lease("%d" % i)])
+        for i in range(3):
+            store.remove_share("si%d" % i + "\x00" * 13, 0)
+        compactor = ss.packed_compactor
+        compactor.grace_period = -60 # remove emptied segments at once
+        threads_used = []
+        real_compact = store.compact
+        def _compact(*args):
+            threads_used.append(threading.current_thread())
+            return real_compact(*args)
+        # the first tick came when the server was started
+        d = self.poll(lambda: not compactor._compacting)
+        def _tick(ign):
+            store.compact = _compact
+            d = compactor.compact()
+            self.failUnless(isinstance(d, defer.Deferred))
+            # the pass runs in a disk I/O thread, and a tick that comes
+            # before it has finished is skipped
+            self.failUnlessEqual(compactor.compact(), None)
+            return d
+        d.addCallback(_tick)
+        def _compacted(ign):
+            self.failUnlessEqual(len(threads_used), 1)
+            self.failIfIdentical(threads_used[0], threading.current_thread())
+            self.failUnlessEqual(store.bytes_compacted, 250)
+            self.failUnlessEqual(store.get_stats()["retired"], 0)
+            # and the next tick runs another pass
+            return compactor.compact()
+        d.addCallback(_compacted)
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(len(threads_used), 2))
+        return d
+
+    def test_crawlers(self):
+        basedir = "storage/Packed/crawlers"
+        ss = StorageServer(basedir, "\x00" * 20, packed_enabled=True,
+                           expiration_enabled=True,
+                           expiration_mode="cutoff-date",
+                           expiration_cutoff_date=int(time.time()) + 1000,
+                           expiration_sharetypes=("immutable",))
+        self.write(ss, "a" * 16, [0, 1], 100)
+        self.write(ss, "b" * 16, [0], 100)
+        self.write(ss, "b" * 16, [1], 100000) # a share file
+        ss.remote_add_lease("b" * 16, hashutil.tagged_hash("renew", "2"),
+                            hashutil.tagged_hash("cancel", "2"))
+        self.failUnlessEqual(len(ss.packed.get_leases("b" * 16, 0)), 2)
+
+        bc = ss.bucket_counter
+        bc.cpu_slice = 500
+        bc.start_current_prefix(time.time())
+        self.failUnlessEqual(bc.get_state()["last-complete-bucket-count"], 2)
+
+        # every lease was granted before the cutoff date, so all of the
+        # shares go
+        lc = ss.lease_checker
+        lc.cpu_slice = 500
+        lc.start_current_prefix(time.time())
+        rec = lc.get_state()["history"][0]["space-recovered"]
+        self.failUnlessEqual(rec["examined-buckets"], 2)
+        self.failUnlessEqual(rec["examined-shares"], 4)
+        self.failUnlessEqual(rec["actual-shares"], 4)
+        self.failUnlessEqual(rec["actual-sharebytes"], 300 + 100000 + 12
+                             + 2*ShareFile.LEASE_SIZE)
+        self.failUnlessEqual(rec["actual-buckets"], 2)
+        self.failIf(ss.packed.has_shares())
+        self.failUnlessEqual(ss.remote_get_buckets("a" * 16), {})
+
+    def test_leasedb(self):
+        basedir = "storage/Packed/leasedb"
+        ss = StorageServer(basedir, "\x00" * 20, packed_enabled=True)
+        self.write(ss, "a" * 16, [0, 1], 100)
+        del ss
+        # the migration crawler finds the leases of packed shares
+        ss = StorageServer(basedir, "\x00" * 20, packed_enabled=True,
+                           leasedb_enabled=True,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=0)
+        migrator = ss.lease_migrator
+        migrator.cpu_slice = 500
+        migrator.start_current_prefix(time.time())
+        self.failUnless(ss.leasedb.is_migrated())
+        self.failUnlessEqual(len(ss.leasedb.get_leases("a" * 16, 1)), 1)
+
+        # and the indexed lease checker expires them
+        lc = ss.lease_checker
+        lc.cpu_slice = 500
+        lc.start_current_prefix(time.time())
+        rec = lc.get_state()["history"][0]["space-recovered"]
+        self.failUnlessEqual(rec["actual-shares"], 2)
+        self.failUnlessEqual(rec["actual-sharebytes"], 200)
+        self.failUnlessEqual(ss.packed.get_shnums("a" * 16), [])
+        self.failUnlessEqual(ss.leasedb.get_leases("a" * 16, 0), [])
+
+    def test_migration(self):
+        basedir = "storage/Packed/migration"
+        ss = StorageServer(basedir, "\x00" * 20)
+        self.write(ss, "a" * 16, [0, 1], 100)
+        self.write(ss, "b" * 16, [0], 5000)
+        ss.remote_add_lease("a" * 16, hashutil.tagged_hash("renew", "2"),
+                            hashutil.tagged_hash("cancel", "2"))
+        secrets = ("we1", "rs1", "cs1")
+        ss.remote_slot_testv_and_readv_and_writev("c" * 16, secrets,
+                                                  {0: ([], [(0, "x"*10)],
+                                                       None)}, [])
+        del ss
+
+        store = PackedShareStore(os.path.join(basedir, "packed"))
+        sharedir = os.path.join(basedir, "shares")
+        self.failUnlessEqual(pack_share_dirs(store, [sharedir], 1000),
+                             (2, 200))
+        store.close()
+        # the bucket directory of the packed shares is gone, and the others
+        # are left alone
+        self.failIf(os.path.exists(os.path.join(sharedir,
+                                                storage_index_to_dir("a" * 16))))
+        self.failUnless(os.path.exists(os.path.join(sharedir,
+                                                    storage_index_to_dir("b" * 16),
+                                                    "0")))
+
+        ss = StorageServer(basedir, "\x00" * 20, packed_enabled=True)
+        readers = ss.remote_get_buckets("a" * 16)
+        self.failUnlessEqual(readers[1].remote_read(0, 200), "1" * 100)
+        self.failUnlessEqual(len(list(ss.get_leases("a" * 16))), 2)
+        self.failUnlessEqual(ss.remote_get_buckets("b" * 16)[0].remote_read(0, 3),
+                             "000")
+        self.failUnlessEqual(ss.remote_slot_readv("c" * 16, [0], [(0, 3)]),
+                             {0: ["xxx"]})
+
+class ShareCounting(unittest.TestCase):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def write(self, ss, storage_index, sharenums, size):
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, hashutil.tagged_hash("renew", "lease"),
+            hashutil.tagged_hash("cancel", "lease"), sharenums, size,
+            FakeCanary())
+        for shnum, bw in writers.items():
+            bw.remote_write(0, chr(48+shnum) * size)
+            bw.remote_close()
+
+    def writev(self, ss, storage_index, sharenums, size):
+        secrets = (hashutil.tagged_hash("we", "x"),
+                   hashutil.tagged_hash("renew", "x"),
+                   hashutil.tagged_hash("cancel", "x"))
+        tws = dict([(shnum, ([], [(0, "x" * size)], size))
+                    for shnum in sharenums])
+        ss.remote_slot_testv_and_readv_and_writev(storage_index, secrets,
+                                                  tws, [])
+
+    def recount(self, ss):
+        bc = ss.bucket_counter
+        bc.cpu_slice = 500
+        bc.start_current_prefix(time.time())
+
+    def test_counts(self):
+        basedir = "storage/ShareCounting/counts"
+        ss = StorageServer(basedir, "\x00" * 20, share_counts_enabled=True,
+                           packed_enabled=True, packed_max_share_size=500)
+        counts = ss.share_counts
+        # there is nothing on disk to go on yet
+        self.failIf(counts.reconciled)
+        self.write(ss, "a" * 16, [0, 1], 1000)
+        self.failIf("storage_server.share_counts.immutable.shares"
+                    in ss.get_stats())
+        self.recount(ss)
+        self.failUnless(counts.reconciled)
+        self.failUnlessEqual(counts.counts["immutable"]["buckets"], 1)
+        self.failUnlessEqual(counts.counts["immutable"]["shares"], 2)
+
+        # from now on, shares are counted as they come and go
+        self.write(ss, "a" * 16, [2], 1000)
+        self.write(ss, "b" * 16, [0, 1], 100) # packed
+        self.writev(ss, "c" * 16, [0, 1, 2], 300)
+        self.writev(ss, "c" * 16, [1], 500) # grows the share
+        self.writev(ss, "d" * 16, [0], 300)
+        self.writev(ss, "d" * 16, [0], 0) # deletes it
+        live = copy.deepcopy(counts.counts)
+        self.failUnlessEqual(live["immutable"]["buckets"], 2)
+        self.failUnlessEqual(live["immutable"]["shares"], 5)
+        self.failUnlessEqual(live["mutable"]["buckets"], 1)
+        self.failUnlessEqual(live["mutable"]["shares"], 3)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.share_counts.mutable.bytes"],
+                             live["mutable"]["bytes"])
+        self.failUnlessEqual(stats["storage_server.total_bucket_count"], 3)
+        self.failUnlessEqual(ss.bucket_counter.get_progress()["counted-live"],
+                             True)
+
+        # the lease checker removes shares too
+        fn = os.path.join(ss.disks.get_bucketdir("a" * 16), "2")
+        size = os.path.getsize(fn)
+        os.unlink(fn)
+        ss.share_deleted("a" * 16, 2, "immutable", size)
+        ss.packed.remove_share("b" * 16, 0)
+        ss.share_deleted("b" * 16, 0, "immutable", 100)
+        ss.packed.remove_share("b" * 16, 1)
+        ss.share_deleted("b" * 16, 1, "immutable", 100)
+        live = copy.deepcopy(counts.counts)
+        self.failUnlessEqual(live["immutable"]["buckets"], 1)
+        self.failUnlessEqual(live["immutable"]["shares"], 2)
+
+        # and a recount (which is needed, since the server was never
+        # stopped) agrees
+        ss = StorageServer(basedir, "\x00" * 20, share_counts_enabled=True,
+                           packed_enabled=True, packed_max_share_size=500)
+        self.failIf(ss.share_counts.reconciled)
+        self.recount(ss)
+        self.failUnlessEqual(ss.share_counts.counts, live)
+
+    def test_shutdown(self):
+        basedir = "storage/ShareCounting/shutdown"
+        ss = StorageServer(basedir, "\x00" * 20, share_counts_enabled=True)
+        ss.setServiceParent(self.s)
+        self.recount(ss)
+        self.write(ss, "a" * 16, [0], 1000)
+        d = ss.disownServiceParent()
+        def _restart(ign):
+            # the counts survive a clean shutdown
+            ss = StorageServer(basedir, "\x00" * 20,
+                               share_counts_enabled=True)
+            self.failUnless(ss.share_counts.reconciled)
+            self.failUnlessEqual(ss.share_counts.counts["immutable"]["shares"],
+                                 1)
+            self.failUnlessEqual(
+                ss.bucket_counter.get_state()["last-complete-bucket-count"], 1)
+            # but not an unclean one, since we have not been stopped
+            ss = StorageServer(basedir, "\x00" * 20,
+                               share_counts_enabled=True)
+            self.failIf(ss.share_counts.reconciled)
+            self.failUnlessIdentical(ss.share_counts.recount,
+                                     ss.bucket_counter)
+
+            # changes to buckets which an unfinished recount has already
+            # counted are added to its tally
+            bc = ss.bucket_counter
+            bc.begin_cycle()
+            bc.last_complete_prefix_index = len(bc.prefixes) - 1
+            self.write(ss, "b" * 16, [0, 1], 1000)
+            self.failUnlessEqual(bc.state["share-tally"]["immutable"]["shares"],
+                                 2)
+        d.addCallback(_restart)
+        return d
+
+class MutableCompaction(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name, **kwargs):
+        workdir = os.path.join("storage", "MutableCompaction", name)
+        ss = StorageServer(workdir, "\x00" * 20, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def secrets(self, n):
+        return (hashutil.tagged_hash("we", "x"),
+                hashutil.tagged_hash("renew", str(n)),
+                hashutil.tagged_hash("cancel", str(n)))
+
+    def writev(self, ss, datav, new_length=None, lease=0):
+        rc = ss.remote_slot_testv_and_readv_and_writev(
+            "si1", self.secrets(lease), {0: ([], datav, new_length)}, [])
+        self.failUnless(rc[0])
+
+    def get_share(self, ss):
+        return MutableShareFile(os.path.join(ss.sharedir,
+                                             storage_index_to_dir("si1"), "0"))
+
+    def add_extra_leases(self, ss):
+        # the first four leases live in the header: these two are the ones
+        # that have to be moved whenever the container changes size
+        for lease in range(6):
+            self.writev(ss, [(0, "a")], lease=lease)
+        return 4 + 2 * MutableShareFile.LEASE_SIZE
+
+    def test_slack(self):
+        ss = self.create("test_slack")
+        leases_size = self.add_extra_leases(ss)
+        relocated = ss.mutable_relocated_bytes
+        # appending 1000 bytes at a time would move the leases at every
+        # write if the container only ever grew to fit
+        for i in range(100):
+            self.writev(ss, [(i*1000, "b"*1000)])
+        relocated = ss.mutable_relocated_bytes - relocated
+        moves = relocated / leases_size
+        self.failUnlessEqual(relocated, moves * leases_size)
+        self.failUnless(1 <= moves <= 15, moves)
+        share = self.get_share(ss)
+        self.failUnless(share.get_container_size() >= 100*1000)
+        self.failUnlessEqual(len(list(share.get_leases())), 6)
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(99000, 1000)]),
+                             {0: ["b"*1000]})
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.mutable.relocated"],
+                             ss.mutable_relocated_bytes)
+        self.failUnlessEqual(stats["storage_server.mutable.compactions"], 0)
+
+    def test_shrink(self):
+        ss = self.create("test_shrink")
+        leases_size = self.add_extra_leases(ss)
+        self.writev(ss, [(0, "b"*200*1000)])
+        share = self.get_share(ss)
+        filename = share.home
+        self.failUnless(os.path.getsize(filename) > 200*1000)
+        relocated = ss.mutable_relocated_bytes
+
+        # shrinking the data a little leaves the container alone
+        self.writev(ss, [], new_length=150*1000)
+        self.failUnless(os.path.getsize(filename) > 200*1000)
+        self.failUnlessEqual(ss.mutable_compactions, 0)
+
+        # but shrinking it a lot compacts it
+        self.writev(ss, [], new_length=1000)
+        self.failUnlessEqual(os.path.getsize(filename),
+                             MutableShareFile.DATA_OFFSET + 1000 + leases_size)
+        self.failUnlessEqual(ss.mutable_compactions, 1)
+        self.failUnlessEqual(ss.mutable_relocated_bytes,
+                             relocated + leases_size)
+        self.failUnlessEqual(ss.mutable_compacted_bytes, 199*1000)
+        self.failUnlessEqual(len(list(share.get_leases())), 6)
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(0, 2000)]),
+                             {0: ["b"*1000]})
+
+        # and it can grow again
+        self.writev(ss, [(1000, "c"*1000)])
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(990, 20)]),
+                             {0: ["b"*10 + "c"*10]})
+        self.failUnlessEqual(len(list(share.get_leases())), 6)
+
+    def test_compact(self):
+        ss = self.create("test_compact")
+        leases_size = self.add_extra_leases(ss)
+        self.writev(ss, [(0, "b"*10000)])
+        self.writev(ss, [], new_length=5000)
+        share = self.get_share(ss)
+        filename = share.home
+        size = os.path.getsize(filename)
+        # this is not worth compacting, unless we insist
+        self.failUnlessEqual(share.compact(), 0)
+        self.failUnlessEqual(os.path.getsize(filename), size)
+        freed = share.compact(force=True)
+        self.failUnless(freed >= 5000)
+        self.failUnlessEqual(os.path.getsize(filename), size - freed)
+        self.failUnlessEqual(os.path.getsize(filename),
+                             MutableShareFile.DATA_OFFSET + 5000 + leases_size)
+        self.failUnlessEqual(share.get_container_size(), 5000)
+        self.failUnlessEqual(share.relocated_bytes, leases_size)
+        self.failUnlessEqual(len(list(share.get_leases())), 6)
+        # once compacted, there is nothing left to gain
+        self.failUnlessEqual(share.compact(force=True), 0)
+
+    def test_compactor(self):
+        ss = self.create("test_compactor", mutable_compaction_enabled=True,
+                         share_counts_enabled=True)
+        compactor = ss.mutable_compactor
+        self.failUnless(compactor)
+        leases_size = self.add_extra_leases(ss)
+        self.writev(ss, [(0, "b"*40*1000)])
+        # this share has too little to gain to be compacted when it shrinks
+        self.writev(ss, [], new_length=1000)
+        filename = self.get_share(ss).home
+        self.failUnless(os.path.getsize(filename) > 40*1000)
+        self.failUnlessEqual(ss.mutable_compactions, 0)
+        committed = ss.space.committed_total
+
+        # but the compactor will take back a smaller gain
+        self.patch(MutableShareFile, "COMPACTION_MINIMUM", 1000)
+        compactor.cpu_slice = 500
+        compactor.start_current_prefix(time.time())
+        state = compactor.get_state()
+        last = state["history"][state["last-cycle-finished"]]
+        self.failUnlessEqual(last["examined-buckets"], 1)
+        self.failUnlessEqual(last["examined-shares"], 1)
+        self.failUnlessEqual(last["compacted-shares"], 1)
+        new_size = MutableShareFile.DATA_OFFSET + 1000 + leases_size
+        self.failUnlessEqual(os.path.getsize(filename), new_size)
+        freed = last["compacted-bytes"]
+        self.failUnlessEqual(freed, 39*1000)
+        self.failUnlessEqual(ss.mutable_compactions, 1)
+        self.failUnlessEqual(ss.mutable_compacted_bytes, freed)
+        self.failUnlessEqual(ss.space.committed_total, committed - freed)
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(0, 2000)]),
+                             {0: ["b"*1000]})
+
+class ShareDirLayout(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self._lease_secret = itertools.count()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name, **kwargs):
+        workdir = os.path.join("storage", "ShareDirLayout", name)
+        ss = StorageServer(workdir, "\x00" * 20, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def restart(self, ss, name, **kwargs):
+        ss.disownServiceParent()
+        return self.create(name, **kwargs)
+
+    def write_immutable(self, ss, storage_index, sharenums):
+        renew_secret = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+        cancel_secret = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+        already, writers = ss.remote_allocate_buckets(storage_index,
+                                                      renew_secret,
+                                                      cancel_secret,
+                                                      sharenums, 100,
+                                                      FakeCanary())
+        for shnum, bw in writers.items():
+            bw.remote_write(0, "%d" % shnum * 10)
+            bw.remote_close()
+        return already, writers
+
+    def write_mutable(self, ss, storage_index, data):
+        secrets = (hashutil.tagged_hash("we", "x"),
+                   hashutil.tagged_hash("renew", "x"),
+                   hashutil.tagged_hash("cancel", "x"))
+        rc = ss.remote_slot_testv_and_readv_and_writev(
+            storage_index, secrets, {0: ([], [(0, data)], None)}, [])
+        self.failUnless(rc[0])
+
+    def read_levels(self, ss):
+        return fileutil.read(os.path.join(ss.storedir,
+                                          "share_dir_levels")).strip()
+
+    def test_storage_index_to_dir(self):
+        sia = base32.b2a("si1")
+        self.failUnlessEqual(storage_index_to_dir("si1"),
+                             os.path.join(sia[:2], sia))
+        self.failUnlessEqual(storage_index_to_dir("si1", 2),
+                             os.path.join(sia[:2], sia[2:4], sia))
+        self.failUnlessEqual(storage_index_to_dir("si1", 3),
+                             os.path.join(sia[:2], sia[2:4], sia[4:6], sia))
+
+    def test_bad_levels(self):
+        self.failUnlessRaises(ValueError, self.create, "test_bad_levels",
+                              share_dir_levels=4)
+
+    def test_deep(self):
+        ss = self.create("test_deep", share_dir_levels=2)
+        self.failUnlessEqual(self.read_levels(ss), "2")
+        self.failIf(ss.disks.migrating)
+        self.failUnlessEqual(ss.share_dir_migrator, None)
+        self.write_immutable(ss, "si1", [0, 1])
+        self.write_mutable(ss, "si2", "data")
+        for si in ("si1", "si2"):
+            self.failUnless(os.path.isdir(os.path.join(
+                ss.sharedir, storage_index_to_dir(si, 2))))
+        readers = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(sorted(readers), [0, 1])
+        self.failUnlessEqual(readers[1].remote_read(0, 10), "1" * 10)
+        self.failUnlessEqual(ss.remote_slot_readv("si2", [0], [(0, 4)]),
+                             {0: ["data"]})
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.share_dir_levels"], 2)
+        self.failUnlessEqual(stats["storage_server.share_dir_migrating"], 0)
+
+        # the crawlers find the buckets further down
+        counter = ss.bucket_counter
+        counter.cpu_slice = 500
+        counter.start_current_prefix(time.time())
+        self.failUnlessEqual(counter.get_state()["last-complete-bucket-count"],
+                             2)
+
+        # and so does the inventory
+        ss = self.restart(ss, "test_deep", share_dir_levels=2,
+                          inventory_enabled=True)
+        self.failUnlessEqual(ss.inventory.get_num_buckets(), 2)
+        self.failUnlessEqual(sorted(ss.remote_get_buckets("si1")), [0, 1])
+
+        # emptying a mutable bucket removes its directory
+        self.write_mutable(ss, "si2", "")
+        secrets = (hashutil.tagged_hash("we", "x"),
+                   hashutil.tagged_hash("renew", "x"),
+                   hashutil.tagged_hash("cancel", "x"))
+        ss.remote_slot_testv_and_readv_and_writev("si2", secrets,
+                                                  {0: ([], [], 0)}, [])
+        self.failIf(os.path.exists(os.path.join(
+            ss.sharedir, storage_index_to_dir("si2", 2))))
+
+    def test_migrate(self):
+        ss = self.create("test_migrate")
+        self.failUnlessEqual(self.read_levels(ss), "1")
+        self.write_immutable(ss, "si1", [0, 1])
+        self.write_mutable(ss, "si2", "data")
+        old_dirs = [os.path.join(ss.sharedir, storage_index_to_dir(si))
+                    for si in ("si1", "si2")]
+
+        # restarting with a deeper layout leaves the buckets where they are
+        # until they are moved, but they can still be found
+        ss = self.restart(ss, "test_migrate", share_dir_levels=2)
+        self.failUnlessEqual(self.read_levels(ss), "1")
+        self.failUnless(ss.disks.migrating)
+        migrator = ss.share_dir_migrator
+        self.failUnless(migrator)
+        for d in old_dirs:
+            self.failUnless(os.path.isdir(d))
+        reader = ss.remote_get_buckets("si1")[0]
+        self.failUnlessEqual(reader.remote_read(0, 10), "0" * 10)
+        self.failUnlessEqual(ss.remote_slot_readv("si2", [0], [(0, 4)]),
+                             {0: ["data"]})
+        already, writers = self.write_immutable(ss, "si1", [0, 1, 2])
+        self.failUnlessEqual((sorted(already), sorted(writers)), ([0, 1], [2]))
+        # the new share goes into the new layout, so the bucket is split
+        self.failUnless(os.path.exists(os.path.join(
+            ss.sharedir, storage_index_to_dir("si1", 2), "2")))
+        self.failUnlessEqual(sorted(ss.remote_get_buckets("si1")), [0, 1, 2])
+        self.write_mutable(ss, "si3", "new")
+        self.failUnlessEqual(ss.get_stats()["storage_server.share_dir_migrating"],
+                             1)
+
+        migrator.cpu_slice = 500
+        migrator.start_current_prefix(time.time())
+        last = migrator.get_state()["last-cycle"]
+        self.failUnlessEqual(last["examined-buckets"], 3)
+        self.failUnlessEqual(last["moved-buckets"], 2)
+        self.failUnlessEqual(last["moved-shares"], 3)
+        self.failUnlessEqual(last["remaining-buckets"], 0)
+        for d in old_dirs:
+            self.failIf(os.path.exists(d))
+        for si, shnums in [("si1", ["0", "1", "2"]), ("si2", ["0"]),
+                           ("si3", ["0"])]:
+            bucketdir = os.path.join(ss.sharedir,
+                                     storage_index_to_dir(si, 2))
+            self.failUnlessEqual(sorted(os.listdir(bucketdir)), shnums)
+        # which is now recorded, and the migrator is gone
+        self.failUnlessEqual(self.read_levels(ss), "2")
+        self.failIf(ss.disks.migrating)
+        self.failUnlessEqual(migrator.parent, None)
+
+        # a reader made before its share was moved finds it again
+        self.failUnlessEqual(reader.remote_read(0, 10), "0" * 10)
+        self.failUnlessEqual(ss.remote_slot_readv("si2", [0], [(0, 4)]),
+                             {0: ["data"]})
+
+        # and a later restart does not migrate again
+        ss = self.restart(ss, "test_migrate", share_dir_levels=2)
+        self.failIf(ss.disks.migrating)
+        self.failUnlessEqual(ss.share_dir_migrator, None)
+
 class Stats(unittest.TestCase):
 
     def setUp(self):
@@ -2796,6 +5102,10 @@ class Stats(unittest.TestCase):
         ss.setServiceParent(self.sparent)
         return ss
 
+    def failUnlessApproximately(self, value, expected, output):
+        # the histograms report values to within about 6%
+        self.failUnless(abs(value - expected) <= 0.07 * expected, output)
+
     def test_latencies(self):
         ss = self.create("test_latencies")
         for i in range(10000):
@@ -2812,47 +5122,48 @@ class Stats(unittest.TestCase):
 
         self.failUnlessEqual(sorted(output.keys()),
                              sorted(["allocate", "renew", "cancel", "write", "get"]))
-        self.failUnlessEqual(len(ss.latencies["allocate"]), 1000)
-        self.failUnless(abs(output["allocate"]["mean"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["01_0_percentile"] - 9010) < 1, output)
-        self.failUnless(abs(output["allocate"]["10_0_percentile"] - 9100) < 1, output)
-        self.failUnless(abs(output["allocate"]["50_0_percentile"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["90_0_percentile"] - 9900) < 1, output)
-        self.failUnless(abs(output["allocate"]["95_0_percentile"] - 9950) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_0_percentile"] - 9990) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_9_percentile"] - 9999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["renew"]), 1000)
+        approx = self.failUnlessApproximately
+        self.failUnlessEqual(output["allocate"]["samplesize"], 10000)
+        self.failUnless(abs(output["allocate"]["mean"] - 4999.5) < 1, output)
+        approx(output["allocate"]["01_0_percentile"], 100, output)
+        approx(output["allocate"]["10_0_percentile"], 1000, output)
+        approx(output["allocate"]["50_0_percentile"], 5000, output)
+        approx(output["allocate"]["90_0_percentile"], 9000, output)
+        approx(output["allocate"]["95_0_percentile"], 9500, output)
+        approx(output["allocate"]["99_0_percentile"], 9900, output)
+        approx(output["allocate"]["99_9_percentile"], 9990, output)
+
+        self.failUnlessEqual(output["renew"]["samplesize"], 1000)
         self.failUnless(abs(output["renew"]["mean"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["01_0_percentile"] -  10) < 1, output)
-        self.failUnless(abs(output["renew"]["10_0_percentile"] - 100) < 1, output)
-        self.failUnless(abs(output["renew"]["50_0_percentile"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["90_0_percentile"] - 900) < 1, output)
-        self.failUnless(abs(output["renew"]["95_0_percentile"] - 950) < 1, output)
-        self.failUnless(abs(output["renew"]["99_0_percentile"] - 990) < 1, output)
-        self.failUnless(abs(output["renew"]["99_9_percentile"] - 999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["write"]), 20)
+        approx(output["renew"]["01_0_percentile"],  10, output)
+        approx(output["renew"]["10_0_percentile"], 100, output)
+        approx(output["renew"]["50_0_percentile"], 500, output)
+        approx(output["renew"]["90_0_percentile"], 900, output)
+        approx(output["renew"]["95_0_percentile"], 950, output)
+        approx(output["renew"]["99_0_percentile"], 990, output)
+        approx(output["renew"]["99_9_percentile"], 999, output)
+
+        self.failUnlessEqual(output["write"]["samplesize"], 20)
         self.failUnless(abs(output["write"]["mean"] - 9) < 1, output)
         self.failUnless(output["write"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["write"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["write"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["write"]["90_0_percentile"] - 18) < 1, output)
-        self.failUnless(abs(output["write"]["95_0_percentile"] - 19) < 1, output)
+        approx(output["write"]["10_0_percentile"],  2, output)
+        approx(output["write"]["50_0_percentile"], 10, output)
+        approx(output["write"]["90_0_percentile"], 18, output)
+        approx(output["write"]["95_0_percentile"], 19, output)
         self.failUnless(output["write"]["99_0_percentile"] is None, output)
         self.failUnless(output["write"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["cancel"]), 10)
+        self.failUnlessEqual(output["cancel"]["samplesize"], 10)
         self.failUnless(abs(output["cancel"]["mean"] - 9) < 1, output)
         self.failUnless(output["cancel"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["cancel"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["cancel"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["cancel"]["90_0_percentile"] - 18) < 1, output)
+        approx(output["cancel"]["10_0_percentile"],  2, output)
+        approx(output["cancel"]["50_0_percentile"], 10, output)
+        approx(output["cancel"]["90_0_percentile"], 18, output)
         self.failUnless(output["cancel"]["95_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["get"]), 1)
+        self.failUnlessEqual(output["get"]["samplesize"], 1)
         self.failUnless(output["get"]["mean"] is None, output)
         self.failUnless(output["get"]["01_0_percentile"] is None, output)
         self.failUnless(output["get"]["10_0_percentile"] is None, output)
@@ -2862,6 +5173,43 @@ class Stats(unittest.TestCase):
         self.failUnless(output["get"]["99_0_percentile"] is None, output)
         self.failUnless(output["get"]["99_9_percentile"] is None, output)
 
+        stats = ss.get_stats()
+        approx(stats["storage_server.latencies.renew.50_0_percentile"], 500,
+               stats)
+        html = StorageStatus(ss).renderSynchronously()
+        s = remove_tags(html)
+        self.failUnlessIn("Operation Latencies", s)
+        self.failUnlessIn("allocate 10000 ", s)
+
+    def test_latency_windows(self):
+        now = [1000000.0]
+        h = LatencyHistogram(clock=lambda: now[0])
+        self.failUnlessEqual(h.get_stats("1m"), None)
+        for i in range(100):
+            h.add(0.001 * (i+1))
+        def _sizes():
+            return [(h.get_stats(w) or {}).get("samplesize")
+                    for w in ("1m", "5m", "1h")]
+        self.failUnlessEqual(_sizes(), [100, 100, 100])
+        now[0] += 30
+        h.add(0.5)
+        self.failUnlessEqual(_sizes(), [101, 101, 101])
+        self.failUnlessApproximately(h.get_stats("1m")["99_0_percentile"],
+                                     0.1, h.get_stats("1m"))
+        now[0] += 40
+        self.failUnlessEqual(_sizes(), [1, 101, 101])
+        now[0] += 300
+        self.failUnlessEqual(_sizes(), [None, None, 101])
+        # a slot which comes around again in the ring starts out empty
+        now[0] += 3600
+        h.add(0.25)
+        self.failUnlessEqual(_sizes(), [1, 1, 1])
+        # out-of-range values are clamped rather than dropped
+        h.add(0)
+        h.add(-1)
+        h.add(1e9)
+        self.failUnlessEqual(_sizes(), [4, 4, 4])
+
 def remove_tags(s):
     s = re.sub(r'<[^>]*>', ' ', s)
     s = re.sub(r'\s+', ' ', s)
@@ -3957,6 +6305,174 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d = self.render1(page, args={"t": ["json"]})
         return d
 
+class LeaseDatabase(unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def make_shares(self, ss):
+        canary = FakeCanary()
+        data = "\xff" * 1000
+        self.sis = []
+        for i in range(2):
+            si = chr(i) * 16
+            rs = hashutil.tagged_hash("renew", si)
+            cs = hashutil.tagged_hash("cancel", si)
+            a,w = ss.remote_allocate_buckets(si, rs, cs, [0, 1], 1000, canary)
+            for bw in w.values():
+                bw.remote_write(0, data)
+                bw.remote_close()
+            self.sis.append(si)
+        si = "\x02" * 16
+        secrets = (hashutil.tagged_hash("write-enabler", si),
+                   hashutil.tagged_hash("renew", si),
+                   hashutil.tagged_hash("cancel", si))
+        ss.remote_slot_testv_and_readv_and_writev(si, secrets,
+                                                  {0: ([], [(0,data)], None)},
+                                                  [])
+        self.sis.append(si)
+
+    def test_server_records_leases(self):
+        basedir = "storage/LeaseDatabase/server_records_leases"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, leasedb_enabled=True)
+        ss.setServiceParent(self.s)
+        self.failUnless(ss.leasedb.is_migrated())
+        self.failUnlessEqual(ss.lease_migrator, None)
+        self.failUnless(isinstance(ss.lease_checker,
+                                   IndexedLeaseCheckingCrawler))
+        self.make_shares(ss)
+        [si0, si1, si2] = self.sis
+        db = ss.leasedb
+        self.failUnlessEqual(len(db.get_leases(si0, 0)), 1)
+        self.failUnlessEqual(len(db.get_leases(si0, 1)), 1)
+        self.failUnlessEqual(len(db.get_leases(si2, 0)), 1)
+        self.failUnlessEqual(db.get_share_counts(),
+                             {"immutable": (2, 4), "mutable": (1, 1)})
+
+        # an aborted upload leaves nothing behind
+        a,w = ss.remote_allocate_buckets("\x03" * 16, "r"*32, "c"*32, [0],
+                                         1000, FakeCanary())
+        w[0].remote_abort()
+        self.failUnlessEqual(db.get_leases("\x03" * 16, 0), [])
+
+        # a second lease, then a renewal
+        ss.remote_add_lease(si0, "R"*32, "C"*32)
+        leases = db.get_leases(si0, 0)
+        self.failUnlessEqual(len(leases), 2)
+        for li in leases:
+            if li.renew_secret == "R"*32:
+                db.set_expiration_time(si_b2a(si0), 0, "R"*32, 1000)
+        db.commit()
+        ss.remote_renew_lease(si0, "R"*32)
+        [li] = [li for li in db.get_leases(si0, 0)
+                if li.renew_secret == "R"*32]
+        self.failUnless(li.expiration_time > time.time(), li.expiration_time)
+
+        # deleting a mutable share removes its leases
+        secrets = (hashutil.tagged_hash("write-enabler", si2),
+                   hashutil.tagged_hash("renew", si2),
+                   hashutil.tagged_hash("cancel", si2))
+        ss.remote_slot_testv_and_readv_and_writev(si2, secrets,
+                                                  {0: ([], [], 0)}, [])
+        self.failUnlessEqual(db.get_leases(si2, 0), [])
+
+    def test_migration(self):
+        basedir = "storage/LeaseDatabase/migration"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20)
+        self.make_shares(ss)
+        ss.remote_add_lease(self.sis[0], "R"*32, "C"*32)
+        del ss
+
+        ss = StorageServer(basedir, "\x00" * 20, leasedb_enabled=True)
+        db = ss.leasedb
+        self.failIf(db.is_migrated())
+        self.failUnlessEqual(db.get_leases(self.sis[0], 0), [])
+        migrator = ss.lease_migrator
+        migrator.slow_start = 0
+        ss.setServiceParent(self.s)
+
+        d = self.poll(lambda: db.is_migrated())
+        def _check(ign):
+            self.failIf(migrator.running)
+            self.failUnlessEqual(len(db.get_leases(self.sis[0], 0)), 2)
+            self.failUnlessEqual(len(db.get_leases(self.sis[1], 1)), 1)
+            self.failUnlessEqual(len(db.get_leases(self.sis[2], 0)), 1)
+        d.addCallback(_check)
+        return d
+
+    def _run_checker(self, ss):
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        ss.setServiceParent(self.s)
+        return self.poll(lambda: lc.get_state()["last-cycle-finished"]
+                         is not None)
+
+    def test_expire(self):
+        basedir = "storage/LeaseDatabase/expire"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, leasedb_enabled=True,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=0,
+                           expiration_sharetypes=("immutable",))
+        self.make_shares(ss)
+        [si0, si1, si2] = self.sis
+        # a lease which was renewed while the database wasn't watching
+        # protects its share
+        sf = list(ss._iter_share_files(si1))[0]
+        sf.renew_lease(hashutil.tagged_hash("renew", si1),
+                       time.time() + 100*24*60*60)
+
+        d = self._run_checker(ss)
+        def _check(ign):
+            db = ss.leasedb
+            self.failUnlessEqual(len(list(ss._iter_share_files(si0))), 0)
+            self.failUnlessEqual(db.get_leases(si0, 0), [])
+            self.failUnlessEqual(len(list(ss._iter_share_files(si1))), 1)
+            [li] = db.get_leases(si1, 0)
+            self.failUnless(li.expiration_time > time.time() + 99*24*60*60)
+            # mutable shares are not expired in this configuration
+            self.failUnlessEqual(len(list(ss._iter_share_files(si2))), 1)
+            self.failUnlessEqual(len(db.get_leases(si2, 0)), 1)
+
+            last = ss.lease_checker.get_state()["history"][0]
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-shares"], 5)
+            self.failUnlessEqual(rec["examined-buckets"], 3)
+            self.failUnlessEqual(rec["actual-shares"], 3)
+            self.failUnlessEqual(rec["actual-shares-immutable"], 3)
+            self.failUnlessEqual(rec["actual-buckets"], 1)
+            self.failUnlessEqual(rec["configured-shares"], 3)
+        d.addCallback(_check)
+        return d
+
+    def test_scan_only(self):
+        basedir = "storage/LeaseDatabase/scan_only"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, leasedb_enabled=True,
+                           expiration_enabled=False,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=0)
+        self.make_shares(ss)
+        ss.remote_add_lease(self.sis[0], "R"*32, "C"*32)
+
+        d = self._run_checker(ss)
+        def _check(ign):
+            for si in self.sis:
+                self.failIfEqual(len(list(ss._iter_share_files(si))), 0)
+            last = ss.lease_checker.get_state()["history"][0]
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["actual-shares"], 0)
+            self.failUnlessEqual(rec["configured-shares"], 5)
+            self.failUnlessEqual(rec["configured-shares-mutable"], 1)
+        d.addCallback(_check)
+        return d
+
 class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
 
     def setUp(self):
@@ -4001,6 +6517,98 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d = self.render1(page, args={"t": ["json"]})
         return d
 
+    def test_status_scrubber(self):
+        basedir = "storage/WebStatus/status_scrubber"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, scrubber_enabled=True,
+                           scrubber_bytes_per_second=2000)
+        ss.setServiceParent(self.s)
+        scrubber = ss.share_scrubber
+        scrubber.state["history"][0] = {
+            "cycle-start-finish-times": (time.time() - 60, time.time()),
+            "examined-buckets": 1,
+            "examined-shares": 2,
+            "examined-bytes": 3000,
+            "corrupt-shares": [("a"*26, 1, "immutable", "bad block 0")],
+            "incompatible-shares": [],
+            }
+        w = StorageStatus(ss)
+        d = self.render1(w)
+        def _check_html(html):
+            s = remove_tags(html)
+            self.failUnlessIn("Share Scrubber", s)
+            self.failUnlessIn("Reading up to 2.00 kB/s", s)
+            self.failUnlessIn("examined 2 shares in 1 buckets (3.00 kB)", s)
+            self.failUnlessIn("Corrupt shares: SI %s shnum 1 (immutable): "
+                              "bad block 0" % ("a"*26), s)
+        d.addCallback(_check_html)
+        d.addCallback(lambda ign: self.render_json(w))
+        def _check_json(json):
+            data = simplejson.loads(json)
+            last = data["share-scrubber"]["history"]["0"]
+            self.failUnlessEqual(last["corrupt-shares"],
+                                 [["a"*26, 1, "immutable", "bad block 0"]])
+        d.addCallback(_check_json)
+        return d
+
+    def test_status_share_dir_layout(self):
+        basedir = "storage/WebStatus/status_share_dir_layout"
+        # a server with shares from before share_dir_levels was set
+        fileutil.make_dirs(os.path.join(basedir, "shares", "ab"))
+        ss = StorageServer(basedir, "\x00" * 20, share_dir_levels=2)
+        ss.setServiceParent(self.s)
+        self.failUnless(ss.disks.migrating)
+        w = StorageStatus(ss)
+        d = self.render1(w)
+        def _check_html(html):
+            s = remove_tags(html)
+            self.failUnlessIn("Share directory layout: moving buckets into "
+                              "2 levels of prefix directories", s)
+        d.addCallback(_check_html)
+        d.addCallback(lambda ign: self.render_json(w))
+        def _check_json(json):
+            data = simplejson.loads(json)
+            self.failUnlessIn("share-dir-migrator", data)
+            s = data["stats"]
+            self.failUnlessEqual(s["storage_server.share_dir_levels"], 2)
+            self.failUnlessEqual(s["storage_server.share_dir_migrating"], 1)
+        d.addCallback(_check_json)
+        return d
+
+    def test_status_requesters(self):
+        basedir = "storage/WebStatus/status_requesters"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20)
+        ss.setServiceParent(self.s)
+        w = StorageStatus(ss)
+        d = self.render1(w)
+        d.addCallback(lambda html:
+                      self.failIfIn("Disk I/O by Client", remove_tags(html)))
+        def _busy(ign):
+            ss.get_requester_stats = lambda: [
+                {"name": "alice", "priority": "bulk", "queued": 3,
+                 "running": 1, "completed": 20, "mean_wait": 0.5,
+                 "requests": {"read": 20, "write": 4}, "demoted": 0},
+                {"name": "(anonymous)", "priority": "interactive",
+                 "queued": 0, "running": 0, "completed": 0,
+                 "mean_wait": None, "requests": {"lease": 1}, "demoted": 2},
+                ]
+            return self.render1(w)
+        d.addCallback(_busy)
+        def _check_html(html):
+            s = remove_tags(html)
+            self.failUnlessIn("Disk I/O by Client", s)
+            self.failUnlessIn("(anonymous) interactive 0 0 0 2 1 0 0", s)
+            self.failUnlessIn("alice bulk 3 1 20 0 500ms 0 20 4", s)
+        d.addCallback(_check_html)
+        d.addCallback(lambda ign: self.render_json(w))
+        def _check_json(json):
+            data = simplejson.loads(json)
+            self.failUnlessEqual(sorted([r["name"] for r in data["clients"]]),
+                                 ["(anonymous)", "alice"])
+        d.addCallback(_check_json)
+        return d
+
     @mock.patch('allmydata.util.fileutil.get_disk_stats')
     def test_status_no_disk_stats(self, mock_get_disk_stats):
         mock_get_disk_stats.side_effect = AttributeError()
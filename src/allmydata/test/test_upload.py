@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-import os, shutil
+import os, shutil, time
 from cStringIO import StringIO
 from twisted.trial import unittest
 from twisted.python.failure import Failure
@@ -9,7 +9,7 @@ from foolscap.api import fireEventually
 
 import allmydata # for __full_version__
 from allmydata import uri, monitor, client
-from allmydata.immutable import upload, encode
+from allmydata.immutable import upload, encode, keycache
 from allmydata.interfaces import FileTooLargeError, UploadUnhappinessError
 from allmydata.util import log, base32
 from allmydata.util.assertutil import precondition
@@ -633,6 +633,141 @@ class ServerSelection(unittest.TestCase):
         return d
 
 
+class FakeStatsProvider:
+    def __init__(self):
+        self.counters = {}
+    def count(self, name, delta=1):
+        self.counters[name] = self.counters.get(name, 0) + delta
+
+class ConvergenceKeyCache(unittest.TestCase):
+    def setUp(self):
+        self.basedir = self.mktemp()
+        os.makedirs(self.basedir)
+        self.dbfile = os.path.join(self.basedir, "convergence-keys.sqlite")
+        self.stats = FakeStatsProvider()
+
+    def _make_file(self, name, data):
+        fn = os.path.join(self.basedir, name)
+        f = open(fn, "wb")
+        f.write(data)
+        f.close()
+        return fn
+
+    def _add(self, cache, fn, key, convergence="xyzzy"):
+        st = os.stat(fn)
+        return cache.add_key(fn, st, st, time.time() + 10, convergence,
+                             3, 10, 1024, key)
+
+    def _get(self, cache, fn, convergence="xyzzy", k=3):
+        return cache.get_key(fn, os.stat(fn), convergence, k, 10, 1024)
+
+    def test_add_and_get(self):
+        cache = keycache.ConvergenceKeyCache(self.dbfile, 10, self.stats)
+        fn = self._make_file("a", "a"*100)
+        self.failUnlessEqual(self._get(cache, fn), None)
+        self.failUnless(self._add(cache, fn, "k"*16))
+        self.failUnlessEqual(self._get(cache, fn), "k"*16)
+        # the convergence secret and encoding parameters must match
+        self.failUnlessEqual(self._get(cache, fn, convergence="other"), None)
+        self.failUnlessEqual(self._get(cache, fn, k=4), None)
+        prefix = "uploader.convergence_key_cache."
+        self.failUnlessEqual(self.stats.counters, {prefix+"hits": 1,
+                                                   prefix+"misses": 3})
+        # and the cache persists
+        cache.close()
+        cache = keycache.ConvergenceKeyCache(self.dbfile, 10)
+        self.failUnlessEqual(self._get(cache, fn), "k"*16)
+        # the secret is not stored
+        self.failIfIn("xyzzy", open(self.dbfile, "rb").read())
+
+    def test_changed(self):
+        cache = keycache.ConvergenceKeyCache(self.dbfile, 10, self.stats)
+        fn = self._make_file("a", "a"*100)
+        self._add(cache, fn, "k"*16)
+        self._make_file("a", "b"*101)
+        self.failUnlessEqual(self._get(cache, fn), None)
+        self.failUnlessEqual(
+            self.stats.counters["uploader.convergence_key_cache.stale"], 1)
+        # the stale entry is gone
+        st = os.stat(fn)
+        self._make_file("a", "a"*100)
+        os.utime(fn, (st.st_atime, st.st_mtime))
+        self.failUnlessEqual(self._get(cache, fn), None)
+
+    def test_racy(self):
+        cache = keycache.ConvergenceKeyCache(self.dbfile, 10)
+        fn = self._make_file("a", "a"*100)
+        st = os.stat(fn)
+        # a file modified just before it was hashed is not remembered
+        self.failIf(cache.add_key(fn, st, st, time.time(), "xyzzy",
+                                  3, 10, 1024, "k"*16))
+        # nor is one that changed while it was being hashed
+        self._make_file("a", "a"*101)
+        self.failIf(cache.add_key(fn, st, os.stat(fn), time.time() + 10,
+                                  "xyzzy", 3, 10, 1024, "k"*16))
+        self.failUnlessEqual(self._get(cache, fn), None)
+
+    def test_eviction(self):
+        cache = keycache.ConvergenceKeyCache(self.dbfile, 2)
+        files = [self._make_file(name, name) for name in "abc"]
+        self._add(cache, files[0], "a"*16)
+        self._add(cache, files[1], "b"*16)
+        time.sleep(0.01)
+        self._get(cache, files[0])
+        self._add(cache, files[2], "c"*16)
+        # the least recently used file is forgotten
+        self.failUnlessEqual([self._get(cache, fn) for fn in files],
+                             ["a"*16, None, "c"*16])
+
+    def test_unusable(self):
+        f = open(self.dbfile, "wb")
+        f.write("not a database"*100)
+        f.close()
+        cache = keycache.ConvergenceKeyCache(self.dbfile, 10)
+        fn = self._make_file("a", "a"*100)
+        self.failUnless(self._add(cache, fn, "k"*16))
+        self.failUnlessEqual(self._get(cache, fn), "k"*16)
+
+    def test_filename(self):
+        cache = keycache.ConvergenceKeyCache(self.dbfile, 10, self.stats)
+        self.patch(cache, "RACY_SECONDS", -10)
+        fn = self._make_file("a", "a"*1000)
+        hashed = []
+        real_convergence_hasher = upload.convergence_hasher
+        def _convergence_hasher(*args):
+            hashed.append(args)
+            return real_convergence_hasher(*args)
+        self.patch(upload, "convergence_hasher", _convergence_hasher)
+        def _get_key(key_cache):
+            u = upload.FileName(fn, convergence="secret", key_cache=key_cache)
+            u.set_default_encoding_parameters({"k": 3, "happy": 5, "n": 10,
+                                               "max_segment_size": 300})
+            d = u.get_encryption_key()
+            def _got(key):
+                u.close()
+                return key
+            d.addCallback(_got)
+            return d
+        d = _get_key(None)
+        def _uncached(key):
+            self.key = key
+            return _get_key(cache)
+        d.addCallback(_uncached)
+        d.addCallback(lambda key: self.failUnlessEqual(key, self.key))
+        d.addCallback(lambda ign: self.failUnlessEqual(len(hashed), 2))
+        # the second time, the file is not hashed
+        d.addCallback(lambda ign: _get_key(cache))
+        d.addCallback(lambda key: self.failUnlessEqual(key, self.key))
+        d.addCallback(lambda ign: self.failUnlessEqual(len(hashed), 2))
+        def _changed(ign):
+            self._make_file("a", "b"*1000)
+            return _get_key(cache)
+        d.addCallback(_changed)
+        d.addCallback(lambda key: self.failIfEqual(key, self.key))
+        d.addCallback(lambda ign: self.failUnlessEqual(len(hashed), 3))
+        return d
+
+
 class StorageIndex(unittest.TestCase):
     def test_params_must_matter(self):
         DATA = "I am some data"
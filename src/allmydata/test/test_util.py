@@ -12,7 +12,7 @@ from pycryptopp.hash.sha256 import SHA256 as _hash
 from allmydata.util import base32, idlib, humanreadable, mathutil, hashutil
 from allmydata.util import assertutil, fileutil, deferredutil, abbreviate
 from allmydata.util import limiter, time_format, pollmixin, cachedir
-from allmydata.util import statistics, dictutil, pipeline
+from allmydata.util import statistics, dictutil, pipeline, workerpool
 from allmydata.util import log as tahoe_log
 from allmydata.util.spans import Spans, overlap, DataSpans
 
@@ -1609,6 +1609,154 @@ class Log(unittest.TestCase):
         self.flushLoggedErrors(SampleError)
 
 
+def _double(x):
+    return 2*x
+
+def _fail():
+    raise SampleError("failed in a worker")
+
+def _die():
+    os._exit(1)
+
+def _sleep(seconds):
+    time.sleep(seconds)
+
+def _unpicklable_result():
+    return lambda: None
+
+class WorkerPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.workers = None
+
+    def tearDown(self):
+        if self.workers:
+            return self.workers.stopService()
+
+    def test_bad_type(self):
+        self.failUnlessRaises(ValueError, workerpool.WorkerPool, 2, "fibers")
+
+    def _test_pool(self, worker_type):
+        self.workers = workerpool.WorkerPool(2, worker_type)
+        self.workers.startService()
+        times = {}
+        d = defer.gatherResults([self.workers.run(_double, (i,),
+                                                  times, "double")
+                                 for i in range(10)])
+        d.addCallback(self.failUnlessEqual, range(0, 20, 2))
+        d.addCallback(lambda ign: self.failUnless("double" in times))
+        d.addCallback(lambda ign: self.workers.run(_fail))
+        def _failed(f):
+            f.trap(workerpool.WorkerError)
+            self.failUnlessIn("failed in a worker", str(f.value))
+        d.addCallbacks(lambda res: self.fail("should have failed"), _failed)
+        return d
+
+    def test_processes(self):
+        d = self._test_pool("processes")
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(self.workers.jobs,
+                                           {"threads": 0, "processes": 11}))
+        return d
+
+    def test_threads(self):
+        d = self._test_pool("threads")
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(self.workers.jobs,
+                                           {"threads": 11, "processes": 0}))
+        return d
+
+    def test_default_type(self):
+        self.failUnlessEqual(workerpool.WorkerPool(2).worker_type, "processes")
+
+    def test_fork_before_reactor(self):
+        # twistd calls privilegedStartService() before the reactor starts,
+        # and the worker processes are forked then
+        self.workers = workerpool.WorkerPool(2)
+        self.workers.privilegedStartService()
+        self.failUnlessEqual(len(self.workers._processes), 2)
+        for worker in self.workers._processes:
+            self.failUnless(worker.process.is_alive())
+        self.failUnlessEqual(workerpool.WorkerPool(2, "threads")._processes,
+                             None)
+
+    def _failed_process_job(self, f, args, why, job_timeout=None,
+                            workers_left=1):
+        self.workers = workerpool.WorkerPool(2, "processes", job_timeout)
+        self.workers.startService()
+        d = self.workers.run(f, args)
+        def _failed(f):
+            f.trap(workerpool.WorkerError)
+            self.failUnlessIn(why, str(f.value))
+            self.failIf(self.workers._running)
+            self.failUnlessEqual(len(self.workers._processes), workers_left)
+        d.addCallbacks(lambda res: self.fail("should have failed"), _failed)
+        # the pool still works afterwards
+        d.addCallback(lambda ign: self.workers.run(_double, (4,)))
+        d.addCallback(self.failUnlessEqual, 8)
+        return d
+
+    def test_worker_dies(self):
+        return self._failed_process_job(_die, (), "a worker process died")
+
+    def test_unpicklable(self):
+        d = self._failed_process_job(lambda: None, (), "PicklingError",
+                                     workers_left=2)
+        d.addCallback(lambda ign: self.workers.run(_unpicklable_result))
+        def _failed(f):
+            f.trap(workerpool.WorkerError)
+            self.failUnlessEqual(len(self.workers._processes), 2)
+        d.addCallbacks(lambda res: self.fail("should have failed"), _failed)
+        return d
+
+    def test_timeout(self):
+        return self._failed_process_job(_sleep, (2,), "timed out",
+                                        job_timeout=0.5)
+
+    def test_all_workers_lost(self):
+        self.workers = workerpool.WorkerPool(1, "processes")
+        self.workers.startService()
+        d = defer.DeferredList([self.workers.run(_die),
+                                self.workers.run(_double, (3,))],
+                               consumeErrors=True)
+        def _ran(res):
+            # the job that was waiting for the lost worker is run in a
+            # thread instead, and so is everything after it
+            self.failUnlessEqual(res[0][0], False)
+            res[0][1].trap(workerpool.WorkerError)
+            self.failUnlessEqual(res[1], (True, 6))
+            self.failUnlessEqual(self.workers._processes, [])
+            return self.workers.run(_double, (5,))
+        d.addCallback(_ran)
+        d.addCallback(self.failUnlessEqual, 10)
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(self.workers.jobs,
+                                           {"threads": 1, "processes": 2}))
+        return d
+
+    def test_stopped(self):
+        workers = workerpool.WorkerPool(2, "processes")
+        workers.startService()
+        d = workers.run(_sleep, (10,))
+        workers.stopService()
+        def _failed(f):
+            f.trap(workerpool.WorkerError)
+            self.failUnlessIn("the worker pool was stopped", str(f.value))
+        d.addCallbacks(lambda res: self.fail("should have failed"), _failed)
+        return d
+
+    def test_in_thread(self):
+        self.workers = workerpool.WorkerPool(2, "processes")
+        self.workers.startService()
+        events = []
+        @workerpool.in_thread
+        def _append(event):
+            # this could not be pickled for a worker process
+            events.append(event)
+        d = self.workers.run(_append, ("hello",))
+        d.addCallback(lambda ign: self.failUnlessEqual(events, ["hello"]))
+        return d
+
+
 class SimpleSpans:
     # this is a simple+inefficient form of util.spans.Spans . We compare the
     # behavior of this reference model against the real (efficient) form.
@@ -213,6 +213,10 @@ class FakeLeaseChecker(object):
                 "cycle-in-progress": False,
                 "remaining-wait-time": 0}
 
+class FakeDiskSet(list):
+    levels = 1
+    migrating = False
+
 class FakeStorageServer(service.MultiService):
     name = 'storage'
     def __init__(self, nodeid, nickname):
@@ -221,8 +225,16 @@ class FakeStorageServer(service.MultiService):
         self.nickname = nickname
         self.bucket_counter = FakeBucketCounter()
         self.lease_checker = FakeLeaseChecker()
+        self.inventory = None
+        self.packed = None
+        self.share_scrubber = None
+        self.disks = FakeDiskSet()
     def get_stats(self):
         return {"storage_server.accepting_immutable_shares": False}
+    def get_latencies(self, window):
+        return {}
+    def get_requester_stats(self):
+        return []
 
 class FakeClient(Client):
     def __init__(self):
@@ -4655,6 +4667,8 @@ class Grid(GridTestMixin, WebErrorMixin, ShouldFailMixin, testutil.ReallyEqualMi
             self.failUnlessReallyEqual(r["results"]["count-shares-good"], 9)
             self.failUnlessReallyEqual(r["results"]["count-corrupt-shares"], 1)
         d.addCallback(_got_json_corrupt)
+        d.addCallback(self.CHECK, "corrupt", "t=check&verify=server&output=json")
+        d.addCallback(_got_json_corrupt)
 
         d.addErrback(self.explain_web_error)
         return d
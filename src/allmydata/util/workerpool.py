@@ -0,0 +1,282 @@
+"""
+Run CPU-bound work (encryption, hashing, erasure coding) off the reactor
+thread, so that a large upload does not stall everything else.
+"""
+
+import os, signal, time, traceback
+import multiprocessing
+from collections import deque
+
+from twisted.application import service
+from twisted.internet import defer, reactor, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from allmydata.util import log
+
+
+def in_thread(f):
+    """Mark 'f' to be run by WorkerPools in a worker thread even when they
+    run other functions in worker processes: because it works on objects
+    (like hashers) that cannot be passed to another process."""
+    f.in_thread = True
+    return f
+
+class WorkerError(Exception):
+    """A function that was run in a worker process raised an exception, or
+    its worker process died, or it took too long. The original exception
+    cannot be carried back to us, so I hold a description of it (with its
+    traceback) instead."""
+
+def _call_timed(f, args):
+    # this runs in a worker thread or process
+    start = time.time()
+    try:
+        return (True, f(*args), time.time() - start)
+    except Exception:
+        return (False, traceback.format_exc(), time.time() - start)
+
+def _init_worker_process():
+    # the worker inherits the parent's signal handlers, and SIGINT is for
+    # the parent to deal with
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.set_wakeup_fd(-1)
+
+def _worker_main(conn, inherited):
+    # this is the whole life of a worker process: it runs one job at a
+    # time, for as long as the parent holds the other end of 'conn'.
+    # 'inherited' are the parent's ends of the pipes to the workers that
+    # were started before this one: we must not hold them open.
+    _init_worker_process()
+    for c in inherited:
+        c.close()
+    while True:
+        try:
+            (f, args) = conn.recv()
+        except (EOFError, IOError):
+            return
+        res = _call_timed(f, args)
+        try:
+            conn.send(res)
+        except Exception:
+            # the result could not be pickled
+            conn.send((False, traceback.format_exc(), res[2]))
+
+
+class _JobLost(Exception):
+    pass
+
+class _WorkerProcess:
+    """I am one worker process, and the pipe that it takes its jobs from,
+    one at a time."""
+
+    def __init__(self, others):
+        (self._conn, child_conn) = multiprocessing.Pipe()
+        inherited = [w._conn for w in others]
+        self.process = multiprocessing.Process(target=_worker_main,
+                                               args=(child_conn, inherited))
+        self.process.daemon = True
+        self.process.start()
+        # once only the worker holds its end of the pipe, we see EOF on
+        # ours if it dies
+        child_conn.close()
+
+    def call(self, f, args, timeout):
+        # this runs in one of the WorkerPool's dispatch threads, and blocks
+        # until the job is done
+        try:
+            self._conn.send((f, args))
+        except Exception:
+            # the job could not be pickled, and nothing was sent
+            return (False, traceback.format_exc(), 0.0)
+        try:
+            if not self._conn.poll(timeout):
+                raise _JobLost("job timed out after %s seconds" % timeout)
+            return self._conn.recv()
+        except (EOFError, IOError):
+            raise _JobLost("a worker process died")
+
+    def kill(self):
+        # SIGKILL rather than SIGTERM, which a worker that has only just
+        # been forked may still be handling with the node's own handler.
+        # This wakes up a dispatch thread that is waiting on our pipe.
+        if self.process.is_alive():
+            os.kill(self.process.pid, signal.SIGKILL)
+        self.process.join()
+
+    def close(self):
+        # only once no dispatch thread is using the pipe
+        self._conn.close()
+
+
+class WorkerPool(service.Service):
+    """I run functions in up to 'num_workers' worker processes, or worker
+    threads, and return Deferreds for their results.
+
+    CPython runs only one thread at a time unless it is in C code that has
+    released the GIL, and zfec and pycryptopp never release it. So by
+    default ('worker_type' is 'processes') functions are run in worker
+    processes, unless they have been marked with @in_thread. A function
+    that is run in a process must be a module-level function, and its
+    arguments and result must be picklable: they are copied to and from
+    the worker. With 'worker_type' set to 'threads', everything is run in
+    worker threads instead, which only helps with builds of those
+    libraries that do release the GIL.
+
+    The worker processes are forked in privilegedStartService(), which
+    twistd calls before the reactor starts, so that they do not inherit the
+    node's threads, listening sockets or other file descriptors. Each one
+    is fed one job at a time, over a pipe of its own, by a dispatch thread
+    which waits for its answer. If a worker process dies, or takes longer
+    than 'job_timeout' seconds over a job (and is then killed), that job
+    fails with a WorkerError, as does a job whose arguments or result
+    cannot be pickled. Workers that are lost are not replaced (that would
+    mean forking the running node): once there are none left, everything
+    is run in worker threads.
+
+    The thread pool is started when it is first needed. Both pools are
+    stopped when I am.
+    """
+
+    WORKER_TYPES = ("processes", "threads")
+
+    def __init__(self, num_workers, worker_type="processes", job_timeout=300):
+        assert num_workers > 0, num_workers
+        if worker_type not in self.WORKER_TYPES:
+            raise ValueError("worker type must be one of %s, not %r"
+                             % (", ".join(self.WORKER_TYPES), worker_type))
+        self.num_workers = num_workers
+        self.worker_type = worker_type
+        self.job_timeout = job_timeout
+        self._thread_pool = None # (ThreadPool, shutdown trigger)
+        self._processes = None # list of _WorkerProcess, once started
+        self._dispatch_pool = None # (ThreadPool, shutdown trigger)
+        self._idle = [] # _WorkerProcesses with nothing to do
+        self._waiting = deque() # (f, args, Deferred) for an idle worker
+        self._running = {} # Deferred -> _WorkerProcess
+        self.jobs = {"threads": 0, "processes": 0}
+
+    def privilegedStartService(self):
+        if self.worker_type == "processes":
+            self._start_processes()
+        return service.Service.privilegedStartService(self)
+
+    def run(self, f, args=(), times=None, stage=None):
+        """Call f(*args) in a worker, and return a Deferred that fires with
+        its result. If 'times' is given, the number of seconds that f() took
+        is added to times[stage]. The result, or the failure, is delivered
+        on the reactor thread."""
+        if (self.worker_type == "threads" or getattr(f, "in_thread", False)
+            or not self._start_processes()):
+            self.jobs["threads"] += 1
+            d = threads.deferToThreadPool(reactor, self._get_thread_pool(),
+                                          _call_timed, f, args)
+        else:
+            self.jobs["processes"] += 1
+            d = defer.Deferred()
+            self._waiting.append((f, args, d))
+            self._dispatch()
+        def _done((ok, res, elapsed)):
+            if times is not None:
+                times[stage] = times.get(stage, 0.0) + elapsed
+            if not ok:
+                raise WorkerError(res)
+            return res
+        d.addCallback(_done)
+        return d
+
+    def _start_processes(self):
+        # this is normally called by privilegedStartService(), but a
+        # WorkerPool that was started some other way forks its workers when
+        # they are first needed. Returns the number of workers left.
+        if self._processes is None:
+            self._processes = []
+            for i in range(self.num_workers):
+                self._processes.append(_WorkerProcess(self._processes))
+            self._idle = list(self._processes)
+            pool = ThreadPool(0, self.num_workers, name="cpu-worker-dispatch")
+            pool.start()
+            trigger = reactor.addSystemEventTrigger("during", "shutdown",
+                                                    self._stop_processes)
+            self._dispatch_pool = (pool, trigger)
+        return len(self._processes)
+
+    def _dispatch(self):
+        while self._waiting and self._idle:
+            (f, args, d) = self._waiting.popleft()
+            worker = self._idle.pop()
+            self._running[d] = worker
+            d2 = threads.deferToThreadPool(reactor, self._dispatch_pool[0],
+                                           worker.call, f, args,
+                                           self.job_timeout)
+            d2.addBoth(self._process_job_done, d, worker)
+
+    def _process_job_done(self, res, d, worker):
+        if self._running.pop(d, None) is None:
+            return # the pool was stopped
+        if isinstance(res, Failure):
+            self._lose_worker(worker)
+            if res.check(_JobLost):
+                d.errback(WorkerError(str(res.value)))
+            else:
+                d.errback(res)
+        else:
+            self._idle.append(worker)
+            d.callback(res)
+        self._dispatch()
+
+    def _lose_worker(self, worker):
+        worker.kill()
+        worker.close()
+        self._processes.remove(worker)
+        log.msg("an encoding worker process was lost, %d left"
+                % len(self._processes), level=log.UNUSUAL)
+        if not self._processes:
+            # nothing will ever take the waiting jobs: run them in threads
+            waiting = self._waiting
+            self._waiting = deque()
+            for (f, args, d) in waiting:
+                d2 = threads.deferToThreadPool(reactor,
+                                               self._get_thread_pool(),
+                                               _call_timed, f, args)
+                d2.chainDeferred(d)
+
+    def _get_thread_pool(self):
+        if self._thread_pool is None:
+            pool = ThreadPool(0, self.num_workers, name="cpu-workers")
+            pool.start()
+            # like the reactor's own thread pool, make sure that our threads
+            # cannot keep the process alive once the reactor has stopped
+            trigger = reactor.addSystemEventTrigger("during", "shutdown",
+                                                    pool.stop)
+            self._thread_pool = (pool, trigger)
+        return self._thread_pool[0]
+
+    def _stop_processes(self):
+        # killing the workers wakes up the dispatch threads, which can then
+        # be stopped
+        for worker in self._processes:
+            worker.kill()
+        self._dispatch_pool[0].stop()
+        for worker in self._processes:
+            worker.close()
+
+    def stopService(self):
+        if self._thread_pool is not None:
+            (pool, trigger) = self._thread_pool
+            reactor.removeSystemEventTrigger(trigger)
+            pool.stop()
+            self._thread_pool = None
+        if self._processes is not None:
+            reactor.removeSystemEventTrigger(self._dispatch_pool[1])
+            self._stop_processes()
+            self._processes = None
+            self._dispatch_pool = None
+            self._idle = []
+        jobs = self._running.keys() + [d for (f, args, d) in self._waiting]
+        self._running.clear()
+        self._waiting.clear()
+        for d in jobs:
+            d.errback(WorkerError("the worker pool was stopped"))
+        return service.Service.stopService(self)
@@ -31,6 +31,14 @@ def boolean_of_arg(arg):
         raise WebError("invalid boolean argument: %r" % (arg,), http.BAD_REQUEST)
     return arg.lower() in ("true", "t", "1", "on")
 
+def parse_verify_arg(verify):
+    if verify.lower() == "server":
+        return "server"
+    try:
+        return boolean_of_arg(verify)
+    except WebError:
+        raise WebError("invalid verify= argument: %r" % (verify,), http.BAD_REQUEST)
+
 def parse_replace_arg(replace):
     if replace.lower() == "only-files":
         return replace
@@ -23,7 +23,7 @@ from allmydata.monitor import Monitor, OperationCancelledError
 from allmydata import dirnode
 from allmydata.web.common import text_plain, WebError, \
      IOpHandleTable, NeedOperationHandleError, \
-     boolean_of_arg, get_arg, get_root, parse_replace_arg, \
+     boolean_of_arg, get_arg, get_root, parse_replace_arg, parse_verify_arg, \
      should_create_intermediate_directories, \
      getxmlfile, RenderMixin, humanize_failure, convert_children_json, \
      get_format, get_mutable_type
@@ -441,7 +441,7 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
 
     def _POST_check(self, req):
         # check this directory
-        verify = boolean_of_arg(get_arg(req, "verify", "false"))
+        verify = parse_verify_arg(get_arg(req, "verify", "false"))
         repair = boolean_of_arg(get_arg(req, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(req, "add-lease", "false"))
         if repair:
@@ -461,7 +461,7 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         # check this directory and everything reachable from it
         if not get_arg(ctx, "ophandle"):
             raise NeedOperationHandleError("slow operation requires ophandle=")
-        verify = boolean_of_arg(get_arg(ctx, "verify", "false"))
+        verify = parse_verify_arg(get_arg(ctx, "verify", "false"))
         repair = boolean_of_arg(get_arg(ctx, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(ctx, "add-lease", "false"))
         if repair:
@@ -473,7 +473,7 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         return self._start_operation(monitor, renderer, ctx)
 
     def _POST_stream_deep_check(self, ctx):
-        verify = boolean_of_arg(get_arg(ctx, "verify", "false"))
+        verify = parse_verify_arg(get_arg(ctx, "verify", "false"))
         repair = boolean_of_arg(get_arg(ctx, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(ctx, "add-lease", "false"))
         walker = DeepCheckStreamer(ctx, self.node, verify, repair, add_lease)
@@ -1153,7 +1153,9 @@ class DeepCheckStreamer(dirnode.DeepStats):
         self.req = IRequest(ctx)
         self.verify = verify
         self.repair = repair
-        self.add_lease = add_lease
+        self.lease_adder = None
+        if add_lease:
+            self.lease_adder = dirnode.DeepLeaseAdder(origin)
 
     def setMonitor(self, monitor):
         self.monitor = monitor
@@ -1164,6 +1166,11 @@ class DeepCheckStreamer(dirnode.DeepStats):
     def stopProducing(self):
         self.monitor.cancel()
 
+    def enter_directory(self, parent, children):
+        if not self.verify:
+            dirnode.prefetch_check_queries(parent, children)
+        return dirnode.DeepStats.enter_directory(self, parent, children)
+
     def add_node(self, node, path):
         dirnode.DeepStats.add_node(self, node, path)
         data = {"path": path,
@@ -1191,13 +1198,16 @@ class DeepCheckStreamer(dirnode.DeepStats):
             si = base32.b2a(si)
         data["storage-index"] = si or ""
 
+        # leases are added in batches by our DeepLeaseAdder
         if self.repair:
-            d = node.check_and_repair(self.monitor, self.verify, self.add_lease)
+            d = node.check_and_repair(self.monitor, self.verify, False)
             d.addCallback(self.add_check_and_repair, data)
         else:
-            d = node.check(self.monitor, self.verify, self.add_lease)
+            d = node.check(self.monitor, self.verify, False)
             d.addCallback(self.add_check, data)
         d.addCallback(self.write_line)
+        if self.lease_adder:
+            d.addCallback(lambda ign: self.lease_adder.add_node(node))
         return d
 
     def add_check_and_repair(self, crr, data):
@@ -1214,6 +1224,13 @@ class DeepCheckStreamer(dirnode.DeepStats):
         self.req.write(j+"\n")
 
     def finish(self):
+        d = defer.succeed(None)
+        if self.lease_adder:
+            d.addCallback(lambda ign: self.lease_adder.finish())
+        d.addCallback(lambda ign: self.write_stats())
+        return d
+
+    def write_stats(self):
         stats = dirnode.DeepStats.get_results(self)
         d = {"type": "stats",
              "stats": stats,
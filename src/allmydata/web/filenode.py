@@ -17,8 +17,8 @@ from allmydata.blacklist import FileProhibited, ProhibitedNode
 
 from allmydata.web.common import text_plain, WebError, RenderMixin, \
      boolean_of_arg, get_arg, should_create_intermediate_directories, \
-     MyExceptionHandler, parse_replace_arg, parse_offset_arg, \
-     get_format, get_mutable_type
+     MyExceptionHandler, parse_replace_arg, parse_verify_arg, \
+     parse_offset_arg, get_format, get_mutable_type
 from allmydata.web.check_results import CheckResultsRenderer, \
      CheckAndRepairResultsRenderer, LiteralCheckResultsRenderer
 from allmydata.web.info import MoreInfo
@@ -298,7 +298,7 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         return LiteralCheckResultsRenderer(self.client)
 
     def _POST_check(self, req):
-        verify = boolean_of_arg(get_arg(req, "verify", "false"))
+        verify = parse_verify_arg(get_arg(req, "verify", "false"))
         repair = boolean_of_arg(get_arg(req, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(req, "add-lease", "false"))
         if repair:
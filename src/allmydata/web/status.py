@@ -93,6 +93,15 @@ class UploadResultsRendererMixin(RateAndTimeMixin):
     def data_time_cumulative_encoding(self, ctx, data):
         return self._get_time("cumulative_encoding")
 
+    def data_time_cumulative_encoding_encrypt(self, ctx, data):
+        return self._get_time("cumulative_encoding_encrypt")
+
+    def data_time_cumulative_encoding_hash(self, ctx, data):
+        return self._get_time("cumulative_encoding_hash")
+
+    def data_time_cumulative_encoding_codec(self, ctx, data):
+        return self._get_time("cumulative_encoding_codec")
+
     def data_time_cumulative_sending(self, ctx, data):
         return self._get_time("cumulative_sending")
 
@@ -4,6 +4,7 @@ from nevow import rend, tags as T, inevow
 from allmydata.web.common import getxmlfile, abbreviate_time, get_arg
 from allmydata.util.abbreviate import abbreviate_space
 from allmydata.util import time_format, idlib
+from allmydata.storage.latency import WINDOWS
 
 def remove_prefix(s, prefix):
     if not s.startswith(prefix):
@@ -32,7 +33,15 @@ class StorageStatus(rend.Page):
              "bucket-counter": self.storage.bucket_counter.get_state(),
              "lease-checker": self.storage.lease_checker.get_state(),
              "lease-checker-progress": self.storage.lease_checker.get_progress(),
+             "latencies": dict([(window, self.storage.get_latencies(window))
+                                for (window, slot, slots) in WINDOWS]),
+             "clients": self.storage.get_requester_stats(),
              }
+        if self.storage.share_scrubber:
+            d["share-scrubber"] = self.storage.share_scrubber.get_state()
+        if self.storage.disks.migrating:
+            d["share-dir-migrator"] = \
+                self.storage.share_dir_migrator.get_state()
         return simplejson.dumps(d, indent=1) + "\n"
 
     def data_nickname(self, ctx, storage):
@@ -99,8 +108,128 @@ class StorageStatus(rend.Page):
             return "Not computed yet"
         return count
 
+    def render_share_inventory(self, ctx, storage):
+        inv = self.storage.inventory
+        if not inv:
+            return ""
+        return ctx.tag["Share inventory: %d shares in %d buckets, "
+                       "indexed at startup in %s, using about %s of memory"
+                       % (inv.get_num_shares(), inv.get_num_buckets(),
+                          abbreviate_time(inv.build_time),
+                          abbreviate_space(inv.get_memory_footprint()))]
+
+    def render_packed_store(self, ctx, storage):
+        packed = self.storage.packed
+        if not packed:
+            return ""
+        stats = packed.get_stats()
+        return ctx.tag["Packed shares: %d shares in %d segments, "
+                       "using %s of %s (%d segments awaiting removal)"
+                       % (stats["shares"], stats["segments"],
+                          abbreviate_space(stats["live"]),
+                          abbreviate_space(stats["size"]),
+                          stats["retired"])]
+
+    def render_latencies(self, ctx, storage):
+        windows = [window for (window, slot, slots) in WINDOWS]
+        latencies = [self.storage.get_latencies(window) for window in windows]
+        categories = set()
+        for l in latencies:
+            categories.update(l.keys())
+        if not categories:
+            return ctx.tag["No operations recorded yet"]
+        columns = [("samplesize", "ops"), ("50_0_percentile", "median"),
+                   ("90_0_percentile", "90%"), ("99_0_percentile", "99%"),
+                   ("99_9_percentile", "99.9%")]
+        table = T.table()
+        row = T.tr[T.th[""]]
+        for window in windows:
+            row[T.th(colspan=len(columns))["last %s" % window]]
+        table[row]
+        row = T.tr[T.th["operation"]]
+        for window in windows:
+            row[[T.th[title] for (name, title) in columns]]
+        table[row]
+        for category in sorted(categories):
+            row = T.tr[T.td[category]]
+            for l in latencies:
+                stats = l.get(category, {})
+                for (name, title) in columns:
+                    v = stats.get(name)
+                    if v is None:
+                        row[T.td[""]]
+                    elif name == "samplesize":
+                        row[T.td["%d" % v]]
+                    elif category in ("io-queue-depth", "commit-batch"):
+                        # a count of operations, not a time
+                        row[T.td["%.1f" % v]]
+                    else:
+                        row[T.td[abbreviate_time(v)]]
+            table[row]
+        return ctx.tag[table]
+
+    def render_requesters(self, ctx, storage):
+        requesters = self.storage.get_requester_stats()
+        if not requesters:
+            # no I/O threads, or nothing done with them yet
+            return ""
+        categories = set()
+        for r in requesters:
+            categories.update(r["requests"].keys())
+        categories = sorted(categories)
+        table = T.table()
+        table[T.tr[T.th["client"], T.th["priority"], T.th["queued"],
+                   T.th["running"], T.th["completed"], T.th["demoted"],
+                   T.th["mean wait"],
+                   [T.th[category] for category in categories]]]
+        for r in sorted(requesters, key=lambda r: (r["name"], r["priority"])):
+            mean_wait = ""
+            if r["mean_wait"] is not None:
+                mean_wait = abbreviate_time(r["mean_wait"])
+            table[T.tr[T.td[r["name"]], T.td[r["priority"]],
+                       T.td["%d" % r["queued"]], T.td["%d" % r["running"]],
+                       T.td["%d" % r["completed"]], T.td["%d" % r["demoted"]],
+                       T.td[mean_wait],
+                       [T.td["%d" % r["requests"].get(category, 0)]
+                        for category in categories]]]
+        return ctx.tag[T.h2["Disk I/O by Client"], table]
+
+    def render_share_dirs(self, ctx, storage):
+        disks = self.storage.disks
+        if len(disks) < 2:
+            return ""
+        return ctx.tag["Share directories:",
+                       T.ul[[T.li["%s: %s available, %d buckets"
+                                  % (disk.sharedir,
+                                     self.render_abbrev_space(ctx,
+                                         disk.get_available_space()),
+                                     disk.num_buckets)]
+                             for disk in disks]]]
+
+    def render_share_dir_layout(self, ctx, storage):
+        disks = self.storage.disks
+        levels = disks.levels
+        layout = "%d level%s of prefix directories" % (levels,
+                                                      levels > 1 and "s" or "")
+        if not disks.migrating:
+            if levels == 1:
+                return ""
+            return ctx.tag["Share directory layout: %s" % layout]
+        migrator = self.storage.share_dir_migrator
+        s = migrator.get_state()
+        p = T.ul[T.li[self.format_crawler_progress(migrator.get_progress())]]
+        so_far = s.get("cycle-to-date")
+        if so_far:
+            p[T.li["moved %d shares in %d buckets of the %d examined so far"
+                   % (so_far["moved-shares"], so_far["moved-buckets"],
+                      so_far["examined-buckets"])]]
+        return ctx.tag["Share directory layout: moving buckets into %s"
+                       % layout, p]
+
     def render_count_crawler_status(self, ctx, storage):
         p = self.storage.bucket_counter.get_progress()
+        if p.get("counted-live"):
+            return ctx.tag["Counted as shares are added and removed"]
         return ctx.tag[self.format_crawler_progress(p)]
 
     def format_crawler_progress(self, p):
@@ -108,6 +237,9 @@ class StorageStatus(rend.Page):
         cycletime_s = ""
         if cycletime is not None:
             cycletime_s = " (estimated cycle time %s)" % abbreviate_time(cycletime)
+        rate = p.get("cpu-percentage")
+        if rate is not None:
+            cycletime_s += " (working %d%% of the time)" % round(100 * rate)
 
         if p["cycle-in-progress"]:
             pct = p["cycle-complete-percentage"]
@@ -267,3 +399,41 @@ class StorageStatus(rend.Page):
 
         return ctx.tag[p]
 
+
+    def format_scrubbed(self, so_far):
+        p = T.ul()
+        p[T.li["examined %d shares in %d buckets (%s)"
+               % (so_far["examined-shares"], so_far["examined-buckets"],
+                  abbreviate_space(so_far["examined-bytes"]))]]
+        for (status, label) in [("corrupt", "Corrupt shares:"),
+                                ("incompatible",
+                                 "Shares of an unknown version:")]:
+            shares = so_far[status + "-shares"]
+            if shares:
+                p[T.li[label,
+                       T.ul[[T.li["SI %s shnum %d (%s): %s"
+                                  % (si_s, shnum, sharetype, reason)]
+                             for (si_s, shnum, sharetype, reason) in shares]]]]
+        return p
+
+    def render_share_scrubber(self, ctx, storage):
+        scrubber = self.storage.share_scrubber
+        if not scrubber:
+            return ""
+        s = scrubber.get_state()
+        p = T.ul()
+        if scrubber.bytes_per_second is not None:
+            p[T.li["Reading up to %s/s" %
+                   abbreviate_space(scrubber.bytes_per_second)]]
+        p[T.li[self.format_crawler_progress(scrubber.get_progress())]]
+        if "cycle-to-date" in s:
+            p[T.li["Current cycle:", self.format_scrubbed(s["cycle-to-date"])]]
+        h = s["history"]
+        if h:
+            last = h[max(h.keys())]
+            start, end = last["cycle-start-finish-times"]
+            p[T.li["Last complete cycle (which took %s and finished %s ago):"
+                   % (abbreviate_time(end-start),
+                      abbreviate_time(time.time() - end)),
+                   self.format_scrubbed(last)]]
+        return ctx.tag[T.h2["Share Scrubber"], p]